@@ -1,4 +1,4 @@
-import time, serial
+import time, serial, weakref
 import inspect
 
 
@@ -24,33 +24,82 @@ SCALE_TO_100MS = {
         "min"   : 600,
         }
 
+# Reusable receive buffer of each serial port. Frames returned by read_all_TLV() are
+# memoryview slices of it: valid until the next read on the same port (copy with bytes() to keep).
+TLV_BUFFER_SIZE = 4096
+# Longest blocking read of read_all_TLV(): its deadline is met within this many seconds
+TLV_READ_SLICE = 0.05
+_TLV_buffers = weakref.WeakKeyDictionary()
+
+
+def _TLV_buffer(port):
+    try:
+        return _TLV_buffers[port]
+    except (KeyError, TypeError):
+        buf = memoryview(bytearray(TLV_BUFFER_SIZE))
+        try:
+            _TLV_buffers[port] = buf
+        except TypeError:
+            pass
+        return buf
+
+
 def read_single_TLV_frame(port, cutoff_bytes=0):
     if not cutoff_bytes:
-        _TL_header = port.read(2)
-        if _TL_header:
-            _frame_value = port.read(_TL_header[1])
-            return _TL_header + _frame_value
-        else:
-            return b''
+        TLV_frames = read_all_TLV(port, expecting=1)
+        return bytes(TLV_frames[0]) if TLV_frames else b''
     else:
         return port.read(cutoff_bytes)
     
-def read_all_TLV(port, expecting=0, timeout=1):
-    if expecting:
-        TLV_frames = [read_single_TLV_frame(port) for n in range(expecting)]
-    else:
-        TLV_frames = []
-        _time_cnt = 0
-        while port.inWaiting() or _time_cnt < timeout:
-            if port.inWaiting():
-                TLV_frames.append(read_single_TLV_frame(port))
-                _time_cnt = 0
-            elif _time_cnt < timeout:
-                time.sleep(0.01)
-                _time_cnt += 0.01
-            else:
-                break
-    return TLV_frames
+def read_all_TLV(port, expecting=0, timeout=1, verbose=False):
+    """ Read TLV frames into the reusable buffer of the port and split them by their length byte.
+        With expecting > 0, returns as soon as that many frames (or an error frame) arrived, 
+        or at the deadline of timeout seconds. 
+        With expecting == 0, reads until no more bytes arrive for timeout seconds. 
+        Each read asks for all the bytes available, at least the rest of the current frame. 
+        The port timeout is set once for the call and restored after it. The bytes read past the 
+        last returned frame (frames beyond the expected ones, or a frame cut by the deadline) are 
+        dropped by the next request, which resets the input buffer; with verbose they are printed. 
+
+        :returns:
+            list of frames (memoryview, type + length + value)
+    """
+    buf = _TLV_buffer(port)
+    TLV_frames = []
+    filled, pos = 0, 0
+    port_timeout = port.timeout
+    read_timeout = min(timeout, TLV_READ_SLICE)
+    if port_timeout != read_timeout:
+        port.timeout = read_timeout
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            # Split all the complete frames in the buffer
+            while filled - pos >= 2 and filled - pos >= 2 + buf[pos + 1]:
+                frame_end = pos + 2 + buf[pos + 1]
+                TLV_frames.append(buf[pos:frame_end])
+                # An error response (0x40 0x01 err_code != 0) is not followed by other frames
+                is_error = buf[pos] == 0x40 and buf[pos + 1] == 1 and buf[pos + 2] != 0
+                pos = frame_end
+                if expecting and (len(TLV_frames) == expecting or is_error):
+                    return TLV_frames
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or filled == len(buf):
+                return TLV_frames
+            missing = (2 if filled - pos < 2 else 2 + buf[pos + 1]) - (filled - pos)
+            size = min(max(missing, port.in_waiting), len(buf) - filled)
+            n = port.readinto(buf[filled:filled + size])
+            if n:
+                filled += n
+                if not expecting:
+                    # Keep reading as long as the device is sending
+                    deadline = time.monotonic() + timeout
+    finally:
+        if port.timeout != port_timeout:
+            port.timeout = port_timeout
+        if verbose and pos < filled:
+            print("[read_all_TLV] {} bytes unread after {} frames: {}"
+                  .format(filled - pos, len(TLV_frames), hex_in_string(buf[pos:filled])))
 
 
 def hex_in_string(bytes_to_show):
@@ -60,7 +109,7 @@ def hex_in_string(bytes_to_show):
 
 
 def verbose_request(TLV_bytes):
-    _func_name = inspect.stack()[1][3]
+    _func_name = inspect.currentframe().f_back.f_code.co_name
     print("[{}] TLV Written to serial: {}".format(_func_name, hex_in_string(TLV_bytes)))
 
 
@@ -120,7 +169,7 @@ def dwm_pos_set(t, coords, qual_fact_percent, unit="mm", verbose=False):
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     if unit not in ("mm", "cm", "m"):
         raise ValueError("[{}]: Invalid input unit".format(_func_name))
     TYPE, LENGTH, VALUE = b'\x01', b'\x0D', b''
@@ -140,7 +189,7 @@ def dwm_pos_set(t, coords, qual_fact_percent, unit="mm", verbose=False):
     if verbose:
         verbose_request(output_bytes)   
     
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -170,7 +219,7 @@ def dwm_pos_get(t, verbose=False):
     :return: 
         [x, y, z, qual_fact_percent, err_code] unit in millimeter
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x02', b'\x00', b''  
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -179,7 +228,7 @@ def dwm_pos_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -217,7 +266,7 @@ def dwm_upd_rate_set(t, act_upd_intval, sta_upd_intval, unit="100ms", verbose=Fa
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     if unit not in ("100ms", "s", "min"):
         raise ValueError("[{}]: Invalid input unit".format(_func_name))
     
@@ -240,7 +289,7 @@ def dwm_upd_rate_set(t, act_upd_intval, sta_upd_intval, unit="100ms", verbose=Fa
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)   
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -268,7 +317,7 @@ def dwm_upd_rate_get(t, verbose=False):
     :return: 
         [act_upd_intval, sta_upd_intval, err_code] unit in milliseconds
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x04', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -277,7 +326,7 @@ def dwm_upd_rate_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -337,7 +386,7 @@ def dwm_cfg_tag_set(t,
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x05', b'\x02', b''
     
     if ble_en and enc_en:
@@ -366,7 +415,7 @@ def dwm_cfg_tag_set(t,
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)   
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -418,7 +467,7 @@ def dwm_cfg_anchor_set( t,
     :return: 
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x07', b'\x02', b''
 
     if ble_en and enc_en:
@@ -445,7 +494,7 @@ def dwm_cfg_anchor_set( t,
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)   
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -486,7 +535,7 @@ def dwm_cfg_get(t, verbose=False):
     :return: 
         [node_cfg, err_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
 
     TYPE, LENGTH, VALUE = b'\x08', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
@@ -497,7 +546,7 @@ def dwm_cfg_get(t, verbose=False):
     if verbose:
         verbose_request(output_bytes)
 
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -538,7 +587,7 @@ def dwm_sleep(t, verbose=False):
     error will be returned.
     ------------------------------------
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
 
     TYPE, LENGTH, VALUE = b'\x0A', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
@@ -549,7 +598,7 @@ def dwm_sleep(t, verbose=False):
     if verbose:
         verbose_request(output_bytes)
     
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -606,7 +655,7 @@ def dwm_anchor_list_get(t, verbose=False, timeout=5):
     :return:
         list of hash maps (key-value pairs for anchors), length unit in millimeter
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x0B', b'\x01', b''
 
     _page_nbr = 0
@@ -618,13 +667,14 @@ def dwm_anchor_list_get(t, verbose=False, timeout=5):
         t.reset_output_buffer()
         t.reset_input_buffer()
         t.write(_page_polling_bytes)
-        TLV_frames = read_all_TLV(t, expecting=2)
+        TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
         _page_polling_response = TLV_frames[0]
         err_code = _page_polling_response[2] if _page_polling_response[0:2] == b'\x40\x01' else 6
         error_handler(_page_polling_response, err_code, _func_name)
         anchor_nbr_in_this_page = TLV_frames[1][2]
         if anchor_nbr_in_this_page != 0:
-            anchor_bytes = TLV_frames[1][3:]
+            # Copied: the frames are overwritten by the polling of the next page
+            anchor_bytes = bytes(TLV_frames[1][3:])
             if len(anchor_bytes) != anchor_nbr_in_this_page * 16:
                 raise ValueError("[{}]: Bytes for anchors do not match specs: 16 bits per anchor on page {}. Expecting {} anchors. Got {} Bytes."
                                     .format(_func_name, _page_nbr, anchor_nbr_in_this_page, t.inWaiting()))
@@ -720,7 +770,7 @@ def dwm_loc_get(t, verbose=False):
     :return:
         [pos, anchors, node_mode, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x0C', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
     
@@ -729,7 +779,7 @@ def dwm_loc_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=3)
+    TLV_frames = read_all_TLV(t, expecting=3, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -761,7 +811,7 @@ def dwm_loc_get(t, verbose=False):
                 _anchor_i['addr'] = "{0:0{1}X}"\
                                 .format(int.from_bytes(anchor_bytes[i*20 + 0  :i*20 + 2],   byteorder='little', signed=False), 4)
                 _anchor_i['dist_to'] =  int.from_bytes(anchor_bytes[i*20 + 2  :i*20 + 6],   byteorder='little', signed=False)
-                _anchor_i['qual'] =     anchor_bytes[6]
+                _anchor_i['qual'] =     anchor_bytes[i*20 + 6]
                 _anchor_i['x'] =        int.from_bytes(anchor_bytes[i*20 + 7  :i*20 + 11],  byteorder='little', signed=True)
                 _anchor_i['y'] =        int.from_bytes(anchor_bytes[i*20 + 11 :i*20 + 15],  byteorder='little', signed=True)
                 _anchor_i['z'] =        int.from_bytes(anchor_bytes[i*20 + 15 :i*20 + 19],  byteorder='little', signed=True)
@@ -803,7 +853,7 @@ def dwm_baddr_set(t, ble_addr, verbose=False):
     :return: 
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x0F', b'\x06', b''
     
     ble_addr_bytes = bytearray.fromhex(ble_addr)
@@ -819,7 +869,7 @@ def dwm_baddr_set(t, ble_addr, verbose=False):
     if verbose:
         verbose_request(output_bytes)   
     
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -846,7 +896,7 @@ def dwm_baddr_get(t, verbose=False):
     :return: 
         [BLE Address, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x10', b'\x00', b''
     
     output_bytes = TYPE + LENGTH + VALUE
@@ -856,7 +906,7 @@ def dwm_baddr_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -890,7 +940,7 @@ def dwm_stnry_cfg_set(t, stnry_sensitivity=0, verbose=False):
     :return: 
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     if stnry_sensitivity not in (0, 1, 2):
         raise ValueError("[{}]: Invalid input unit".format(_func_name))
     
@@ -904,7 +954,7 @@ def dwm_stnry_cfg_set(t, stnry_sensitivity=0, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)   
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -935,7 +985,7 @@ def dwm_stnry_cfg_get(t, verbose=False):
     :return: 
         [stnry_sensitivity, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x12', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -944,7 +994,7 @@ def dwm_stnry_cfg_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -978,7 +1028,7 @@ def dwm_factory_reset(t, verbose=False):
     :return: 
         [stnry_sensitivity, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x13', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -987,7 +1037,7 @@ def dwm_factory_reset(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1012,7 +1062,7 @@ def dwm_reset(t, verbose=False):
     :return: 
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x14', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -1021,7 +1071,7 @@ def dwm_reset(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1054,7 +1104,7 @@ def dwm_ver_get(t, verbose=False):
     :return: 
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x15', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
 
@@ -1063,7 +1113,7 @@ def dwm_ver_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=4)
+    TLV_frames = read_all_TLV(t, expecting=4, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1164,7 +1214,7 @@ def dwm_uwb_cfg_set(t, pg_delay, tx_power, verbose=False):
         [error_code]
     """
     
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x17', b'\x00', b''
     
     pg_delay_bytes = pg_delay_encode(pg_delay)
@@ -1176,7 +1226,7 @@ def dwm_uwb_cfg_set(t, pg_delay, tx_power, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1207,7 +1257,7 @@ def dwm_uwb_cfg_get(t, verbose=False):
     :return:
         [pg_delay, tx_power, pg_delay_comp, tx_power_comp, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x18', b'\x00', b''
     
     output_bytes = TYPE + LENGTH + VALUE
@@ -1216,7 +1266,7 @@ def dwm_uwb_cfg_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1246,7 +1296,7 @@ def dwm_usr_data_read(t, verbose=False):
     :return:
         [length, data, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x19', b'\x00', b''
     
     output_bytes = TYPE + LENGTH + VALUE
@@ -1255,14 +1305,14 @@ def dwm_usr_data_read(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
         verbose_response(TLV_response, err_code, _func_name)
     error_handler(TLV_response, err_code, _func_name)
     length = TLV_frames[1][1]
-    data = TLV_frames[1][-length:]
+    data = bytes(TLV_frames[1][-length:])
     return [data, err_code]
 
 def dwm_usr_data_write(t, data, overwrite=False, verbose=False):
@@ -1282,7 +1332,7 @@ def dwm_usr_data_write(t, data, overwrite=False, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x1A', bytes([len(data) + 1]), b''
 
     VALUE += b'\x00' if not overwrite else b'\x01'
@@ -1294,7 +1344,7 @@ def dwm_usr_data_write(t, data, overwrite=False, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1322,7 +1372,7 @@ def dwm_label_read(t, verbose=False):
     :return:
         [label, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x1C', b'\x00', b''
     
     output_bytes = TYPE + LENGTH + VALUE
@@ -1331,13 +1381,13 @@ def dwm_label_read(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
         verbose_response(TLV_response, err_code, _func_name)
     error_handler(TLV_response, err_code, _func_name)
-    label = TLV_frames[1][-6:]
+    label = bytes(TLV_frames[1][-6:])
     #TODO: determine if the label needs to be string or raw bytes
     return [label, err_code]
 
@@ -1357,7 +1407,7 @@ def dwm_label_write(t, label, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x1D', b'', b''
     #TODO: determine if the label needs to be string or raw bytes
     VALUE, LENGTH = label, len(label)
@@ -1367,7 +1417,7 @@ def dwm_label_write(t, label, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1401,7 +1451,7 @@ def dwm_gpio_cfg_output(t, gpio_idx, gpio_value, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x28', b'\x02', b''
 
     VALUE = gpio_idx.to_bytes(1, byteorder='little', signed=False) \
@@ -1412,7 +1462,7 @@ def dwm_gpio_cfg_output(t, gpio_idx, gpio_value, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1445,7 +1495,7 @@ def dwm_gpio_cfg_input(t, gpio_idx, gpio_pull, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x29', b'\x02', b''
 
     VALUE = gpio_idx.to_bytes(1, byteorder='little', signed=False) \
@@ -1456,7 +1506,7 @@ def dwm_gpio_cfg_input(t, gpio_idx, gpio_pull, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1488,18 +1538,18 @@ def dwm_gpio_value_set(t, gpio_idx, gpio_pvalue, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x2A', b'\x02', b''
 
     VALUE = gpio_idx.to_bytes(1, byteorder='little', signed=False) \
-            + gpio_value.to_bytes(1, byteorder='little', signed=False)
+            + gpio_pvalue.to_bytes(1, byteorder='little', signed=False)
     output_bytes = TYPE + LENGTH + VALUE
     t.reset_output_buffer()
     t.reset_input_buffer()
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1529,7 +1579,7 @@ def dwm_gpio_value_get(t, gpio_idx, verbose=False):
     :return:
         [gpio_value, error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x2B', b'\x01', b''
     VALUE = gpio_idx.to_bytes(1, byteorder='little', signed=False) 
     output_bytes = TYPE + LENGTH + VALUE
@@ -1538,7 +1588,7 @@ def dwm_gpio_value_get(t, gpio_idx, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1567,7 +1617,7 @@ def dwm_gpio_value_toggle(t, gpio_idx, verbose=False):
     :return:
         [error_code]
     """
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x2C', b'\x01', b''
     VALUE = gpio_idx.to_bytes(1, byteorder='little', signed=False) 
     output_bytes = TYPE + LENGTH + VALUE
@@ -1576,7 +1626,7 @@ def dwm_gpio_value_toggle(t, gpio_idx, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1599,7 +1649,7 @@ def dwm_panid_set(t, panid, verbose=False):
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x2E', b'\x02', b''
     
     if isinstance(panid, str):
@@ -1617,7 +1667,7 @@ def dwm_panid_set(t, panid, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)   
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1644,7 +1694,7 @@ def dwm_panid_get(t, verbose=False):
     :return: 
         [panid, error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x2F', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
     t.reset_output_buffer()
@@ -1652,7 +1702,7 @@ def dwm_panid_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1679,7 +1729,7 @@ def dwm_nodeid_get(t, verbose=False):
     :return: 
         [nodeid, error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x30', b'\x00', b''
     output_bytes = TYPE + LENGTH + VALUE
     t.reset_output_buffer()
@@ -1687,7 +1737,7 @@ def dwm_nodeid_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1736,7 +1786,7 @@ def dwm_status_get(t, verbose=False):
     :return: 
         [status, error_code] status in hashmap (bool)
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x32', b'\x00', b''
 
     output_bytes = TYPE + LENGTH + VALUE
@@ -1745,7 +1795,7 @@ def dwm_status_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1811,7 +1861,7 @@ def dwm_int_cfg_set(t,
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x34', b'\x02', b''
            
     int_cfg_1 = 0b00000000
@@ -1836,7 +1886,7 @@ def dwm_int_cfg_set(t,
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1879,7 +1929,7 @@ def dwm_int_cfg_get(t, verbose=False):
     :return: 
         [int_cfg, error_code] hashmap for interrupt configuration flags
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x35', b'\x00', b''
     
     output_bytes = TYPE + LENGTH + VALUE
@@ -1888,7 +1938,7 @@ def dwm_int_cfg_get(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=2)
+    TLV_frames = read_all_TLV(t, expecting=2, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1936,7 +1986,7 @@ def dwm_enc_key_set(t, enc_key, verbose=False):
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x3C', b'\x10', b''
            
     if isinstance(enc_key, str):
@@ -1953,7 +2003,7 @@ def dwm_enc_key_set(t, enc_key, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -1983,7 +2033,7 @@ def dwm_enc_key_clear(t, verbose=False):
     :return: 
         [error_code]
     """ 
-    _func_name = inspect.stack()[0][3]
+    _func_name = inspect.currentframe().f_code.co_name
     TYPE, LENGTH, VALUE = b'\x3D', b'\x10', b''
 
     output_bytes = TYPE + LENGTH + VALUE
@@ -1992,7 +2042,7 @@ def dwm_enc_key_clear(t, verbose=False):
     t.write(output_bytes)
     if verbose:
         verbose_request(output_bytes)
-    TLV_frames = read_all_TLV(t, expecting=1)
+    TLV_frames = read_all_TLV(t, expecting=1, verbose=verbose)
     TLV_response = b''.join(TLV_frames)
     err_code = TLV_response[2] if TLV_response[0:2] == b'\x40\x01' else 6
     if verbose:
@@ -2184,4 +2234,78 @@ def dwm_backhaul_xfer():
     :return:
         Not Yet Implemented.
     """
-    return -1 
\ No newline at end of file
+    return -1 
+
+if __name__ == "__main__":
+    # Unit Testing: TLV API round trips with a pty-emulated DWM1001 in UART API mode
+    import os, pty, tty, threading
+    responses = {
+        b'\x02\x00': bytes.fromhex("400100" "410d" "9e050000" "30050000" "00030000" "16"),
+        b'\x0C\x00': bytes.fromhex("400100" "410d" "9e050000" "30050000" "00030000" "16" "4929" "02"
+                                   "8782" "32010000" "64" "78050000" "9a060000" "e8030000" "64"
+                                   "2813" "03010000" "5a" "e0060000" "1a040000" "e8030000" "64"),
+        b'\x0B\x01\x00': bytes.fromhex("400100" "5621" "02" "84c5" "3c050000" "da070000" "f40b0000" "b2" "00"
+                                       "0c0c" "dc050000" "c4090000" "b80b0000" "b2" "01"),
+        b'\x0B\x01\x01': bytes.fromhex("400100" "5601" "00"),
+        b'\x1C\x00': bytes.fromhex("400102"),
+    }
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(slave_fd)
+    def emulated_dwm():
+        request = b''
+        while True:
+            try:
+                request += os.read(master_fd, 1)
+            except OSError:
+                return
+            if len(request) >= 2 and len(request) == 2 + request[1]:
+                os.write(master_fd, responses.get(request, b'\x40\x01\x01'))
+                request = b''
+    threading.Thread(target=emulated_dwm, daemon=True).start()
+    t = serial.Serial(os.ttyname(slave_fd), baudrate=115200, timeout=3.0)
+
+    pos, anchors, node_mode, err_code = dwm_loc_get(t)
+    assert node_mode == 0 and err_code == 0 and pos['x'] == 1438 and pos['z'] == 768
+    assert [(a['addr'], a['dist_to'], a['qual'], a['x']) for a in anchors] == [("8287", 306, 100, 1400), ("1328", 259, 90, 1760)]
+    assert dwm_pos_get(t)[:3] == [1438, 1328, 768]
+    anchor_list, err_code = dwm_anchor_list_get(t)
+    assert [(a['addr'], a['x'], a['seat']) for a in anchor_list] == [("C584", 1340, 0), ("0C0C", 1500, 1)]
+    t_start = time.monotonic()
+    try:
+        dwm_usr_data_read(t)
+        raise AssertionError("no error raised")
+    except ValueError:
+        pass
+    t_error = time.monotonic() - t_start
+    assert t_error < 0.5, "error responses must not wait for the missing frames"
+    t_start = time.monotonic()
+    for _ in range(500):
+        dwm_loc_get(t)
+    t_loc_get = (time.monotonic() - t_start) / 500
+    t_start = time.monotonic()
+    t.write(b'\x02\x00')
+    frames = read_all_TLV(t, timeout=0.1)
+    t_idle = time.monotonic() - t_start
+    assert [bytes(f) for f in frames] == [responses[b'\x02\x00'][:3], responses[b'\x02\x00'][3:]]
+    # The port timeout is set once per call and restored; the bytes past the expected frames are printed if verbose
+    import io, contextlib
+    timeout_sets = []
+    class CountingSerial(serial.Serial):
+        @serial.Serial.timeout.setter
+        def timeout(self, timeout):
+            timeout_sets.append(timeout)
+            serial.Serial.timeout.fset(self, timeout)
+    t.close()
+    t = CountingSerial(os.ttyname(slave_fd), baudrate=115200, timeout=3.0)
+    del timeout_sets[:]
+    assert dwm_loc_get(t)[3] == 0 and timeout_sets == [TLV_READ_SLICE, 3.0] and t.timeout == 3.0
+    for verbose in (False, True):
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            t.reset_input_buffer()
+            t.write(b'\x02\x00')
+            time.sleep(0.05)
+            frames = read_all_TLV(t, expecting=1, verbose=verbose)
+        assert len(frames) == 1 and ("bytes unread after 1 frames" in log.getvalue()) == verbose, log.getvalue()
+    print("dwm_loc_get round trip: {:.3f} ms | error response: {:.3f} ms | idle-terminated read of 0.1 s: {:.3f} s"
+          .format(t_loc_get * 1e3, t_error * 1e3, t_idle))
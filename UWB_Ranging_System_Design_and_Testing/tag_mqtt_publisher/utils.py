@@ -1,9 +1,18 @@
 from datetime import datetime
-import sys, time, json, re, base64, math
+import sys, os, time, json, re, base64, math
 from time import localtime
 import atexit, signal
 
 
+try:
+    # Shared DIST report parser of ../uwb_ranging: dist_parser.py copied alongside this file,
+    # or ../uwb_ranging on PYTHONPATH (appended after this directory, not to shadow this utils.py)
+    from dist_parser import parse_dist_report
+except ImportError:
+    # make_json_dict_oem()/make_json_dict_accel_en() parse with their own regular expressions
+    parse_dist_report = None
+
+
 def load_config_json(json_path):
     raise("loading json is deprecated! ")
     try:
@@ -316,6 +325,9 @@ def make_json_dict_oem(raw_string):
             Dictionary of parsed UWB reporting
     """
     try:
+        if parse_dist_report is not None:
+            return parse_dist_report(raw_string, oem_firmware=True).to_dict()
+        # Without dist_parser (see the imports): the original regular expressions
         data = {}
         # ---------parse for anchors and individual readings---------
         anc_match_iter = re.finditer(   "(?<=AN)(?P<anc_idx>[0-9]{1})[,]"
@@ -365,6 +377,9 @@ def make_json_dict_accel_en(raw_string):
             Dictionary of parsed UWB reporting
     """
     try:
+        if parse_dist_report is not None:
+            return parse_dist_report(raw_string, oem_firmware=False).to_dict()
+        # Without dist_parser (see the imports): the original regular expressions
         data = {}
         # ---------parse for anchors and individual readings---------
         anc_match_iter = re.finditer(   "(?<=\[AN)(?P<anc_idx>[0-9]{1})[,]"
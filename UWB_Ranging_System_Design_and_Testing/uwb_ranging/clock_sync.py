@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+
+import os, sys, time, socket, struct, threading
+from collections import deque
+from mono_clock import CLOCK
+
+
+# This file contains the clock synchronization service between the computers of the vehicles, so the
+# logs of several vehicles can be aligned without photo-synced clock snapshots.
+# Each computer answers the time requests of its peers over UDP (ClockSyncResponder), and polls its
+# own peers every SYNC_INTERVAL seconds (ClockSyncService), NTP-style:
+#   t1: request sent (local clock)      t2: request received (peer clock)
+#   t3: reply sent (peer clock)         t4: reply received (local clock)
+#   offset = ((t2 - t1) + (t3 - t4)) / 2        delay = (t4 - t1) - (t3 - t2)
+# offset: clock of the peer minus the local clock. The exchange with the shortest delay of the last
+# SYNC_FILTER ones is kept (clock filter: the queuing delays are not symmetric), and the drift
+# (ppm) is the slope of a least squares line through the kept offsets of the last SYNC_WINDOW.
+# The clocks are not adjusted: the estimates are written into the session, a CSV file alongside the
+# ranging logs (<exp_name>-clock_sync.csv), from which the post-processing aligns the logs of the
+# vehicles (../uwb_ranging_fieldtest_results/utils.py, post_process_align_clock_sync()).
+# The responder is unauthenticated and gives out the host name and the clock of the computer: it is
+# started only when clock sync is asked for (peers to poll, or an explicit port), on the interface
+# of uwb_master.py --sync-host (the network of the vehicles).
+# SkewedClock simulates the clock of another computer, e.g. a responder on the loopback interface
+# standing in for a peer vehicle.
+
+SYNC_HOST = "0.0.0.0"           # Default interface of uwb_master.py --sync-host: all of them
+SYNC_PORT = 9189                # Responder port when peers are given without uwb_master.py --sync-port
+SYNC_INTERVAL = 2.0             # Seconds between two polls of a peer
+SYNC_TIMEOUT = 0.5              # Seconds to wait for a reply
+RESPONDER_POLL = 0.5            # Seconds between two checks of the stop flag of the responder
+SYNC_FILTER = 8                 # Exchanges of the clock filter (the shortest delay is kept)
+SYNC_WINDOW = 64                # Filtered offsets of the drift regression (~2 min at SYNC_INTERVAL)
+CLOCK_SYNC_LOG_SUFFIX = "-clock_sync.csv"
+CLOCK_SYNC_COLUMNS = ("local_us", "host", "peer", "offset_us", "delay_us", "offset_est_us", "drift_ppm")
+
+PACKET_MAGIC = b"UWBC"
+PACKET_VERSION = 1
+KIND_REQUEST, KIND_REPLY = 1, 2
+NODE_ID_SIZE = 16
+# magic, version, kind, t1, t2, t3 (ns since the epoch), node id of the sender
+PACKET_FORMAT = struct.Struct("!4sBB2xqqq{}s".format(NODE_ID_SIZE))
+
+
+def pack_packet(kind, t1, t2, t3, node_id):
+    return PACKET_FORMAT.pack(PACKET_MAGIC, PACKET_VERSION, kind, t1, t2, t3,
+                              node_id.encode("utf-8")[:NODE_ID_SIZE])
+
+
+def unpack_packet(data):
+    """ :returns:
+            (kind, t1, t2, t3, node id), None if not a packet of this protocol
+    """
+    if len(data) != PACKET_FORMAT.size:
+        return None
+    magic, version, kind, t1, t2, t3, node_id = PACKET_FORMAT.unpack(data)
+    if magic != PACKET_MAGIC or version != PACKET_VERSION:
+        return None
+    return kind, t1, t2, t3, node_id.rstrip(b"\x00").decode("utf-8", "replace")
+
+
+def parse_peer(spec, default_port=SYNC_PORT):
+    """ "host[:port]" to a UDP address
+    """
+    host, _, port = spec.rpartition(":")
+    if not host or not port.isdigit():
+        return (spec, default_port)
+    return (host, int(port))
+
+
+class SkewedClock():
+
+    # Wall clock of a simulated computer: offset_ns ahead of the local clock, and running drift_ppm faster
+    def __init__(self, offset_ns=0, drift_ppm=0.0, clock=None):
+        self.clock = CLOCK.wall_ns if clock is None else clock
+        self.offset_ns = offset_ns
+        self.drift_ppm = drift_ppm
+        self._t0 = self.clock()
+
+    def __call__(self):
+        t = self.clock()
+        return t + self.offset_ns + int((t - self._t0) * self.drift_ppm * 1e-6)
+
+
+class OffsetDriftEstimator():
+
+    # Offset and drift of the clock of one peer, relative to the local clock (ns)
+    def __init__(self, filter_size=SYNC_FILTER, window=SYNC_WINDOW):
+        self._recent = deque(maxlen=filter_size)    # (delay, local time, offset) of the last exchanges
+        self.samples = deque(maxlen=window)         # (local time, offset, delay) kept by the clock filter
+        self.exchanges = 0
+
+    def add(self, t1, t2, t3, t4):
+        """ Add an exchange
+
+            :returns:
+                True if the clock filter kept a new sample
+        """
+        offset = ((t2 - t1) + (t3 - t4)) // 2
+        delay = (t4 - t1) - (t3 - t2)
+        self._recent.append((delay, (t1 + t4) // 2, offset))
+        self.exchanges += 1
+        delay, local_ns, offset = min(self._recent)
+        # Only newer samples: an older one with a shorter delay is not used twice
+        if self.samples and local_ns <= self.samples[-1][0]:
+            return False
+        self.samples.append((local_ns, offset, delay))
+        return True
+
+    def estimate(self, local_ns=None):
+        """ Least squares line through the samples
+
+            :returns:
+                (offset ns at local_ns (latest sample if None), drift ppm, delay ns of the latest sample),
+                None without samples
+        """
+        samples = self.samples
+        if not samples:
+            return None
+        x0 = samples[0][0]
+        n = len(samples)
+        mean_x = sum(s[0] - x0 for s in samples) / n
+        mean_y = sum(s[1] for s in samples) / n
+        sxx = sum((s[0] - x0 - mean_x) ** 2 for s in samples)
+        slope = sum((s[0] - x0 - mean_x) * (s[1] - mean_y) for s in samples) / sxx if sxx > 0 else 0.0
+        if local_ns is None:
+            local_ns = samples[-1][0]
+        return mean_y + slope * (local_ns - x0 - mean_x), slope * 1e6, samples[-1][2]
+
+
+class ClockSyncResponder():
+
+    # Answers the time requests of the peers, served by a daemon thread
+    def __init__(self, host=SYNC_HOST, port=SYNC_PORT, node_id=None, wall_clock=None):
+        self.node_id = socket.gethostname() if node_id is None else node_id
+        self.wall_clock = CLOCK.wall_ns if wall_clock is None else wall_clock
+        self.requests = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((host, port))
+        self._sock.settimeout(RESPONDER_POLL)
+        self.address = self._sock.getsockname()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._respond_job, name="Clock Sync Responder", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sock.close()
+
+    def _respond_job(self):
+        while not self._stop.is_set():
+            try:
+                data, address = self._sock.recvfrom(PACKET_FORMAT.size + 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            t2 = self.wall_clock()
+            packet = unpack_packet(data)
+            if packet is None or packet[0] != KIND_REQUEST:
+                continue
+            self.requests += 1
+            try:
+                self._sock.sendto(pack_packet(KIND_REPLY, packet[1], t2, self.wall_clock(), self.node_id), address)
+            except OSError:
+                continue
+
+
+class PeerClock():
+
+    # State of one peer of the service
+    def __init__(self, spec, address):
+        self.spec = spec
+        self.address = address
+        self.node_id = spec                 # Replaced by the node id of the peer at its first reply
+        self.estimator = OffsetDriftEstimator()
+        self.reachable = None
+        self.timeouts = 0
+
+
+class ClockSyncService():
+
+    # Responder of the local clock, and offset/drift estimators of the peers polled by a daemon thread
+    # port: responder port, 0: none (the peers are polled anyway); peers: "host[:port]" specs
+    def __init__(self, peers=(), port=SYNC_PORT, host=SYNC_HOST, node_id=None, interval=SYNC_INTERVAL,
+                 timeout=SYNC_TIMEOUT, wall_clock=None):
+        self.node_id = socket.gethostname() if node_id is None else node_id
+        self.wall_clock = CLOCK.wall_ns if wall_clock is None else wall_clock
+        self.interval = interval
+        self.timeout = timeout
+        self.responder = ClockSyncResponder(host, port, self.node_id, self.wall_clock) if port else None
+        self.peers = [PeerClock(spec, parse_peer(spec)) for spec in peers]
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Requests leave from the same interface as the responder
+        self._sock.bind((host, 0))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sync_job, name="Clock Sync", daemon=True)
+        self._session_lock = threading.Lock()
+        self._session_f = None
+        self.session_fpath = None
+
+    def start(self):
+        if self.responder is not None:
+            self.responder.start()
+        if self.peers:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.responder is not None:
+            self.responder.stop()
+        self._sock.close()
+        self.close_session()
+
+    def open_session(self, log_fpath, exp_name):
+        """ Write the estimates into <log_fpath>/<exp_name>-clock_sync.csv until close_session()
+        """
+        from utils import timestamp_log
+        fpath = os.path.join(log_fpath, exp_name + CLOCK_SYNC_LOG_SUFFIX)
+        with self._session_lock:
+            self._close_session_file()
+            new_file = not os.path.exists(fpath)
+            self._session_f = open(fpath, "a")
+            if new_file:
+                self._session_f.write(",".join(CLOCK_SYNC_COLUMNS) + "\n")
+            self.session_fpath = fpath
+        sys.stdout.write(timestamp_log() + "Clock sync of {} with {} peer(s) logged into {}\n"
+                         .format(self.node_id, len(self.peers), fpath))
+
+    def close_session(self):
+        with self._session_lock:
+            if self._session_f is None:
+                return
+            self._close_session_file()
+        self.log_estimates()
+
+    def _close_session_file(self):
+        if self._session_f is not None:
+            self._session_f.close()
+            self._session_f = None
+
+    def exchange(self, peer):
+        """ One request to a peer
+
+            :returns:
+                (t1, t2, t3, t4, node id of the peer), None without a reply within the timeout
+        """
+        t1 = self.wall_clock()
+        try:
+            self._sock.sendto(pack_packet(KIND_REQUEST, t1, 0, 0, self.node_id), peer.address)
+        except OSError:
+            # e.g. network unreachable, no route to the vehicle yet
+            return None
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._sock.settimeout(remaining)
+            try:
+                data, _ = self._sock.recvfrom(PACKET_FORMAT.size + 1)
+            except OSError:
+                return None
+            t4 = self.wall_clock()
+            packet = unpack_packet(data)
+            # Late replies of earlier requests are not matched (t1 echoed)
+            if packet is not None and packet[0] == KIND_REPLY and packet[1] == t1:
+                return t1, packet[2], packet[3], t4, packet[4]
+
+    def sync_peer(self, peer):
+        """ Poll a peer, update its estimator and log the estimates into the session
+
+            :returns:
+                True if the peer replied
+        """
+        from utils import timestamp_log
+        exchange = self.exchange(peer)
+        if exchange is None:
+            peer.timeouts += 1
+            if peer.reachable is not False:
+                sys.stdout.write(timestamp_log() + "Clock sync: no reply from {}\n".format(peer.spec))
+            peer.reachable = False
+            return False
+        t1, t2, t3, t4, peer.node_id = exchange
+        if not peer.reachable:
+            sys.stdout.write(timestamp_log() + "Clock sync: {} ({}) replied\n".format(peer.spec, peer.node_id))
+        peer.reachable = True
+        peer.estimator.add(t1, t2, t3, t4)
+        offset_est, drift_ppm, _ = peer.estimator.estimate(t4)
+        with self._session_lock:
+            if self._session_f is not None:
+                # Local time of the log timestamps: UTC ns of the local clock + UTC offset of the time zone
+                local_us = t4 // 1000 + CLOCK.local_us() - CLOCK.utc_us()
+                self._session_f.write("{},{},{},{},{},{:.0f},{:.3f}\n".format(
+                    local_us, self.node_id, peer.node_id, ((t2 - t1) + (t3 - t4)) // 2000,
+                    ((t4 - t1) - (t3 - t2)) // 1000, offset_est / 1000, drift_ppm))
+                self._session_f.flush()
+        return True
+
+    def _sync_job(self):
+        while not self._stop.is_set():
+            for peer in self.peers:
+                self.sync_peer(peer)
+            self._stop.wait(self.interval)
+
+    def estimates(self):
+        """ :returns:
+                {peer node id: (offset ns, drift ppm, delay ns)} of the peers with samples
+        """
+        result = {}
+        for peer in self.peers:
+            estimate = peer.estimator.estimate()
+            if estimate is not None:
+                result[peer.node_id] = estimate
+        return result
+
+    def log_estimates(self):
+        from utils import timestamp_log
+        for node_id, (offset_ns, drift_ppm, delay_ns) in self.estimates().items():
+            sys.stdout.write(timestamp_log() + "Clock sync: {} offset {:+.3f} ms, drift {:+.2f} ppm, delay {:.3f} ms\n"
+                             .format(node_id, offset_ns / 1e6, drift_ppm, delay_ns / 1e6))
+
+    def metric_samples(self):
+        """ :returns:
+                samples of the metrics endpoint (metrics_server.py)
+        """
+        samples = []
+        for node_id, (offset_ns, drift_ppm, delay_ns) in self.estimates().items():
+            labels = (("peer", node_id),)
+            samples.append(("uwb_clock_offset_seconds", labels, offset_ns / 1e9))
+            samples.append(("uwb_clock_drift_ppm", labels, drift_ppm))
+            samples.append(("uwb_clock_sync_delay_seconds", labels, delay_ns / 1e9))
+        for peer in self.peers:
+            samples.append(("uwb_clock_sync_timeouts_total", (("peer", peer.node_id),), peer.timeouts))
+        return samples
+
+
+def start_clock_sync(port=None, peers=None, host=SYNC_HOST):
+    """ Poll the given peers and answer them on host:port. Without peers, only an explicit port
+        starts a responder; port None: SYNC_PORT with peers, 0: no responder
+
+        :returns:
+            ClockSyncService, or None if disabled or the port is not available
+    """
+    if port is None:
+        port = SYNC_PORT if peers else 0
+    if not port and not peers:
+        return None
+    from utils import timestamp_log
+    try:
+        service = ClockSyncService(peers or (), port, host).start()
+    except OSError as e:
+        sys.stdout.write(timestamp_log() + "Clock sync not available on {}:{}: {}\n".format(host, port, repr(e)))
+        return None
+    if service.responder is not None:
+        sys.stdout.write(timestamp_log() + "Clock sync of {} answering on UDP {}:{}\n"
+                         .format(service.node_id, *service.responder.address))
+    return service
+
+
+if __name__ == "__main__":
+    # Unit Testing: the estimator on simulated clocks with asymmetric queuing delays, a responder
+    # standing in for a peer vehicle on the loopback interface (skewed clock), and the session file.
+    import random, tempfile
+
+    assert unpack_packet(pack_packet(KIND_REPLY, 1, -2, 3, "vehicle-2-raspberrypi")) == (KIND_REPLY, 1, -2, 3, "vehicle-2-raspbe")
+    assert unpack_packet(b"UWBC" + bytes(PACKET_FORMAT.size - 4 + 1)) is None
+    assert parse_peer("192.168.4.12") == ("192.168.4.12", SYNC_PORT) and parse_peer("v2.local:9200") == ("v2.local", 9200)
+
+    # Peer 3.2 ms ahead and 40 ppm faster, 10 minutes of exchanges every 2 s; the queuing delays of
+    # one way are up to 5 ms longer (a naive mean of the offsets is off by ~1 ms)
+    rng = random.Random(20)
+    offset_ns, drift_ppm = 3200000, 40.0
+    peer_clock = lambda t: t + offset_ns + int(t * drift_ppm * 1e-6)
+    estimator, naive = OffsetDriftEstimator(), []
+    t = 0
+    for _ in range(300):
+        t += 2 * 10**9
+        t2 = peer_clock(t + 200000 + int(rng.expovariate(1 / 2e6)))
+        t3 = t2 + 50000
+        t4 = (t3 - offset_ns) / (1 + drift_ppm * 1e-6) + 200000 + int(rng.expovariate(1 / 0.3e6))
+        estimator.add(t, t2, t3, int(t4))
+        naive.append(((t2 - t) + (t3 - t4)) / 2 - t * drift_ppm * 1e-6)
+    est_offset, est_drift, _ = estimator.estimate(t)
+    offset_err_us = abs(est_offset - (peer_clock(t) - t)) / 1e3
+    naive_err_us = abs(sum(naive) / len(naive) - offset_ns) / 1e3
+    assert offset_err_us < 100 and abs(est_drift - drift_ppm) < 2, (offset_err_us, est_drift)
+    assert naive_err_us > offset_err_us
+    print("simulated: offset error {:.0f} us (mean of the exchanges: {:.0f} us), drift {:.2f} ppm (true {:.0f})"
+          .format(offset_err_us, naive_err_us, est_drift, drift_ppm))
+
+    # Nothing answers without peers nor an explicit port
+    assert start_clock_sync() is None and start_clock_sync(port=0) is None
+
+    # Loopback stand-in of a vehicle 250 ms ahead, 500 ppm faster
+    skewed = SkewedClock(offset_ns=250 * 10**6, drift_ppm=500.0)
+    responder = ClockSyncResponder("127.0.0.1", 0, node_id="loopback-v2", wall_clock=skewed).start()
+    service = ClockSyncService(["127.0.0.1:{}".format(responder.address[1]), "127.0.0.1:9"], port=0, host="127.0.0.1",
+                               node_id="loopback-v1", interval=0.02, timeout=0.05)
+    log_dir = tempfile.mkdtemp()
+    service.open_session(log_dir, "2021-05-25-08-52-15")
+    service.start()
+    time.sleep(3.0)
+    service.stop()
+    responder.stop()
+    (node_id, (est_offset, est_drift, est_delay)), = service.estimates().items()
+    true_offset = skewed() - CLOCK.wall_ns()
+    assert node_id == "loopback-v2" and service.peers[1].reachable is False
+    assert abs(est_offset - true_offset) < 500000 and abs(est_drift - 500.0) < 50, (est_offset - true_offset, est_drift)
+    with open(os.path.join(log_dir, "2021-05-25-08-52-15" + CLOCK_SYNC_LOG_SUFFIX)) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ",".join(CLOCK_SYNC_COLUMNS) and len(lines) - 1 == service.peers[0].estimator.exchanges
+    row = lines[-1].split(",")
+    assert row[1:3] == ["loopback-v1", "loopback-v2"] and abs(int(row[0]) - CLOCK.local_us()) < 10**6
+    print("loopback: {} exchanges, offset error {:.3f} ms, drift {:.1f} ppm (true 500), delay {:.3f} ms"
+          .format(len(lines) - 1, (est_offset - true_offset) / 1e6, est_drift, est_delay / 1e6))
+    print("All clock sync tests passed")
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+import time, threading, queue, collections
+
+
+# This file contains the hand-over containers between the end ranging threads (producers)
+# and their consumers (GUI, headless loop).
+#   LatestValueMailbox: single slot holding only the latest frame. A consumer polling at a lower
+#                       rate than the reporting (the GUI at 10 Hz) always gets the newest frame,
+#                       nothing piles up over a long shift. Overwritten frames are counted.
+#   DataRing:           bounded FIFO history of the latest frames for consumers that need more
+#                       than the latest one. The oldest frames are evicted (and counted) when full.
+# Both have the put() / get(block=False) interface of queue.Queue used by the end reporting jobs,
+# and raise queue.Empty when there is nothing new.
+# One producer per container. The non-blocking paths take no lock: the slot is replaced by one
+# atomic attribute assignment of a (sequence number, value) tuple, and deque appends/pops are
+# atomic. Blocking get() waits on an Event set by put().
+
+
+class LatestValueMailbox():
+
+    # Single-slot "latest value" mailbox with a sequence number and a drop counter.
+    # notify: optional Event shared by several mailboxes, set on every put(), to wait for any of them.
+    def __init__(self, notify=None):
+        self.notify = notify
+        self.seq = 0            # sequence number of the latest put(); 0: nothing put yet
+        self._slot = None       # (seq, value)
+        self._taken_seq = 0     # sequence number of the latest value taken by get()
+        self._taken = 0         # number of values taken by get()
+        self._fresh = threading.Event()
+
+    def put(self, value, block=True, timeout=None):
+        """ Replace the latest value. Never blocks; block/timeout are accepted for queue.Queue compatibility.
+        """
+        seq = self.seq + 1
+        self._slot = (seq, value)
+        self.seq = seq
+        self._fresh.set()
+        if self.notify is not None:
+            self.notify.set()
+
+    def put_nowait(self, value):
+        self.put(value)
+
+    def _fresh_slot(self, timeout):
+        """ Wait until the slot holds a value not taken yet
+
+            :returns:
+                (seq, value), or None at the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self._slot
+            if slot is not None and slot[0] != self._taken_seq:
+                return slot
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self._fresh.clear()
+            # put() may have run between the check and clear()
+            slot = self._slot
+            if slot is not None and slot[0] != self._taken_seq:
+                return slot
+            self._fresh.wait(remaining)
+
+    def get(self, block=True, timeout=None):
+        """ Take the latest value, if not taken already
+
+            :returns:
+                value, or raises queue.Empty if there is no new value (after the timeout if blocking)
+        """
+        slot = self._fresh_slot(timeout if block else 0)
+        if slot is None:
+            raise queue.Empty
+        self._taken_seq = slot[0]
+        self._taken += 1
+        return slot[1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def peek(self):
+        """ :returns:
+                (sequence number, latest value) without taking it, (0, None) if nothing was put yet
+        """
+        slot = self._slot
+        return (0, None) if slot is None else slot
+
+    def wait(self, timeout=None):
+        """ Wait for a value not taken yet
+
+            :returns:
+                True if there is one, False at the timeout
+        """
+        return self._fresh_slot(timeout) is not None
+
+    @property
+    def dropped(self):
+        """ Number of values overwritten before being taken
+        """
+        pending = 1 if self.seq != self._taken_seq else 0
+        return self.seq - self._taken - pending
+
+    def empty(self):
+        return self.seq == self._taken_seq
+
+    def qsize(self):
+        return 0 if self.empty() else 1
+
+
+class DataRing():
+
+    # Bounded FIFO ring of the latest values with sequence numbers and an eviction counter
+    def __init__(self, maxlen=64):
+        self.maxlen = maxlen
+        self.seq = 0
+        self.evicted = 0
+        self._ring = collections.deque(maxlen=maxlen)
+        self._fresh = threading.Event()
+
+    def put(self, value, block=True, timeout=None):
+        """ Append a value, evicting the oldest one when full. Never blocks.
+        """
+        if len(self._ring) == self.maxlen:
+            self.evicted += 1
+        self.seq += 1
+        self._ring.append((self.seq, value))
+        self._fresh.set()
+
+    def put_nowait(self, value):
+        self.put(value)
+
+    def get(self, block=True, timeout=None):
+        """ Take the oldest value in the ring
+
+            :returns:
+                value, or raises queue.Empty if the ring is empty (after the timeout if blocking)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self._ring.popleft()[1]
+            except IndexError:
+                pass
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not block or (remaining is not None and remaining <= 0):
+                raise queue.Empty
+            self._fresh.clear()
+            if not self._ring:
+                self._fresh.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def snapshot(self, since_seq=0):
+        """ Values in the ring without taking them, oldest first
+
+            :returns:
+                list of (sequence number, value) newer than since_seq
+        """
+        # deque.copy() is atomic, iterating the live deque is not
+        return [item for item in self._ring.copy() if item[0] > since_seq]
+
+    def latest(self):
+        """ :returns:
+                (sequence number, newest value) without taking it, (0, None) if empty
+        """
+        try:
+            return self._ring[-1]
+        except IndexError:
+            return (0, None)
+
+    def empty(self):
+        return not self._ring
+
+    def qsize(self):
+        return len(self._ring)
+
+
+if __name__ == "__main__":
+    # Unit Testing: a 10 Hz consumer of a fast producer always gets the newest frame, memory stays
+    # bounded and every frame is accounted for as taken or dropped.
+    import sys, timeit
+
+    mailbox, ring = LatestValueMailbox(), DataRing(maxlen=16)
+    try:
+        mailbox.get(block=False)
+        raise AssertionError("no queue.Empty")
+    except queue.Empty:
+        pass
+    for i in range(5):
+        mailbox.put([{"superFrameNumber": i}, []])
+    assert mailbox.get(block=False)[0]["superFrameNumber"] == 4 and mailbox.dropped == 4 and mailbox.empty()
+    assert not mailbox.wait(timeout=0.01)
+    mailbox.put("x")
+    assert mailbox.wait(timeout=0) and mailbox.qsize() == 1 and mailbox.get(block=False) == "x" and mailbox.dropped == 4
+
+    n_frames = 200000
+    def producer():
+        for i in range(1, n_frames + 1):
+            frame = [{"superFrameNumber": i}, []]
+            mailbox.put(frame)
+            ring.put(frame)
+    producer_thread = threading.Thread(target=producer, daemon=True)
+    mailbox, ring = LatestValueMailbox(), DataRing(maxlen=16)
+    producer_thread.start()
+    taken = []
+    while producer_thread.is_alive() or not mailbox.empty():
+        try:
+            taken.append(mailbox.get(timeout=0.001)[0]["superFrameNumber"])
+        except queue.Empty:
+            pass
+    assert taken == sorted(taken) and len(set(taken)) == len(taken) and taken[-1] == n_frames
+    assert len(taken) + mailbox.dropped == n_frames, (len(taken), mailbox.dropped)
+    history = ring.snapshot()
+    assert [s for s, _ in history] == list(range(n_frames - 15, n_frames + 1)) and ring.evicted == n_frames - 16
+    assert [ring.get(block=False)[0]["superFrameNumber"] for _ in range(16)] == list(range(n_frames - 15, n_frames + 1))
+    print("{} frames: {} taken by the consumer, {} dropped, ring of {} kept the latest"
+          .format(n_frames, len(taken), mailbox.dropped, ring.maxlen))
+
+    # The LifoQueue it replaces keeps every frame the GUI does not get to
+    lifo = queue.LifoQueue()
+    for i in range(3000):   # 5 minutes of 10 Hz reporting, one GUI get per two frames
+        lifo.put([{"superFrameNumber": i}, []])
+        if i % 2:
+            lifo.get(block=False)
+    print("LifoQueue after 5 min at 10 Hz with a slower consumer: {} stale frames kept | mailbox: 1"
+          .format(lifo.qsize()))
+
+    frame = [{}, []]
+    t_lifo = timeit.timeit(lambda: (lifo.put(frame), lifo.get(block=False)), number=100000)
+    t_mailbox = timeit.timeit(lambda: (mailbox.put(frame), mailbox.get(block=False)), number=100000)
+    print("put+get: LifoQueue {:.2f} us | mailbox {:.2f} us".format(t_lifo * 10, t_mailbox * 10))
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import os, sys, re, json, time, threading
+from utils import timestamp_log
+
+
+# This file contains the persistent cache of the device information of the UWB boards, for warm starts.
+# A cold pairing of a board (utils.pair_uwb_port) interrogates its shell: parse_uart_sys_info() with
+# up to 5 attempts of "aurs" + "si" and ~15 regexes over the "si" dump, then the label of a master is
+# base64-decoded (decode_info_pos_from_label()). The parsed sys_info and the decoded informative
+# position are stored here, keyed by the UWB address and the firmware/config versions of the board.
+# A warm pairing sends a single "si" and validates the entry with the signature of the dump: the
+# configuration lines (sys, uwb0, mode, cfg, enc, ble) without their uptime stamps. Any change of
+# the board (firmware, mode, label, update rates, BLE...) fails the validation and the board is
+# interrogated in full again. The connection state lines (uwbmac) are not part of the signature.
+# The cache is a JSON file (DEVICE_CACHE_FILE in the log directory of uwb_master.py), written
+# atomically at the end of each pairing. refresh=True (uwb_master.py --refresh-device-cache)
+# interrogates every board in full and rewrites its entry.
+# The time saved is the duration of the last cold interrogation of a board minus the warm one.
+
+DEVICE_CACHE_FILE = "uwb_device_cache.json"
+DEVICE_CACHE_VERSION = 1
+
+# Configuration lines of the "si" dump: "[000006.570 INF] cfg: sync=0 fwup=0 ble=1 ..."
+SI_LINE_PATTERN = re.compile(r"^\[[^\]]*\]\s*(sys|uwb0|mode|cfg|enc|ble):\s*(.*?)\s*$", re.MULTILINE)
+SI_KEY_PATTERN = re.compile(r"fw_ver=(x[0-9a-fA-F]+)\s+cfg_ver=(x[0-9a-fA-F]+)[^\n]*\n.*?addr=(x[0-9a-fA-F]+)", re.DOTALL)
+
+
+def si_signature(si):
+    """ :returns:
+            (cache key, signature) of a "si" dump, None if the dump is incomplete
+    """
+    lines = SI_LINE_PATTERN.findall(si)
+    if len(lines) != 6 or [name for name, _ in lines] != ["sys", "uwb0", "mode", "cfg", "enc", "ble"]:
+        return None
+    signature = "\n".join(name + ": " + text for name, text in lines)
+    match = SI_KEY_PATTERN.search(signature)
+    if match is None:
+        return None
+    fw_ver, cfg_ver, addr = match.groups()
+    return "{}/{}/{}".format(addr, fw_ver, cfg_ver), signature
+
+
+class DeviceInfoCache():
+
+    # Cached device information of the boards: {key: entry}, shared by the pairing workers
+    def __init__(self, fpath=None, refresh=False):
+        self.fpath = fpath
+        self.refresh = refresh
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        self.saved = 0.0                # Seconds saved by the hits
+        self._dirty = False
+        self._lock = threading.Lock()
+        if fpath is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.fpath, "r") as f:
+                content = json.load(f)
+            if content.get("version") != DEVICE_CACHE_VERSION:
+                raise ValueError("cache version {}".format(content.get("version")))
+            self.entries = content["devices"]
+        except FileNotFoundError:
+            self.entries = {}
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            # Unreadable cache: all the boards are interrogated in full and the file is rewritten
+            sys.stdout.write(timestamp_log() + "UWB device cache {} ignored: {}\n".format(self.fpath, repr(e)))
+            self.entries = {}
+            self._dirty = True
+
+    def save(self):
+        """ Write the cache if it changed (atomic replace of the file)
+        """
+        with self._lock:
+            if self.fpath is None or not self._dirty:
+                return
+            content = json.dumps({"version": DEVICE_CACHE_VERSION, "devices": self.entries}, indent=1, sort_keys=True)
+            self._dirty = False
+        tmp_fpath = self.fpath + ".tmp"
+        with open(tmp_fpath, "w") as f:
+            f.write(content)
+        os.replace(tmp_fpath, self.fpath)
+
+    def warm(self):
+        """ :returns:
+                True if a board may be validated (not refreshing, entries cached), else it is
+                interrogated in full right away
+        """
+        return not self.refresh and bool(self.entries)
+
+    def lookup(self, si, warm_time=0.0):
+        """ Validate the cached entry of a board against its "si" dump
+
+            :param warm_time: seconds spent to query the dump
+            :returns:
+                (sys_info, info_pos) copies, None if not cached or changed
+        """
+        identity = si_signature(si)
+        with self._lock:
+            entry = None if identity is None else self.entries.get(identity[0])
+            if entry is None or entry["signature"] != identity[1]:
+                return None
+            self.hits += 1
+            self.saved += max(entry["cold_time"] - warm_time, 0.0)
+            return dict(entry["sys_info"]), (None if entry["info_pos"] is None else dict(entry["info_pos"]))
+
+    def store(self, si, sys_info, info_pos, cold_time):
+        """ Cache the device information of a board interrogated in full
+
+            :param si: "si" dump of the board, the signature of its entry
+            :param cold_time: seconds of the full interrogation
+        """
+        identity = si_signature(si)
+        with self._lock:
+            if self.refresh:
+                self.refreshed += 1
+            else:
+                self.misses += 1
+            if identity is None:
+                return
+            self.entries[identity[0]] = {"signature": identity[1], "sys_info": dict(sys_info),
+                                         "info_pos": None if info_pos is None else dict(info_pos),
+                                         "cold_time": cold_time, "stored": time.time()}
+            self._dirty = True
+
+    def report(self):
+        return {"hits": self.hits, "misses": self.misses, "refreshed": self.refreshed,
+                "saved": self.saved, "entries": len(self.entries)}
+
+    def describe(self):
+        return "{} hit(s), {} miss(es), {} refreshed, {:.2f} s saved".format(
+            self.hits, self.misses, self.refreshed, self.saved)
+
+
+if __name__ == "__main__":
+    # Unit Testing: cold, warm, changed-board and forced-refresh pairings of the emulated boards of a
+    # vehicle (dwm_emulator.py), with the device information compared to the cold pairing.
+    import io, tempfile
+    from dwm_emulator import DwmEmulator, make_fleet
+    from utils import pairing_uwb_ports, encode_info_pos_to_label, decode_info_pos_from_label
+
+    def pair(cache):
+        serial_ports, startup_report = {}, {}
+        log_out, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            assert pairing_uwb_ports(serial_ports_dict=serial_ports, startup_report=startup_report,
+                                     serial_tty_devices=emulator.tty_devices(vehicles[:1]), device_cache=cache) == 1
+        finally:
+            sys.stdout, log_txt = log_out, sys.stdout.getvalue()
+        info = {addr: (entry["config"], entry["sys_info"], entry["info_pos"]) for addr, entry in serial_ports.items()}
+        for entry in serial_ports.values():
+            entry["port"].close()
+        sys_info_time = sum(port_report["steps"].get("sys_info", 0.0) for port_report in startup_report["ports"].values())
+        return info, startup_report, sys_info_time, log_txt
+
+    vehicles = make_fleet(2, spacing=8000)
+    emulator = DwmEmulator(vehicles, seed=22).start()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = os.path.join(tmp_dir, DEVICE_CACHE_FILE)
+        cold_info, cold_report, cold_time, _ = pair(DeviceInfoCache(fpath))
+        assert cold_report["device_cache"]["misses"] == 4 and os.path.exists(fpath)
+        warm_cache = DeviceInfoCache(fpath)
+        warm_info, warm_report, warm_time, log_txt = pair(warm_cache)
+        assert warm_info == cold_info, (warm_info, cold_info)
+        assert warm_report["device_cache"]["hits"] == 4 and warm_cache.saved > 0
+        assert "UWB device cache: 4 hit(s)" in log_txt
+        print("sys info of 4 boards: cold {:.2f} s, warm {:.2f} s (pairing {:.2f} s -> {:.2f} s), {:.2f} s saved"
+              .format(cold_time, warm_time, cold_report["total"], warm_report["total"], warm_cache.saved))
+
+        # A master relabeled (moved on the vehicle): its entry is not valid anymore
+        master = next(dev for dev in emulator.devices if dev.vehicle is vehicles[0] and dev.role == "tag")
+        info_pos = decode_info_pos_from_label(master.label)
+        info_pos["x_master"] += 1000
+        master.label = encode_info_pos_to_label(info_pos)
+        changed_info, changed_report, _, _ = pair(DeviceInfoCache(fpath))
+        assert changed_report["device_cache"]["hits"] == 3 and changed_report["device_cache"]["misses"] == 1
+        assert changed_info[master.short_id][2]["x_master"] == info_pos["x_master"]
+        again_info, again_report, _, _ = pair(DeviceInfoCache(fpath))
+        assert again_report["device_cache"]["hits"] == 4 and again_info == changed_info
+
+        # Forced refresh: full interrogation of every board
+        refresh_info, refresh_report, _, _ = pair(DeviceInfoCache(fpath, refresh=True))
+        assert refresh_report["device_cache"]["refreshed"] == 4 and refresh_info == changed_info
+
+        # Unreadable cache file: cold pairing, the file is rewritten
+        with open(fpath, "w") as f:
+            f.write("{not json")
+        log_out, sys.stdout = sys.stdout, io.StringIO()
+        broken_cache = DeviceInfoCache(fpath)
+        sys.stdout = log_out
+        assert broken_cache.entries == {}
+        _, broken_report, _, _ = pair(broken_cache)
+        assert broken_report["device_cache"]["misses"] == 4 and len(DeviceInfoCache(fpath).entries) == 4
+
+    assert si_signature("[000001.000 INF] sys: fw2 fw_ver=x01 cfg_ver=x02\r\n") is None
+    emulator.stop()
+    print("All device cache tests passed")
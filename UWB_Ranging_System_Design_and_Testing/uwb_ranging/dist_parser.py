@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+import sys, re
+from collections import namedtuple
+
+
+# This file contains the parser of the DWM1001 "DIST" location reports (shell mode).
+# Lines are parsed straight from serial.readline() as bytes, without UTF-8 decoding:
+# - dwm-accelerometer-enabled firmware: a byte-level tokenizer splits the report into its
+#   ";" separated fields.
+#   Wrong-format (convoluted) reports happen at high update rates, e.g.:
+#     DIST,4;[AN0,8D38,35783168,5111808,20972734]=[4717,100];...;ACC=[17696,-1056,-352,19531278]=[13834,100];ACC=[16288,48,-80];UWBLOCALTIME,1207183493;
+#   Convoluted segments that cannot yield a reading are skipped by the tokenizer, with
+#   the same results as the original regular expressions. Reports with a segment the tokenizer
+#   cannot prove equivalent are parsed by the (precompiled) regular expressions instead: a
+#   deliberate fallback, as reproducing every partial match of the original expressions in the
+#   tokenizer would cost more than the rare convoluted report (PARSE_STATS, uwb_regex_fallbacks_total).
+# - OEM PANS firmware ("," separated float fields): the original expressions, precompiled for
+#   bytes, scan the undecoded line. A Python tokenizer of these reports measured 0.7-0.9x the
+#   speed of the regular expressions (one float() per field either way), not faster.
+#   Lines with non-ASCII bytes (".{4}" counts characters in the original, bytes here) are decoded
+#   and parsed by the original expressions.
+
+AnchorReading = namedtuple("AnchorReading", ["anc_id", "x", "y", "z", "dist_to", "anc_qf"])
+
+# Counters of the parsing paths taken, for diagnostics.
+PARSE_STATS = {"fast": 0, "regex_fallback": 0, "skipped_segments": 0}
+
+SEGMENT_MARKERS = (b"[AN", b"POS=[", b"ACC=[", b"UWBLOCALTIME")
+_ACCEL_EN_NUMERIC_BYTES = b"0123456789+-,[]="
+
+
+class DistReport():
+    """ Compact record of one DIST location report
+        anchors:        list of AnchorReading, in reported order (duplicates kept, as reported)
+        est_pos:        (x, y, z) or None
+        est_pos_qf:     int or None
+        acc:            (x, y, z) or None, dwm-accelerometer-enabled firmware only
+        uwb_timestamp:  int or None, dwm-accelerometer-enabled firmware only
+        oem:            True if reported by the OEM firmware (float fields, no anchor quality factor)
+    """
+    __slots__ = ("anchors", "est_pos", "est_pos_qf", "acc", "uwb_timestamp", "oem")
+
+    def __init__(self, anchors, est_pos=None, est_pos_qf=None, acc=None, uwb_timestamp=None, oem=False):
+        self.anchors = anchors
+        self.est_pos = est_pos
+        self.est_pos_qf = est_pos_qf
+        self.acc = acc
+        self.uwb_timestamp = uwb_timestamp
+        self.oem = oem
+
+    def to_dict(self):
+        """ Convert into the JSON-style dictionary of make_json_dict_accel_en()/make_json_dict_oem()
+        """
+        data = {}
+        all_anc_id = []
+        for anc in self.anchors:
+            all_anc_id.append(anc.anc_id)
+            if self.oem:
+                data[anc.anc_id] = {'anc_id': anc.anc_id, 'x': anc.x, 'y': anc.y, 'z': anc.z, 'dist_to': anc.dist_to}
+            else:
+                data[anc.anc_id] = {'anc_id': anc.anc_id, 'x': anc.x, 'y': anc.y, 'z': anc.z, 'dist_to': anc.dist_to, 'anc_qf': anc.anc_qf}
+        data['anc_num'] = len(self.anchors)
+        data['all_anc_id'] = all_anc_id
+        if self.est_pos is not None:
+            data['est_pos'] = {'x': self.est_pos[0], 'y': self.est_pos[1], 'z': self.est_pos[2]}
+            data['est_pos_qf'] = self.est_pos_qf
+        if self.acc is not None:
+            data['acc'] = {'x': self.acc[0], 'y': self.acc[1], 'z': self.acc[2]}
+        if self.uwb_timestamp is not None:
+            data['timestamp'] = self.uwb_timestamp
+        return data
+
+    def __repr__(self):
+        return "DistReport(" + repr(self.to_dict()) + ")"
+
+
+# -------------- Regular expressions of the original parsers, precompiled, used as fallback --------------
+_ANC_ACCEL_EN_RE = re.compile(  "(?<=\[AN)(?P<anc_idx>[0-9]{1})[,]"
+                                "(?P<anc_id>.{4})[,]"
+                                "(?P<anc_x>[+-]?[0-9]*)[,]"
+                                "(?P<anc_y>[+-]?[0-9]*)[,]"
+                                "(?P<anc_z>[+-]?[0-9]*)(\]\=\[)"
+                                "(?P<dist_to>[+-]?[0-9]*)[,]"
+                                "(?P<anc_qf>[+-]?[0-9]*)(\]\;)")
+_POS_ACCEL_EN_RE = re.compile(  "(?<=POS=\[)"
+                                "(?P<pos_x>[-+]?[0-9]*)[,]"
+                                "(?P<pos_y>[-+]?[0-9]*)[,]"
+                                "(?P<pos_z>[-+]?[0-9]*)[,]"
+                                "(?P<pos_qf>[-+]?[0-9]*)(\]\;)")
+_ACC_ACCEL_EN_RE = re.compile(  "(?<=ACC=\[)"
+                                "(?P<acc_x>[-+]?[0-9]*)[,]"
+                                "(?P<acc_y>[-+]?[0-9]*)[,]"
+                                "(?P<acc_z>[-+]?[0-9]*)(\]\;)")
+_UWB_TIMESTAMP_RE = re.compile( "(?<=UWBLOCALTIME)[,](?P<timestamp>[-+]?[0-9]*)[;]")
+_ANC_OEM_RE = re.compile(       "(?<=AN)(?P<anc_idx>[0-9]{1})[,]"
+                                "(?P<anc_id>.{4})[,]"
+                                "(?P<anc_x>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<anc_y>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<anc_z>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<dist_to>[+-]?[0-9]*[.][0-9]{2})")
+_POS_OEM_RE = re.compile(       "(?<=POS[,])"
+                                "(?P<pos_x>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_y>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_z>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_qf>[0-9]*)")
+# The OEM expressions for undecoded (ASCII) lines
+_ANC_OEM_BYTES_RE = re.compile(_ANC_OEM_RE.pattern.encode("ascii"))
+_POS_OEM_BYTES_RE = re.compile(_POS_OEM_RE.pattern.encode("ascii"))
+# The same anchor/position/acceleration patterns, matched against a single ";"-terminated segment
+_SEGMENT_ACCEL_EN_RE = {b"[AN": re.compile(rb"\[AN[0-9],.{4},[+-]?[0-9]*,[+-]?[0-9]*,[+-]?[0-9]*\]=\[[+-]?[0-9]*,[+-]?[0-9]*\];", re.DOTALL),
+                        b"POS=[": re.compile(rb"POS=\[[-+]?[0-9]*,[-+]?[0-9]*,[-+]?[0-9]*,[-+]?[0-9]*\];"),
+                        b"ACC=[": re.compile(rb"ACC=\[[-+]?[0-9]*,[-+]?[0-9]*,[-+]?[0-9]*\];"),
+                        b"UWBLOCALTIME": re.compile(rb"UWBLOCALTIME,[-+]?[0-9]*;")}
+
+
+def _regex_dist_report_accel_en(raw_string):
+    anchors = []
+    for regex_match in _ANC_ACCEL_EN_RE.finditer(raw_string):
+        anchors.append(AnchorReading(regex_match.group("anc_id"),
+                                     int(regex_match.group("anc_x")),
+                                     int(regex_match.group("anc_y")),
+                                     int(regex_match.group("anc_z")),
+                                     int(regex_match.group("dist_to")),
+                                     int(regex_match.group("anc_qf"))))
+    report = DistReport(anchors)
+    pos_match = _POS_ACCEL_EN_RE.search(raw_string)
+    if pos_match:
+        report.est_pos = (int(pos_match.group("pos_x")), int(pos_match.group("pos_y")), int(pos_match.group("pos_z")))
+        report.est_pos_qf = int(pos_match.group("pos_qf"))
+    acc_match = _ACC_ACCEL_EN_RE.search(raw_string)
+    if acc_match:
+        report.acc = (int(acc_match.group("acc_x")), int(acc_match.group("acc_y")), int(acc_match.group("acc_z")))
+    timestamp_match = _UWB_TIMESTAMP_RE.search(raw_string)
+    if timestamp_match:
+        report.uwb_timestamp = int(timestamp_match.group("timestamp"))
+    return report
+
+
+def _regex_dist_report_oem(raw_string):
+    anchors = []
+    for regex_match in _ANC_OEM_RE.finditer(raw_string):
+        anchors.append(AnchorReading(regex_match.group("anc_id"),
+                                     float(regex_match.group("anc_x")),
+                                     float(regex_match.group("anc_y")),
+                                     float(regex_match.group("anc_z")),
+                                     float(regex_match.group("dist_to")),
+                                     None))
+    report = DistReport(anchors, oem=True)
+    pos_match = _POS_OEM_RE.search(raw_string)
+    if pos_match:
+        report.est_pos = (float(pos_match.group("pos_x")), float(pos_match.group("pos_y")), float(pos_match.group("pos_z")))
+        report.est_pos_qf = int(pos_match.group("pos_qf"))
+    return report
+
+
+def _skippable_accel_en_segment(segment):
+    """ True if no regular expression of the original parser could match in this (";"-terminated) segment,
+        so that dropping it gives the same results. Only called for segments the tokenizer rejected.
+    """
+    markers = [(segment.find(marker), marker) for marker in SEGMENT_MARKERS if marker in segment]
+    if not markers:
+        # No match can start in a segment without any marker
+        return True
+    if len(markers) > 1 or markers[0][0] != 0 or segment.count(markers[0][1]) > 1:
+        return False
+    marker = markers[0][1]
+    if marker == b"[AN" and len(segment) < 9:
+        # The anchor id (any 4 characters) could run over the ";" into the next segment
+        return False
+    return _SEGMENT_ACCEL_EN_RE[marker].fullmatch(segment + b";") is None
+
+
+def _tokenize_accel_en(line):
+    """ Byte-level tokenizer of the dwm-accelerometer-enabled firmware report
+        e.g. DIST,4;[AN0,C584,160,0,-1510]=[1176,100];...;POS=[502,827,803,58];ACC=[-512,768,9449];UWBLOCALTIME,38439537;
+
+        :returns:
+            DistReport, or None if the report is not provably parsed like the original parser
+    """
+    segments = line.split(b";")
+    # Every field is ";"-terminated. An unterminated tail (truncated report) never yields a reading.
+    segments.pop()
+    anchors = []
+    report = DistReport(anchors)
+    for segment in segments:
+        try:
+            head = segment[:3]
+            if head == b"[AN":
+                # [AN0,8D38,35783168,5111808,20972734]=[4717,100]
+                # int() also takes blanks and underscores: only digits, signs and separators may follow the anchor id
+                fields = segment[3:-1].split(b",")
+                if (len(fields) != 6 or segment[-1:] != b"]" or len(fields[1]) != 4 or not fields[0].isdigit() or len(fields[0]) != 1
+                    or segment[10:].translate(None, _ACCEL_EN_NUMERIC_BYTES)):
+                    raise ValueError(segment)
+                z, dist_to = fields[4].split(b"]=[")
+                anchors.append(AnchorReading(fields[1].decode("ascii"), int(fields[2]), int(fields[3]), int(z), int(dist_to), int(fields[5])))
+            elif head == b"DIS":
+                # The report header "DIST,<n>" carries no reading
+                if segment[:5] != b"DIST," or not segment[5:].isdigit():
+                    raise ValueError(segment)
+            elif head == b"ACC" or head == b"POS":
+                if segment[3:5] != b"=[" or segment[-1:] != b"]" or segment[5:-1].translate(None, _ACCEL_EN_NUMERIC_BYTES):
+                    raise ValueError(segment)
+                fields = segment[5:-1].split(b",")
+                if head == b"ACC":
+                    if len(fields) != 3:
+                        raise ValueError(segment)
+                    if report.acc is None:
+                        report.acc = (int(fields[0]), int(fields[1]), int(fields[2]))
+                else:
+                    if len(fields) != 4:
+                        raise ValueError(segment)
+                    if report.est_pos is None:
+                        # Both set once all four fields parsed: a broken quality factor leaves no partial position
+                        est_pos, est_pos_qf = (int(fields[0]), int(fields[1]), int(fields[2])), int(fields[3])
+                        report.est_pos, report.est_pos_qf = est_pos, est_pos_qf
+            elif segment[:13] == b"UWBLOCALTIME,":
+                if segment[13:].translate(None, _ACCEL_EN_NUMERIC_BYTES):
+                    raise ValueError(segment)
+                if report.uwb_timestamp is None:
+                    report.uwb_timestamp = int(segment[13:])
+            else:
+                raise ValueError(segment)
+        except (ValueError, UnicodeDecodeError):
+            # int() raised on e.g. "--1" or an empty field, or the segment has a convoluted layout
+            if not _skippable_accel_en_segment(segment):
+                return None
+            PARSE_STATS["skipped_segments"] += 1
+    return report
+
+
+def _parse_oem_bytes(line):
+    """ Parser of the OEM PANS firmware report (lec/lep), on the undecoded line
+        e.g. DIST,4,AN0,022E,7.94,8.03,0.00,3.44,AN1,9280,7.95,0.00,0.00,5.68,...,POS,6.95,5.37,-1.97,52
+
+        :returns:
+            DistReport, or None if the line is not ASCII
+    """
+    if not line.isascii():
+        return None
+    # Groups: anchor index, anchor id, x, y, z, distance
+    anchors = [AnchorReading(m[2].decode("ascii"), float(m[3]), float(m[4]), float(m[5]), float(m[6]), None)
+               for m in _ANC_OEM_BYTES_RE.finditer(line)]
+    report = DistReport(anchors, oem=True)
+    pos_match = _POS_OEM_BYTES_RE.search(line)
+    if pos_match:
+        report.est_pos = (float(pos_match[1]), float(pos_match[2]), float(pos_match[3]))
+        report.est_pos_qf = int(pos_match[4])
+    return report
+
+
+def parse_dist_report(raw_line, oem_firmware=False, on_fallback=None):
+    """ Parse one DIST location report, as bytes from serial.readline() (or str, for the legacy callers)
+        Reports the accel-enabled tokenizer cannot prove equivalent, and non-ASCII OEM reports, are parsed
+        by the original regular expressions.
+        on_fallback: optional callable, called without argument when the regular expressions are used
+
+        :returns:
+            DistReport. Raises ValueError if the report cannot be parsed at all (as the original parser did)
+    """
+    if isinstance(raw_line, str):
+        raw_string, raw_line = raw_line, raw_line.encode("utf-8")
+    else:
+        raw_string = None
+    line = raw_line.strip()
+    report = _parse_oem_bytes(line) if oem_firmware else _tokenize_accel_en(line)
+    if report is not None:
+        PARSE_STATS["fast"] += 1
+        return report
+    PARSE_STATS["regex_fallback"] += 1
+    if on_fallback is not None:
+        on_fallback()
+    if raw_string is None:
+        raw_string = str(raw_line, encoding="utf-8", errors="replace").rstrip()
+    if oem_firmware:
+        return _regex_dist_report_oem(raw_string)
+    return _regex_dist_report_accel_en(raw_string)
+
+
+if __name__ == "__main__":
+    # Unit Testing and micro-benchmark against the original regular expression parsers
+    import os, timeit
+
+    def legacy_make_json_dict_oem(raw_string):
+        data = {}
+        anc_match_iter = re.finditer(   "(?<=AN)(?P<anc_idx>[0-9]{1})[,]"
+                                        "(?P<anc_id>.{4})[,]"
+                                        "(?P<anc_x>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                        "(?P<anc_y>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                        "(?P<anc_z>[+-]?[0-9]*[.][0-9]{2})[,]"
+                                        "(?P<dist_to>[+-]?[0-9]*[.][0-9]{2})", raw_string)
+        all_anc_id = []
+        num_anc = 0
+        for regex_match in anc_match_iter:
+            anc_id = regex_match.group("anc_id")
+            all_anc_id.append(anc_id)
+            data[anc_id] = {}
+            data[anc_id]['anc_id'] = anc_id
+            data[anc_id]['x'] = float(regex_match.group("anc_x"))
+            data[anc_id]['y'] = float(regex_match.group("anc_y"))
+            data[anc_id]['z'] = float(regex_match.group("anc_z"))
+            data[anc_id]['dist_to'] = float(regex_match.group("dist_to"))
+            num_anc += 1
+        data['anc_num'] = num_anc
+        data['all_anc_id'] = all_anc_id
+        pos_match = re.search("(?<=POS[,])"
+                                "(?P<pos_x>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_y>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_z>[-+]?[0-9]*[.][0-9]{2})[,]"
+                                "(?P<pos_qf>[0-9]*)", raw_string)
+        if pos_match:
+            data['est_pos'] = {}
+            data['est_pos']['x'] = float(pos_match.group("pos_x"))
+            data['est_pos']['y'] = float(pos_match.group("pos_y"))
+            data['est_pos']['z'] = float(pos_match.group("pos_z"))
+            data['est_pos_qf'] = int(pos_match.group("pos_qf"))
+        return data
+
+    def legacy_make_json_dict_accel_en(raw_string):
+        data = {}
+        anc_match_iter = re.finditer(   "(?<=\[AN)(?P<anc_idx>[0-9]{1})[,]"
+                                        "(?P<anc_id>.{4})[,]"
+                                        "(?P<anc_x>[+-]?[0-9]*)[,]"
+                                        "(?P<anc_y>[+-]?[0-9]*)[,]"
+                                        "(?P<anc_z>[+-]?[0-9]*)(\]\=\[)"
+                                        "(?P<dist_to>[+-]?[0-9]*)[,]"
+                                        "(?P<anc_qf>[+-]?[0-9]*)(\]\;)", raw_string)
+        all_anc_id = []
+        num_anc = 0
+        for regex_match in anc_match_iter:
+            anc_id = regex_match.group("anc_id")
+            all_anc_id.append(anc_id)
+            data[anc_id] = {}
+            data[anc_id]['anc_id'] = anc_id
+            data[anc_id]['x'] = int(regex_match.group("anc_x"))
+            data[anc_id]['y'] = int(regex_match.group("anc_y"))
+            data[anc_id]['z'] = int(regex_match.group("anc_z"))
+            data[anc_id]['dist_to'] = int(regex_match.group("dist_to"))
+            data[anc_id]['anc_qf'] = int(regex_match.group("anc_qf"))
+            num_anc += 1
+        data['anc_num'] = num_anc
+        data['all_anc_id'] = all_anc_id
+        pos_match = re.search("(?<=POS=\[)"
+                              "(?P<pos_x>[-+]?[0-9]*)[,]"
+                              "(?P<pos_y>[-+]?[0-9]*)[,]"
+                              "(?P<pos_z>[-+]?[0-9]*)[,]"
+                              "(?P<pos_qf>[-+]?[0-9]*)(\]\;)", raw_string)
+        if pos_match:
+            data['est_pos'] = {}
+            data['est_pos']['x'] = int(pos_match.group("pos_x"))
+            data['est_pos']['y'] = int(pos_match.group("pos_y"))
+            data['est_pos']['z'] = int(pos_match.group("pos_z"))
+            data['est_pos_qf'] = int(pos_match.group("pos_qf"))
+        acc_match = re.search("(?<=ACC=\[)"
+                              "(?P<acc_x>[-+]?[0-9]*)[,]"
+                              "(?P<acc_y>[-+]?[0-9]*)[,]"
+                              "(?P<acc_z>[-+]?[0-9]*)(\]\;)", raw_string)
+        if acc_match:
+            data['acc'] = {}
+            data['acc']['x'] = int(acc_match.group("acc_x"))
+            data['acc']['y'] = int(acc_match.group("acc_y"))
+            data['acc']['z'] = int(acc_match.group("acc_z"))
+        timestamp_match = re.search("(?<=UWBLOCALTIME)[,](?P<timestamp>[-+]?[0-9]*)[;]", raw_string)
+        if timestamp_match:
+            data['timestamp'] = int(timestamp_match.group("timestamp"))
+        return data
+
+    # Sample strings of the utils.py __main__ block and docstrings
+    oem_samples = ["DIST,4,AN0,0090,0.00,0.00,0.00,-3.25,AN1,D91E,0.00,0.00,0.00,3.33,AN2,0487,0.00,0.00,0.00,0.18,AN3,15BA,0.00,0,AN3,15BA,0.00,0.00,0.00,0.00",
+                   "DIST,4,AN0,0090,0.00,0.00,0.00,-3.25,AN1,D91E,-0.00,0.00,0.00,3.33,AN2,0487,0.00,0.00,0.00,0.18,AN3,15BA,0.00,0,AN3,15BA,0.00,0.00,0.00,0.00,POS,6.95,5.37,-1.97,52",
+                   "DIST,4,AN0,022E,7.94,8.03,0.00,3.44,AN1,9280,7.95,0.00,0.00,5.68,AN2,DCAE,0.00,8.03,0.00,7.76,AN3,5431,0.00,0.00,0.00,8.73,POS,6.95,5.37,-1.97,52",
+                   "DIST,2,AN0,0\u00e9AB,1.00,2.00,3.00,4.00,AN1,0\u00e9A,1.00,2.00,3.00,4.00"]
+    accel_en_samples = ["DIST,4;[AN0,C584,160,0,-1510]=[1176,100];[AN1,8287,-2700,0,1340]=[2801,100];[AN2,DA36,400,3250,790]=[2838,100];[AN3,9234,2910,-2984,550]=[3058,100];POS=[502,827,803,58];ACC=[-512,768,9449];UWBLOCALTIME,38439537;",
+                        "DIST,4;[AN0,8D38,35783168,5111808,20972734]=[4717,100];[AN1,1912,15860225,9568257,12256446]=[2805,100];[AN2,45BA,1900800,7798784,18417164]=[8559,100];[AN3,0B8A,76480776,7012352,19531278]=[12215,100];ACC=[17696,-1056,-352,19531278]=[13834,100];ACC=[16288,48,-80];UWBLOCALTIME,1207183493;",
+                        "DIST,2;[AN0,8D38,35783168,5111808,20972734]=[4717,100];[AN1,19",
+                        "DIST,2;[AN0,8D38,35783168,5111808,20972734]=[4717,100];[AN1,19;12,1,2,3]=[4,5];POS=[1,2,3,4];POS=[5,6,7,8];",
+                        "DIST,4;[AN0,C584,160,0,-1510]=[1176,100];POS=[502,827,803,5-8];ACC=[-512,768,9449];UWBLOCALTIME,38439537;",
+                        "DIST,4;[AN0,C584,160,0,-1510]=[1176,100];POS=[502,827,803,5-8];POS=[501,826,802,57];UWBLOCALTIME,38439537;"]
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log) as f:
+        accel_en_log_lines = [line.split(" end reporting raw data: ")[1].rstrip() for line in f if " end reporting raw data: " in line]
+
+    for samples, oem_firmware, legacy_parser in ((oem_samples, True, legacy_make_json_dict_oem),
+                                                 (accel_en_samples + accel_en_log_lines, False, legacy_make_json_dict_accel_en)):
+        for raw_string in samples:
+            raw_bytes = (raw_string + "\r\n").encode("utf-8")
+            assert parse_dist_report(raw_bytes, oem_firmware).to_dict() == legacy_parser(raw_string), raw_string
+            assert parse_dist_report(raw_string, oem_firmware).to_dict() == legacy_parser(raw_string), raw_string
+    print("Parsed identically to the regular expressions: {} OEM, {} accel-enabled reports. Parsing paths: {}"
+          .format(len(oem_samples), len(accel_en_samples) + len(accel_en_log_lines), PARSE_STATS))
+
+    number = 2000
+    for name, samples, oem_firmware, legacy_parser in (("OEM firmware", oem_samples[:3], True, legacy_make_json_dict_oem),
+                                                       ("accel-enabled firmware", accel_en_samples[:2], False, legacy_make_json_dict_accel_en),
+                                                       ("accel-enabled field test log", accel_en_log_lines[:200], False, legacy_make_json_dict_accel_en)):
+        raw_bytes_samples = [(raw_string + "\r\n").encode("utf-8") for raw_string in samples]
+        t_legacy = timeit.timeit(lambda: [legacy_parser(str(b, encoding="UTF-8").rstrip()) for b in raw_bytes_samples], number=number // len(samples) + 1)
+        t_record = timeit.timeit(lambda: [parse_dist_report(b, oem_firmware) for b in raw_bytes_samples], number=number // len(samples) + 1)
+        t_dict = timeit.timeit(lambda: [parse_dist_report(b, oem_firmware).to_dict() for b in raw_bytes_samples], number=number // len(samples) + 1)
+        n_lines = (number // len(samples) + 1) * len(samples)
+        print("{:<30} regex: {:>9.0f} lines/s | bytes record: {:>9.0f} lines/s ({:.1f}x) | bytes + dict: {:>9.0f} lines/s ({:.1f}x)"
+              .format(name, n_lines / t_legacy, n_lines / t_record, t_legacy / t_record, n_lines / t_dict, t_legacy / t_dict))
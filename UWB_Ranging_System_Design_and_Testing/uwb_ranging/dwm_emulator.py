@@ -0,0 +1,941 @@
+#!/usr/bin/python3
+
+import sys, os, time, math, pty, tty, random, struct, argparse, threading, selectors
+from utils import timestamp_log, encode_info_pos_to_label
+from slave_info_codec import encode_slave_info_fields
+from dist_parser import AnchorReading, DistReport
+from report_source import encode_loc_get_response
+
+
+# This file contains the DWM1001 device emulator of the ranging unit (Linux/POSIX only).
+# Every emulated device is a pseudo terminal pair: the ranging programs open the slave side
+# (e.g. /dev/pts/5) as the serial port of a DWM1001-Dev board, the emulator serves the master side.
+# Devices boot in the UART API (TLV) mode, as the real boards:
+#   - two "Enter" (CR) within SHELL_ENTER_WINDOW seconds switch to the shell mode, "quit" switches back;
+#   - shell mode: characters are echoed (characters typed faster than min_char_gap are lost), the
+#     commands used by the ranging unit are implemented: si, aurs, av, lec, lep, acts (and quit, help);
+#   - UART API mode: the TLV requests of ../tag_mqtt_publisher/DWM1001.py (error frame 0x40 first).
+# Every virtual vehicle carries two masters (tags, informative position in the label, see
+# utils.decode_info_pos_from_label) and two slaves (anchors, informative position in the anchor
+# position fields, see slave_info_codec.py), one of each at the A and the B end.
+# Vehicles move along the world X axis at constant speed. Masters in shell mode report the
+# distances to the nearest slaves of all the vehicles (their own ones included) as DIST lines,
+# at the "aurs" update rate (the stationary rate when the vehicle does not move):
+#   dwm-accelerometer-enabled firmware:  DIST,2;[AN0,8D38,x,y,z]=[dist,qf];...;ACC=[ax,ay,az];UWBLOCALTIME,us;
+#   OEM PANS firmware ("lec"):           DIST,2,AN0,8D38,x.xx,y.yy,z.zz,d.dd,...
+# Reports can be impaired for load tests: Gaussian noise, outliers, zero distances (dropouts),
+# convoluted frames (a spliced segment, as seen at high update rates, see dist_parser.py) and
+# truncated frames. period_scale < 1 reports faster than the firmware can (aurs 1 1 is 100 ms).
+# A single selector thread serves all the devices; output the reader does not consume in time is
+# dropped (counted), as the UART of the boards would.
+# Boards can be unplugged and plugged in again (unplug(), replug()): the tty device disappears, and
+# the board comes back on a new one in its power-on state (hot-plug tests, port_supervisor.py).
+# Run the emulator (prints the tty device of each emulated board):
+#   python3 dwm_emulator.py [--vehicles N] [--period-scale 0.1] [--noise 30] [--convoluted-rate 0.01] ...
+# Ranging against the emulated boards: python3 uwb_master.py --tty /dev/pts/5 --tty /dev/pts/6 ...
+
+FW_VER, CFG_VER, HW_VER = 0x01030001, 0x00010700, 0xDECA002A
+PANID = 0x6D14
+SHELL_BANNER = (b"\r\nDWM1001 TWR Real Time Location System\r\n\r\nCopyright :  2016-2019 LEAPS and Decawave\r\n"
+                b"License   :  Please visit https://decawave.com/dwm1001_license\r\nCompiled  :  emulated\r\n\r\n"
+                b"Help      :  ? or help\r\n\r\n")
+SHELL_PROMPT = b"dwm> "
+SHELL_COMMANDS = ("?", "help", "si", "aurs", "av", "lec", "lep", "acts", "quit")
+SHELL_ENTER_WINDOW = 1.0        # Seconds between the two "Enter" switching the API mode to the shell mode
+SHELL_MAX_LINE = 128            # Characters of a shell command line
+TLV_FRAME_TIMEOUT = 0.5         # Seconds after which an incomplete TLV request is discarded
+TLV_ERR_OK, TLV_ERR_UNKNOWN, TLV_ERR_PARAM, TLV_ERR_NOT_PERMITTED = 0, 1, 3, 5
+TLV_ANCHOR_LIST_PAGE = 15       # Anchors per dwm_anchor_list_get page (1 + 16 * 15 bytes)
+GPIO_AVAILABLE = (2, 8, 9, 10, 12, 13, 14, 15, 22, 23, 27, 30, 31)
+UPD_RATE_UNIT = 0.1             # Seconds per "aurs"/dwm_upd_rate_set unit
+DEFAULT_UPD_RATE = (1, 1)       # "aurs 1 1" of the last ranging session, stored in the flash of the masters
+ANCHOR_UPD_RATE_STAT = 120
+SIDE_A, SIDE_B = 2, 1
+MASTER_OFFSET = (2400, -1470, 1890)     # Master position (mm) from its vehicle end: inward, lateral, height
+SLAVE_OFFSET = (290, 1190, 2810)        # Slave position (mm) from its vehicle end
+VEHICLE_LENGTH = 15500          # mm
+MAX_RANGE = 60000               # mm, slaves farther away are not ranged
+ACC_GRAVITY = (16300, -1000, -350)      # Raw accelerometer reading at rest, as in the field test logs
+EMULATOR_POLL = 0.1             # Max seconds between two scheduling rounds of the selector thread
+EMULATOR_READ_SIZE = 4096
+
+
+class VirtualVehicle():
+
+    # Rigid vehicle moving along the world X axis. position: world X (mm) of its A end at the
+    # start of the emulation, speed in mm/s (negative: toward -X), direction +1 if the A end faces +X.
+    def __init__(self, id_assoc, position=0.0, speed=0.0, length=VEHICLE_LENGTH, lane=0.0, direction=1,
+                 master_offset=MASTER_OFFSET, slave_offset=SLAVE_OFFSET):
+        self.id_assoc = id_assoc
+        self.position = position
+        self.speed = speed
+        self.length = length
+        self.lane = lane
+        self.direction = direction
+        self.master_offset = master_offset
+        self.slave_offset = slave_offset
+
+    def moving(self):
+        return self.speed != 0
+
+    def world_position(self, side, offset, t):
+        """ World position (mm) of a device at the given end (side code) and offset from the end, t seconds
+            after the start of the emulation
+
+            :returns:
+                (x, y, z)
+        """
+        inward = offset[0] if side == SIDE_A else self.length - offset[0]
+        return (self.position + self.speed * t - self.direction * inward, self.lane + offset[1], offset[2])
+
+
+def make_fleet(n, spacing=10000, speed=0.0, length=VEHICLE_LENGTH):
+    """ n vehicles in a row on the same track, A ends facing +X, spacing (mm) between the B end of a
+        vehicle and the A end of the next one. The first vehicle (id_assoc 1) is the ego vehicle.
+
+        :returns:
+            list of VirtualVehicle
+    """
+    return [VirtualVehicle(i + 1, position=-i * (length + spacing), speed=speed, length=length) for i in range(n)]
+
+
+class EmulatedDwm():
+
+    # One emulated DWM1001-Dev board: its pseudo terminal, shell and UART API state
+    def __init__(self, emulator, vehicle, role, side, addr):
+        self.emulator = emulator
+        self.vehicle = vehicle
+        self.role = role                # "tag" (master) or "anchor" (slave)
+        self.side = side
+        self.addr = addr                # 64-bit UWB address
+        self.short_id = "{:04X}".format(addr & 0xFFFF)
+        self.offset = vehicle.master_offset if role == "tag" else vehicle.slave_offset
+        if role == "tag":
+            self.label = encode_info_pos_to_label({"x_master": self.offset[0], "y_master": self.offset[1],
+                                                   "z_master": self.offset[2], "vehicle_length_master": vehicle.length,
+                                                   "id_assoc": vehicle.id_assoc, "side_master": side})
+            self.anchor_fields = None
+        else:
+            self.label = "DW" + self.short_id
+            # The slave firmware reports its informative position as its anchor position
+            self.anchor_fields = encode_slave_info_fields(*self.offset, vehicle.length, vehicle.id_assoc, side)
+        self.ble_addr = bytes((addr >> (8 * i)) & 0xFF for i in range(6))
+        self.plug()
+
+    def plug(self):
+        """ Connect the board: a new pseudo terminal (tty device), power-on state
+        """
+        self.fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.fd, False)
+        self.tty_device = os.ttyname(self.slave_fd)
+        self.boot(time.monotonic())
+
+    def boot(self, now):
+        """ Power-on state: UART API mode, configuration from the flash
+        """
+        self.t_boot = now
+        self.shell = False
+        self.line = bytearray()
+        self.last_char = 0.0
+        self.last_enter = None
+        self.frame = bytearray()
+        self.frame_start = 0.0
+        self.upd_rate = list(DEFAULT_UPD_RATE) if self.role == "tag" else [ANCHOR_UPD_RATE_STAT, ANCHOR_UPD_RATE_STAT]
+        # The accelerometer-enabled firmware reports in the shell mode, the OEM firmware after "lec"
+        self.report_dist = not self.emulator.oem_firmware
+        self.report_pos = False
+        self.loc_engine = self.emulator.location_engine
+        self.loc_ready = False
+        self.next_report = now
+        self.prev_segments = None
+        self.cfg = bytes([0x5B, 0x04]) if self.role == "tag" else bytes([0x1B, 0x30])
+        self.stnry_sensitivity = 1
+        self.int_cfg = bytes(2)
+        self.uwb_cfg = bytes(10)
+        self.gpio = {}
+        self.panid = PANID
+        self.enc = False
+        self.pos_default = (tuple(self.anchor_fields) if self.anchor_fields else (0, 0, 0)) + (100,)
+
+    def close(self):
+        """ Disconnect the board: the reader of the tty device gets an error (USB unplugged)
+        """
+        for fd in (self.fd, self.slave_fd):
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.fd, self.slave_fd, self.tty_device = None, None, None
+
+    def uptime(self, now):
+        return now - self.t_boot
+
+    def write(self, data):
+        # Non-blocking: bytes the reader leaves in the full pty buffer are lost, as on the UART
+        if self.fd is None:
+            return
+        try:
+            n = os.write(self.fd, data)
+        except (BlockingIOError, OSError):
+            n = 0
+        if n < len(data):
+            self.emulator.stats["dropped_bytes"] += len(data) - n
+
+    def report_period(self):
+        rate = self.upd_rate[0] if self.vehicle.moving() else self.upd_rate[1]
+        return max(rate, 1) * UPD_RATE_UNIT * self.emulator.period_scale
+
+    def on_input(self, data, now):
+        for B in data:
+            if self.shell:
+                self.shell_input(B, now)
+            else:
+                self.api_input(B, now)
+
+    # ---------------------------------- shell mode ----------------------------------
+
+    def shell_input(self, B, now):
+        too_fast = now - self.last_char < self.emulator.min_char_gap
+        self.last_char = now
+        if B in (0x0D, 0x0A):
+            self.write(b"\r\n")
+            command, self.line = bytes(self.line).decode("ascii", errors="replace").strip(), bytearray()
+            self.emulator.stats["shell_commands"] += 1
+            output = self.shell_command(command, now)
+            if self.shell:
+                self.write(output + SHELL_PROMPT)
+            return
+        if too_fast:
+            # Lost character: not echoed, not in the command line
+            self.emulator.stats["lost_chars"] += 1
+            return
+        self.write(bytes([B]))
+        if len(self.line) < SHELL_MAX_LINE:
+            self.line.append(B)
+
+    def shell_command(self, command, now):
+        """ :returns:
+                output of the shell command (lines ending with CR LF)
+        """
+        args = command.split()
+        if not args:
+            return b""
+        cmd = args[0]
+        if cmd in ("?", "help"):
+            return ("Usage: " + " ".join(SHELL_COMMANDS) + "\r\n").encode()
+        if cmd == "si":
+            return self.sys_info(now)
+        if cmd == "aurs":
+            try:
+                act, stat = int(args[1]), int(args[2])
+                if not (1 <= act <= 0xFFFF and 1 <= stat <= 0xFFFF):
+                    raise ValueError(args)
+            except (IndexError, ValueError):
+                return b"Usage: aurs <upd_rate> <upd_rate_stat>\r\n"
+            self.set_upd_rate(act, stat, now)
+            return b"aurs: ok\r\n"
+        if cmd == "av":
+            acc = self.emulator.acceleration()
+            return "acc: x = {}, y = {}, z = {}\r\n".format(*acc).encode()
+        if cmd == "lec":
+            self.report_dist = not self.report_dist
+            return b""
+        if cmd == "lep":
+            self.report_pos = not self.report_pos
+            return b""
+        if cmd == "acts":
+            # acts <meas_mode> <stnry_en> <low_power_en> <loc_en> <enc_en> <led_en> <ble_en> <uwb_mode> <fw_upd_en>
+            try:
+                fields = [int(arg) for arg in args[1:]]
+                if len(fields) != 9 or self.role != "tag":
+                    raise ValueError(args)
+            except ValueError:
+                return b"acts: invalid parameter\r\n"
+            self.loc_engine = bool(fields[3])
+            return b"acts: ok\r\n"
+        if cmd == "quit":
+            self.shell = False
+            return b""
+        return "{}: command not found\r\n".format(cmd).encode()
+
+    def sys_info(self, now):
+        if self.role == "tag":
+            mode = "tn (act,twr,np,{})".format("le" if self.loc_engine else "nole")
+            cfg = ("sync=0 fwup=0 ble=1 leds=1 le={} lp=0 stat_det=1 (sens={}) mode=0 upd_rate_norm={} upd_rate_stat={} label={}"
+                   .format(int(self.loc_engine), self.stnry_sensitivity, self.upd_rate[0], self.upd_rate[1], self.label))
+        else:
+            mode = "ani (act,-)"
+            cfg = "sync=0 fwup=0 ble=1 leds=1 init=1 upd_rate_stat={} label={}".format(self.upd_rate[1], self.label)
+        lines = ["sys: fw2 fw_ver=x{:08X} cfg_ver=x{:08X}".format(FW_VER, CFG_VER),
+                 "uwb0: panid=x{:04X} addr=x{:016X}".format(self.panid, self.addr),
+                 "mode: " + mode,
+                 "uwbmac: connected",
+                 "uwbmac: bh disconnected",
+                 "cfg: " + cfg,
+                 "enc: " + ("on" if self.enc else "off"),
+                 "ble: addr=" + ":".join("{:02X}".format(B) for B in reversed(self.ble_addr))]
+        uptime = self.uptime(now)
+        return "".join("[{:010.3f} INF] {}\r\n".format(uptime + 0.01 * (i // 2), line) for i, line in enumerate(lines)).encode()
+
+    def set_upd_rate(self, act, stat, now):
+        self.upd_rate = [act, stat]
+        # The new rate applies from the next measurement on (e.g. "aurs 600 600" pauses at once)
+        self.next_report = now + self.report_period()
+
+    # ---------------------------------- UART API mode ----------------------------------
+
+    def api_input(self, B, now):
+        if self.frame and now - self.frame_start > TLV_FRAME_TIMEOUT:
+            self.frame = bytearray()
+        if not self.frame and B == 0x0D:
+            # No TLV type 0x0D: "Enter", twice to switch to the shell mode
+            if self.last_enter is not None and now - self.last_enter <= SHELL_ENTER_WINDOW:
+                self.shell, self.last_enter, self.line = True, None, bytearray()
+                self.write(SHELL_BANNER + SHELL_PROMPT)
+            else:
+                self.last_enter = now
+            return
+        if not self.frame:
+            self.frame_start = now
+        self.frame.append(B)
+        if len(self.frame) >= 2 and len(self.frame) == 2 + self.frame[1]:
+            request, self.frame = bytes(self.frame), bytearray()
+            self.emulator.stats["tlv_requests"] += 1
+            self.write(self.tlv_request(request[0], request[2:], now))
+
+    def tlv_request(self, tlv_type, value, now):
+        """ :returns:
+                TLV response bytes of the request, starting with the error frame
+        """
+        handler = TLV_HANDLERS.get(tlv_type)
+        if handler is None:
+            return bytes([0x40, 1, TLV_ERR_UNKNOWN])
+        method, length = handler
+        if length is not None and len(value) not in ((length,) if isinstance(length, int) else length):
+            return bytes([0x40, 1, TLV_ERR_PARAM])
+        ret = method(self, value, now)
+        if isinstance(ret, int):
+            return bytes([0x40, 1, ret])
+        return bytes([0x40, 1, TLV_ERR_OK]) + b"".join(bytes([t, len(v)]) + v for t, v in ret)
+
+    def tlv_pos_set(self, value, now):
+        self.pos_default = struct.unpack("<iiiB", value)
+        return []
+
+    def tlv_pos_get(self, value, now):
+        if self.role == "tag":
+            x, y, z = self.emulator.world_position(self, now)
+            return [(0x41, struct.pack("<iiiB", int(x), int(y), int(z), 50))]
+        return [(0x41, struct.pack("<iiiB", *self.pos_default))]
+
+    def tlv_upd_rate_set(self, value, now):
+        act, stat = struct.unpack("<HH", value)
+        if not act or not stat:
+            return TLV_ERR_PARAM
+        self.set_upd_rate(act, stat, now)
+        return []
+
+    def tlv_upd_rate_get(self, value, now):
+        return [(0x45, struct.pack("<HH", *self.upd_rate))]
+
+    def tlv_cfg_tag_set(self, value, now):
+        if self.role != "tag":
+            return TLV_ERR_NOT_PERMITTED
+        self.cfg = value
+        return []
+
+    def tlv_cfg_anchor_set(self, value, now):
+        if self.role != "anchor":
+            return TLV_ERR_NOT_PERMITTED
+        self.cfg = value
+        return []
+
+    def tlv_cfg_get(self, value, now):
+        return [(0x46, self.cfg)]
+
+    def tlv_sleep(self, value, now):
+        # Low power mode is disabled
+        return TLV_ERR_NOT_PERMITTED
+
+    def tlv_anchor_list_get(self, value, now):
+        if self.role != "anchor":
+            return TLV_ERR_NOT_PERMITTED
+        neighbors = [anchor for _, anchor in self.emulator.nearest_anchors(self, now, exclude=self)]
+        page = neighbors[value[0] * TLV_ANCHOR_LIST_PAGE:(value[0] + 1) * TLV_ANCHOR_LIST_PAGE]
+        return [(0x56, bytes([len(page)]) + b"".join(struct.pack("<HiiibB", anchor.addr & 0xFFFF, *anchor.anchor_fields, -78, seat)
+                                                     for seat, anchor in enumerate(page)))]
+
+    def tlv_loc_get(self, value, now):
+        self.loc_ready = False
+        if self.role == "tag":
+            # Error frame, position and distances of the tag mode, as report_source.decode_loc_get_frames() reads them
+            response = encode_loc_get_response(self.emulator.measure(self, now), pos_qf=0)
+            frames, offset = [], 3
+            while offset < len(response):
+                frames.append((response[offset], response[offset + 2:offset + 2 + response[offset + 1]]))
+                offset += 2 + response[offset + 1]
+            return frames
+        return [(0x41, struct.pack("<iiiB", *self.pos_default)), (0x48, bytes([0]))]
+
+    def tlv_baddr_set(self, value, now):
+        self.ble_addr = value
+        return []
+
+    def tlv_baddr_get(self, value, now):
+        return [(0x5F, self.ble_addr)]
+
+    def tlv_stnry_cfg_set(self, value, now):
+        if value[0] > 2:
+            return TLV_ERR_PARAM
+        self.stnry_sensitivity = value[0]
+        return []
+
+    def tlv_stnry_cfg_get(self, value, now):
+        return [(0x4A, bytes([self.stnry_sensitivity]))]
+
+    def tlv_reset(self, value, now):
+        # Answered, then rebooted into the UART API mode
+        self.boot(now)
+        return []
+
+    def tlv_ver_get(self, value, now):
+        return [(0x50, FW_VER.to_bytes(4, "big")), (0x51, CFG_VER.to_bytes(4, "little")), (0x52, HW_VER.to_bytes(4, "little"))]
+
+    def tlv_uwb_cfg_set(self, value, now):
+        self.uwb_cfg = value + value
+        return []
+
+    def tlv_uwb_cfg_get(self, value, now):
+        return [(0x4F, self.uwb_cfg)]
+
+    def tlv_usr_data_read(self, value, now):
+        # No user data is received over UWB
+        return [(0x4B, b"")]
+
+    def tlv_usr_data_write(self, value, now):
+        return []
+
+    def tlv_label_read(self, value, now):
+        return [(0x4C, self.label.encode())]
+
+    def tlv_label_write(self, value, now):
+        self.label = value.decode("ascii", errors="replace")
+        return []
+
+    def tlv_gpio_set(self, value, now):
+        if value[0] not in GPIO_AVAILABLE:
+            return TLV_ERR_PARAM
+        self.gpio[value[0]] = value[1] & 1 if len(value) > 1 else 1 - self.gpio.get(value[0], 0)
+        return []
+
+    def tlv_gpio_value_get(self, value, now):
+        if value[0] not in GPIO_AVAILABLE:
+            return TLV_ERR_PARAM
+        return [(0x55, bytes([self.gpio.get(value[0], 0)]))]
+
+    def tlv_panid_set(self, value, now):
+        self.panid = struct.unpack("<H", value)[0]
+        return []
+
+    def tlv_panid_get(self, value, now):
+        return [(0x4D, struct.pack("<H", self.panid))]
+
+    def tlv_nodeid_get(self, value, now):
+        return [(0x4E, struct.pack("<Q", self.addr))]
+
+    def tlv_status_get(self, value, now):
+        # loc_ready: a new measurement since the last dwm_loc_get; uwbmac_joined. Flags are cleared by the call.
+        status = (1 if self.loc_ready else 0) | 0b10
+        self.loc_ready = False
+        return [(0x5A, struct.pack("<H", status))]
+
+    def tlv_int_cfg_set(self, value, now):
+        self.int_cfg = value
+        return []
+
+    def tlv_int_cfg_get(self, value, now):
+        return [(0x47, self.int_cfg)]
+
+    def tlv_enc_key_set(self, value, now):
+        self.enc = True
+        return []
+
+    def tlv_enc_key_clear(self, value, now):
+        self.enc = False
+        return []
+
+    # ---------------------------------- reporting ----------------------------------
+
+    def report(self, now):
+        """ Measurement at the update rate: DIST (and POS) lines in the shell mode, loc_ready in the API mode
+        """
+        self.loc_ready = True
+        if not self.shell or not (self.report_dist or self.report_pos):
+            return
+        emulator = self.emulator
+        report = emulator.measure(self, now)
+        lines = b""
+        if self.report_dist:
+            segments = emulator.dist_segments(report)
+            prev_segments, self.prev_segments = self.prev_segments, segments
+            separator = b"," if emulator.oem_firmware else b";"
+            if prev_segments and emulator.rng.random() < emulator.convoluted_rate:
+                segments = emulator.convolute(segments, prev_segments)
+                emulator.stats["convoluted"] += 1
+            line = separator.join(segments) + (b"" if emulator.oem_firmware else b";")
+            if emulator.rng.random() < emulator.truncated_rate:
+                line = line[:emulator.rng.randrange(5, len(line))]
+                emulator.stats["truncated"] += 1
+            lines += line + b"\r\n"
+            emulator.stats["frames"] += 1
+        if self.report_pos:
+            x, y, z = emulator.world_position(self, now)
+            lines += "POS,{:.2f},{:.2f},{:.2f},50\r\n".format(x / 1000, y / 1000, z / 1000).encode()
+        self.write(lines)
+
+
+TLV_HANDLERS = {
+    # TLV request type: (handler, length(s) of the request value, None: any)
+    0x01: (EmulatedDwm.tlv_pos_set, 13),
+    0x02: (EmulatedDwm.tlv_pos_get, 0),
+    0x03: (EmulatedDwm.tlv_upd_rate_set, 4),
+    0x04: (EmulatedDwm.tlv_upd_rate_get, 0),
+    0x05: (EmulatedDwm.tlv_cfg_tag_set, 2),
+    0x07: (EmulatedDwm.tlv_cfg_anchor_set, 2),
+    0x08: (EmulatedDwm.tlv_cfg_get, 0),
+    0x0A: (EmulatedDwm.tlv_sleep, 0),
+    0x0B: (EmulatedDwm.tlv_anchor_list_get, 1),
+    0x0C: (EmulatedDwm.tlv_loc_get, 0),
+    0x0F: (EmulatedDwm.tlv_baddr_set, 6),
+    0x10: (EmulatedDwm.tlv_baddr_get, 0),
+    0x11: (EmulatedDwm.tlv_stnry_cfg_set, 1),
+    0x12: (EmulatedDwm.tlv_stnry_cfg_get, 0),
+    0x13: (EmulatedDwm.tlv_reset, 0),     # dwm_factory_reset
+    0x14: (EmulatedDwm.tlv_reset, 0),
+    0x15: (EmulatedDwm.tlv_ver_get, 0),
+    0x17: (EmulatedDwm.tlv_uwb_cfg_set, 5),
+    0x18: (EmulatedDwm.tlv_uwb_cfg_get, 0),
+    0x19: (EmulatedDwm.tlv_usr_data_read, 0),
+    0x1A: (EmulatedDwm.tlv_usr_data_write, range(1, 36)),
+    0x1C: (EmulatedDwm.tlv_label_read, 0),
+    0x1D: (EmulatedDwm.tlv_label_write, range(0, 17)),
+    0x28: (EmulatedDwm.tlv_gpio_set, 2),    # dwm_gpio_cfg_output
+    0x29: (EmulatedDwm.tlv_gpio_set, 2),    # dwm_gpio_cfg_input (pull setting, reads as 0)
+    0x2A: (EmulatedDwm.tlv_gpio_set, 2),
+    0x2B: (EmulatedDwm.tlv_gpio_value_get, 1),
+    0x2C: (EmulatedDwm.tlv_gpio_set, 1),    # dwm_gpio_value_toggle
+    0x2E: (EmulatedDwm.tlv_panid_set, 2),
+    0x2F: (EmulatedDwm.tlv_panid_get, 0),
+    0x30: (EmulatedDwm.tlv_nodeid_get, 0),
+    0x32: (EmulatedDwm.tlv_status_get, 0),
+    0x34: (EmulatedDwm.tlv_int_cfg_set, 2),
+    0x35: (EmulatedDwm.tlv_int_cfg_get, 0),
+    0x3C: (EmulatedDwm.tlv_enc_key_set, 16),
+    0x3D: (EmulatedDwm.tlv_enc_key_clear, None),
+}
+
+
+class DwmEmulator():
+
+    # Pseudo terminal DWM1001 boards of a fleet of virtual vehicles, served by one selector thread
+    def __init__(self, vehicles,
+                 oem_firmware=False,
+                 period_scale=1.0,
+                 noise_sigma=0.0,
+                 outlier_rate=0.0,
+                 outlier_mm=8000,
+                 dropout_rate=0.0,
+                 convoluted_rate=0.0,
+                 truncated_rate=0.0,
+                 max_anchors=4,
+                 max_range=MAX_RANGE,
+                 location_engine=False,
+                 min_char_gap=0.0,
+                 seed=None):
+        self.vehicles = vehicles
+        self.oem_firmware = oem_firmware
+        self.period_scale = period_scale
+        self.noise_sigma = noise_sigma
+        self.outlier_rate = outlier_rate
+        self.outlier_mm = outlier_mm
+        self.dropout_rate = dropout_rate
+        self.convoluted_rate = convoluted_rate
+        self.truncated_rate = truncated_rate
+        self.max_anchors = max_anchors
+        self.max_range = max_range
+        self.location_engine = location_engine
+        self.min_char_gap = min_char_gap
+        self.rng = random.Random(seed)
+        self.stats = {"frames": 0, "convoluted": 0, "truncated": 0, "dropped_bytes": 0, "lost_chars": 0,
+                      "shell_commands": 0, "tlv_requests": 0}
+        self.t_start = time.monotonic()
+        self.devices = []
+        short_ids = set()
+        for vehicle in vehicles:
+            for side in (SIDE_A, SIDE_B):
+                for role in ("tag", "anchor"):
+                    short_id = self.rng.randrange(0x1000, 0x10000)
+                    while short_id in short_ids:
+                        short_id = self.rng.randrange(0x1000, 0x10000)
+                    short_ids.add(short_id)
+                    addr = (0xDECA << 48) | (self.rng.getrandbits(32) << 16) | short_id
+                    self.devices.append(EmulatedDwm(self, vehicle, role, side, addr))
+        self.tags = [dev for dev in self.devices if dev.role == "tag"]
+        self.anchors = [dev for dev in self.devices if dev.role == "anchor"]
+        self._selector = selectors.DefaultSelector()
+        for dev in self.devices:
+            self._selector.register(dev.fd, selectors.EVENT_READ, dev)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="DWM Emulator Thread", daemon=True)
+
+    def tty_devices(self, vehicles=None):
+        """ :returns:
+                tty devices of the boards of the given vehicles (all vehicles by default)
+        """
+        return [dev.tty_device for dev in self.devices
+                if (vehicles is None or dev.vehicle in vehicles) and dev.tty_device is not None]
+
+    def device(self, short_id):
+        return next(dev for dev in self.devices if dev.short_id == short_id)
+
+    def unplug(self, short_id):
+        """ Unplug a board (hot-plug tests): its tty device disappears
+        """
+        dev = self.device(short_id)
+        if dev.fd is not None:
+            self._selector.unregister(dev.fd)
+            dev.close()
+
+    def replug(self, short_id):
+        """ Plug an unplugged board in again, on a new tty device
+        """
+        dev = self.device(short_id)
+        if dev.fd is None:
+            dev.plug()
+            self._selector.register(dev.fd, selectors.EVENT_READ, dev)
+            self.wakeup()
+
+    def wakeup(self):
+        os.write(self._wakeup_w, b"\x00")
+
+    def world_position(self, dev, now):
+        return dev.vehicle.world_position(dev.side, dev.offset, now - self.t_start)
+
+    def true_distance(self, dev_from, dev_to, now=None):
+        now = time.monotonic() if now is None else now
+        return math.dist(self.world_position(dev_from, now), self.world_position(dev_to, now))
+
+    def nearest_anchors(self, dev, now, exclude=None):
+        """ :returns:
+                list of (distance in mm, anchor) within range of the device, nearest first
+        """
+        position = self.world_position(dev, now)
+        in_range = []
+        for anchor in self.anchors:
+            if anchor is exclude:
+                continue
+            d = math.dist(position, self.world_position(anchor, now))
+            if d <= self.max_range:
+                in_range.append((d, anchor))
+        in_range.sort(key=lambda x: x[0])
+        return in_range
+
+    def acceleration(self):
+        return tuple(int(self.rng.gauss(g, 40)) for g in ACC_GRAVITY)
+
+    def measure(self, master, now):
+        """ One ranging round of a master with the nearest slaves, noise and impairments applied
+
+            :returns:
+                DistReport
+        """
+        rng = self.rng
+        anchors = []
+        for d, anchor in self.nearest_anchors(master, now)[:self.max_anchors]:
+            draw = rng.random()
+            if draw < self.dropout_rate:
+                dist_to = 0
+            elif draw < self.dropout_rate + self.outlier_rate:
+                dist_to = max(0, int(d + rng.uniform(-1.0, 1.0) * self.outlier_mm))
+            else:
+                dist_to = max(0, int(round(rng.gauss(d, self.noise_sigma) if self.noise_sigma else d)))
+            if self.oem_firmware:
+                x, y, z = self.world_position(anchor, now)
+                anchors.append(AnchorReading(anchor.short_id, x, y, z, dist_to, None))
+            else:
+                anchors.append(AnchorReading(anchor.short_id, *anchor.anchor_fields, dist_to, 100))
+        report = DistReport(anchors, oem=self.oem_firmware)
+        if master.loc_engine and len(anchors) >= 3:
+            report.est_pos = tuple(int(v) for v in self.world_position(master, now))
+            report.est_pos_qf = 50
+        if not self.oem_firmware:
+            report.acc = self.acceleration()
+            report.uwb_timestamp = int(master.uptime(now) * 1e6)
+        return report
+
+    def dist_segments(self, report):
+        """ :returns:
+                the fields of the DIST line of a report, without separators
+        """
+        n = len(report.anchors)
+        if self.oem_firmware:
+            segments = ["DIST,{}".format(n)]
+            segments += ["AN{},{},{:.2f},{:.2f},{:.2f},{:.2f}".format(i, anc.anc_id, anc.x / 1000, anc.y / 1000, anc.z / 1000,
+                                                                      anc.dist_to / 1000)
+                         for i, anc in enumerate(report.anchors)]
+            if report.est_pos is not None:
+                segments.append("POS,{:.2f},{:.2f},{:.2f},{}".format(*(v / 1000 for v in report.est_pos), report.est_pos_qf))
+        else:
+            segments = ["DIST,{}".format(n)]
+            segments += ["[AN{},{},{},{},{}]=[{},{}]".format(i, *anc) for i, anc in enumerate(report.anchors)]
+            if report.est_pos is not None:
+                segments.append("POS=[{},{},{},{}]".format(*report.est_pos, report.est_pos_qf))
+            segments.append("ACC=[{},{},{}]".format(*report.acc))
+            segments.append("UWBLOCALTIME,{}".format(report.uwb_timestamp))
+        return [segment.encode() for segment in segments]
+
+    def convolute(self, segments, prev_segments):
+        """ Splice the head of a segment of the previous report with the tail of another segment into
+            the report, e.g. ...;ACC=[17696,-1056,-352,19531278]=[13834,100];ACC=[16288,48,-80];...
+
+            :returns:
+                list of segments
+        """
+        rng = self.rng
+        head = rng.choice(prev_segments[1:] or prev_segments)
+        tail = rng.choice(segments[1:] or segments)
+        junk = head[:rng.randrange(1, len(head) + 1)] + tail[rng.randrange(0, len(tail)):]
+        idx = rng.randrange(1, len(segments) + 1)
+        return segments[:idx] + [junk] + segments[idx:]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        os.write(self._wakeup_w, b"\x00")
+        if self._thread.is_alive():
+            self._thread.join()
+        self._selector.close()
+        for dev in self.devices:
+            dev.close()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            os.close(fd)
+
+    def run(self):
+        """ Selector loop: device input (shell characters, TLV requests) and the scheduled reports
+        """
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            next_due = min((dev.next_report for dev in self.tags if dev.fd is not None), default=now + EMULATOR_POLL)
+            for key, _ in self._selector.select(min(max(next_due - now, 0.0), EMULATOR_POLL)):
+                if key.data is None:
+                    os.read(self._wakeup_r, 512)
+                    continue
+                try:
+                    data = os.read(key.fd, EMULATOR_READ_SIZE)
+                except (BlockingIOError, OSError):
+                    continue
+                key.data.on_input(data, time.monotonic())
+            now = time.monotonic()
+            for dev in self.tags:
+                if dev.fd is not None and dev.next_report <= now:
+                    period = dev.report_period()
+                    # No burst to catch up after a stall: the next measurement is a period ahead
+                    dev.next_report = max(dev.next_report + period, now)
+                    dev.report(now)
+
+    def describe(self):
+        """ :returns:
+                one line per emulated board: tty device, role, vehicle, end and address
+        """
+        return "\n".join("{} {:6s} vehicle {} end {} addr {} label {}".format(
+                            dev.tty_device, "master" if dev.role == "tag" else "slave", dev.vehicle.id_assoc,
+                            "A" if dev.side == SIDE_A else "B", dev.short_id, dev.label)
+                         for dev in self.devices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the DWM1001 boards of virtual vehicles on pseudo terminals")
+    parser.add_argument("--vehicles", type=int, default=2, help="number of vehicles, 4 boards each (default: %(default)s)")
+    parser.add_argument("--spacing", type=float, default=10000, help="gap between the vehicles in mm (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=0.0, help="speed of the vehicles in mm/s (default: %(default)s)")
+    parser.add_argument("--oem", action="store_true", help="OEM PANS firmware reports instead of the accelerometer-enabled firmware")
+    parser.add_argument("--period-scale", type=float, default=1.0,
+                        help="report period factor, 0.1: 10 times the update rate set by aurs (default: %(default)s)")
+    parser.add_argument("--noise", type=float, default=30.0, help="distance noise sigma in mm (default: %(default)s)")
+    parser.add_argument("--outlier-rate", type=float, default=0.0, help="share of outlier distances (default: %(default)s)")
+    parser.add_argument("--dropout-rate", type=float, default=0.0, help="share of zero distances (default: %(default)s)")
+    parser.add_argument("--convoluted-rate", type=float, default=0.0, help="share of convoluted DIST lines (default: %(default)s)")
+    parser.add_argument("--truncated-rate", type=float, default=0.0, help="share of truncated DIST lines (default: %(default)s)")
+    parser.add_argument("--max-anchors", type=int, default=4, help="slaves ranged per report (default: %(default)s)")
+    parser.add_argument("--char-gap", type=float, default=0.0,
+                        help="seconds, shell characters typed faster are lost (default: %(default)s)")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args()
+    emulator = DwmEmulator(make_fleet(args.vehicles, args.spacing, args.speed), oem_firmware=args.oem,
+                           period_scale=args.period_scale, noise_sigma=args.noise, outlier_rate=args.outlier_rate,
+                           dropout_rate=args.dropout_rate, convoluted_rate=args.convoluted_rate,
+                           truncated_rate=args.truncated_rate, max_anchors=args.max_anchors,
+                           min_char_gap=args.char_gap, seed=args.seed).start()
+    sys.stdout.write(emulator.describe() + "\n")
+    sys.stdout.write(timestamp_log() + "DWM1001 emulator running, Ctrl+C to stop\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    sys.stdout.write(timestamp_log() + "DWM1001 emulator stopped: {}\n".format(emulator.stats))
+
+
+if __name__ == "__main__":
+    # Run: python3 dwm_emulator.py [--vehicles N] ...
+    if len(sys.argv) > 1:
+        main()
+        sys.exit(0)
+    # Unit Testing:
+    #   1. pairing of the four boards of the ego vehicle (shell: si, aurs, av) and the multiplexed
+    #      ranging job against the ground truth distances;
+    #   2. the TLV API of DWM1001.py (after "quit"), and the TLV report source;
+    #   3. load test: concurrent pairing of a fleet, then fast and impaired DIST streams through the parser.
+    import io, queue, tempfile
+    import serial
+    from utils import pairing_uwb_ports, decode_info_pos_from_label
+    from serial_mux import end_ranging_job_multiplexed
+    from dist_parser import parse_dist_report, PARSE_STATS
+    from report_source import TlvLocSource, DWM1001
+
+    vehicles = make_fleet(2, spacing=8000)
+    emulator = DwmEmulator(vehicles, seed=1).start()
+    ego = [dev for dev in emulator.devices if dev.vehicle is vehicles[0]]
+    serial_ports, startup_report = {}, {}
+    sys.stdout, log_out = io.StringIO(), sys.stdout
+    ret = pairing_uwb_ports(serial_ports_dict=serial_ports, startup_report=startup_report,
+                            serial_tty_devices=emulator.tty_devices(vehicles[:1]))
+    sys.stdout = log_out
+    assert ret == 1, ret
+    assert sorted(serial_ports) == sorted(dev.short_id for dev in ego)
+    for dev in ego:
+        entry = serial_ports[dev.short_id]
+        assert entry["sys_info"]["label"] == dev.label
+        if dev.role == "tag":
+            assert entry["config"] == "master" and entry["info_pos"]["side_master"] == dev.side
+            assert entry["info_pos"] == dict(decode_info_pos_from_label(dev.label), master_id=dev.short_id)
+            assert entry["info_pos"]["x_master"] == MASTER_OFFSET[0]
+        else:
+            assert entry["config"] == "slave" and entry["sys_info"]["uwb_mode"] == "ani (act,-)"
+    print("ego vehicle paired in {:.2f} s ({} shell commands)".format(startup_report["total"], emulator.stats["shell_commands"]))
+
+    # Ranging: the foreign slaves reported to the ego masters are at their true distances
+    data_ptr_queues = {SIDE_A: queue.Queue(), SIDE_B: queue.Queue()}
+    stop = threading.Event()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sys.stdout = io.StringIO()
+        job = threading.Thread(target=end_ranging_job_multiplexed,
+                               kwargs={"serial_ports": serial_ports, "data_ptr_queues": data_ptr_queues,
+                                       "log_fpath": tmp_dir, "stop_flag_callback": stop.is_set, "exp_name": "emulated"},
+                               daemon=True)
+        job.start()
+        time.sleep(3.0)
+        stop.set()
+        job.join(5.0)
+        sys.stdout = log_out
+    frames = 0
+    for side, q in data_ptr_queues.items():
+        master = next(dev for dev in ego if dev.role == "tag" and dev.side == side)
+        while not q.empty():
+            uwb_reporting_dict, foreign_slaves = q.get()
+            frames += 1
+            assert len(uwb_reporting_dict["all_anc_id"]) == 4
+            for slave in foreign_slaves:
+                anchor = emulator.device(slave["slave_id"])
+                assert anchor.vehicle is vehicles[1] and slave["id_assoc"] == 2 and slave["side_slave"] == anchor.side
+                assert abs(slave["dist_to"] - emulator.true_distance(master, anchor)) < 2
+    assert frames >= 30, frames
+    print("{} frames of the two ego masters, foreign slaves at their true distances".format(frames))
+
+    # TLV API: leave the shell mode of a master, as the TLV report source does
+    tag = ego[0]
+    port = serial_ports[tag.short_id]["port"]
+    source = TlvLocSource(port)
+    source.start()
+    report, data_raw = source.read_frame()
+    assert report is not None and len(report.anchors) == 4, data_raw
+    assert DWM1001.dwm_upd_rate_get(port)[:2] == [100, 100]
+    DWM1001.dwm_upd_rate_set(port, 5, 20)
+    assert DWM1001.dwm_upd_rate_get(port)[:2] == [500, 2000]
+    assert DWM1001.dwm_label_read(port)[0] == tag.label[-6:].encode()
+    assert DWM1001.dwm_nodeid_get(port)[0] == tag.addr
+    assert DWM1001.dwm_panid_get(port)[0] == PANID
+    assert DWM1001.dwm_ver_get(port)[0]["fw_version"] == {"maj": 1, "min": 3, "patch": 0, "res": 0, "var": 1}
+    pos, anchors, node_mode, err_code = DWM1001.dwm_loc_get(port)
+    assert node_mode == 0 and [a["addr"] for a in anchors] == [anc.anc_id for anc in report.anchors]
+    assert DWM1001.dwm_status_get(port)[0]["uwbmac_joined"]
+    DWM1001.dwm_gpio_value_set(port, 13, 1)
+    assert DWM1001.dwm_gpio_value_get(port, 13)[0] == 1
+    try:
+        DWM1001.dwm_anchor_list_get(port)
+        raise AssertionError("no error raised")
+    except ValueError:
+        pass
+    anchor_port = serial_ports[next(dev for dev in ego if dev.role == "anchor").short_id]["port"]
+    anchor_port.write(b"quit\r")
+    time.sleep(0.2)
+    anchor_list = DWM1001.dwm_anchor_list_get(anchor_port)[0]
+    assert len(anchor_list) == 3 and all(a["addr"] in [dev.short_id for dev in emulator.anchors] for a in anchor_list)
+    print("TLV API: {} requests answered".format(emulator.stats["tlv_requests"]))
+    for entry in serial_ports.values():
+        entry["port"].close()
+    emulator.stop()
+
+    # Load test: concurrent pairing of the boards of many vehicles
+    vehicles = make_fleet(10, spacing=5000, speed=2000)
+    emulator = DwmEmulator(vehicles, period_scale=0.05, noise_sigma=30, outlier_rate=0.01, dropout_rate=0.01,
+                           convoluted_rate=0.05, truncated_rate=0.02, seed=2).start()
+    serial_ports, startup_report = {}, {}
+    sys.stdout = io.StringIO()
+    ret = pairing_uwb_ports(serial_ports_dict=serial_ports, startup_report=startup_report,
+                            serial_tty_devices=emulator.tty_devices())
+    sys.stdout = log_out
+    assert ret == 1 and len(serial_ports) == 40, ret
+    slowest = max(port_report["total"] for port_report in startup_report["ports"].values())
+    print("{} boards paired concurrently in {:.2f} s (slowest port {:.2f} s)".format(len(serial_ports), startup_report["total"], slowest))
+
+    # Fast, impaired DIST streams of all the masters (200 Hz each) through the parser
+    masters = [entry["port"] for entry in serial_ports.values() if entry["config"] == "master"]
+    for p in masters:
+        p.reset_input_buffer()
+    stats_before, t_0 = dict(emulator.stats), time.monotonic()
+    received = {p: bytearray() for p in masters}
+    while time.monotonic() - t_0 < 2.0:
+        for p in masters:
+            received[p].extend(p.read(p.in_waiting))
+        time.sleep(0.005)
+    elapsed = time.monotonic() - t_0
+    lines = [line.rstrip() for data in received.values() for line in bytes(data).split(b"\n")[1:-1]]
+    fallback_before = PARSE_STATS["regex_fallback"]
+    # Convoluted anchor segments with an empty number (e.g. "...,1901056,,18548238]=[...") are matched by
+    # the original expressions and fail in int(): ValueError, as the original parser
+    failures = 0
+    for line in lines:
+        try:
+            parse_dist_report(line)
+        except ValueError:
+            failures += 1
+    assert len(lines) > 0.8 * len(masters) * elapsed / (UPD_RATE_UNIT * 0.05), len(lines)
+    print("{} DIST lines/s from {} masters parsed ({} convoluted, {} truncated, {} dropped bytes): "
+          "{} regex fallbacks, {} unparseable".format(int(len(lines) / elapsed), len(masters),
+                                                      emulator.stats["convoluted"] - stats_before["convoluted"],
+                                                      emulator.stats["truncated"] - stats_before["truncated"],
+                                                      emulator.stats["dropped_bytes"] - stats_before["dropped_bytes"],
+                                                      PARSE_STATS["regex_fallback"] - fallback_before, failures))
+    for entry in serial_ports.values():
+        entry["port"].close()
+    emulator.stop()
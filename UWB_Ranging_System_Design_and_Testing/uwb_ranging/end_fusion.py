@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+
+import time, threading, queue, collections
+from utils import RX_STAMP_KEY
+from data_mailbox import LatestValueMailbox
+
+
+# This file contains the A/B end fusion stage between the end ranging jobs (producers) and the
+# consumers running the near side and adjusted distance processing (GUI, headless service).
+# The A and B masters report asynchronously, each at most at 10 Hz. Instead of combining whatever
+# the latest frames of both ends happen to be, EndFusionBuffer:
+#   - keeps a short history of the frames of each end, stamped at reception (RX_STAMP_KEY)
+#   - pairs A and B frames one to one by nearest reception time, within a tolerance
+#   - interpolates the slave distances of the earlier frame of a pair to the reception time of the
+#     later one (the common instant), from the next frame of the same end if it already arrived,
+#     extrapolated from the previous frame otherwise
+#   - hands the fused pairs over in a LatestValueMailbox, with skew and pairing latency statistics
+# A pair is emitted as soon as no frame still to come can be nearer: at the reception of the later
+# frame in the steady state (reporting periods of both ends estimated from the history).
+# LatestPairSource is the unaligned alternative: the latest frame of each end, as the GUI used to do.
+# Both have get(block=False) returning an (a_data_point, b_data_point) pair or raising queue.Empty.
+
+A_END_CODE, B_END_CODE = 2, 1
+FUSION_TOLERANCE = 0.05         # Seconds: maximum reception time skew of a pair (half the 10 Hz reporting period)
+FUSION_HISTORY = 8              # Frames kept per end for the interpolation
+FUSION_MAX_GAP = 0.5            # Seconds: frames further apart are not interpolated between (missed reports)
+FUSED_STAMP_KEY = 'fusedMonotonicNs'    # Common instant (time.monotonic_ns()) of a fused pair
+
+
+class RunningStat():
+
+    # Count, mean, maximum and last value of a series, in constant memory
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.last = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self, scale=1.0):
+        return {"count": self.count, "mean": self.mean * scale, "max": self.max * scale, "last": self.last * scale}
+
+
+def interpolate_slaves(slaves, t_ns, ref_frames, target_t_ns):
+    """ Linearly interpolate (or extrapolate) the distances of the decoded slaves of a frame at t_ns
+        to target_t_ns. Each slave is interpolated with the first reference frame of the same end
+        reporting it; slaves reported in none keep their distance.
+        ref_frames: (t_ref_ns, decoded slaves) of the other frames, in order of preference
+
+        :returns:
+            (new list of slave dictionaries nearest slave first, number of interpolated, number of extrapolated)
+    """
+    interpolated, extrapolated = 0, 0
+    aligned = []
+    for slave in slaves:
+        slave = slave.copy()
+        dist, slave_id = slave.get("dist_to"), slave.get("slave_id")
+        for t_ref, ref_slaves in ref_frames:
+            dist_ref = next((ref.get("dist_to") for ref in ref_slaves if ref.get("slave_id") == slave_id), None)
+            if dist is not None and dist_ref is not None:
+                slave["dist_to"] = int(round(dist + (dist_ref - dist) * (target_t_ns - t_ns) / (t_ref - t_ns)))
+                if t_ref > t_ns:
+                    interpolated += 1
+                else:
+                    extrapolated += 1
+                break
+        aligned.append(slave)
+    aligned.sort(key=lambda x: x.get("dist_to", float("inf")))
+    return aligned, interpolated, extrapolated
+
+
+class EndQueue():
+
+    # put() interface of one end for its end reporting job, feeding the fusion buffer
+    def __init__(self, fusion, end_side_code):
+        self.fusion = fusion
+        self.end_side_code = end_side_code
+
+    def put(self, data_point, block=True, timeout=None):
+        self.fusion.put_frame(self.end_side_code, data_point)
+
+    def put_nowait(self, data_point):
+        self.put(data_point)
+
+
+class EndFusionBuffer():
+
+    # Timestamp-aligned pairing of the A/B end frames
+    # notify: optional Event set on every fused pair (see LatestValueMailbox)
+    # clock: monotonic clock in ns, replaceable for the replay of logged frames
+    def __init__(self, tolerance=FUSION_TOLERANCE, history=FUSION_HISTORY, notify=None, clock=time.monotonic_ns):
+        self.tolerance_ns = int(tolerance * 1e9)
+        self.max_gap_ns = int(FUSION_MAX_GAP * 1e9)
+        self.clock = clock
+        self.history = {A_END_CODE: collections.deque(maxlen=history), B_END_CODE: collections.deque(maxlen=history)}
+        self.pending = {A_END_CODE: collections.deque(), B_END_CODE: collections.deque()}
+        self.max_pending = history
+        self.frames = {A_END_CODE: 0, B_END_CODE: 0}
+        self.unmatched = {A_END_CODE: 0, B_END_CODE: 0}
+        self.interpolated = 0         # slave distances interpolated between two frames
+        self.extrapolated = 0         # slave distances extrapolated from previous frames
+        self.skew = RunningStat()       # ns between the reception of the frames of a pair
+        self.latency = RunningStat()    # ns between the reception of the later frame and the pairing
+        self.pairs = LatestValueMailbox(notify)
+        self._lock = threading.Lock()
+
+    def end_queue(self, end_side_code):
+        """ :returns:
+                queue-like object of one end for data_ptr_queues of the end ranging jobs
+        """
+        return EndQueue(self, end_side_code)
+
+    @property
+    def seq_a(self):
+        return self.frames[A_END_CODE]
+
+    @property
+    def seq_b(self):
+        return self.frames[B_END_CODE]
+
+    def put_frame(self, end_side_code, data_point):
+        """ Add a frame ([uwb_reporting_dict, decoded foreign slaves]) of one end and pair what can be paired
+        """
+        t_ns = data_point[0].get(RX_STAMP_KEY)
+        if t_ns is None:
+            t_ns = self.clock()
+        with self._lock:
+            self.frames[end_side_code] += 1
+            self.history[end_side_code].append((t_ns, data_point))
+            pending = self.pending[end_side_code]
+            pending.append((t_ns, data_point))
+            if len(pending) > self.max_pending:
+                # The other end stopped reporting
+                pending.popleft()
+                self.unmatched[end_side_code] += 1
+            self._pair_frames(self.clock())
+
+    def _period_ns(self, end_side_code):
+        """ :returns:
+                mean reporting period of an end over its history, None if unknown
+        """
+        history = self.history[end_side_code]
+        if len(history) < 2:
+            return None
+        return (history[-1][0] - history[0][0]) / (len(history) - 1)
+
+    def _pair_frames(self, now_ns):
+        pending_a, pending_b = self.pending[A_END_CODE], self.pending[B_END_CODE]
+        while pending_a and pending_b:
+            early, late = (A_END_CODE, B_END_CODE) if pending_a[0][0] <= pending_b[0][0] else (B_END_CODE, A_END_CODE)
+            pending_early, pending_late = self.pending[early], self.pending[late]
+            t_early, t_late = pending_early[0][0], pending_late[0][0]
+            skew = t_late - t_early
+            if skew > self.tolerance_ns:
+                pending_early.popleft()
+                self.unmatched[early] += 1
+                continue
+            if len(pending_early) > 1:
+                if abs(pending_early[1][0] - t_late) < skew:
+                    # The next frame of the early end is nearer to the late frame
+                    pending_early.popleft()
+                    self.unmatched[early] += 1
+                    continue
+            else:
+                # Wait for the next frame of the early end, unless it can not be nearer
+                period = self._period_ns(early)
+                if now_ns - t_late < skew and (period is None or t_early + period - t_late < skew):
+                    break
+            self._emit(early, pending_early.popleft(), pending_late.popleft(), now_ns)
+
+    def _align(self, end_side_code, t_ns, data_point, target_t_ns):
+        """ :returns:
+                copy of a data point with the distances interpolated to target_t_ns
+        """
+        uwb_reporting_dict, slaves = data_point
+        if t_ns == target_t_ns:
+            slaves = [slave.copy() for slave in slaves]
+        else:
+            # Next frames of the same end first (interpolation), then the previous ones (extrapolation)
+            history = [(t_ref, ref_point[1]) for t_ref, ref_point in self.history[end_side_code]
+                       if t_ref != t_ns and abs(t_ref - t_ns) <= self.max_gap_ns]
+            ref_frames = [ref for ref in history if ref[0] > t_ns] + [ref for ref in reversed(history) if ref[0] < t_ns]
+            slaves, interpolated, extrapolated = interpolate_slaves(slaves, t_ns, ref_frames, target_t_ns)
+            self.interpolated += interpolated
+            self.extrapolated += extrapolated
+        # Shallow copy: a frame record (frame_records.Frame) keeps its report
+        uwb_reporting_dict = uwb_reporting_dict.copy()
+        uwb_reporting_dict[FUSED_STAMP_KEY] = target_t_ns
+        return [uwb_reporting_dict, slaves]
+
+    def _emit(self, early, early_frame, late_frame, now_ns):
+        (t_early, early_point), (t_late, late_point) = early_frame, late_frame
+        early_point = self._align(early, t_early, early_point, t_late)
+        late_point = self._align(B_END_CODE if early == A_END_CODE else A_END_CODE, t_late, late_point, t_late)
+        self.skew.add(t_late - t_early)
+        self.latency.add(now_ns - t_late)
+        if early == A_END_CODE:
+            self.pairs.put((early_point, late_point))
+        else:
+            self.pairs.put((late_point, early_point))
+
+    def get(self, block=True, timeout=None):
+        """ Take the latest fused pair, if not taken already
+
+            :returns:
+                (a_data_point, b_data_point), or raises queue.Empty
+        """
+        if not block:
+            # Pairs waiting for a frame that can no longer be nearer
+            with self._lock:
+                self._pair_frames(self.clock())
+        return self.pairs.get(block, timeout)
+
+    def stats(self):
+        """ :returns:
+                dictionary of the pairing statistics, times in ms
+        """
+        return {"frames": {"A": self.frames[A_END_CODE], "B": self.frames[B_END_CODE]},
+                "pairs": self.skew.count,
+                "unmatched": {"A": self.unmatched[A_END_CODE], "B": self.unmatched[B_END_CODE]},
+                "interpolated": self.interpolated,
+                "extrapolated": self.extrapolated,
+                "dropped": self.pairs.dropped,
+                "skew_ms": self.skew.as_dict(1e-6),
+                "latency_ms": self.latency.as_dict(1e-6)}
+
+    def metric_samples(self):
+        """ Collector of the metrics endpoint (metrics_server.py), read without the lock
+
+            :returns:
+                list of (name, labels, value) samples
+        """
+        samples = [("uwb_dropped_pairs_total", (), self.pairs.dropped)]
+        for end_side_code, end_name in ((A_END_CODE, "A"), (B_END_CODE, "B")):
+            samples.append(("uwb_queue_depth", (("end", end_name),), len(self.pending[end_side_code])))
+            samples.append(("uwb_dropped_frames_total", (("end", end_name), ("reason", "unmatched")), self.unmatched[end_side_code]))
+        return samples
+
+    def summary(self):
+        stats = self.stats()
+        return ("{} A/B pairs of {}/{} frames ({}/{} unmatched), skew mean {:.1f} ms max {:.1f} ms, "
+                "pairing latency mean {:.1f} ms max {:.1f} ms"
+                .format(stats["pairs"], stats["frames"]["A"], stats["frames"]["B"], stats["unmatched"]["A"],
+                        stats["unmatched"]["B"], stats["skew_ms"]["mean"], stats["skew_ms"]["max"],
+                        stats["latency_ms"]["mean"], stats["latency_ms"]["max"]))
+
+
+class LatestPairSource():
+
+    # Unaligned pairs: the latest frame of each end whenever either end reported a new one
+    def __init__(self, mailbox_a, mailbox_b):
+        self.mailbox_a, self.mailbox_b = mailbox_a, mailbox_b
+        self.last_a_data_point, self.last_b_data_point = None, None
+
+    def end_queue(self, end_side_code):
+        return self.mailbox_a if end_side_code == A_END_CODE else self.mailbox_b
+
+    @property
+    def seq_a(self):
+        return self.mailbox_a.seq
+
+    @property
+    def seq_b(self):
+        return self.mailbox_b.seq
+
+    def get(self, block=False, timeout=None):
+        """ :returns:
+                (a_data_point, b_data_point), or raises queue.Empty if neither end has a new frame
+        """
+        fresh = False
+        try:
+            self.last_a_data_point = self.mailbox_a.get(block=False)
+            fresh = True
+        except queue.Empty:
+            pass
+        try:
+            self.last_b_data_point = self.mailbox_b.get(block=False)
+            fresh = True
+        except queue.Empty:
+            pass
+        if not fresh or self.last_a_data_point is None or self.last_b_data_point is None:
+            raise queue.Empty
+        return self.last_a_data_point, self.last_b_data_point
+
+    def metric_samples(self):
+        """ Collector of the metrics endpoint (metrics_server.py)
+
+            :returns:
+                list of (name, labels, value) samples
+        """
+        samples = []
+        for mailbox, end_name in ((self.mailbox_a, "A"), (self.mailbox_b, "B")):
+            samples.append(("uwb_queue_depth", (("end", end_name),), mailbox.qsize()))
+            samples.append(("uwb_dropped_frames_total", (("end", end_name), ("reason", "overwritten")), mailbox.dropped))
+        return samples
+
+    def summary(self):
+        return "{} frames dropped (A: {}, B: {})".format(self.mailbox_a.dropped + self.mailbox_b.dropped,
+                                                         self.mailbox_a.dropped, self.mailbox_b.dropped)
+
+
+def make_pair_source(tolerance=FUSION_TOLERANCE, notify=None):
+    """ :returns:
+            EndFusionBuffer, or LatestPairSource (unaligned) if the tolerance is 0
+    """
+    if tolerance > 0:
+        return EndFusionBuffer(tolerance=tolerance, notify=notify)
+    return LatestPairSource(LatestValueMailbox(notify), LatestValueMailbox(notify))
+
+
+if __name__ == "__main__":
+    # Unit Testing: the sample field test log frames (B end), replayed into both ends with a
+    # reception time offset and a synthetic approaching vehicle. The fused pairs see both ends
+    # at the same instant; the latest frames of each end are off by the skew.
+    import os, sys, random, timeit
+    from data_mailbox import DataRing
+    from utils import EndReportingProcessor, process_async_raw_ranging_results
+    import tempfile, io
+
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+
+    master_b = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 1}
+    master_a = dict(master_b, side_master=2)
+    local_slaves = {"8D38": {"port": None}, "1912": {"port": None}}
+    tmp_dir = tempfile.mkdtemp()
+    rings = {A_END_CODE: DataRing(maxlen=len(lines)), B_END_CODE: DataRing(maxlen=len(lines))}
+    sys.stdout, log_out = io.StringIO(), sys.stdout
+    processors = [EndReportingProcessor(local_slaves, code, master, rings[code], tmp_dir, exp_name="fusion-test")
+                  for code, master in ((A_END_CODE, master_a), (B_END_CODE, master_b))]
+    for processor in processors:
+        processor.start()
+        for line in lines:
+            processor.process_line(line)
+        processor.stop(verbose=False)
+    sys.stdout = log_out
+    frames = {code: [value for _, value in ring.snapshot()] for code, ring in rings.items()}
+    assert all(RX_STAMP_KEY in point[0] for points in frames.values() for point in points)
+
+    # Every slave approaches at 5 m/s from its first reported distance; A end frames every 100 ms
+    # (with a jitter), B end frames 37 ms later
+    speed, period, offset = 5.0, 100000000, 37000000
+    def truth(slave_id, t_ns):
+        return start_dist[slave_id] - speed * t_ns / 1e6
+    start_dist = {}
+    for points in frames.values():
+        for point in points:
+            for slave in point[1]:
+                start_dist.setdefault(slave["slave_id"], slave["dist_to"] + 10000)
+    rng = random.Random(7)
+    events = []
+    for code, shift in ((A_END_CODE, 0), (B_END_CODE, offset)):
+        for k, point in enumerate(frames[code]):
+            t_ns = 10 * period + k * period + shift + rng.randint(-3000000, 3000000)
+            point[0][RX_STAMP_KEY] = t_ns
+            for slave in point[1]:
+                slave["dist_to"] = int(round(truth(slave["slave_id"], t_ns)))
+            events.append((t_ns, code, point))
+    events.sort(key=lambda e: e[0])
+
+    def replay(fusion, events, skip=lambda code, k: False):
+        replay.now = 0
+        fused = []
+        for k, (t_ns, code, point) in enumerate(events):
+            replay.now = t_ns
+            if skip(code, k):
+                continue
+            point[0][RX_STAMP_KEY] = t_ns
+            fusion.put_frame(code, point)
+            try:
+                fused.append(fusion.get(block=False))
+            except queue.Empty:
+                pass
+        return fused
+
+    fusion = EndFusionBuffer(clock=lambda: replay.now)
+    fused = replay(fusion, events)
+    stats = fusion.stats()
+    assert stats["pairs"] == len(fused) == len(lines) and stats["unmatched"] == {"A": 0, "B": 0}, stats
+    # Only the first pair waits for the next frame (reporting period not known yet)
+    assert stats["latency_ms"]["last"] == 0 and stats["latency_ms"]["mean"] < 1 and 31 <= stats["skew_ms"]["mean"] <= 43, stats
+    fused_err, latest_err = [], []
+    for a_point, b_point in fused:
+        assert a_point[0][FUSED_STAMP_KEY] == b_point[0][FUSED_STAMP_KEY] == b_point[0][RX_STAMP_KEY]
+        for point in (a_point, b_point):
+            for slave in point[1]:
+                fused_err.append(abs(slave["dist_to"] - truth(slave["slave_id"], point[0][FUSED_STAMP_KEY])))
+        # The latest frames of both ends are ranged the skew apart
+        latest_err.append(speed * abs(b_point[0][RX_STAMP_KEY] - a_point[0][RX_STAMP_KEY]) / 1e6)
+        veh_a, veh_b = process_async_raw_ranging_results(a_point, b_point, master_a, master_b)
+    # Slaves reported for the first time in a while have no reference frame to be aligned with
+    unaligned = sum(err > 1.0 for err in fused_err)
+    assert unaligned < 0.05 * len(fused_err), (unaligned, len(fused_err))
+    print("{} frames per end -> {}".format(len(lines), fusion.summary()))
+    print("distance error at the common instant: fused {:.1f} mm mean, {:.1f} % not aligned | latest frames {:.0f} mm mean"
+          .format(sum(fused_err) / len(fused_err), 100 * unaligned / len(fused_err), sum(latest_err) / len(latest_err)))
+
+    # Missed reports: B frames missing, the A frames around the gap stay unmatched or are paired
+    # within the tolerance only
+    fusion = EndFusionBuffer(clock=lambda: replay.now)
+    fused = replay(fusion, events, skip=lambda code, k: code == B_END_CODE and 200 <= k < 260)
+    stats = fusion.stats()
+    assert stats["unmatched"]["A"] > 0 and stats["unmatched"]["B"] == 0 and stats["skew_ms"]["max"] <= 50, stats
+    print("30 missed B frames -> {}".format(fusion.summary()))
+
+    # B end 63 ms after A: every B frame pairs with the next A frame, the pair waits for it
+    events_late = [(t_ns + (period - 2 * offset) if code == B_END_CODE else t_ns, code, point) for t_ns, code, point in events]
+    events_late.sort(key=lambda e: e[0])
+    fusion = EndFusionBuffer(clock=lambda: replay.now)
+    fused = replay(fusion, events_late)
+    assert fusion.stats()["pairs"] >= len(lines) - 1 and fusion.stats()["skew_ms"]["max"] <= 43
+    print("B end 63 ms after A -> {}".format(fusion.summary()))
+
+    fusion = EndFusionBuffer(history=FUSION_HISTORY)
+    t_put = timeit.timeit(lambda: [fusion.put_frame(code, point) for _, code, point in events[:200]], number=20)
+    print("put_frame: {:.1f} us per frame".format(t_put / 20 / 200 * 1e6))
@@ -0,0 +1,372 @@
+#!/usr/bin/python3
+
+import sys
+from dist_parser import AnchorReading, DistReport
+from slave_info_codec import decode_slave_info_fields
+from pipeline_latency import STAGE_STAMPS_KEY
+
+
+# This file contains the compact typed records of the ranging frames, handed over from the end
+# reporting threads (utils.EndReportingProcessor) to the logs, the A/B end fusion and the geometry:
+#   MasterInfo:     informative position of a master (decode_info_pos_from_label() + "master_id")
+#   SlaveReading:   decoded informative position and distance of a slave (decode_slave_info_position())
+#   Frame:          one DIST report (dist_parser.DistReport, kept as parsed) of a master with its super
+#                   frame number, master, reception and stage stamps
+# A frame used to be a dictionary of dictionaries: one per anchor, per decoded slave, per position,
+# built for every report whether anyone reads them or not. The records keep __slots__ instead.
+# For the consumers of the dictionaries, the records are read (and written) with the keys of their
+# legacy dictionary: record["dist_to"], record.get("adjusted_dist"), "masterInfoPos" in frame,
+# repr() as the dictionary (text logs). to_dict() converts a record into its legacy dictionary.
+# The slots of MasterInfo and SlaveReading are named after their legacy keys, in the legacy key order;
+# a slot not set (e.g. "adjusted_dist" before the geometry) is a key absent from the dictionary.
+# The report keys of a Frame (anchor ids, "all_anc_id", "est_pos"...) are built on demand, and keys
+# set by the consumers (e.g. end_fusion.FUSED_STAMP_KEY) are kept aside in a small dictionary.
+
+RX_STAMP_KEY = 'rxMonotonicNs'  # Reception time of a frame (time.monotonic_ns()), for the A/B end fusion (end_fusion.py)
+SUPER_FRAME_KEY = 'superFrameNumber'
+MASTER_INFO_KEY = 'masterInfoPos'
+
+
+class RecordMapping():
+
+    # Dictionary access of a record by the keys of its legacy dictionary
+    __slots__ = ()
+    KEYS = ()
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError("{} has no field {}".format(type(self).__name__, repr(key)))
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        return [key for key in self.KEYS if hasattr(self, key)]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        """ :returns:
+                legacy dictionary of the record (nested records converted)
+        """
+        return {key: value.to_dict() if isinstance(value, RecordMapping) else value for key, value in self.items()}
+
+    def copy(self):
+        record = type(self).__new__(type(self))
+        for key in self.keys():
+            setattr(record, key, getattr(self, key))
+        return record
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, RecordMapping)):
+            return self.to_dict() == (other.to_dict() if isinstance(other, RecordMapping) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class MasterInfo(RecordMapping):
+
+    # Informative position of a master (mm), from its label
+    KEYS = ("x_master", "y_master", "z_master", "vehicle_length_master", "id_assoc", "side_master", "master_id")
+    __slots__ = KEYS
+
+    @classmethod
+    def from_dict(cls, info_pos):
+        """ :returns:
+                MasterInfo of an informative position dictionary (serial_ports entry "info_pos"), other
+                keys ignored. A MasterInfo is returned as is.
+        """
+        if isinstance(info_pos, MasterInfo):
+            return info_pos
+        info = cls.__new__(cls)
+        for key in cls.KEYS:
+            if key in info_pos:
+                setattr(info, key, info_pos[key])
+        return info
+
+
+class SlaveReading(RecordMapping):
+
+    # Decoded informative position (mm) of a slave and its distance to the master
+    KEYS = ("slave_id", "x_slave", "y_slave", "z_slave", "vehicle_length_slave", "id_assoc", "side_slave", "dist_to",
+            "adjusted_dist")
+    __slots__ = KEYS
+
+    def __init__(self, slave_id, x_slave, y_slave, z_slave, vehicle_length_slave, id_assoc, side_slave, dist_to):
+        self.slave_id = slave_id
+        self.x_slave = x_slave
+        self.y_slave = y_slave
+        self.z_slave = z_slave
+        self.vehicle_length_slave = vehicle_length_slave
+        self.id_assoc = id_assoc
+        self.side_slave = side_slave
+        self.dist_to = dist_to
+
+
+FRAME_FIELDS = {SUPER_FRAME_KEY: "super_frame", MASTER_INFO_KEY: "master_info", RX_STAMP_KEY: "rx_ns",
+                STAGE_STAMPS_KEY: "stage_stamps"}
+
+
+def report_item(report, key):
+    """ :returns:
+            report.to_dict()[key], without building the dictionary. Raises KeyError.
+    """
+    if key == "all_anc_id":
+        return [anc.anc_id for anc in report.anchors]
+    if key == "anc_num":
+        return len(report.anchors)
+    if key == "est_pos" and report.est_pos is not None:
+        return {'x': report.est_pos[0], 'y': report.est_pos[1], 'z': report.est_pos[2]}
+    if key == "est_pos_qf" and report.est_pos is not None:
+        return report.est_pos_qf
+    if key == "acc" and report.acc is not None:
+        return {'x': report.acc[0], 'y': report.acc[1], 'z': report.acc[2]}
+    if key == "timestamp" and report.uwb_timestamp is not None:
+        return report.uwb_timestamp
+    # An anchor reported twice: its last reading, as in the dictionary
+    for anc in reversed(report.anchors):
+        if anc.anc_id == key:
+            if report.oem:
+                return {'anc_id': anc.anc_id, 'x': anc.x, 'y': anc.y, 'z': anc.z, 'dist_to': anc.dist_to}
+            return {'anc_id': anc.anc_id, 'x': anc.x, 'y': anc.y, 'z': anc.z, 'dist_to': anc.dist_to, 'anc_qf': anc.anc_qf}
+    raise KeyError(key)
+
+
+class Frame(RecordMapping):
+
+    # One parsed DIST report of a master, as handed over to the consumers
+    __slots__ = ("report", "super_frame", "master_info", "rx_ns", "stage_stamps", "extra")
+
+    def __init__(self, report, super_frame, master_info, rx_ns=None, stage_stamps=None):
+        self.report = report
+        self.super_frame = super_frame
+        self.master_info = master_info
+        self.rx_ns = rx_ns
+        self.stage_stamps = stage_stamps
+        self.extra = None       # keys set by the consumers
+
+    def __getitem__(self, key):
+        attr = FRAME_FIELDS.get(key)
+        if attr is not None:
+            value = getattr(self, attr)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return report_item(self.report, key)
+
+    def __setitem__(self, key, value):
+        attr = FRAME_FIELDS.get(key)
+        if attr is not None:
+            setattr(self, attr, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def keys(self):
+        return list(self.to_dict())
+
+    def to_dict(self):
+        """ :returns:
+                legacy dictionary of the frame: make_json_dict_accel_en() dictionary of the report with
+                the "superFrameNumber", "masterInfoPos", RX_STAMP_KEY and STAGE_STAMPS_KEY keys
+        """
+        uwb_reporting_dict = self.report.to_dict()
+        for key, attr in FRAME_FIELDS.items():
+            value = getattr(self, attr)
+            if value is not None:
+                uwb_reporting_dict[key] = value.to_dict() if isinstance(value, RecordMapping) else value
+        if self.extra is not None:
+            uwb_reporting_dict.update(self.extra)
+        return uwb_reporting_dict
+
+    def copy(self):
+        frame = Frame(self.report, self.super_frame, self.master_info, self.rx_ns, self.stage_stamps)
+        if self.extra is not None:
+            frame.extra = dict(self.extra)
+        return frame
+
+
+def decode_slave_readings(report):
+    """ Decode the informative positions of the slaves ranged in a DIST report, see decode_slave_info_position()
+
+        :returns:
+            dictionary of slave id -> SlaveReading, in reported order (the last reading of a slave reported twice)
+    """
+    slaves = {}
+    for anc in report.anchors:
+        slaves[anc.anc_id] = SlaveReading(anc.anc_id, *decode_slave_info_fields(anc.x, anc.y, anc.z, anc.anc_qf or 0),
+                                          anc.dist_to)
+    return slaves
+
+
+def dist_report_from_dict(uwb_reporting_dict, oem_firmware=False):
+    """ Inverse of DistReport.to_dict(), for the reports still produced as dictionaries (replays of logs)
+
+        :returns:
+            DistReport
+    """
+    anchors = []
+    for anc in uwb_reporting_dict.get("all_anc_id", []):
+        anc_dict = uwb_reporting_dict[anc]
+        anchors.append(AnchorReading(anc, anc_dict["x"], anc_dict["y"], anc_dict["z"], anc_dict["dist_to"], anc_dict.get("anc_qf")))
+    report = DistReport(anchors, oem=oem_firmware)
+    est_pos = uwb_reporting_dict.get("est_pos")
+    if est_pos is not None:
+        report.est_pos = (est_pos["x"], est_pos["y"], est_pos["z"])
+        report.est_pos_qf = uwb_reporting_dict.get("est_pos_qf")
+    acc = uwb_reporting_dict.get("acc")
+    if acc is not None:
+        report.acc = (acc["x"], acc["y"], acc["z"])
+    report.uwb_timestamp = uwb_reporting_dict.get("timestamp")
+    return report
+
+
+def as_dist_report(uwb_reporting, oem_firmware=False):
+    """ :returns:
+            DistReport of a Frame, a DistReport or a make_json_dict_accel_en() dictionary
+    """
+    if isinstance(uwb_reporting, Frame):
+        return uwb_reporting.report
+    if isinstance(uwb_reporting, DistReport):
+        return uwb_reporting
+    return dist_report_from_dict(uwb_reporting, oem_firmware)
+
+
+def to_legacy_dict(value):
+    """ :returns:
+            legacy dictionary of a record, or a shallow copy of a dictionary
+    """
+    return value.to_dict() if isinstance(value, RecordMapping) else dict(value)
+
+
+if __name__ == "__main__":
+    # Unit Testing: the records of the sample field test log against the legacy dictionaries (frames,
+    # decoded foreign slaves, geometry results, text log lines), and the memory and allocations per
+    # 10k frames of both.
+    import os, copy, time, tracemalloc
+    from utils import (make_json_dict_accel_en, make_dist_report, decode_slave_info_position, process_async_raw_ranging_results,
+                       slave_distance)
+    from session_replay import scan_processed_log
+    from log_writer import format_frame_text_lines
+
+    sample_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results", "data", "sample")
+    with open(os.path.join(sample_dir, "2021-05-25-08-52-15-data-B-raw_log.log"), "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+    master_info_pos, local_slaves = scan_processed_log(os.path.join(sample_dir, "2021-05-25-08-52-15-data-B-user-processed_log.log"))
+    master_info = MasterInfo.from_dict(master_info_pos)
+    serial_ports = {anc: {"info_pos": {}} for anc in local_slaves}
+
+    def legacy_data_pointer(line, super_frame, rx_ns):
+        # EndReportingProcessor.process_report() before the records
+        uwb_reporting_dict = make_json_dict_accel_en(line)
+        slave_reporting_dict = decode_slave_info_position(uwb_reporting_dict)
+        foreign_slaves = [slave_reporting_dict.get(anc, {}) for anc in uwb_reporting_dict.get("all_anc_id", [])
+                          if not serial_ports.get(anc)]
+        uwb_reporting_dict['superFrameNumber'] = super_frame
+        uwb_reporting_dict['masterInfoPos'] = master_info_pos
+        uwb_reporting_dict[RX_STAMP_KEY] = rx_ns
+        uwb_reporting_dict[STAGE_STAMPS_KEY] = [rx_ns, rx_ns, rx_ns, rx_ns]
+        foreign_slaves.sort(key=lambda x: x.get("dist_to", float("inf")))
+        return [uwb_reporting_dict, foreign_slaves]
+
+    def record_data_pointer(line, super_frame, rx_ns):
+        report = make_dist_report(line)
+        slave_readings = decode_slave_readings(report)
+        foreign_slaves = [slave_readings[anc.anc_id] for anc in report.anchors if not serial_ports.get(anc.anc_id)]
+        frame = Frame(report, super_frame, master_info, rx_ns, [rx_ns, rx_ns, rx_ns, rx_ns])
+        foreign_slaves.sort(key=slave_distance)
+        return [frame, foreign_slaves]
+
+    def run(func, *args):
+        args = copy.deepcopy(args)
+        try:
+            return repr(func(*args)), repr(args)
+        except BaseException as e:
+            return repr(e), None
+
+    legacy = [legacy_data_pointer(line, i, 1000 * i) for i, line in enumerate(lines)]
+    records = [record_data_pointer(line, i, 1000 * i) for i, line in enumerate(lines)]
+    for (legacy_dict, legacy_slaves), (frame, slaves) in zip(legacy, records):
+        assert frame.to_dict() == legacy_dict and frame == legacy_dict and repr(frame) == repr(legacy_dict)
+        assert list(frame.keys()) == list(legacy_dict) and all(frame[key] == legacy_dict[key] for key in legacy_dict)
+        assert repr(slaves) == repr(legacy_slaves) and [slave.to_dict() for slave in slaves] == legacy_slaves
+        assert dist_report_from_dict(legacy_dict).to_dict() == frame.report.to_dict()
+        assert format_frame_text_lines("B", 0, 0, frame, [], lines[0], master_info_pos) == \
+               format_frame_text_lines("B", 0, 0, legacy_dict, [], lines[0], master_info_pos)
+    # Adjusted distances of consecutive frames paired as A/B ends
+    for a, b in zip(range(0, len(lines) - 1, 2), range(1, len(lines), 2)):
+        assert run(process_async_raw_ranging_results, records[a], records[b], master_info, master_info) == \
+               run(process_async_raw_ranging_results, legacy[a], legacy[b], master_info_pos, master_info_pos)
+    print("{} frames of the sample log: records identical to the legacy dictionaries".format(len(lines)))
+
+    # Legacy dictionary access of the records
+    slave = records[0][1][0]
+    assert "adjusted_dist" not in slave and slave.get("adjusted_dist") is None and slave.get("nope", 1) == 1
+    slave["adjusted_dist"] = 1234
+    assert slave["adjusted_dist"] == 1234 and list(slave)[-1] == "adjusted_dist" and dict(slave) == slave.to_dict()
+    for bad_key in ("nope", "get", 0):
+        try:
+            slave[bad_key]
+            raise AssertionError(bad_key)
+        except KeyError:
+            pass
+    frame = records[0][0].copy()
+    frame["fusedMonotonicNs"] = 42
+    assert frame["fusedMonotonicNs"] == 42 and "fusedMonotonicNs" not in records[0][0]
+    assert records[0][0]["masterInfoPos"]["side_master"] == master_info_pos["side_master"]
+
+    # Memory and allocations per 10k frames, as queued to the consumers
+    n = 10000
+    samples = (lines * (n // len(lines) + 1))[:n]
+    print("per {} frames:            retained | allocated blocks | build time".format(n))
+    for name, build in (("dictionaries", legacy_data_pointer), ("records", record_data_pointer)):
+        t_0 = time.perf_counter()
+        frames = [build(line, i, i) for i, line in enumerate(samples)]
+        t_build = time.perf_counter() - t_0
+        del frames
+        blocks_0 = sys.getallocatedblocks()
+        tracemalloc.start()
+        frames = [build(line, i, i) for i, line in enumerate(samples)]
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        blocks = sys.getallocatedblocks() - blocks_0
+        del frames
+        print("    {:13s} {:12.1f} MB | {:16d} | {:7.1f} ms ({:.1f} us per frame)".format(
+              name, retained / 1e6, blocks, t_build * 1e3, t_build / n * 1e6))
+    print("All frame record tests passed")
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+import os, struct, time
+from multiprocessing import shared_memory
+
+
+# This file contains the shared memory frame ring of the multi-process ranging (multiproc_ranging.py).
+# One reader process per master writes its parsed frames into its own ring; the consumer processes
+# (logger, GUI/headless fusion) read them from the same memory, without pickling nor copying the
+# records through a pipe.
+# Ring layout (little endian):
+#   header:     magic, version, slot count, slot body size, head (frames written), producer counters
+#   slots:      seq | read ns | parsed ns | written ns | body length | body (fixed size)
+# The body of a slot is a frame record of the binary ranging logs (log_writer.encode_frame_record()):
+# the logger writes it to the log as is, the other consumers decode it in place.
+# Single producer per ring. A slot is written seqlock-style: its seq is cleared, the body and
+# stamps are written, then its seq is set to the frame number + 1, and the head of the ring last.
+# A reader checks the seq of a slot before and after decoding it: a slot overwritten meanwhile (the
+# reader is more than a ring behind) is counted as dropped, never returned torn.
+# The producer wakes the consumers up through a pipe per consumer (notify()): the write to the
+# pipe and the wait of the consumer are system calls, which also order the shared memory accesses.
+
+RING_MAGIC = b"UWBFRING"
+RING_VERSION = 1
+RING_SLOTS = 256                # Frames per ring: 25 s at 10 Hz
+RING_BODY_SIZE = 1024           # Bytes of a frame record: ~40 + 24 per anchor + the raw DIST line
+RING_COUNTERS = ("lines", "parse_failures", "regex_fallbacks", "oversized", "state")
+
+STATE_STARTING = 0
+STATE_RUNNING = 1
+STATE_STOPPED = 2
+STATE_FAILED = 3
+
+# magic, version, slot count, body size, head, counters
+RING_HEADER = struct.Struct("<8sIII4xQ" + "Q" * len(RING_COUNTERS))
+RING_HEAD_OFFSET = struct.calcsize("<8sIII4x")
+RING_COUNTERS_OFFSET = RING_HEAD_OFFSET + 8
+# seq, read ns, parsed ns, written ns, body length
+SLOT_HEADER = struct.Struct("<QqqqH6x")
+U64 = struct.Struct("<Q")
+
+
+class FrameRing():
+
+    # Fixed-size slot ring of frame records in a shared memory block
+    def __init__(self, name=None, create=False, slots=RING_SLOTS, body_size=RING_BODY_SIZE):
+        if create:
+            self.slots = slots
+            self.body_size = body_size
+            self.slot_size = SLOT_HEADER.size + body_size
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=RING_HEADER.size + slots * self.slot_size)
+            RING_HEADER.pack_into(self.shm.buf, 0, RING_MAGIC, RING_VERSION, slots, body_size, 0,
+                                  *([0] * len(RING_COUNTERS)))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            magic, version, self.slots, self.body_size = RING_HEADER.unpack_from(self.shm.buf, 0)[:4]
+            if magic != RING_MAGIC or version != RING_VERSION:
+                self.shm.close()
+                raise ValueError("{} is not a frame ring".format(name))
+            self.slot_size = SLOT_HEADER.size + self.body_size
+        self.name = self.shm.name
+        self.owner = create
+        self.counters = [0] * len(RING_COUNTERS)     # producer side copy
+        self._notify = []
+
+    def close(self):
+        self._notify = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # ------------------------------ producer ------------------------------
+
+    def set_notify(self, connections):
+        """ Pipe connections (multiprocessing.Pipe send ends) of the consumers to wake up on new frames
+        """
+        for conn in connections:
+            # A consumer behind does not block the producer: the wakeup is dropped, the frames are not
+            os.set_blocking(conn.fileno(), False)
+        self._notify = list(connections)
+
+    def write(self, body, read_ns, parsed_ns):
+        """ Write a frame record (log_writer.encode_frame_record() body)
+
+            :returns:
+                False if the record does not fit in a slot (counted as oversized), True otherwise
+        """
+        if len(body) > self.body_size:
+            self.count("oversized")
+            return False
+        buf = self.shm.buf
+        n = self.head()
+        offset = RING_HEADER.size + (n % self.slots) * self.slot_size
+        U64.pack_into(buf, offset, 0)
+        buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(body)] = body
+        SLOT_HEADER.pack_into(buf, offset, n + 1, read_ns, parsed_ns, time.monotonic_ns(), len(body))
+        U64.pack_into(buf, RING_HEAD_OFFSET, n + 1)
+        return True
+
+    def notify(self):
+        for conn in self._notify:
+            try:
+                # An empty message is 4 bytes: written whole or not at all (PIPE_BUF)
+                conn.send_bytes(b"")
+            except (BlockingIOError, BrokenPipeError, OSError):
+                pass
+
+    def count(self, counter, n=1):
+        idx = RING_COUNTERS.index(counter)
+        self.counters[idx] += n
+        U64.pack_into(self.shm.buf, RING_COUNTERS_OFFSET + 8 * idx, self.counters[idx])
+
+    def set_state(self, state):
+        self.count("state", state - self.counters[RING_COUNTERS.index("state")])
+
+    # ------------------------------ consumers ------------------------------
+
+    def head(self):
+        """ :returns:
+                number of frames written
+        """
+        return U64.unpack_from(self.shm.buf, RING_HEAD_OFFSET)[0]
+
+    def counter_values(self):
+        values = struct.unpack_from("<" + "Q" * len(RING_COUNTERS), self.shm.buf, RING_COUNTERS_OFFSET)
+        return dict(zip(RING_COUNTERS, values))
+
+    def read(self, n, decode):
+        """ Decode frame n in place
+
+            :param decode: decode(body memoryview, read ns, parsed ns, written ns); must not keep the memoryview
+            :returns:
+                what decode() returned, None if the frame has been overwritten
+        """
+        offset = RING_HEADER.size + (n % self.slots) * self.slot_size
+        seq, read_ns, parsed_ns, written_ns, length = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        if seq != n + 1:
+            return None
+        body = self.shm.buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length]
+        try:
+            ret = decode(body, read_ns, parsed_ns, written_ns)
+        finally:
+            body.release()
+        if U64.unpack_from(self.shm.buf, offset)[0] != n + 1:
+            # Overwritten while decoding
+            return None
+        return ret
+
+
+class RingCursor():
+
+    # Read position of one consumer in a ring, with the frames it missed
+    def __init__(self, ring, start=0):
+        self.ring = ring
+        self.next = start
+        self.read = 0
+        self.dropped = 0
+
+    def pending(self):
+        return self.ring.head() - self.next
+
+    def read_new(self, decode):
+        """ Decode the frames written since the last call, oldest first
+
+            :returns:
+                list of what decode() returned
+        """
+        head = self.ring.head()
+        if head - self.next > self.ring.slots:
+            # Lapped by the producer: the oldest frames are gone
+            self.dropped += head - self.ring.slots - self.next
+            self.next = head - self.ring.slots
+        ret = []
+        while self.next < head:
+            value = self.ring.read(self.next, decode)
+            self.next += 1
+            if value is None:
+                self.dropped += 1
+                continue
+            self.read += 1
+            ret.append(value)
+        return ret
+
+
+if __name__ == "__main__":
+    # Unit Testing: frame records through a ring and back, attached by name; lapped consumer,
+    # frames overwritten while decoded, oversized records, counters.
+    import multiprocessing
+    from utils import make_json_dict_accel_en
+    from log_writer import encode_frame_record, decode_frame_record
+
+    lines = [b"DIST,2;[AN0,8D38,35783168,5111808,20972734]=[4717,100];[AN1,1912,35783168,-5111808,20972734]=[%d,100];"
+             b"ACC=[-512,768,9449];UWBLOCALTIME,%d;" % (1000 + i, 38439537 + i) for i in range(1000)]
+    frames = [(1_600_000_000_000_000 + i, i, make_json_dict_accel_en(line), [1], line) for i, line in enumerate(lines)]
+    ring = FrameRing(create=True, slots=64)
+    reader_ring = FrameRing(ring.name)
+    cursor = RingCursor(reader_ring)
+    decode = lambda body, read_ns, parsed_ns, written_ns: (decode_frame_record(body), read_ns, parsed_ns)
+    assert cursor.read_new(decode) == []
+    for i, frame in enumerate(frames[:10]):
+        assert ring.write(encode_frame_record(*frame), i, i + 1)
+    got = cursor.read_new(decode)
+    assert [(tuple(record), read_ns, parsed_ns) for record, read_ns, parsed_ns in got] == \
+           [(frame, i, i + 1) for i, frame in enumerate(frames[:10])]
+
+    # Lapped: only the last ring of frames is left
+    for i, frame in enumerate(frames[10:]):
+        ring.write(encode_frame_record(*frame), 0, 0)
+    got = cursor.read_new(decode)
+    assert len(got) == 64 and cursor.dropped == len(frames) - 10 - 64
+    assert got[-1][0] == frames[-1] and got[0][0] == frames[-64]
+
+    # Overwritten while being decoded: the producer laps the slot under the reader
+    def lapping_decode(body, read_ns, parsed_ns, written_ns):
+        for frame in frames[:64]:
+            ring.write(encode_frame_record(*frame), 0, 0)
+        return decode_frame_record(body)
+    head = ring.head()
+    assert reader_ring.read(head - 1, lapping_decode) is None
+    assert reader_ring.read(head + 63, decode)[0] == frames[63]
+
+    assert not ring.write(bytes(RING_BODY_SIZE + 1), 0, 0)
+    ring.count("lines", 5)
+    ring.set_state(STATE_RUNNING)
+    assert reader_ring.counter_values() == {"lines": 5, "parse_failures": 0, "regex_fallbacks": 0, "oversized": 1,
+                                            "state": STATE_RUNNING}
+
+    # Wakeup of a consumer through its pipe
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    ring.set_notify([send_conn])
+    for _ in range(100000):
+        ring.notify()
+    assert recv_conn.poll(0) and recv_conn.recv_bytes() == b""
+
+    n, t_0 = 20000, time.perf_counter()
+    bodies = [encode_frame_record(*frame) for frame in frames]
+    for i in range(n):
+        ring.write(bodies[i % len(bodies)], i, i)
+    t_write = (time.perf_counter() - t_0) / n
+    t_0 = time.perf_counter()
+    for i in range(n - 64, n):
+        reader_ring.read(i, decode)
+    t_read = (time.perf_counter() - t_0) / 64
+    reader_ring.close()
+    ring.close()
+    print("frame ring: {:.1f} us per write, {:.1f} us per read and decode".format(t_write * 1e6, t_read * 1e6))
+    print("All frame ring tests passed")
@@ -0,0 +1,627 @@
+#!/usr/bin/python3
+
+import sys, math
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only required by the columnar (batch) path
+    np = None
+
+
+# This file contains the geometry engine of the adjusted side-to-side distances between
+# the local vehicle (masters) and the foreign vehicles (slaves).
+# For every slave ranged by a master:
+#   x_diff = x_master + s * x_slave
+#   y_diff = y_master + s * y_slave
+#   z_diff = z_master - z_slave
+#   adjusted_dist = int(sqrt(dist_to^2 - z_diff^2 - y_diff^2) + d * x_diff)    (nan if the root is imaginary)
+# The signs s (slave position mirrored or not) and d (distance toward or away from the master)
+# only depend on the end, the near sides and the side of the slave, and are looked up in
+# sign tables instead of one code branch per case. The paths share the tables:
+#   process_end_columns():          NumPy, all slaves of all vehicles seen by a master in one call;
+#                                   vehicles and near sides are found by sorting. For columnar input.
+#   process_end_geometry_scalar():  one pass over the slave dictionaries of a frame. A master reports
+#                                   at most a few slaves per frame, and gathering the dictionaries into
+#                                   columns costs more than the NumPy arithmetic saves (see the benchmark).
+#   process_end_vehicles_few():     fast path of the drop-in engines for one or two vehicles (the usual
+#                                   frame): the vehicles are kept in local variables and the vehicle
+#                                   dictionaries are built in the same call.
+# Vehicles are grouped once instead of rescanning both slave lists for every vehicle.
+#   ASYNC_SIGNS[end][near_side_code_local][side_slave]:     s of process_async_raw_ranging_results(), d = -1.
+#                                                           end 0: A end data point (1st argument), 1: B end.
+#                                                           0: undetermined side of the slave (error)
+#   SYNCED_SIGNS[master is near side][slave is near side]:  (s, d) of process_sycned_raw_ranging_results()
+# The async results of the slaves of a vehicle are the running minimum (in ranging order) of
+# the distances of its slaves, as computed by the original per-end loops.
+# Near side determination (as utils.determine_near_side_local/foreign()):
+#   local:      the side of the master having ranged the nearest slave of any vehicle (ties: same side)
+#   foreign:    the side of the nearest slave of the vehicle ranged by the master (ties: first in order)
+
+SIDE_CODES = (1, 2)     # 1: "B", 2: "A"; 0: "UNKNOWN"
+END_NAMES = ("A", "B")
+ASYNC_SIGNS = ((    # A end data point
+                    (0, 0, 0),
+                    (0, 1, -1),     # near side local 1: others.A.A_slave +, others.A.B_slave -
+                    (0, -1, 1)),    # near side local 2: others.B.A_slave -, others.B.B_slave +
+               (    # B end data point
+                    (0, 0, 0),
+                    (0, 1, -1),     # near side local 1: others.A.A_slave +, others.A.B_slave -
+                    (0, 1, -1)))    # near side local 2: others.B.A_slave +, others.B.B_slave -
+SYNCED_SIGNS = (((1, 1), (-1, 1)),      # master on the far side: far slaves, near slaves
+                ((-1, -1), (1, -1)))    # master on the near side: far slaves, near slaves (safety critical!)
+SLAVE_COLUMNS = ("id_assoc", "side_slave", "x_slave", "y_slave", "z_slave", "dist_to")
+NO_VEHICLE = object()  # Vehicle slot not taken yet (process_end_vehicles_few())
+INF, NAN = float("inf"), float("nan")
+INT64_SAFE_DIST = 3 * 10**9     # Squares of larger distances overflow int64; exact Python ints are used instead
+
+
+def slave_columns(slave_dicts):
+    """ Gather the decoded slaves (slave_reporting_dict entries) into columns
+
+        :returns:
+            (n, 6) array of SLAVE_COLUMNS, int64 (object array of Python ints for huge values)
+    """
+    rows = [[d["id_assoc"], d["side_slave"], d["x_slave"], d["y_slave"], d["z_slave"], d["dist_to"]] for d in slave_dicts]
+    try:
+        cols = np.array(rows, dtype=np.int64).reshape(len(rows), len(SLAVE_COLUMNS))
+    except OverflowError:
+        return np.array(rows, dtype=object).reshape(len(rows), len(SLAVE_COLUMNS))
+    if cols.size and np.abs(cols[:, 2:]).max() >= INT64_SAFE_DIST:
+        return cols.astype(object)
+    return cols
+
+
+def group_vehicles(id_assoc):
+    """ :returns:
+            (vehicle ids in order of first appearance, vehicle index of each slave)
+    """
+    vehicle_ids, first_idx, inverse = np.unique(id_assoc, return_index=True, return_inverse=True)
+    appearance = np.argsort(first_idx, kind="stable")
+    vehicle_idx = np.empty_like(appearance)
+    vehicle_idx[appearance] = np.arange(len(appearance))
+    return vehicle_ids[appearance], vehicle_idx[inverse.reshape(-1)]
+
+
+def nearest_slave_by_vehicle(vehicle_idx, dist_to, n_vehicles):
+    """ :returns:
+            index of the nearest slave of each vehicle (the first one on ties)
+    """
+    order = np.lexsort((np.arange(len(dist_to)), dist_to, vehicle_idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = vehicle_idx[order][1:] != vehicle_idx[order][:-1]
+    return order[first][:n_vehicles]
+
+
+def near_side_local(cols_same, cols_oppo, master_same, master_oppo):
+    """ :returns:
+            side code of the master having ranged the nearest slave, 0 if none
+    """
+    min_same = cols_same[:, 5].min() if len(cols_same) else float("inf")
+    min_oppo = cols_oppo[:, 5].min() if len(cols_oppo) else float("inf")
+    if min_oppo < min_same:
+        return master_oppo["side_master"]
+    return master_same["side_master"] if min_same < float("inf") else 0
+
+
+def adjusted_distances(cols, master, sign, dist_sign):
+    """ Adjusted side-to-side distances of the slaves to the master
+
+        :returns:
+            float64 array, truncated toward zero, nan where the geometry is inconsistent
+    """
+    x_diff = master["x_master"] + sign * cols[:, 2]
+    y_diff = master["y_master"] + sign * cols[:, 3]
+    z_diff = master["z_master"] - cols[:, 4]
+    radicand = cols[:, 5] ** 2 - z_diff ** 2 - y_diff ** 2
+    imaginary = radicand < 0
+    root = np.sqrt(np.where(imaginary, 0, radicand).astype(np.float64))
+    adjusted = np.trunc(root + dist_sign * x_diff.astype(np.float64))
+    adjusted[imaginary.astype(bool)] = np.nan
+    return adjusted
+
+
+def running_min_by_vehicle(values, vehicle_idx, n_vehicles):
+    """ Running minimum of the values of each vehicle in slave order, with the nan semantics of
+        adjusted_dist = min(side_to_side_dist, adjusted_dist): a nan distance replaces the minimum,
+        a distance after a nan minimum replaces it.
+
+        :returns:
+            float64 array
+    """
+    out = np.empty(len(values))
+    running = np.full(n_vehicles, np.inf)
+    rank = np.zeros(len(values), dtype=np.int64)
+    if len(values):
+        order = np.argsort(vehicle_idx, kind="stable")
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = vehicle_idx[order][1:] != vehicle_idx[order][:-1]
+        pos = np.arange(len(order))
+        rank[order] = pos - np.maximum.accumulate(np.where(starts, pos, 0))
+    for r in range(rank.max() + 1 if len(values) else 0):
+        rows = np.flatnonzero(rank == r)
+        veh = vehicle_idx[rows]
+        current, new = running[veh], values[rows]
+        running[veh] = np.where(current < new, current, new)
+        out[rows] = running[veh]
+    return out
+
+
+def process_end_vehicles_few(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end=None):
+    """ Fast path of the drop-in engines for the slaves of one or two vehicles (the usual frame):
+        one pass for the vehicles and the near sides into local variables, the adjusted distances
+        written and the vehicle dictionaries built directly, without the per-vehicle lists of
+        process_end_geometry_scalar() and build_vehicle_dicts().
+
+        :returns:
+            vehicle dictionaries (see build_vehicle_dicts()), None if the slaves belong to more than two vehicles
+    """
+    if not slave_dicts_same:
+        return []
+    veh_0 = veh_1 = NO_VEHICLE
+    dist_0 = dist_1 = INF
+    foreign_0 = foreign_1 = 0
+    bad_0 = bad_1 = False
+    slaves_0, slaves_1 = [], []
+    for d in slave_dicts_same:
+        veh, dist_to, side = d["id_assoc"], d["dist_to"], d["side_slave"]
+        if veh == veh_0 or veh_0 is NO_VEHICLE:
+            veh_0 = veh
+            slaves_0.append(d)
+            if dist_to < dist_0:
+                dist_0, foreign_0 = dist_to, side
+            if side != 1 and side != 2:
+                bad_0 = True
+        elif veh == veh_1 or veh_1 is NO_VEHICLE:
+            veh_1 = veh
+            slaves_1.append(d)
+            if dist_to < dist_1:
+                dist_1, foreign_1 = dist_to, side
+            if side != 1 and side != 2:
+                bad_1 = True
+        else:
+            return None
+    min_same = dist_0 if dist_0 <= dist_1 else dist_1
+    min_oppo = min([d["dist_to"] for d in slave_dicts_oppo]) if slave_dicts_oppo else INF
+    if min_oppo < min_same:
+        near_local = master_oppo["side_master"]
+    else:
+        near_local = master_same["side_master"] if min_same < INF else 0
+    if near_local == 0:
+        raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(veh_0))
+    check_slaves = end is not None and (near_local == 1 or near_local == 2)
+    # Errors are raised for the first vehicle (in ranging order) having one, as the per-vehicle loops did
+    if foreign_0 == 0:
+        raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(veh_0))
+    if check_slaves and bad_0:
+        raise BaseException("{} side: Undetermined side of the foreign vehicle slave unit.".format(END_NAMES[end]))
+    if veh_1 is not NO_VEHICLE:
+        if foreign_1 == 0:
+            raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(veh_1))
+        if check_slaves and bad_1:
+            raise BaseException("{} side: Undetermined side of the foreign vehicle slave unit.".format(END_NAMES[end]))
+    x_master, y_master, z_master = master_same["x_master"], master_same["y_master"], master_same["z_master"]
+    sqrt = math.sqrt
+    if end is None:
+        signs = SYNCED_SIGNS[master_same["side_master"] == near_local]
+        for slaves, foreign in ((slaves_0, foreign_0), (slaves_1, foreign_1)):
+            for d in slaves:
+                sign, dist_sign = signs[d["side_slave"] == foreign]
+                x_diff = x_master + sign * d["x_slave"]
+                y_diff = y_master + sign * d["y_slave"]
+                z_diff = z_master - d["z_slave"]
+                try:
+                    d["adjusted_dist"] = int(sqrt(d["dist_to"]**2 - z_diff**2 - y_diff**2) + dist_sign * x_diff)
+                except ValueError:
+                    d["adjusted_dist"] = NAN
+        ret = [{"vehicle_id": veh_0,
+                "master_doing_ranging": master_same,
+                "near_side_code_foreign": foreign_0,
+                "near_side_code_local": near_local,
+                "slaves_in_ranging": slaves_0}]
+        if slaves_1:
+            ret.append({"vehicle_id": veh_1,
+                        "master_doing_ranging": master_same,
+                        "near_side_code_foreign": foreign_1,
+                        "near_side_code_local": near_local,
+                        "slaves_in_ranging": slaves_1})
+        return ret
+    if check_slaves:
+        signs = ASYNC_SIGNS[end][near_local]
+        for slaves in (slaves_0, slaves_1):
+            running = INF
+            for d in slaves:
+                sign = signs[d["side_slave"]]
+                x_diff = x_master + sign * d["x_slave"]
+                y_diff = y_master + sign * d["y_slave"]
+                z_diff = z_master - d["z_slave"]
+                try:
+                    side_to_side_dist = int(sqrt(d["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
+                except ValueError:
+                    side_to_side_dist = NAN
+                running = min(side_to_side_dist, running)
+                d["adjusted_dist"] = running
+    ret = [{"vehicle_id": veh_0,
+            "master_doing_ranging": master_same,
+            "slaves_in_ranging": slaves_0,
+            "near_side_code_local": near_local,
+            "near_side_code_foreign": foreign_0}]
+    if slaves_1:
+        ret.append({"vehicle_id": veh_1,
+                    "master_doing_ranging": master_same,
+                    "slaves_in_ranging": slaves_1,
+                    "near_side_code_local": near_local,
+                    "near_side_code_foreign": foreign_1})
+    return ret
+
+
+def process_end_geometry_scalar(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end=None):
+    """ Plain Python path of process_end_geometry(), for the few slaves of a usual frame.
+        One pass over the slaves, same sign tables as the NumPy path.
+
+        :returns:
+            see process_end_geometry()
+    """
+    if not slave_dicts_same:
+        return [], 0, [], [], None
+    vehicle_ids, vehicle_pos, vehicle_idx, nearest, near_foreign = [], {}, [], [], []
+    min_same = float("inf")
+    for d in slave_dicts_same:
+        veh, dist_to = d["id_assoc"], d["dist_to"]
+        idx = vehicle_pos.get(veh)
+        if idx is None:
+            idx = vehicle_pos[veh] = len(vehicle_ids)
+            vehicle_ids.append(veh)
+            nearest.append(float("inf"))
+            near_foreign.append(0)
+        vehicle_idx.append(idx)
+        if dist_to < nearest[idx]:
+            nearest[idx], near_foreign[idx] = dist_to, d["side_slave"]
+        if dist_to < min_same:
+            min_same = dist_to
+    min_oppo = min((d["dist_to"] for d in slave_dicts_oppo), default=float("inf"))
+    if min_oppo < min_same:
+        near_local = master_oppo["side_master"]
+    else:
+        near_local = master_same["side_master"] if min_same < float("inf") else 0
+    if near_local == 0:
+        raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(vehicle_ids[0]))
+    check_slaves = end is not None and near_local in SIDE_CODES
+    if 0 in near_foreign or (check_slaves and any(d["side_slave"] not in SIDE_CODES for d in slave_dicts_same)):
+        # Errors are raised for the first vehicle (in ranging order) having one, as the per-vehicle loops did
+        undetermined_slave = set(idx for d, idx in zip(slave_dicts_same, vehicle_idx)
+                                 if check_slaves and d["side_slave"] not in SIDE_CODES)
+        for idx, veh in enumerate(vehicle_ids):
+            if near_foreign[idx] == 0:
+                raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(veh))
+            if idx in undetermined_slave:
+                raise BaseException("{} side: Undetermined side of the foreign vehicle slave unit.".format(END_NAMES[end]))
+    if end is not None and not check_slaves:
+        return vehicle_ids, near_local, near_foreign, vehicle_idx, None
+    x_master, y_master, z_master = master_same["x_master"], master_same["y_master"], master_same["z_master"]
+    sqrt, nan = math.sqrt, float("nan")
+    adjusted = []
+    if end is None:
+        signs = SYNCED_SIGNS[int(master_same["side_master"] == near_local)]
+        for d, idx in zip(slave_dicts_same, vehicle_idx):
+            sign, dist_sign = signs[int(d["side_slave"] == near_foreign[idx])]
+            x_diff = x_master + sign * d["x_slave"]
+            y_diff = y_master + sign * d["y_slave"]
+            z_diff = z_master - d["z_slave"]
+            try:
+                adjusted.append(int(sqrt(d["dist_to"]**2 - z_diff**2 - y_diff**2) + dist_sign * x_diff))
+            except ValueError:
+                adjusted.append(nan)
+    else:
+        signs = ASYNC_SIGNS[end][near_local]
+        running = [float("inf")] * len(vehicle_ids)
+        for d, idx in zip(slave_dicts_same, vehicle_idx):
+            sign = signs[d["side_slave"]]
+            x_diff = x_master + sign * d["x_slave"]
+            y_diff = y_master + sign * d["y_slave"]
+            z_diff = z_master - d["z_slave"]
+            try:
+                side_to_side_dist = int(sqrt(d["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
+            except ValueError:
+                side_to_side_dist = nan
+            running[idx] = min(side_to_side_dist, running[idx])
+            adjusted.append(running[idx])
+    return vehicle_ids, near_local, near_foreign, vehicle_idx, adjusted
+
+
+def process_end_geometry(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end=None, batch=False):
+    """ Vehicles, near sides and adjusted distances of the slaves ranged by one master
+
+        :param end: 0/1 (A/B end data point) for the async processing, None for the synced processing
+        :param batch: True to gather the slave dictionaries into NumPy columns (process_end_columns())
+        :returns:
+            (vehicle ids, near side code local, near side codes foreign (per vehicle),
+             vehicle index (per slave), adjusted distances (per slave), or None if not processed)
+    """
+    if batch:
+        if np is None:
+            raise ImportError("NumPy is required by the batch geometry engine")
+        return process_end_geometry_batch(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end)
+    return process_end_geometry_scalar(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end)
+
+
+def process_end_columns(cols_same, cols_oppo, master_same, master_oppo, end=None):
+    """ NumPy core of process_end_geometry(): all slaves ranged by the masters in one call.
+        Takes the columns of slave_columns() directly, e.g. the slaves of many frames
+        decoded offline (slave_info_codec.decode_slave_info_batch()) grouped per frame.
+
+        :returns:
+            (vehicle ids, near side code local, near side codes foreign, vehicle index, adjusted distances
+             as float64 with nan, or None if not processed), as NumPy arrays
+    """
+    if not len(cols_same):
+        return np.zeros(0, dtype=np.int64), 0, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), None
+    vehicle_ids, vehicle_idx = group_vehicles(cols_same[:, 0])
+    near_local = near_side_local(cols_same, cols_oppo, master_same, master_oppo)
+    if near_local == 0:
+        raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(vehicle_ids[0]))
+    near_foreign = cols_same[nearest_slave_by_vehicle(vehicle_idx, cols_same[:, 5], len(vehicle_ids)), 1]
+    side_slave = cols_same[:, 1]
+    # Errors are raised for the first vehicle (in ranging order) having one, as the per-vehicle loops did
+    undetermined_foreign = near_foreign == 0
+    undetermined_slave = np.zeros(len(vehicle_ids), dtype=bool)
+    if end is not None and near_local in SIDE_CODES:
+        undetermined_slave[vehicle_idx[(side_slave != SIDE_CODES[0]) & (side_slave != SIDE_CODES[1])]] = True
+    if (undetermined_foreign | undetermined_slave).any():
+        veh = np.flatnonzero(undetermined_foreign | undetermined_slave)[0]
+        if undetermined_foreign[veh]:
+            raise BaseException("Unable to determine near side of the foreign vehicle, association id: {}".format(vehicle_ids[veh]))
+        raise BaseException("{} side: Undetermined side of the foreign vehicle slave unit.".format(END_NAMES[end]))
+    if end is None:
+        near_slave = (side_slave == near_foreign[vehicle_idx]).astype(np.int64)
+        signs = np.array(SYNCED_SIGNS[int(master_same["side_master"] == near_local)])[near_slave]
+        adjusted = adjusted_distances(cols_same, master_same, signs[:, 0], signs[:, 1])
+    elif near_local in SIDE_CODES:
+        signs = np.array(ASYNC_SIGNS[end][near_local])[side_slave.astype(np.int64)]
+        adjusted = running_min_by_vehicle(adjusted_distances(cols_same, master_same, signs, -1),
+                                          vehicle_idx, len(vehicle_ids))
+    else:
+        adjusted = None
+    return vehicle_ids, near_local, near_foreign, vehicle_idx, adjusted
+
+
+def process_end_geometry_batch(slave_dicts_same, slave_dicts_oppo, master_same, master_oppo, end=None):
+    """ NumPy path of process_end_geometry()
+
+        :returns:
+            see process_end_geometry()
+    """
+    vehicle_ids, near_local, near_foreign, vehicle_idx, adjusted = process_end_columns(
+        slave_columns(slave_dicts_same), slave_columns(slave_dicts_oppo), master_same, master_oppo, end)
+    if adjusted is not None:
+        adjusted = [int(v) if v == v else float("nan") for v in adjusted.tolist()]
+    return vehicle_ids.tolist(), near_local, near_foreign.tolist(), vehicle_idx.tolist(), adjusted
+
+
+def build_vehicle_dicts(slave_dicts, master_info_dict, vehicle_ids, near_local, near_foreign, vehicle_idx, adjusted,
+                        synced=False):
+    """ Build the per-vehicle dictionaries of the processed results (in the key order of the original
+        functions), and set "adjusted_dist" of the slave dictionaries
+
+        :returns:
+            list of vehicle dictionaries, in order of the vehicles first ranged
+    """
+    slaves_by_vehicle = [[] for _ in vehicle_ids]
+    for slave_dict, veh in zip(slave_dicts, vehicle_idx):
+        slaves_by_vehicle[veh].append(slave_dict)
+    if adjusted is not None:
+        for slave_dict, adjusted_dist in zip(slave_dicts, adjusted):
+            slave_dict["adjusted_dist"] = adjusted_dist
+    if synced:
+        return [{"vehicle_id": veh,
+                 "master_doing_ranging": master_info_dict,
+                 "near_side_code_foreign": near_foreign[idx],
+                 "near_side_code_local": near_local,
+                 "slaves_in_ranging": slaves_by_vehicle[idx]}
+                for idx, veh in enumerate(vehicle_ids)]
+    return [{"vehicle_id": veh,
+             "master_doing_ranging": master_info_dict,
+             "slaves_in_ranging": slaves_by_vehicle[idx],
+             "near_side_code_local": near_local,
+             "near_side_code_foreign": near_foreign[idx]}
+            for idx, veh in enumerate(vehicle_ids)]
+
+
+def process_async_geometry(a_data_point, b_data_point, master_info_dict_a, master_info_dict_b, batch=False):
+    """ Drop-in engine of utils.process_async_raw_ranging_results()
+
+        :returns:
+            (vehicle dictionaries of the A end, vehicle dictionaries of the B end)
+    """
+    slaves_a, slaves_b = a_data_point[1], b_data_point[1]
+    ret_a = None if batch else process_end_vehicles_few(slaves_a, slaves_b, master_info_dict_a, master_info_dict_b, end=0)
+    if ret_a is None:
+        ret_a = build_vehicle_dicts(slaves_a, master_info_dict_a,
+                                    *process_end_geometry(slaves_a, slaves_b, master_info_dict_a, master_info_dict_b, end=0, batch=batch))
+    ret_b = None if batch else process_end_vehicles_few(slaves_b, slaves_a, master_info_dict_b, master_info_dict_a, end=1)
+    if ret_b is None:
+        ret_b = build_vehicle_dicts(slaves_b, master_info_dict_b,
+                                    *process_end_geometry(slaves_b, slaves_a, master_info_dict_b, master_info_dict_a, end=1, batch=batch))
+    return ret_a, ret_b
+
+
+def process_synced_geometry(ranging_results_foreign_slaves_same_side, ranging_results_foreign_slaves_opposite_side,
+                            master_info_dict_same_side, master_info_dict_opposite_side, batch=False):
+    """ Drop-in engine of utils.process_sycned_raw_ranging_results()
+
+        :returns:
+            vehicle dictionaries of the same side master
+    """
+    if not batch:
+        ret = process_end_vehicles_few(ranging_results_foreign_slaves_same_side, ranging_results_foreign_slaves_opposite_side,
+                                       master_info_dict_same_side, master_info_dict_opposite_side)
+        if ret is not None:
+            return ret
+    return build_vehicle_dicts(ranging_results_foreign_slaves_same_side, master_info_dict_same_side,
+                               *process_end_geometry(ranging_results_foreign_slaves_same_side,
+                                                     ranging_results_foreign_slaves_opposite_side,
+                                                     master_info_dict_same_side, master_info_dict_opposite_side,
+                                                     batch=batch),
+                               synced=True)
+
+
+if __name__ == "__main__":
+    # Unit Testing: hand-checked frames, then the three paths (one or two vehicles, plain Python,
+    # NumPy) against each other on random frames. The reference is the four-branch implementation
+    # of utils.process_async_raw_ranging_results()/process_sycned_raw_ranging_results() before
+    # this engine (git history), whose results these cases were checked with.
+    import copy, random, timeit
+
+    master_a = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 2}
+    master_b = dict(master_a, y_master=1470, side_master=1)
+
+    def slave(slave_id, vehicle, side, x, y, dist_to):
+        return {"slave_id": slave_id, "x_slave": x, "y_slave": y, "z_slave": 1890, "vehicle_length_slave": 15480,
+                "id_assoc": vehicle, "side_slave": side, "dist_to": dist_to}
+
+    # The A end ranged the nearest slave (near side local: A, 2). z_diff = 0 in all cases.
+    # A end, near side local 2: B slaves x_diff = x_m - x_s, y_diff = y_m - y_s; A slaves x_diff = x_m + x_s,
+    # y_diff = y_m + y_s; adjusted = sqrt(dist^2 - y_diff^2) - x_diff, running minimum per vehicle.
+    #   a9:  y_diff = -3000 > dist:                             nan
+    #   a7b: sqrt(5000^2 - 0) - (2400 - 400) = 3000
+    #   a7a: sqrt(20000^2 - 0) - (2400 + 400) = 17200           min 3000
+    #   a11: sqrt(30000^2 - 0) - (2400 + 400) = 27200
+    # B end, near side local 2: B slaves x_diff = x_m + x_s, y_diff = y_m + y_s
+    #   b7b: sqrt(10000^2 - (1470 + 4530)^2) - (2400 + 600) = 5000
+    a9 = slave("A9B0", 9, 1, 400, 1530, 100)
+    a7b, a7a = slave("A7B0", 7, 1, 400, -1470, 5000), slave("A7A0", 7, 2, 400, 1470, 20000)
+    a11 = slave("A11A", 11, 2, 400, 1470, 30000)
+    b7b = slave("B7B0", 7, 1, 600, 4530, 10000)
+    nan = float("nan")
+    async_cases = (
+        # A end slaves, B end slaves: expected adjusted distances, near side foreign per vehicle
+        ([a7b, a7a], [b7b], {"A7B0": 3000, "A7A0": 3000, "B7B0": 5000}, {7: 1}),
+        ([a9, a7b, a7a], [b7b], {"A9B0": nan, "A7B0": 3000, "A7A0": 3000, "B7B0": 5000}, {9: 1, 7: 1}),
+        ([a9, a7b, a7a, a11], [b7b], {"A9B0": nan, "A7B0": 3000, "A7A0": 3000, "A11A": 27200, "B7B0": 5000}, {9: 1, 7: 1, 11: 2}),
+    )
+
+    def check_vehicles(vehicles, slaves, master, near_local, near_foreign, adjusted, keys):
+        assert [v["vehicle_id"] for v in vehicles] == list(dict.fromkeys(d["id_assoc"] for d in slaves))
+        for v in vehicles:
+            assert list(v) == keys and v["master_doing_ranging"] is master and v["near_side_code_local"] == near_local
+            assert v["near_side_code_foreign"] == near_foreign[v["vehicle_id"]]
+            assert v["slaves_in_ranging"] == [d for d in slaves if d["id_assoc"] == v["vehicle_id"]]
+            for d in v["slaves_in_ranging"]:
+                expected = adjusted[d["slave_id"]]
+                assert d["adjusted_dist"] == expected or (expected != expected and d["adjusted_dist"] != d["adjusted_dist"]), (d, expected)
+
+    async_keys = ["vehicle_id", "master_doing_ranging", "slaves_in_ranging", "near_side_code_local", "near_side_code_foreign"]
+    batches = (False, True) if np is not None else (False,)
+    for slaves_a, slaves_b, adjusted, near_foreign in async_cases:
+        for batch in batches:
+            slaves_a, slaves_b = copy.deepcopy(slaves_a), copy.deepcopy(slaves_b)
+            ret_a, ret_b = process_async_geometry([{}, slaves_a], [{}, slaves_b], master_a, master_b, batch=batch)
+            check_vehicles(ret_a, slaves_a, master_a, 2, near_foreign, adjusted, async_keys)
+            check_vehicles(ret_b, slaves_b, master_b, 2, {7: 1}, adjusted, async_keys)
+
+    # Synced, A master (near side local A = its side: "master on the near side"), near side foreign B (1):
+    #   near slave s7b: x_diff = x_m + x_s, y_diff = -y_m - y_s: sqrt(5000^2 - 3000^2) - (2400 + 600) = 1000
+    #   far slave s7a:  x_diff = x_m - x_s, y_diff = -y_m + y_s: sqrt(6000^2 - 0) - (2400 - 15000) = 18600
+    # B master (far side), near side foreign B (1):
+    #   near slave t7b: x_diff = x_m - x_s, y_diff = -y_m + y_s: sqrt(10000^2 - 6000^2) + (2400 - 600) = 9800
+    s7b, s7a = slave("S7B0", 7, 1, 600, -1530, 5000), slave("S7A0", 7, 2, 15000, -1470, 6000)
+    t7b = slave("T7B0", 7, 1, 600, 7470, 10000)
+    synced_keys = ["vehicle_id", "master_doing_ranging", "near_side_code_foreign", "near_side_code_local", "slaves_in_ranging"]
+    for batch in batches:
+        slaves_a, slaves_b = copy.deepcopy([s7b, s7a]), copy.deepcopy([t7b])
+        check_vehicles(process_synced_geometry(slaves_a, slaves_b, master_a, master_b, batch=batch), slaves_a, master_a, 2,
+                       {7: 1}, {"S7B0": 1000, "S7A0": 18600}, synced_keys)
+        check_vehicles(process_synced_geometry(slaves_b, slaves_a, master_b, master_a, batch=batch), slaves_b, master_b, 2,
+                       {7: 1}, {"T7B0": 9800}, synced_keys)
+
+    # Errors, as raised by the original functions
+    for slaves_a, message in (([slave("A7X0", 7, 0, 400, 0, 100)], "Unable to determine near side of the foreign vehicle, association id: 7"),
+                              ([a7b, slave("A7X0", 7, 0, 400, 0, 9000)], "A side: Undetermined side of the foreign vehicle slave unit.")):
+        for batch in batches:
+            try:
+                process_async_geometry([{}, copy.deepcopy(slaves_a)], [{}, [b7b]], master_a, master_b, batch=batch)
+                raise AssertionError("no error raised")
+            except AssertionError:
+                raise
+            except BaseException as e:
+                assert str(e) == message, e
+    print("Hand-checked frames: adjusted distances, near sides and errors as the original implementations")
+
+    def run(func, *args):
+        args = copy.deepcopy(args)
+        try:
+            return repr(func(*args)), repr(args)
+        except BaseException as e:
+            return repr(e), None
+
+    def scalar_async(a_data_point, b_data_point, master_info_dict_a, master_info_dict_b):
+        slaves_a, slaves_b = a_data_point[1], b_data_point[1]
+        return (build_vehicle_dicts(slaves_a, master_info_dict_a,
+                                    *process_end_geometry_scalar(slaves_a, slaves_b, master_info_dict_a, master_info_dict_b, end=0)),
+                build_vehicle_dicts(slaves_b, master_info_dict_b,
+                                    *process_end_geometry_scalar(slaves_b, slaves_a, master_info_dict_b, master_info_dict_a, end=1)))
+
+    def scalar_synced(slaves_same, slaves_oppo, master_same, master_oppo):
+        return build_vehicle_dicts(slaves_same, master_same,
+                                   *process_end_geometry_scalar(slaves_same, slaves_oppo, master_same, master_oppo), synced=True)
+
+    def random_slave(vehicle, side):
+        return {"slave_id": "{:04X}".format(random.randint(0, 0xFFFF)),
+                "x_slave": random.randint(-400, 20000) // 10 * 10,
+                "y_slave": random.choice((-1, 1)) * random.randint(0, 3500) // 10 * 10,
+                "z_slave": random.randint(0, 3000) // 10 * 10,
+                "vehicle_length_slave": 15480, "id_assoc": vehicle, "side_slave": side,
+                "dist_to": random.randint(0, 60000)}
+
+    def random_end(n_vehicles, bad_side=0.0):
+        slaves = [random_slave(veh, 0 if random.random() < bad_side else side)
+                  for veh in random.sample(range(1, 255), n_vehicles) for side in random.sample(SIDE_CODES, random.randint(1, 2))]
+        random.shuffle(slaves)
+        if random.random() < 0.9:
+            slaves.sort(key=lambda x: x.get("dist_to", float("inf")))
+        return slaves
+
+    random.seed(0)
+    cases = 0
+    for trial in range(20000):
+        slaves_a = random_end(random.randint(0, 4), bad_side=0.02)
+        slaves_b = random_end(random.randint(0, 4), bad_side=0.02)
+        if random.random() < 0.1:
+            # Ties between distances
+            for d in slaves_a + slaves_b:
+                d["dist_to"] = random.choice((1000, 2000))
+        ma, mb = (master_a, master_b) if random.random() < 0.95 else (dict(master_a, side_master=random.randint(0, 3)), master_b)
+        expected_async = run(scalar_async, [{}, slaves_a], [{}, slaves_b], ma, mb)
+        expected_synced = run(scalar_synced, slaves_a, slaves_b, ma, mb)
+        for batch in batches:
+            assert run(lambda *a: process_async_geometry(*a, batch=batch), [{}, slaves_a], [{}, slaves_b], ma, mb) == expected_async, (slaves_a, slaves_b, ma, batch)
+            assert run(lambda *a: process_synced_geometry(*a, batch=batch), slaves_a, slaves_b, ma, mb) == expected_synced, (slaves_a, slaves_b, ma, batch)
+        cases += 2
+    print("{} random A/B frames processed identically by the {} paths".format(
+          cases, "one or two vehicles, plain Python and NumPy" if np is not None else "one or two vehicles and plain Python"))
+    if np is None:
+        sys.exit(0)
+
+    # Per-frame cost (both ends) as the number of foreign vehicles in range grows
+    print("async, us per frame:  vehicles | plain Python | NumPy from dicts | NumPy columns (one end)")
+    for n_vehicles in (1, 2, 4, 8, 16, 32, 64, 128, 250):
+        slaves_a, slaves_b = random_end(n_vehicles), random_end(n_vehicles)
+        cols_a, cols_b = slave_columns(slaves_a), slave_columns(slaves_b)
+        n = max(20, 4000 // n_vehicles)
+        args = ([{}, slaves_a], [{}, slaves_b], master_a, master_b)
+        timings = [timeit.timeit(lambda: func(*args), number=n) / n * 1e6 for func in (
+                   lambda *a: process_async_geometry(*a, batch=False),
+                   lambda *a: process_async_geometry(*a, batch=True),
+                   lambda *a: process_end_columns(cols_a, cols_b, master_a, master_b, 0))]
+        print("                     {:9d} | {:12.1f} | {:16.1f} | {:13.1f}".format(n_vehicles, *timings))
+    print("synced, us per frame: vehicles | plain Python | NumPy from dicts | NumPy columns")
+    for n_vehicles in (1, 4, 16, 64, 128, 250):
+        slaves_a, slaves_b = random_end(n_vehicles), random_end(n_vehicles)
+        cols_a, cols_b = slave_columns(slaves_a), slave_columns(slaves_b)
+        n = max(20, 4000 // n_vehicles)
+        args = (slaves_a, slaves_b, master_a, master_b)
+        timings = [timeit.timeit(lambda: func(*args), number=n) / n * 1e6 for func in (
+                   lambda *a: process_synced_geometry(*a, batch=False),
+                   lambda *a: process_synced_geometry(*a, batch=True),
+                   lambda *a: process_end_columns(cols_a, cols_b, master_a, master_b))]
+        print("                     {:9d} | {:12.1f} | {:16.1f} | {:13.1f}".format(n_vehicles, *timings))
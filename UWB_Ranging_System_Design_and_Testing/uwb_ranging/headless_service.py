@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+
+import sys, os, time, json, math, socket, signal, threading, queue
+from utils import timestamp_log, process_async_raw_ranging_results, display_safety_ranging_results, RX_STAMP_KEY
+from mono_clock import CLOCK
+from frame_records import RecordMapping
+from vehicle_tracker import frame_time_ns
+from ttc_estimator import format_ttc
+from pipeline_latency import PIPELINE_LATENCY
+from metrics_server import METRICS, count_detections
+
+
+# This file contains the headless ranging service of uwb_master.py, used when there is no display.
+# The main thread sleeps on the Event of the A/B pair source (end_fusion.py) and wakes up only when
+# a new pair is available: timestamp-aligned A/B frames (EndFusionBuffer), or the latest frame of
+# each end (LatestPairSource). For every new A/B pair it runs process_async_raw_ranging_results(),
+# tracks the vehicles (vehicle_tracker.py, distances predicted at publishing time), estimates their
+# closing speed and TTC (ttc_estimator.py, threshold crossings in "events"), sets the update rate of
+# the masters accordingly (rate_controller.py) and publishes one result record to the output sinks:
+#   "stdout":                   JSON lines on the standard output (the ranging log of ranging_service.sh)
+#   "unix:/path/to/socket":     JSON datagrams to a local Unix socket, dropped if nobody is listening
+#   "udp:host:port":            JSON datagrams to a UDP address
+#   "mqtt://host[:port]/topic": MQTT messages (requires paho-mqtt, as ../tag_mqtt_publisher)
+# SIGINT/SIGTERM stop the service: the ranging job is stopped, the sinks and serial ports are closed.
+# The service also stops when the ranging thread died, so that ranging_service.sh restarts the program.
+
+A_END_CODE, B_END_CODE = 2, 1
+SERVICE_IDLE_CHECK = 1.0        # Seconds between ranging thread checks when no frame is reported
+MQTT_DEFAULT_PORT = 1883
+
+
+class StdoutJsonSink():
+
+    # JSON lines on the standard output
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+
+    def publish(self, record):
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class DatagramJsonSink():
+
+    # JSON datagrams to a local Unix socket or a UDP address. Never blocks: records are
+    # dropped while there is no receiver.
+    def __init__(self, address, family):
+        self.address = address
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.dropped = 0
+
+    def publish(self, record):
+        try:
+            self.sock.sendto(json.dumps(record).encode(), self.address)
+        except OSError:
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
+
+
+class MqttJsonSink():
+
+    # MQTT messages to a broker, published from the network thread of paho-mqtt
+    def __init__(self, host, port, topic):
+        import paho.mqtt.client as mqtt
+        self.topic = topic
+        self.client = mqtt.Client("UWB Ranging:{}".format(socket.gethostname()))
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def publish(self, record):
+        self.client.publish(self.topic, json.dumps(record), qos=0, retain=True)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def make_sink(spec):
+    """ :returns:
+            output sink of the given specification (see the header of this file)
+    """
+    if spec == "stdout":
+        return StdoutJsonSink()
+    if spec.startswith("unix:"):
+        return DatagramJsonSink(spec[len("unix:"):], socket.AF_UNIX)
+    if spec.startswith("udp:"):
+        host, port = spec[len("udp:"):].rsplit(":", 1)
+        return DatagramJsonSink((host, int(port)), socket.AF_INET)
+    if spec.startswith("mqtt://"):
+        address, _, topic = spec[len("mqtt://"):].partition("/")
+        host, _, port = address.partition(":")
+        return MqttJsonSink(host, int(port) if port else MQTT_DEFAULT_PORT, topic or "uwb/ranging")
+    raise ValueError("unknown output sink: {}".format(spec))
+
+
+def json_safe(value):
+    """ Replace the non-finite distances (inf: not ranged, nan: inconsistent geometry) by None,
+        as NaN/Infinity are not valid JSON for the consumers of the sinks
+
+        :returns:
+            copy of the value with None in place of non-finite floats
+    """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, (dict, RecordMapping)):
+        # The frame records (frame_records.py) as their legacy dictionaries
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def make_result_record(a_data_point, b_data_point, seq_a, seq_b, tracker=None, ttc_monitor=None, rate_controller=None):
+    """ Run the adjusted distance processing of an A/B pair of data points. With a VehicleTracker
+        (vehicle_tracker.py), the vehicles are tracked and the distances are predicted at publishing time.
+        With a TtcMonitor (ttc_estimator.py), the closing speed, TTC and threshold crossings are added.
+        With an AdaptiveRateController (rate_controller.py), the update rate of the masters follows the vehicles.
+
+        :returns:
+            dictionary of the per-end display text, safety distance flag and detected vehicles
+    """
+    a_master_info_pos = a_data_point[0]['masterInfoPos']
+    b_master_info_pos = b_data_point[0]['masterInfoPos']
+    veh_detection_list_a, veh_detection_list_b = process_async_raw_ranging_results(a_data_point, b_data_point,
+                                                                                  a_master_info_pos, b_master_info_pos)
+    if tracker is not None:
+        publish_time_ns = time.monotonic_ns()
+        tracker.update(A_END_CODE, veh_detection_list_a, frame_time_ns(a_data_point))
+        tracker.update(B_END_CODE, veh_detection_list_b, frame_time_ns(b_data_point))
+        tracker.annotate_prediction(A_END_CODE, veh_detection_list_a, publish_time_ns)
+        tracker.annotate_prediction(B_END_CODE, veh_detection_list_b, publish_time_ns)
+    events = []
+    if ttc_monitor is not None:
+        events = (ttc_monitor.update(A_END_CODE, veh_detection_list_a, frame_time_ns(a_data_point))
+                  + ttc_monitor.update(B_END_CODE, veh_detection_list_b, frame_time_ns(b_data_point)))
+    if rate_controller is not None:
+        rate_controller.update(A_END_CODE, veh_detection_list_a, frame_time_ns(a_data_point),
+                               a_data_point[0].get("superFrameNumber"))
+        rate_controller.update(B_END_CODE, veh_detection_list_b, frame_time_ns(b_data_point),
+                               b_data_point[0].get("superFrameNumber"))
+    a_txt, a_flag = display_safety_ranging_results(veh_detection_list_a, length_unit="METRIC", use_predicted=tracker is not None)
+    b_txt, b_flag = display_safety_ranging_results(veh_detection_list_b, length_unit="METRIC", use_predicted=tracker is not None)
+    a_txt += format_ttc(veh_detection_list_a)
+    b_txt += format_ttc(veh_detection_list_b)
+    # Reception time skew of the ends, from their monotonic stamps (None if not stamped)
+    time_diff = None
+    if RX_STAMP_KEY in a_data_point[0] and RX_STAMP_KEY in b_data_point[0]:
+        time_diff = abs(a_data_point[0][RX_STAMP_KEY] - b_data_point[0][RX_STAMP_KEY]) / 1e9
+    now_ns = CLOCK.now_ns()
+    return json_safe({"timeStamp": CLOCK.format_local(now_ns) + " local ",
+            "timeNs": CLOCK.wall_ns(now_ns),
+            "A": {"seq": seq_a, "superFrameNumber": a_data_point[0].get("superFrameNumber"),
+                  "text": a_txt, "flag": a_flag, "vehicles": veh_detection_list_a},
+            "B": {"seq": seq_b, "superFrameNumber": b_data_point[0].get("superFrameNumber"),
+                  "text": b_txt, "flag": b_flag, "vehicles": veh_detection_list_b},
+            "timeDiff": time_diff,
+            "events": events})
+
+
+class HeadlessRangingService():
+
+    # Event-driven consumer of an A/B pair source (end_fusion.py), publishing to the output sinks
+    def __init__(self, pair_source, notify, sinks, ranging_thread=None, serial_ports=None, tracker=None, ttc_monitor=None,
+                 rate_controller=None):
+        self.pair_source = pair_source
+        self.tracker = tracker
+        self.ttc_monitor = ttc_monitor
+        self.rate_controller = rate_controller
+        self.notify = notify
+        self.sinks = sinks
+        self.ranging_thread = ranging_thread
+        self.serial_ports = {} if serial_ports is None else serial_ports
+        self.stop_event = threading.Event()
+        self.last_a_data_point, self.last_b_data_point = None, None
+        self.published = 0
+        self.errors = 0
+
+    def stopped(self):
+        """ Stop flag callback of the ranging job
+        """
+        return self.stop_event.is_set()
+
+    def stop(self, signum=None, frame=None):
+        if signum is not None:
+            sys.stdout.write(timestamp_log() + "Headless ranging service: signal {} received, stopping\n".format(signum))
+        self.stop_event.set()
+        self.notify.set()
+
+    def install_signal_handlers(self):
+        # Only possible from the main thread
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+    def process_new_frames(self):
+        """ Take the latest A/B pair of the pair source and publish its result
+
+            :returns:
+                True if a result was published
+        """
+        try:
+            self.last_a_data_point, self.last_b_data_point = self.pair_source.get(block=False)
+        except queue.Empty:
+            return False
+        taken_ns = time.monotonic_ns()
+        try:
+            record = make_result_record(self.last_a_data_point, self.last_b_data_point,
+                                        self.pair_source.seq_a, self.pair_source.seq_b, self.tracker, self.ttc_monitor,
+                                        self.rate_controller)
+            geometry_ns = time.monotonic_ns()
+        except Exception as e:
+            self.errors += 1
+            sys.stdout.write(timestamp_log() + "Headless ranging service: processing failed: {}\n".format(repr(e)))
+            return False
+        for sink in self.sinks:
+            try:
+                sink.publish(record)
+            except Exception as e:
+                self.errors += 1
+                sys.stdout.write(timestamp_log() + "Headless ranging service: publishing failed: {}\n".format(repr(e)))
+        PIPELINE_LATENCY.record_pair((self.last_a_data_point, self.last_b_data_point), taken_ns, geometry_ns, time.monotonic_ns())
+        METRICS.inc("uwb_consumer_pairs_total")
+        count_detections("A", record["A"]["vehicles"])
+        count_detections("B", record["B"]["vehicles"])
+        self.published += 1
+        return True
+
+    def run(self):
+        """ Serve until stopped (signal, stop()) or until the ranging thread died
+
+            :returns:
+                0 if stopped, 1 if the ranging thread died
+        """
+        sys.stdout.write(timestamp_log() + "Headless ranging service started\n")
+        ret = 0
+        try:
+            while not self.stop_event.is_set():
+                # Sleep until any end reports a frame; check the ranging thread while idle
+                if not self.notify.wait(SERVICE_IDLE_CHECK):
+                    if self.ranging_thread is not None and not self.ranging_thread.is_alive():
+                        sys.stdout.write(timestamp_log() + "Headless ranging service: ranging thread stopped\n")
+                        ret = 1
+                        break
+                    continue
+                self.notify.clear()
+                self.process_new_frames()
+        finally:
+            self.close()
+        return ret
+
+    def close(self):
+        self.stop_event.set()
+        if self.ranging_thread is not None:
+            self.ranging_thread.join(timeout=2.0)
+        if self.rate_controller is not None:
+            # The masters back to 10 Hz before their ports are closed
+            self.rate_controller.close()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
+        for dev, entry in list(self.serial_ports.items()):
+            port = entry.get("port")
+            if port is not None and port.is_open:
+                port.close()
+        sys.stdout.write(timestamp_log() + "Headless ranging service stopped: {} results published, {}\n"
+                         .format(self.published, self.pair_source.summary()))
+
+
+if __name__ == "__main__":
+    # Unit Testing: replay the sample field test log at 10 Hz into both ends, publish to a Unix
+    # socket and stdout, stop with SIGTERM, and measure the CPU time of the idle service.
+    import tempfile, io
+    from dist_parser import parse_dist_report
+    from data_mailbox import LatestValueMailbox
+    from end_fusion import EndFusionBuffer, LatestPairSource
+    from vehicle_tracker import VehicleTracker
+    from ttc_estimator import TtcMonitor
+    from utils import EndReportingProcessor
+
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+    lines = lines[:50]
+
+    tmp_dir = tempfile.mkdtemp()
+    notify = threading.Event()
+    fusion = EndFusionBuffer(notify=notify)
+    # Master positions and local slaves of the sample log (B end), A end mirrored
+    master_b = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 1}
+    master_a = dict(master_b, side_master=2)
+    local_slaves = {"8D38": {}, "1912": {}}
+    sys.stdout, log_out = io.StringIO(), sys.stdout
+    processor_a = EndReportingProcessor(local_slaves, 2, master_a, fusion.end_queue(2), tmp_dir, exp_name="headless-test")
+    processor_b = EndReportingProcessor(local_slaves, 1, master_b, fusion.end_queue(1), tmp_dir, exp_name="headless-test")
+    processor_a.start()
+    processor_b.start()
+
+    def ranging_job():
+        for line in lines:
+            if service.stopped():
+                break
+            processor_a.process_line(line)
+            processor_b.process_line(line)
+            time.sleep(0.1)
+        # Idle afterwards, as the masters do when no slave is in range
+        while not service.stopped():
+            time.sleep(0.1)
+        processor_a.stop(verbose=False)
+        processor_b.stop(verbose=False)
+
+    socket_path = os.path.join(tmp_dir, "ranging.sock")
+    receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    receiver.bind(socket_path)
+    receiver.settimeout(0.5)
+    received = []
+    def receiver_job():
+        try:
+            while True:
+                received.append(json.loads(receiver.recv(65536)))
+        except socket.timeout:
+            pass
+    receiver_thread = threading.Thread(target=receiver_job, daemon=True)
+    receiver_thread.start()
+    stdout_sink = StdoutJsonSink(io.StringIO())
+    ranging_thread = threading.Thread(target=ranging_job, daemon=True)
+    service = HeadlessRangingService(fusion, notify, [make_sink("unix:" + socket_path), stdout_sink],
+                                     ranging_thread=ranging_thread, tracker=VehicleTracker(), ttc_monitor=TtcMonitor())
+    service.install_signal_handlers()
+    threading.Timer(len(lines) * 0.1 + 2.0, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    ranging_thread.start()
+    cpu_0, t_0 = time.process_time(), time.monotonic()
+    ret = service.run()
+    elapsed, cpu = time.monotonic() - t_0, time.process_time() - cpu_0
+    sys.stdout = log_out
+
+    receiver_thread.join()
+    json_lines = [json.loads(l) for l in stdout_sink.stream.getvalue().splitlines()]
+    assert ret == 0 and not ranging_thread.is_alive()
+    assert len(received) == len(json_lines) == service.published >= len(lines) - 1, (len(received), service.published)
+    assert received[-1]["A"]["superFrameNumber"] == received[-1]["B"]["superFrameNumber"] == len(lines) - 1
+    assert all(r["A"]["text"] for r in received) and service.errors == 0
+    # Same adjusted distances as without tracking, plus the tracked/predicted distances
+    expected = make_result_record(service.last_a_data_point, service.last_b_data_point, fusion.seq_a, fusion.seq_b)
+    tracker_keys = ("tracked_dist", "closing_speed", "predicted_dist", "ttc", "ttc_closing_speed")
+    for end in ("A", "B"):
+        tracked = [veh_dict for veh_dict in received[-1][end]["vehicles"] if "tracked_dist" in veh_dict]
+        assert all(all(key in veh_dict for key in tracker_keys) for veh_dict in tracked)
+        assert ([{k: v for k, v in veh_dict.items() if k not in tracker_keys} for veh_dict in received[-1][end]["vehicles"]]
+                == expected[end]["vehicles"])
+    assert tracked
+    print("{} frames per end in {:.1f} s -> {} results published, stopped by SIGTERM | CPU {:.1f} % of a core"
+          .format(len(lines), elapsed, service.published, 100 * cpu / elapsed))
+    print("last result: A: {} | B: {}".format(received[-1]["A"]["text"], received[-1]["B"]["text"]))
+    print(fusion.summary())
+
+    # The idle service sleeps: CPU time of 2 s without frames vs the "while True: pass" spin
+    service = HeadlessRangingService(LatestPairSource(LatestValueMailbox(), LatestValueMailbox()), threading.Event(), [])
+    threading.Timer(2.0, service.stop).start()
+    cpu_0 = time.process_time()
+    sys.stdout, log_out = io.StringIO(), sys.stdout
+    service.run()
+    sys.stdout = log_out
+    cpu_idle = time.process_time() - cpu_0
+    t_spin = time.monotonic() + 0.2
+    cpu_spin = time.process_time()
+    while time.monotonic() < t_spin:
+        pass
+    cpu_spin = time.process_time() - cpu_spin
+    print("idle CPU: service {:.3f} s per 2 s | spin loop {:.2f} s per 0.2 s".format(cpu_idle, cpu_spin))
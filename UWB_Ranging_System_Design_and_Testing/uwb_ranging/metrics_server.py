@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+import sys, time, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pipeline_latency import PIPELINE_LATENCY
+
+
+# This file contains the metrics endpoint of the ranging process: http://127.0.0.1:<port>/metrics
+# in the Prometheus text exposition format (version 0.0.4).
+# Counters are kept per thread (ThreadCounters): every thread increments its own dictionary, created
+# and registered at its first increment. The scraper sums copies of these dictionaries (one atomic
+# dict.copy() each under the GIL). Neither the serial threads nor the scraper take a lock to count or
+# read; only the registration of a new thread does, once. The counters of the threads that have ended
+# are folded into a retired total at the next scrape, so the pairing workers, supervisor recoveries and
+# TLV polling threads of a long service life do not pile up.
+# Gauges and the counters of existing components are sampled at scrape time by collectors
+# (set_collector()): the queue depths and drops of the A/B pair source, the stage latency quantiles
+# of pipeline_latency.py. The rates (frames/s, vehicle detection rate) are computed over the period
+# since the previous scrape.
+# Counted by:
+#   EndReportingProcessor (utils.py):   frames, parse failures and regex fallbacks per end
+#   end_ranging_job_async_single:       serial read errors and reporting failures per end
+#   serial_mux.py:                      dropped ports and discarded bytes per end
+#   pairing_uwb_ports:                  pairing results per status, serial reopens per port
+#   GUI / headless service consumers:   A/B pairs processed and vehicle detections per end
+#   clock_sync.py (collector):          offset, drift and delay of the clocks of the peer vehicles
+#   rate_controller.py (collector):     update rate of the masters, rate changes and commands
+
+METRICS_HOST = "127.0.0.1"      # Local endpoint only
+METRICS_PORT = 9188             # Default port of uwb_master.py --metrics-port, 0: no endpoint
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+# name: (type, help)
+METRICS_HELP = {
+    "uwb_frames_total":                 ("counter", "Ranging frames reported by the master of an end"),
+    "uwb_frame_rate_hz":                ("gauge", "Ranging frames per second of the master of an end, since the previous scrape"),
+    "uwb_parse_failures_total":         ("counter", "DIST lines of an end that could not be parsed"),
+    "uwb_regex_fallbacks_total":        ("counter", "DIST lines of an end parsed by the regular expression fallback"),
+    "uwb_serial_errors_total":          ("counter", "Serial read errors of the master of an end"),
+    "uwb_reporting_failures_total":     ("counter", "End reporting jobs or multiplexed ports stopped by an error"),
+    "uwb_discarded_bytes_total":        ("counter", "Serial bytes of an end discarded without a line ending"),
+    "uwb_serial_reopens_total":         ("counter", "Serial ports closed and opened again while pairing"),
+    "uwb_pairing_total":                ("counter", "Serial ports paired, per result"),
+    "uwb_queue_depth":                  ("gauge", "Frames of an end waiting for the A/B pairing or the consumer"),
+    "uwb_dropped_frames_total":         ("counter", "Frames of an end never processed by the consumer, per reason"),
+    "uwb_dropped_pairs_total":          ("counter", "A/B pairs replaced by a newer one before the consumer took them"),
+    "uwb_stage_latency_seconds":        ("summary", "Latency of a stage of the ranging pipeline per end (pipeline_latency.py), since start"),
+    "uwb_consumer_pairs_total":         ("counter", "A/B pairs processed by the consumer (GUI, headless service)"),
+    "uwb_vehicle_detections_total":     ("counter", "A/B pairs in which a vehicle was detected by an end"),
+    "uwb_vehicle_detection_rate":       ("gauge", "Fraction of the A/B pairs in which a vehicle was detected by an end, since the previous scrape"),
+    "uwb_clock_offset_seconds":         ("gauge", "Clock of a peer vehicle computer minus the local clock (clock_sync.py)"),
+    "uwb_clock_drift_ppm":              ("gauge", "Drift of the clock of a peer vehicle computer relative to the local clock"),
+    "uwb_clock_sync_delay_seconds":     ("gauge", "Round trip delay of the latest clock sync sample kept for a peer"),
+    "uwb_clock_sync_timeouts_total":    ("counter", "Clock sync requests to a peer without a reply"),
+    "uwb_update_rate_hz":               ("gauge", "Update rate set on the master of an end by the adaptive rate controller"),
+    "uwb_rate_changes_total":           ("counter", "Update rate changes of the masters, per direction"),
+    "uwb_rate_changes_suppressed_total": ("counter", "Update rate lowerings held back by the rate change budget"),
+    "uwb_rate_commands_total":          ("counter", "Update rate commands to the masters, per result"),
+    "uwb_rate_confirmations_total":     ("counter", "Update rate changes checked against the frame period of the masters, per result"),
+}
+
+
+class ThreadCounters():
+
+    # Counters of one thread, written by this thread only: {(name, labels): value}
+    # labels: tuple of (label name, value) pairs, e.g. (("end", "A"),)
+    def __init__(self, thread):
+        self.thread = thread
+        self.thread_name = thread.name
+        self.values = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class MetricsRegistry():
+
+    # Per-thread counters and scrape-time collectors
+    def __init__(self):
+        self._local = threading.local()
+        self._thread_counters = []      # replaced under the lock (new or ended threads), read without it
+        self._retired = {}              # {(name, labels): value} of the ended threads, under the lock
+        self._register_lock = threading.Lock()
+        self._collectors = {}           # key: callable returning [(name, labels, value)]
+        self._scrape_lock = threading.Lock()    # between scrapers only
+        self._previous = None           # (time, {(name, labels): value}) of the previous scrape
+
+    def thread_counters(self):
+        """ :returns:
+                ThreadCounters of the calling thread
+        """
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = ThreadCounters(threading.current_thread())
+            with self._register_lock:
+                self._thread_counters = self._thread_counters + [counters]
+            self._local.counters = counters
+            return counters
+
+    def inc(self, name, labels=(), amount=1):
+        """ Increment a counter of the calling thread
+        """
+        self.thread_counters().inc(name, labels, amount)
+
+    def set_collector(self, key, collector):
+        """ Register (replace) the collector of a component, called at every scrape; None to remove it.
+            collector(): list of (name, labels, value) samples
+        """
+        collectors = dict(self._collectors)
+        if collector is None:
+            collectors.pop(key, None)
+        else:
+            collectors[key] = collector
+        self._collectors = collectors
+
+    def counter_values(self):
+        """ :returns:
+                {(name, labels): value} summed over all threads
+        """
+        if any(not counters.thread.is_alive() for counters in self._thread_counters):
+            self._retire_ended_threads()
+        with self._register_lock:
+            totals = dict(self._retired)
+            thread_counters = self._thread_counters
+        for counters in thread_counters:
+            for key, value in counters.values.copy().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def _retire_ended_threads(self):
+        # An ended thread does not count anymore: its values are final
+        with self._register_lock:
+            alive = []
+            for counters in self._thread_counters:
+                if counters.thread.is_alive():
+                    alive.append(counters)
+                    continue
+                for key, value in counters.values.items():
+                    self._retired[key] = self._retired.get(key, 0) + value
+            self._thread_counters = alive
+
+    def collect(self):
+        """ :returns:
+                list of (name, labels, value) samples of the counters, the collectors and the rates
+        """
+        with self._scrape_lock:
+            now = time.monotonic()
+            totals = self.counter_values()
+            samples = [(name, labels, value) for (name, labels), value in totals.items()]
+            for key, collector in list(self._collectors.items()):
+                try:
+                    samples.extend(collector())
+                except Exception as e:
+                    from utils import timestamp_log
+                    sys.stdout.write(timestamp_log() + "Metrics collector {} failed: {}\n".format(key, repr(e)))
+            samples.extend(latency_samples())
+            samples.extend(self._rates(now, totals))
+            self._previous = (now, totals)
+        return samples
+
+    def _rates(self, now, totals):
+        if self._previous is None:
+            return []
+        then, previous = self._previous
+        elapsed = now - then
+        samples = []
+        pairs = {}
+        for (name, labels), value in totals.items():
+            if name == "uwb_consumer_pairs_total":
+                pairs[labels] = value - previous.get((name, labels), 0)
+        for (name, labels), value in totals.items():
+            delta = value - previous.get((name, labels), 0)
+            if name == "uwb_frames_total" and elapsed > 0:
+                samples.append(("uwb_frame_rate_hz", labels, delta / elapsed))
+            elif name == "uwb_vehicle_detections_total":
+                n_pairs = sum(pairs.values())
+                samples.append(("uwb_vehicle_detection_rate", labels, delta / n_pairs if n_pairs else 0.0))
+        return samples
+
+    def render(self):
+        """ :returns:
+                text of all metrics in the Prometheus exposition format
+        """
+        by_name = {}
+        for name, labels, value in self.collect():
+            base = name
+            for suffix in ("_sum", "_count"):
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS_HELP:
+                    base = name[:-len(suffix)]
+            by_name.setdefault(base, []).append((name, labels, value))
+        lines = []
+        for base in sorted(by_name):
+            metric_type, help_text = METRICS_HELP.get(base, ("untyped", ""))
+            lines.append("# HELP {} {}".format(base, help_text))
+            lines.append("# TYPE {} {}".format(base, metric_type))
+            for name, labels, value in sorted(by_name[base], key=lambda s: (s[0], s[1])):
+                lines.append(name + format_labels(labels) + " " + format_value(value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def latency_samples(latency=PIPELINE_LATENCY):
+    """ :returns:
+            summary samples (quantiles, sum, count in seconds) of the stage latency histograms
+    """
+    samples = []
+    for (stage, end_name), histogram in latency.snapshot().items():
+        if histogram.count == 0:
+            continue
+        labels = (("stage", stage), ("end", end_name))
+        for q in LATENCY_QUANTILES:
+            samples.append(("uwb_stage_latency_seconds", labels + (("quantile", "{:g}".format(q)),),
+                            histogram.percentile(q * 100) / 1e6))
+        samples.append(("uwb_stage_latency_seconds_sum", labels, histogram.total / 1e6))
+        samples.append(("uwb_stage_latency_seconds_count", labels, histogram.count))
+    return samples
+
+
+def count_detections(end_name, veh_detection_list, registry=None):
+    """ Count the vehicles detected by an end in one A/B pair (GUI and headless consumers)
+    """
+    counters = (METRICS if registry is None else registry).thread_counters()
+    for vehicle in veh_detection_list:
+        counters.inc("uwb_vehicle_detections_total", (("end", end_name), ("vehicle", str(vehicle.get("vehicle_id")))))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    # GET /metrics
+    def do_GET(self):
+        if self.path.split("?")[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # No access log in the ranging log
+        pass
+
+
+class MetricsServer():
+
+    # HTTP endpoint of a registry, served by a daemon thread
+    def __init__(self, registry=None, host=METRICS_HOST, port=METRICS_PORT):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = METRICS if registry is None else registry
+        self.address = self.httpd.server_address
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="Metrics Endpoint", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """ Serve the metrics of the running program, if the port is not 0
+
+        :returns:
+            MetricsServer, or None if disabled or the port is not available
+    """
+    if not port:
+        return None
+    from utils import timestamp_log
+    try:
+        server = MetricsServer(METRICS, host, port).start()
+    except OSError as e:
+        sys.stdout.write(timestamp_log() + "Metrics endpoint not available on {}:{}: {}\n".format(host, port, repr(e)))
+        return None
+    sys.stdout.write(timestamp_log() + "Metrics endpoint: http://{}:{}{}\n".format(host, server.address[1], METRICS_PATH))
+    return server
+
+
+# Metrics of the running program
+METRICS = MetricsRegistry()
+
+
+if __name__ == "__main__":
+    # Unit Testing: counters of concurrent threads against the exact totals, the sample field test
+    # log through both end processors, the fusion buffer and a consumer, scraped over HTTP while the
+    # frames are processed; and the scrape cost.
+    import os, queue, tempfile, urllib.request
+
+    registry = MetricsRegistry()
+    def counting_job(end_name, n):
+        labels = (("end", end_name),)
+        for _ in range(n):
+            registry.inc("uwb_frames_total", labels)
+    threads = [threading.Thread(target=counting_job, args=("A" if i % 2 else "B", 20000)) for i in range(8)]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        registry.collect()
+    for t in threads:
+        t.join()
+    totals = registry.counter_values()
+    assert totals[("uwb_frames_total", (("end", "A"),))] == totals[("uwb_frames_total", (("end", "B"),))] == 80000
+    # The ended threads are folded into the retired total
+    assert not registry._thread_counters and registry.counter_values() == totals
+    for _ in range(3):
+        t = threading.Thread(target=counting_job, args=("A", 10))
+        t.start()
+        t.join()
+    registry.inc("uwb_frames_total", (("end", "A"),))
+    assert registry.counter_values()[("uwb_frames_total", (("end", "A"),))] == 80031 and len(registry._thread_counters) == 1
+
+    # The instances of the imported modules, not of this __main__ one
+    from metrics_server import METRICS as registry, MetricsServer as Server
+    from utils import EndReportingProcessor, process_async_raw_ranging_results
+    from end_fusion import EndFusionBuffer
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+    lines = lines[:400]
+    # A convoluted line (regex fallback) and an unparseable one
+    lines[10] = lines[10].replace(b";POS=", b";ACC=[1,2,3];POS=", 1)
+    lines[20] = b"DIST,4;[AN0,8D38,1,2,3]=[,100];"
+
+    master_b = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 1}
+    masters = {2: dict(master_b, side_master=2), 1: master_b}
+    fusion = EndFusionBuffer()
+    registry.set_collector("pair_source", fusion.metric_samples)
+    server = Server(registry, port=0).start()
+    url = "http://{}:{}{}".format(server.address[0], server.address[1], METRICS_PATH)
+    scrapes = []
+    stop = threading.Event()
+    def scraping_job():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(url) as response:
+                scrapes.append((time.perf_counter() - t0, response.read().decode()))
+            time.sleep(0.05)
+    scraper = threading.Thread(target=scraping_job, daemon=True)
+    scraper.start()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as log_dir:
+        processors = {code: EndReportingProcessor({"8D38": {}, "1912": {}}, code, masters[code], fusion.end_queue(code), log_dir,
+                                                  exp_name="metrics-test-") for code in (2, 1)}
+        for processor in processors.values():
+            processor.log_writer.start()
+        t_start = time.monotonic()
+        for k, line in enumerate(lines):
+            for processor in processors.values():
+                try:
+                    processor.process_line(line)
+                except ValueError:
+                    failures += 1
+            try:
+                a_point, b_point = fusion.get(block=False)
+            except queue.Empty:
+                continue
+            veh_a, veh_b = process_async_raw_ranging_results(a_point, b_point, a_point[0]['masterInfoPos'], b_point[0]['masterInfoPos'])
+            registry.inc("uwb_consumer_pairs_total")
+            count_detections("A", veh_a, registry)
+            count_detections("B", veh_b, registry)
+            time.sleep(0.002)
+        for processor in processors.values():
+            processor.stop(verbose=False)
+    time.sleep(0.1)
+    stop.set()
+    scraper.join()
+    server.stop()
+
+    text = scrapes[-1][1]
+    values = {}
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            key, _, value = line.rpartition(" ")
+            values[key] = float(value)
+    assert failures == 2
+    assert values['uwb_frames_total{end="A"}'] == values['uwb_frames_total{end="B"}'] == len(lines) - 1
+    assert values['uwb_parse_failures_total{end="A"}'] == 1
+    assert values['uwb_regex_fallbacks_total{end="B"}'] >= 1
+    assert values['uwb_consumer_pairs_total'] > 0
+    assert any(key.startswith("uwb_vehicle_detections_total{") for key in values)
+    assert 'uwb_stage_latency_seconds{stage="parse",end="A",quantile="0.99"}' in values
+    assert "# TYPE uwb_stage_latency_seconds summary" in text and 'uwb_queue_depth{end="A"}' in values
+    assert any('uwb_frame_rate_hz{end="B"} 0.0' not in s[1] and 'uwb_frame_rate_hz{end="B"}' in s[1] for s in scrapes)
+    scrape_ms = sorted(s[0] for s in scrapes)
+    print("{} scrapes during {} frames per end in {:.1f} s: scrape p50 {:.2f} ms, max {:.2f} ms, {} lines"
+          .format(len(scrapes), len(lines), time.monotonic() - t_start, scrape_ms[len(scrape_ms) // 2] * 1e3,
+                  scrape_ms[-1] * 1e3, len(text.splitlines())))
+    print("\n".join(line for line in text.splitlines() if line.startswith(("uwb_frame", "uwb_vehicle_detection_rate"))))
+    print("All metrics endpoint tests passed")
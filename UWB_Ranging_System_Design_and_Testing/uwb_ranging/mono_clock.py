@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+import time, calendar
+from datetime import datetime, timedelta
+
+
+# This file contains the clock of the ranging program. Frames are stamped with time.monotonic_ns()
+# only, and carry integer nanoseconds from the serial read to the consumers. The wall clock times
+# (UTC, local) are derived from an anchor pairing a time.monotonic_ns() reading with a time.time_ns()
+# reading and the UTC offset of the local time zone. The anchor is refreshed every ANCHOR_REFRESH
+# seconds, so the derived times follow the system clock (NTP slewing and steps, time zone changes)
+# while the stamps stay monotonic between two refreshes.
+# The times are formatted into strings at the human-facing edges only (log lines, text logs), with
+# the date and time of the second cached: a string costs one integer division and a "%06d".
+#   local us: integer microseconds of the naive local time since 1970-01-01 00:00:00 (the time
+#             stamps of the binary logs, log_writer.py), without any time zone round-trip.
+
+TIME_FORMAT_LONG  = '%Y-%m-%d %H:%M:%S.%f'
+TIME_FORMAT_SECONDS = '%Y-%m-%d %H:%M:%S'
+EPOCH_LOCAL = datetime(1970, 1, 1)
+ANCHOR_REFRESH = 10.0           # Seconds between two anchor refreshes
+ANCHOR_READINGS = 3             # time.time_ns() readings per refresh; the one with the shortest monotonic interval is kept
+
+_US = 1000
+_S_US = 1000000
+
+
+def datetime_to_local_us(dt):
+    """ Naive local datetime to integer microseconds, without any timezone round-trip
+    """
+    return (dt - EPOCH_LOCAL) // timedelta(microseconds=1)
+
+
+def local_us_to_datetime(local_us):
+    return EPOCH_LOCAL + timedelta(microseconds=local_us)
+
+
+class _SecondText():
+
+    # Text of the date and time of the latest second formatted, shared by the threads (one tuple)
+    def __init__(self):
+        self._cached = (None, "")
+
+    def format(self, us):
+        """ :returns:
+                "%Y-%m-%d %H:%M:%S.%f" text of microseconds since 1970-01-01 (naive)
+        """
+        seconds, fraction = divmod(us, _S_US)
+        cached = self._cached
+        if cached[0] != seconds:
+            cached = (seconds, time.strftime(TIME_FORMAT_SECONDS, time.gmtime(seconds)))
+            self._cached = cached
+        return cached[1] + ".%06d" % fraction
+
+
+_local_text = _SecondText()
+_utc_text = _SecondText()
+
+
+def format_local_us(local_us):
+    """ :returns:
+            "%Y-%m-%d %H:%M:%S.%f" text of local microseconds, as datetime.strftime(TIME_FORMAT_LONG)
+    """
+    return _local_text.format(local_us)
+
+
+def format_utc_us(utc_us):
+    return _utc_text.format(utc_us)
+
+
+def parse_time_text_us(text):
+    """ Inverse of format_local_us(): fixed position integer parsing of "%Y-%m-%d %H:%M:%S.%f"
+        (str or bytes, e.g. the timestamps of the text logs), without strptime()
+
+        :returns:
+            microseconds since 1970-01-01 (naive), raises ValueError if not a timestamp
+    """
+    if isinstance(text, (bytes, bytearray)):
+        text = text.decode("ascii")
+    if len(text) < 26 or text[4] != "-" or text[7] != "-" or text[10] != " " or text[13] != ":" or text[16] != ":" or text[19] != ".":
+        raise ValueError("not a timestamp: {!r}".format(text))
+    seconds = calendar.timegm((int(text[0:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]), int(text[14:16]), int(text[17:19])))
+    return seconds * _S_US + int(text[20:26])
+
+
+def parse_log_timestamp_us(line):
+    """ :returns:
+            local microseconds of the "[%Y-%m-%d %H:%M:%S.%f local] " timestamp heading a log line
+    """
+    return parse_time_text_us(line[1:27])
+
+
+class MonoClock():
+
+    # Monotonic stamps and the wall clock times derived from them
+    # mono_clock, wall_clock: time.monotonic_ns(), time.time_ns() or replacements (replays, tests)
+    def __init__(self, refresh=ANCHOR_REFRESH, mono_clock=time.monotonic_ns, wall_clock=time.time_ns):
+        self.refresh_ns = int(refresh * 1e9)
+        self.mono_clock = mono_clock
+        self.wall_clock = wall_clock
+        self.refreshes = 0
+        self._anchor = None     # (monotonic ns, UTC ns since the epoch, UTC offset of the local time in us)
+        self.refresh()
+
+    def refresh(self):
+        """ Pair the monotonic clock with the wall clock again
+
+            :returns:
+                the new anchor
+        """
+        best = None
+        for _ in range(ANCHOR_READINGS):
+            before = self.mono_clock()
+            wall_ns = self.wall_clock()
+            after = self.mono_clock()
+            if best is None or after - before < best[0]:
+                best = (after - before, (before + after) // 2, wall_ns)
+        _, mono_ns, wall_ns = best
+        utc_offset_us = time.localtime(wall_ns // 1000000000).tm_gmtoff * _S_US
+        self._anchor = (mono_ns, wall_ns, utc_offset_us)
+        self.refreshes += 1
+        return self._anchor
+
+    def anchor(self, mono_ns=None):
+        """ :returns:
+                the anchor, refreshed first if older than the refresh period (at mono_ns, now if None)
+        """
+        anchor = self._anchor
+        if (self.mono_clock() if mono_ns is None else mono_ns) - anchor[0] >= self.refresh_ns:
+            anchor = self.refresh()
+        return anchor
+
+    def now_ns(self):
+        return self.mono_clock()
+
+    def wall_ns(self, mono_ns=None):
+        """ :returns:
+                UTC nanoseconds since the epoch of a monotonic stamp (now if None)
+        """
+        if mono_ns is None:
+            mono_ns = self.mono_clock()
+        anchor = self.anchor(mono_ns)
+        return anchor[1] + mono_ns - anchor[0]
+
+    def utc_us(self, mono_ns=None):
+        return self.wall_ns(mono_ns) // _US
+
+    def local_us(self, mono_ns=None):
+        """ :returns:
+                local microseconds (naive local time since 1970-01-01) of a monotonic stamp (now if None)
+        """
+        if mono_ns is None:
+            mono_ns = self.mono_clock()
+        anchor = self.anchor(mono_ns)
+        return (anchor[1] + mono_ns - anchor[0]) // _US + anchor[2]
+
+    def format_local(self, mono_ns=None):
+        """ :returns:
+                "%Y-%m-%d %H:%M:%S.%f" local time of a monotonic stamp (now if None)
+        """
+        return format_local_us(self.local_us(mono_ns))
+
+    def format_utc(self, mono_ns=None):
+        return format_utc_us(self.utc_us(mono_ns))
+
+
+# Clock of the running program
+CLOCK = MonoClock()
+
+
+if __name__ == "__main__":
+    # Unit Testing: formatting and parsing against datetime, the derived times against the system
+    # clock, a stepped wall clock followed at the next refresh, and the cost per frame.
+    import random, timeit
+    rng = random.Random(19)
+    for _ in range(20000):
+        dt = EPOCH_LOCAL + timedelta(microseconds=rng.randrange(0, 4102444800 * _S_US))
+        local_us = datetime_to_local_us(dt)
+        assert format_local_us(local_us) == dt.strftime(TIME_FORMAT_LONG)
+        assert parse_time_text_us(dt.strftime(TIME_FORMAT_LONG)) == local_us
+        assert local_us_to_datetime(local_us) == dt
+    assert parse_log_timestamp_us(b"[2021-05-25 08:52:15.123456 local] B end reporting raw data: DIST") \
+        == datetime_to_local_us(datetime(2021, 5, 25, 8, 52, 15, 123456))
+    try:
+        parse_time_text_us("2021-05-25T08:52:15")
+        assert False
+    except ValueError:
+        pass
+
+    clock = MonoClock()
+    local_err_us = abs(clock.local_us() - datetime_to_local_us(datetime.now()))
+    utc_err_us = abs(clock.utc_us() - datetime_to_local_us(datetime.utcnow()))
+    assert local_err_us < 2000 and utc_err_us < 2000, (local_err_us, utc_err_us)
+    stamps = [clock.now_ns() for _ in range(1000)]
+    assert [clock.wall_ns(t) for t in stamps] == sorted(clock.wall_ns(t) for t in stamps)
+
+    # A wall clock stepped by one hour (e.g. NTP after boot without RTC), simulated monotonic clock
+    fake_mono, fake_step = [0], [0]
+    stepped = MonoClock(refresh=1.0, mono_clock=lambda: fake_mono[0], wall_clock=lambda: time.time_ns() + fake_step[0])
+    wall_0 = stepped.wall_ns()
+    fake_step[0], fake_mono[0] = 3600 * 10**9, 500 * 10**6
+    assert abs(stepped.wall_ns() - (wall_0 + 500 * 10**6)) < 10**7, "stepped before the refresh"
+    fake_mono[0] = 1000 * 10**6
+    # The refresh reads the wall clock again: the real time elapsed, stepped by one hour
+    assert abs(stepped.wall_ns() - (wall_0 + 3600 * 10**9)) < 10**7, "not stepped after the refresh"
+
+    n = 200000
+    t_datetime = timeit.timeit(lambda: "[" + datetime.now().strftime(TIME_FORMAT_LONG) + " local] ", number=n) / n * 1e6
+    t_stamp = timeit.timeit(lambda: CLOCK.local_us(time.monotonic_ns()), number=n) / n * 1e6
+    t_format = timeit.timeit(lambda: "[" + CLOCK.format_local() + " local] ", number=n) / n * 1e6
+    sample = datetime.now().strftime(TIME_FORMAT_LONG)
+    t_strptime = timeit.timeit(lambda: datetime.strptime(sample, TIME_FORMAT_LONG), number=n // 4) / (n // 4) * 1e6
+    t_parse = timeit.timeit(lambda: parse_time_text_us(sample), number=n // 4) / (n // 4) * 1e6
+    print("per frame: datetime.now().strftime() {:.2f} us | monotonic stamp to local us {:.2f} us | formatted from the clock {:.2f} us"
+          .format(t_datetime, t_stamp, t_format))
+    print("per log line: strptime() {:.2f} us | numeric parsing {:.2f} us | anchor error local {} us, UTC {} us"
+          .format(t_strptime, t_parse, local_err_us, utc_err_us))
+    print("All mono clock tests passed")
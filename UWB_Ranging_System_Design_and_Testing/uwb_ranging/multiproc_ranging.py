@@ -0,0 +1,474 @@
+#!/usr/bin/python3
+
+import os, sys, time, struct, threading, multiprocessing
+from multiprocessing.connection import wait as wait_connections
+import serial
+from utils import (timestamp_log, find_end_master, resume_master_reporting, serial_port_available_check_flock,
+                   make_dist_report, side_name_from_code, slave_distance)
+from log_writer import RangingLogWriter, encode_frame_record, decode_frame_report
+from frame_records import MasterInfo, Frame, decode_slave_readings
+from frame_ring import FrameRing, RingCursor, STATE_RUNNING, STATE_STOPPED, STATE_FAILED
+from pipeline_latency import PIPELINE_LATENCY
+from metrics_server import METRICS
+from mono_clock import CLOCK
+from report_source import make_report_source
+
+
+# This file contains the multi-process ranging: one reader process per master port, so that the
+# serial reads never wait for the GIL of the logging, geometry or Tk rendering of the main process.
+#   reader process (one per master):   reads and parses the DIST lines of its port, writes each frame
+#                                       into its shared memory ring (frame_ring.py);
+#   logger process:                     writes the frame records of all the rings into the ranging logs
+#                                       (log_writer.py), as the end ranging threads did;
+#   main process:                       a consumer thread decodes the foreign slaves of the new frames
+#                                       and hands them over to the data pointer queues of the GUI or the
+#                                       headless service (A/B end fusion, geometry), as before.
+# The processes are spawned (not forked: the main process runs threads and Tk). The master ports are
+# closed by the main process while the readers hold them, and opened again at the end, so the serial
+# ports map stays usable (e.g. to start the ranging again from the GUI).
+# The local slaves of a reader (foreign frame indices of the logs) are the ports paired when it
+# starts; the consumer of the main process filters the foreign slaves against the live serial ports map.
+# With the TLV report source (--report-source tlv), a reader polls dwm_loc_get at the update rate of
+# its master instead of reading DIST lines; the update rate stays fixed (no adaptive rate controller).
+# A parse or serial error stops the reader of the end, as the serial multiplexer stops the end.
+# Not supported: session recording and the port supervisor (the ports are owned by the readers).
+#   python3 multiproc_ranging.py   compares the throughput and the latency of the threaded and
+#                                  multi-process modes against emulated boards (dwm_emulator.py)
+
+MP_START_METHOD = "spawn"
+MP_READ_TIMEOUT = 0.1           # Seconds of a serial read, between two stop checks of a reader
+MP_READ_SIZE = 4096
+MP_MAX_LINE_BYTES = 4096
+MP_CONSUMER_POLL = 0.1          # Seconds between two stop checks of the consumers without frames
+MP_JOIN_TIMEOUT = 5.0           # Seconds to wait for a process to stop before terminating it
+
+
+def wait_notify(conns, timeout):
+    """ Wait for the wakeups of the producers, and clear them. The connections of the producers
+        gone (end of file) are removed from conns.
+    """
+    for conn in wait_connections(conns, timeout):
+        try:
+            while conn.poll():
+                conn.recv_bytes()
+        except (EOFError, OSError):
+            conns.remove(conn)
+
+
+def reader_process_job(tty_device, end_side_code, ring_name, notify_conns, local_addrs, stop_event,
+                       oem_firmware=False, baudrate=115200, report_source="shell"):
+    """ Reader process of one master port: DIST lines (or dwm_loc_get polls with report_source "tlv",
+        report_source.py) -> frame records in the ring of the end
+    """
+    end_name = side_name_from_code(end_side_code)
+    ring = FrameRing(ring_name)
+    ring.set_notify(notify_conns)
+    on_fallback = lambda: ring.count("regex_fallbacks")
+    super_frame = 0
+    port, pending = None, bytearray()
+
+    def write_frame(report, data_raw, rx_ns):
+        parsed_ns = time.monotonic_ns()
+        foreign_indices = [idx for idx, anc in enumerate(report.anchors) if anc.anc_id not in local_addrs]
+        try:
+            body = encode_frame_record(CLOCK.local_us(rx_ns), super_frame, report, foreign_indices,
+                                       data_raw, oem_firmware)
+        except (struct.error, UnicodeError, KeyError, TypeError):
+            # Outside the binary record layout (e.g. malformed anchor ids): not handed over
+            body = None
+            ring.count("oversized")
+        if body is not None and ring.write(body, rx_ns, parsed_ns):
+            ring.notify()
+
+    try:
+        port = serial.Serial(tty_device, baudrate=baudrate, timeout=MP_READ_TIMEOUT)
+        serial_port_available_check_flock(port)
+        source = None
+        if report_source == "tlv":
+            # Polled at the update rate of the master, read when the source starts
+            source = make_report_source(report_source, port, oem_firmware)
+            source.start()
+        else:
+            resume_master_reporting(port, oem_firmware)
+            port.reset_input_buffer()
+        ring.set_state(STATE_RUNNING)
+        sys.stdout.write(timestamp_log() + end_name + " end reader process {} started on port {}\n".format(os.getpid(), tty_device))
+        while not stop_event.is_set():
+            if source is not None:
+                report, data_raw = source.read_frame()
+                ring.count("lines")
+                if report is None:
+                    ring.count("parse_failures")
+                    continue
+                write_frame(report, data_raw, source.rx_ns)
+                super_frame += 1
+                continue
+            chunk = port.read(port.in_waiting or 1)
+            if not chunk:
+                continue
+            rx_ns = time.monotonic_ns()
+            pending.extend(chunk)
+            if b"\n" not in chunk:
+                if len(pending) > MP_MAX_LINE_BYTES:
+                    del pending[:]
+                continue
+            lines = pending.split(b"\n")
+            pending = bytearray(lines.pop())
+            for line in lines:
+                data_raw = line.rstrip()
+                ring.count("lines")
+                if not data_raw[:4] == b"DIST":
+                    continue
+                try:
+                    report = make_dist_report(data_raw, oem_firmware, on_fallback)
+                except Exception:
+                    ring.count("parse_failures")
+                    raise
+                write_frame(report, data_raw, rx_ns)
+                super_frame += 1
+        ring.set_state(STATE_STOPPED)
+    except BaseException as e:
+        ring.set_state(STATE_FAILED)
+        ring.notify()
+        if not stop_event.is_set():
+            sys.stdout.write(timestamp_log() + end_name + " end reader process stopped on port {}. Last fetched UART data: {}. error: {}\n"
+                             .format(tty_device, bytes(pending), repr(e)))
+    finally:
+        if port is not None and port.is_open:
+            port.close()
+        ring.close()
+
+
+def logger_process_job(rings, notify_conns, log_fpath, exp_name, stop_event,
+                       oem_firmware=False, binary_log=True, compress_log=False):
+    """ Logger process: frame records of the rings -> ranging logs of their ends
+
+        :param rings: list of (ring name, end name, master informative position)
+    """
+    attached = [FrameRing(ring_name) for ring_name, _, _ in rings]
+    cursors = [RingCursor(ring) for ring in attached]
+    writers = [RangingLogWriter(log_fpath, exp_name, end_name, master_info_pos, oem_firmware=oem_firmware,
+                                binary=binary_log, compress=compress_log) for _, end_name, master_info_pos in rings]
+    copy_body = lambda body, read_ns, parsed_ns, written_ns: bytes(body)
+    for writer in writers:
+        for log_name in writer.log_names():
+            sys.stdout.write(timestamp_log() + writer.end_name + " end logger process {} started. See data entries in file: {}\n"
+                             .format(os.getpid(), log_name))
+        writer.start()
+    try:
+        while True:
+            stopping = stop_event.is_set()
+            if notify_conns:
+                wait_notify(notify_conns, MP_CONSUMER_POLL)
+            else:
+                stop_event.wait(MP_CONSUMER_POLL)
+            for cursor, writer in zip(cursors, writers):
+                for body in cursor.read_new(copy_body):
+                    writer.put_frame_record(body)
+            if stopping:
+                # The readers are stopped: the rings are drained
+                break
+    finally:
+        for cursor, writer in zip(cursors, writers):
+            writer.stop()
+            if cursor.dropped:
+                sys.stdout.write(timestamp_log() + writer.end_name + " end logger process missed {} frames\n".format(cursor.dropped))
+        for ring in attached:
+            ring.close()
+
+
+class RingFrameConsumer():
+
+    # Main process consumer of the rings: frame records -> data pointers [Frame, foreign slaves]
+    # of the end data pointer queues, as handed over by EndReportingProcessor
+    def __init__(self, serial_ports):
+        self.serial_ports = serial_ports
+        self.ends = []          # [ring, cursor, end name, master info pos, data pointer queue, metric labels]
+
+    def add_ring(self, ring, end_name, master_info_pos, data_ptr_queue_single_end):
+        self.ends.append([ring, RingCursor(ring), end_name, MasterInfo.from_dict(master_info_pos), data_ptr_queue_single_end,
+                          (("end", end_name),)])
+
+    def _decode(self, body, read_ns, parsed_ns, written_ns):
+        return decode_frame_report(body), read_ns, parsed_ns
+
+    def poll(self):
+        """ Hand the new frames of all the rings over to their queues
+
+            :returns:
+                number of frames handed over
+        """
+        n = 0
+        for ring, cursor, end_name, master_info, data_ptr_queue, labels in self.ends:
+            for record, read_ns, parsed_ns in cursor.read_new(self._decode):
+                local_us, super_frame, report, _, _ = record
+                stage_stamps = [read_ns, parsed_ns, 0, 0]
+                slave_readings = decode_slave_readings(report)
+                ranging_results_foreign_slaves_from_master = [slave_readings[anc.anc_id] for anc in report.anchors
+                                                              if not self.serial_ports.get(anc.anc_id)]
+                stage_stamps[2] = time.monotonic_ns()
+                frame = Frame(report, super_frame, master_info, parsed_ns, stage_stamps)
+                ranging_results_foreign_slaves_from_master.sort(key=slave_distance)
+                stage_stamps[3] = time.monotonic_ns()
+                PIPELINE_LATENCY.record_frame(end_name, stage_stamps)
+                METRICS.inc("uwb_frames_total", labels)
+                data_ptr_queue.put([frame, ranging_results_foreign_slaves_from_master])
+                n += 1
+        return n
+
+    def metric_samples(self):
+        """ :returns:
+                samples of the metrics endpoint (metrics_server.py): counters of the reader processes
+        """
+        samples = []
+        for ring, cursor, end_name, _, _, labels in self.ends:
+            counters = ring.counter_values()
+            samples.append(("uwb_ring_frames_total", labels, ring.head()))
+            samples.append(("uwb_ring_dropped_frames_total", labels, cursor.dropped))
+            samples.append(("uwb_parse_failures_total", labels, counters["parse_failures"]))
+            samples.append(("uwb_regex_fallbacks_total", labels, counters["regex_fallbacks"]))
+            samples.append(("uwb_ring_reader_up", labels, 1 if counters["state"] == STATE_RUNNING else 0))
+        return samples
+
+
+def end_ranging_job_multiprocess(serial_ports,
+                                 data_ptr_queues,
+                                 log_fpath,
+                                 stop_flag_callback=None,
+                                 oem_firmware=False,
+                                 exp_name="",
+                                 binary_log=True,
+                                 compress_log=False,
+                                 report_source="shell"):
+    """ Serve the masters of all requested ends from one reader process per master, a logger process
+        and a consumer loop in the calling thread. Drop-in replacement of end_ranging_job_multiplexed().
+
+        :param data_ptr_queues: dictionary of end side code -> data pointer queue of the end
+        :param report_source: "shell" (DIST lines) or "tlv" (dwm_loc_get polling), report_source.py
+        :returns:
+            None
+    """
+    masters = {}
+    for end_side_code in data_ptr_queues:
+        master_dev_id, master_info_pos = find_end_master(serial_ports, end_side_code, stop_flag_callback)
+        if master_dev_id == "":
+            return
+        masters[end_side_code] = (master_dev_id, master_info_pos)
+    ctx = multiprocessing.get_context(MP_START_METHOD)
+    # The logger stops after the readers, to log their last frames
+    stop_event, logger_stop_event = ctx.Event(), ctx.Event()
+    local_addrs = set(serial_ports)
+    consumer = RingFrameConsumer(serial_ports)
+    rings, readers, main_conns, logger_conns, logger_rings = [], [], [], [], []
+    # Send ends of the wakeup pipes, kept open until the processes are stopped
+    notify_conns = []
+    ports_master = {}
+    logger = None
+    try:
+        for end_side_code, (master_dev_id, master_info_pos) in masters.items():
+            ring = FrameRing(create=True)
+            rings.append(ring)
+            end_name = side_name_from_code(end_side_code)
+            consumer.add_ring(ring, end_name, master_info_pos, data_ptr_queues[end_side_code])
+            logger_rings.append((ring.name, end_name, master_info_pos))
+            main_recv, main_send = ctx.Pipe(duplex=False)
+            logger_recv, logger_send = ctx.Pipe(duplex=False)
+            main_conns.append(main_recv)
+            logger_conns.append(logger_recv)
+            notify_conns += [main_send, logger_send]
+            port_master = serial_ports[master_dev_id]["port"]
+            ports_master[master_dev_id] = port_master
+            # The reader process opens the port (and its lock) on its own
+            port_master.close()
+            readers.append(ctx.Process(target=reader_process_job,
+                                       args=(port_master.port, end_side_code, ring.name, [main_send, logger_send],
+                                             local_addrs, stop_event, oem_firmware, port_master.baudrate,
+                                             report_source),
+                                       name="{} End Reader Process".format(end_name), daemon=True))
+        logger = ctx.Process(target=logger_process_job,
+                             args=(logger_rings, logger_conns, log_fpath, exp_name, logger_stop_event,
+                                   oem_firmware, binary_log, compress_log),
+                             name="Ranging Logger Process", daemon=True)
+        METRICS.set_collector("frame_rings", consumer.metric_samples)
+        logger.start()
+        for reader in readers:
+            reader.start()
+        while not (stop_flag_callback is not None and stop_flag_callback() == True):
+            wait_notify(main_conns, MP_CONSUMER_POLL)
+            consumer.poll()
+            if not any(reader.is_alive() for reader in readers):
+                break
+    finally:
+        stop_event.set()
+        for process in readers + [logger]:
+            if process is None or process.pid is None:
+                continue
+            if process is logger:
+                logger_stop_event.set()
+            process.join(MP_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        consumer.poll()
+        for ring, cursor, end_name, _, _, _ in consumer.ends:
+            sys.stdout.write(timestamp_log() + "{} end ring: {} frames, {} read, {} missed\n"
+                             .format(end_name, ring.head(), cursor.read, cursor.dropped))
+        METRICS.set_collector("frame_rings", None)
+        for ring in rings:
+            ring.close()
+        for port_master in ports_master.values():
+            try:
+                port_master.open()
+                serial_port_available_check_flock(port_master)
+            except (OSError, serial.SerialException) as e:
+                sys.stdout.write(timestamp_log() + "Serial port {} not opened again after the reader process: {}\n"
+                                 .format(port_master.port, repr(e)))
+
+
+def emulator_process_job(conn, n_vehicles, period_scale, seed):
+    """ DWM1001 boards emulated in their own process (benchmark): the load of the ranging process
+        does not delay the reports. Answers "devices" and "boot times" requests on conn until "stop".
+    """
+    from dwm_emulator import DwmEmulator, make_fleet
+    vehicles = make_fleet(n_vehicles, spacing=8000)
+    emulator = DwmEmulator(vehicles, period_scale=period_scale, seed=seed).start()
+    try:
+        while True:
+            request = conn.recv()
+            if request == "devices":
+                conn.send(emulator.tty_devices(vehicles[:1]))
+            elif request == "boot times":
+                # UWBLOCALTIME of a report: microseconds since the boot of its master, on time.monotonic()
+                conn.send({dev.short_id: dev.t_boot for dev in emulator.tags})
+            else:
+                break
+    finally:
+        emulator.stop()
+
+
+def benchmark_mode(mode, serial_ports, boot_times, seconds, load, report_source="shell"):
+    """ Run a ranging mode against the emulated boards with a GIL bound load in the main process
+        (standing for the Tk rendering, geometry and log formatting)
+
+        :returns:
+            (frames, frames/s, latencies in ms from the emission of the reports to the consumer,
+         frames logged, a data pointer)
+    """
+    import glob, queue, tempfile
+    from serial_mux import end_ranging_job_multiplexed
+    from log_writer import read_ranging_log_records, RECORD_FRAME
+    data_ptr_queues = {1: queue.Queue(), 2: queue.Queue()}
+    stop = threading.Event()
+    latencies, frames, sample = [], [0], []
+    sys.stdout, log_out = open(os.devnull, "w"), sys.stdout
+    job = end_ranging_job_multiplexed if mode == "threads" else end_ranging_job_multiprocess
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ranging_thread = threading.Thread(target=job, kwargs={"serial_ports": serial_ports, "data_ptr_queues": data_ptr_queues,
+                                                              "log_fpath": tmp_dir, "stop_flag_callback": stop.is_set,
+                                                              "exp_name": mode, "report_source": report_source},
+                                          daemon=True)
+
+        def consumer_job(q):
+            while not stop.is_set():
+                try:
+                    data_pointer = q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                uwb_reporting_dict = data_pointer[0]
+                sample[:] = [data_pointer]
+                now = time.monotonic()
+                master_id = uwb_reporting_dict["masterInfoPos"]["master_id"]
+                if measuring.is_set():
+                    frames[0] += 1
+                    if "timestamp" not in uwb_reporting_dict:
+                        # No UWB local time in the TLV reports
+                        continue
+                    latencies.append((now - boot_times[master_id] - uwb_reporting_dict["timestamp"] / 1e6) * 1e3)
+
+        def load_job():
+            # Bursts of pure Python work holding the GIL, e.g. a redraw of the display
+            while not stop.is_set():
+                t_end = time.perf_counter() + load
+                while time.perf_counter() < t_end:
+                    sum(i * i for i in range(200))
+                time.sleep(0.01)
+
+        measuring = threading.Event()
+        threads = [threading.Thread(target=consumer_job, args=(q,), daemon=True) for q in data_ptr_queues.values()]
+        if load:
+            threads.append(threading.Thread(target=load_job, daemon=True))
+        ranging_thread.start()
+        for t in threads:
+            t.start()
+        # Warm up: reporting resumed, processes started
+        time.sleep(3.0)
+        measuring.set()
+        time.sleep(seconds)
+        measuring.clear()
+        stop.set()
+        ranging_thread.join(20.0)
+        for t in threads:
+            t.join()
+        logged = sum(1 for fpath in glob.glob(os.path.join(tmp_dir, "*.bin"))
+                     for record_type, _ in read_ranging_log_records(fpath) if record_type == RECORD_FRAME)
+    sys.stdout.close()
+    sys.stdout = log_out
+    return frames[0], frames[0] / seconds, latencies, logged, sample[0]
+
+
+if __name__ == "__main__":
+    # Unit Testing / benchmark: the masters of an emulated vehicle report at 20 times the fastest
+    # firmware rate (aurs 1 1 with period scale 0.05: 200 Hz each). The frames are consumed from the
+    # data pointer queues by the threaded (serial multiplexer) and the multi-process modes, without and
+    # with a GIL bound load in the main process. Latency: emission of the report by the emulated board
+    # (its UWBLOCALTIME) to the consumer of the queue.
+    from utils import pairing_uwb_ports
+    from session_replay import percentiles
+
+    ctx = multiprocessing.get_context(MP_START_METHOD)
+    emulator_conn, child_conn = ctx.Pipe()
+    emulator_process = ctx.Process(target=emulator_process_job, args=(child_conn, 2, 0.05, 23), daemon=True)
+    emulator_process.start()
+    emulator_conn.send("devices")
+    tty_devices = emulator_conn.recv()
+    serial_ports = {}
+    sys.stdout, log_out = open(os.devnull, "w"), sys.stdout
+    ret = pairing_uwb_ports(serial_ports_dict=serial_ports, serial_tty_devices=tty_devices)
+    sys.stdout.close()
+    sys.stdout = log_out
+    assert ret == 1, ret
+    emulator_conn.send("boot times")
+    boot_times = emulator_conn.recv()
+
+    seconds = 5.0
+    results = {}
+    for load in (0.0, 0.05):
+        for mode in ("threads", "processes"):
+            n, rate, latencies, logged, data_pointer = benchmark_mode(mode, serial_ports, boot_times, seconds, load)
+            stats = percentiles(latencies, (50, 99, 99.9))
+            results[(mode, load)] = (n, rate, stats)
+            # Same frames and logs as the end reporting processors
+            assert logged >= n, (mode, logged, n)
+            keys = [key for key in data_pointer[0] if key not in data_pointer[0]["all_anc_id"]]
+            assert keys == results.setdefault("keys", keys), data_pointer
+            assert data_pointer[1] and set(data_pointer[1][0]) == {"slave_id", "x_slave", "y_slave", "z_slave",
+                                                                   "vehicle_length_slave", "id_assoc", "side_slave", "dist_to"}
+            print("{:9s} load {:2.0f} ms/10 ms: {:6d} frames, {:6.1f} frames/s | latency ms p50 {:.2f}, p99 {:.2f}, "
+                  "p99.9 {:.2f}, max {:.2f}".format(mode, load * 1e3, n, rate, stats["p50"], stats["p99"],
+                                                     stats["p99.9"], stats["max"]))
+    results.pop("keys")
+    for key, (n, rate, stats) in results.items():
+        assert rate > 300, (key, rate)
+    # TLV report source: the readers poll dwm_loc_get at the update rate of the masters (aurs 1 1: 10 Hz each)
+    for mode in ("threads", "processes"):
+        n, rate, _, logged, data_pointer = benchmark_mode(mode, serial_ports, boot_times, seconds, 0.0, "tlv")
+        # (the masters leave their shell one after the other in the threaded mode, within the warm up or not)
+        assert 10.0 < rate < 22.0 and logged >= n and data_pointer[1], (mode, rate, logged)
+        print("{:9s} TLV report source: {:6d} frames, {:6.1f} frames/s".format(mode, n, rate))
+    for entry in serial_ports.values():
+        assert entry["port"].is_open
+        entry["port"].close()
+    emulator_conn.send("stop")
+    emulator_process.join(10.0)
+    print("os.cpu_count(): {}".format(os.cpu_count()))
+    print("All multi-process ranging tests passed")
@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+
+import sys, time, signal, threading
+
+
+# This file contains the end-to-end latency instrumentation of the ranging pipeline.
+# Every frame is stamped (time.monotonic_ns()) when it is read from the serial port, parsed,
+# decoded (slave info and foreign slave filtering) and queued (handed over to the fusion buffer),
+# and the consumer (GUI, headless service) stamps its pairs when taken from the fusion buffer,
+# after the geometry (adjusted distance processing, tracking, TTC) and after rendering (labels
+# configured, results published). The stage latencies are the differences of consecutive stamps:
+#   parse:    serial read    -> parsed         (incl. the earlier lines of the same serial read)
+#   decode:   parsed         -> decoded
+#   queue:    decoded        -> queued         (logging, sorting)
+#   fusion:   queued         -> pair taken     (A/B pairing, wait for the other end, mailbox)
+#   geometry: pair taken     -> geometry done
+#   render:   geometry done  -> rendered
+#   total:    serial read    -> rendered
+# They are aggregated into HDR-style (log-linear) histograms per stage and per end, in microseconds.
+# Each histogram has a single writer thread (the reading thread of its end for parse/decode/queue,
+# the consumer for the others): recording takes no lock, readers copy the counts.
+# A summary line of the last period is logged periodically (start_summary()), and the full table
+# is dumped on SIGUSR1 (install_dump_signal()).
+
+STAGE_STAMPS_KEY = 'stageStampsNs'  # [read, parsed, decoded, queued] time.monotonic_ns() of a frame; not written to the logs
+STAGES = ("parse", "decode", "queue", "fusion", "geometry", "render", "total")
+ENDS = ("A", "B")
+SUB_BUCKET_BITS = 6                 # 2^5 buckets per power of two: values known within 1/32 (~3%)
+MAX_VALUE_BITS = 36                 # Largest value recorded: 2^36 us (~19 hours), larger ones are clamped
+SUMMARY_PERIOD = 60.0               # Seconds between two summary lines in the log
+SUMMARY_PERCENTILES = (50, 99)      # Percentiles of the summary line
+DUMP_PERCENTILES = (50, 90, 99, 99.9)
+
+_SUB_COUNT = 1 << SUB_BUCKET_BITS
+_HALF_COUNT = _SUB_COUNT >> 1
+_MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+
+
+def bucket_index(value):
+    """ :returns:
+            index of the histogram bucket of a value (non-negative integer)
+    """
+    if value < _SUB_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return _SUB_COUNT + (shift - 1) * _HALF_COUNT + (value >> shift) - _HALF_COUNT
+
+
+def bucket_bounds(index):
+    """ :returns:
+            (lowest, highest) value of a histogram bucket
+    """
+    if index < _SUB_COUNT:
+        return index, index
+    shift = (index - _SUB_COUNT) // _HALF_COUNT + 1
+    low = ((index - _SUB_COUNT) % _HALF_COUNT + _HALF_COUNT) << shift
+    return low, low + (1 << shift) - 1
+
+
+class LatencyHistogram():
+
+    # Log-linear histogram of latencies in microseconds, a single writer
+    def __init__(self):
+        self.counts = [0] * (bucket_index(_MAX_VALUE) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        elif value > _MAX_VALUE:
+            value = _MAX_VALUE
+        self.counts[bucket_index(value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        # Last: a reader seeing the new count sees the new bucket count too
+        self.count += 1
+
+    def snapshot(self):
+        """ :returns:
+                copy of the histogram, consistent enough for reporting while the writer goes on
+        """
+        copy = LatencyHistogram.__new__(LatencyHistogram)
+        copy.count, copy.total, copy.max = self.count, self.total, self.max
+        copy.counts = list(self.counts)
+        return copy
+
+    def subtract(self, earlier):
+        """ :returns:
+                histogram of the values recorded since an earlier snapshot (max: of all values)
+        """
+        diff = LatencyHistogram.__new__(LatencyHistogram)
+        diff.count, diff.total, diff.max = self.count - earlier.count, self.total - earlier.total, self.max
+        diff.counts = [now - before for now, before in zip(self.counts, earlier.counts)]
+        return diff
+
+    def percentile(self, q):
+        """ :returns:
+                highest value of the bucket holding the q-th percentile, 0 if empty
+        """
+        total = sum(self.counts)
+        if total == 0:
+            return 0
+        rank = max(1, int(total * q / 100.0 + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bucket_bounds(index)[1], self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class PipelineLatency():
+
+    # Histograms of the stage latencies per end. All histograms are created up front: recording
+    # never changes the registry.
+    def __init__(self, stages=STAGES, ends=ENDS):
+        self.stages = stages
+        self.ends = ends
+        self.enabled = True
+        self.histograms = {(stage, end): LatencyHistogram() for stage in stages for end in ends}
+        self._last_summary = None
+        self._summary_thread = None
+        self._summary_stop = threading.Event()
+
+    def record_frame(self, end_name, stamps):
+        """ Record the producer stages (parse, decode, queue) of a frame stamped [read, parsed, decoded, queued]
+        """
+        if not self.enabled or end_name not in self.ends:
+            return
+        read_ns, parsed_ns, decoded_ns, queued_ns = stamps
+        histograms = self.histograms
+        histograms[("parse", end_name)].record((parsed_ns - read_ns) // 1000)
+        histograms[("decode", end_name)].record((decoded_ns - parsed_ns) // 1000)
+        histograms[("queue", end_name)].record((queued_ns - decoded_ns) // 1000)
+
+    def record_pair(self, data_points, taken_ns, geometry_ns, rendered_ns):
+        """ Record the consumer stages (fusion, geometry, render, total) of an A/B pair of data points
+            taken from the fusion buffer at taken_ns
+        """
+        if not self.enabled:
+            return
+        histograms = self.histograms
+        for end_name, data_point in zip(self.ends, data_points):
+            stamps = data_point[0].get(STAGE_STAMPS_KEY) if data_point else None
+            if not stamps:
+                continue
+            histograms[("fusion", end_name)].record((taken_ns - stamps[3]) // 1000)
+            histograms[("geometry", end_name)].record((geometry_ns - taken_ns) // 1000)
+            histograms[("render", end_name)].record((rendered_ns - geometry_ns) // 1000)
+            histograms[("total", end_name)].record((rendered_ns - stamps[0]) // 1000)
+
+    def snapshot(self):
+        return {key: histogram.snapshot() for key, histogram in self.histograms.items()}
+
+    def summary(self, since=None, percentiles=SUMMARY_PERCENTILES):
+        """ :returns:
+                one line of the stage latency percentiles (ms) per end, of the values recorded since
+                an earlier snapshot() (all values if None)
+        """
+        now = self.snapshot()
+        parts = []
+        for end_name in self.ends:
+            stages = []
+            for stage in self.stages:
+                histogram = now[(stage, end_name)]
+                if since is not None:
+                    histogram = histogram.subtract(since[(stage, end_name)])
+                if histogram.count == 0:
+                    continue
+                stages.append(stage + " " + "/".join("{:.2f}".format(histogram.percentile(q) / 1000.0) for q in percentiles))
+            if stages:
+                parts.append(end_name + ": " + ", ".join(stages))
+        return " | ".join(parts) if parts else "no frames"
+
+    def table(self, percentiles=DUMP_PERCENTILES):
+        """ :returns:
+                text table of the count, mean, percentiles and max (ms) of all stages and ends
+        """
+        now = self.snapshot()
+        header = "{:<4}{:<10}{:>9}{:>9}".format("end", "stage", "count", "mean") + "".join(
+            "{:>9}".format("p" + "{:g}".format(q)) for q in percentiles) + "{:>9}".format("max")
+        lines = [header]
+        for end_name in self.ends:
+            for stage in self.stages:
+                histogram = now[(stage, end_name)]
+                lines.append("{:<4}{:<10}{:>9}{:>9.2f}".format(end_name, stage, histogram.count, histogram.mean() / 1000.0)
+                             + "".join("{:>9.2f}".format(histogram.percentile(q) / 1000.0) for q in percentiles)
+                             + "{:>9.2f}".format(histogram.max / 1000.0))
+        return "\n".join(lines)
+
+    def log_summary(self):
+        """ Log the summary line of the period since the previous one
+        """
+        from utils import timestamp_log
+        since, self._last_summary = self._last_summary, self.snapshot()
+        sys.stdout.write(timestamp_log() + "Pipeline latency ms (p" + "/p".join("{:g}".format(q) for q in SUMMARY_PERCENTILES)
+                         + "): " + self.summary(since) + "\n")
+
+    def dump(self, *args):
+        """ Log the full table. Signal handler of install_dump_signal()
+        """
+        from utils import timestamp_log
+        sys.stdout.write(timestamp_log() + "Pipeline latency ms since start:\n" + self.table() + "\n")
+        sys.stdout.flush()
+
+    def start_summary(self, period=SUMMARY_PERIOD):
+        """ Log a summary line every period seconds (daemon thread); period <= 0: no summary
+        """
+        if period <= 0 or self._summary_thread is not None:
+            return
+        self._last_summary = self.snapshot()
+        self._summary_stop.clear()
+        self._summary_thread = threading.Thread(target=self._summary_job, args=(period,),
+                                                name="Pipeline Latency Summary", daemon=True)
+        self._summary_thread.start()
+
+    def stop_summary(self):
+        if self._summary_thread is None:
+            return
+        self._summary_stop.set()
+        self._summary_thread.join()
+        self._summary_thread = None
+
+    def _summary_job(self, period):
+        while not self._summary_stop.wait(period):
+            self.log_summary()
+
+    def install_dump_signal(self, signum=getattr(signal, "SIGUSR1", None)):
+        """ Dump the table on a signal (SIGUSR1, not on Windows). Only possible from the main thread
+
+            :returns:
+                True if installed
+        """
+        if signum is None:
+            return False
+        signal.signal(signum, self.dump)
+        return True
+
+
+# Instrumentation of the running program: the end reporting processors and the consumers record here
+PIPELINE_LATENCY = PipelineLatency()
+
+
+if __name__ == "__main__":
+    # Unit Testing: bucket bounds, percentiles against the exact ones, the recording overhead,
+    # and the stage stamps of the sample field test log through the processors and the fusion buffer.
+    import os, random, queue, tempfile
+
+    for value in list(range(5000)) + [random.randrange(_MAX_VALUE) for _ in range(20000)]:
+        low, high = bucket_bounds(bucket_index(value))
+        assert low <= value <= high and (high - low) <= max(1, value // _HALF_COUNT), value
+    assert bucket_index(_MAX_VALUE) == bucket_index(_MAX_VALUE - 1)
+
+    rng = random.Random(17)
+    histogram = LatencyHistogram()
+    values = [int(rng.lognormvariate(7.0, 1.2)) for _ in range(100000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    for q in (50, 90, 99, 99.9):
+        exact = values[int(len(values) * q / 100.0 + 0.5) - 1]
+        assert abs(histogram.percentile(q) - exact) <= exact / _HALF_COUNT + 1, (q, histogram.percentile(q), exact)
+    assert histogram.percentile(100) == values[-1] == histogram.max
+    half = histogram.snapshot()
+    for value in values[:100]:
+        histogram.record(value)
+    assert histogram.subtract(half).count == 100
+
+    latency = PipelineLatency()
+    stamps = [0, 150000, 230000, 410000]
+    n = 200000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        latency.record_frame("A", stamps)
+    per_frame_us = (time.perf_counter() - t0) / n * 1e6
+    point = [{STAGE_STAMPS_KEY: stamps}, []]
+    t0 = time.perf_counter()
+    for _ in range(n):
+        latency.record_pair((point, point), 500000, 900000, 1300000)
+    per_pair_us = (time.perf_counter() - t0) / n * 1e6
+    assert latency.histograms[("parse", "A")].percentile(50) == 150
+    assert latency.histograms[("fusion", "B")].percentile(99) == 90
+    assert latency.histograms[("total", "B")].percentile(50) == 1300
+    print("Recording cost: {:.2f} us per frame, {:.2f} us per pair ({:.3f}% of a 10 Hz end)"
+          .format(per_frame_us, per_pair_us, (per_frame_us + per_pair_us / 2) / 1e5 * 100))
+
+    # The sample field test log through both end processors and the fusion buffer
+    from utils import EndReportingProcessor, process_async_raw_ranging_results
+    from end_fusion import EndFusionBuffer
+    from log_writer import format_frame_text_lines
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+    # The instance of the imported module, not of this __main__ one
+    from pipeline_latency import PIPELINE_LATENCY as latency
+    fusion = EndFusionBuffer()
+    master_b = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 1}
+    masters = {2: dict(master_b, side_master=2), 1: master_b}
+    with tempfile.TemporaryDirectory() as log_dir:
+        processors = [EndReportingProcessor({"8D38": {}, "1912": {}}, code, masters[code], fusion.end_queue(code), log_dir,
+                                            exp_name="latency-test-") for code in (2, 1)]
+        for processor in processors:
+            processor.log_writer.start()
+        latency.start_summary(0.5)
+        pairs = 0
+        for line in lines[:300]:
+            for processor in processors:
+                processor.process_line(line, rx_ns=time.monotonic_ns())
+            try:
+                a_point, b_point = fusion.get(block=False)
+            except queue.Empty:
+                continue
+            taken_ns = time.monotonic_ns()
+            process_async_raw_ranging_results(a_point, b_point, a_point[0]['masterInfoPos'], b_point[0]['masterInfoPos'])
+            geometry_ns = time.monotonic_ns()
+            latency.record_pair((a_point, b_point), taken_ns, geometry_ns, time.monotonic_ns())
+            pairs += 1
+            time.sleep(0.002)
+        for processor in processors:
+            processor.stop(verbose=False)
+        latency.stop_summary()
+    stamps = a_point[0][STAGE_STAMPS_KEY]
+    assert len(stamps) == 4 and stamps == sorted(stamps)
+    assert STAGE_STAMPS_KEY not in format_frame_text_lines("A", 0, 0, a_point[0], [], b"", 0)[0]
+    for end_name in ENDS:
+        assert latency.histograms[("parse", end_name)].count == 300
+        assert latency.histograms[("total", end_name)].count == pairs > 0
+    assert latency.install_dump_signal()
+    os.kill(os.getpid(), signal.SIGUSR1)
+    time.sleep(0.1)
+    print("All pipeline latency tests passed")
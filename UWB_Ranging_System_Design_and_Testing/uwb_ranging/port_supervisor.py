@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+import sys, time, threading
+import serial
+from utils import timestamp_log, pair_uwb_port, list_uwb_devices
+
+
+# This file contains the hot-plug supervisor of the UWB serial ports of a ranging session.
+# A daemon thread scans the serial devices (list_uwb_devices(): the SEGGER devices of
+# serial.tools.list_ports, or the given tty devices) every SUPERVISOR_POLL seconds, and is woken up
+# by the readers when a port fails (port_failed()):
+#   - a paired port whose device disappeared, or whose reader failed, is down: its listeners are told
+#     ("lost"), then the port is closed. The other ports and ends keep reporting;
+#   - a device not held by a paired port (the board plugged in again, under the same or another tty
+#     device, or a new board) is opened, initialized and identified again (utils.pair_uwb_port), with
+#     an exponential backoff between the attempts (BACKOFF_INITIAL to BACKOFF_MAX seconds);
+#   - the new entry replaces the entry of its UWB address in the live serial_ports map, and the
+#     listeners are told ("recovered"): the readers swap the new port in (serial_mux.py,
+#     utils.end_ranging_job_async_single).
+# Devices present but not paired when the supervisor starts (e.g. still paired by the GUI) are left
+# alone until they are plugged in again.
+# The failures, the downtime and the time to recover of each port (UWB address) are logged at every
+# recovery and at stop (log_report()), and served by the metrics endpoint (metric_samples()).
+
+SUPERVISOR_POLL = 1.0           # Seconds between two scans of the serial devices
+BACKOFF_INITIAL = 1.0           # Seconds before the first pairing attempt of a (re)appeared device (boot of the board)
+BACKOFF_FACTOR = 2.0
+BACKOFF_MAX = 30.0              # Longest wait between two pairing attempts of a device
+
+
+class PortHealth():
+
+    # Failures, downtime and recoveries of the port of one UWB device (short address)
+    def __init__(self, addr, device=None):
+        self.addr = addr
+        self.device = device
+        self.failures = 0
+        self.recoveries = 0
+        self.down_since = None          # time.monotonic() of the failure, None while up
+        self.downtime = 0.0             # Seconds down, recovered periods only
+        self.recover_times = []         # Seconds from each failure to its recovery
+        self.last_error = None
+
+    def is_down(self):
+        return self.down_since is not None
+
+    def total_downtime(self, now=None):
+        if self.down_since is None:
+            return self.downtime
+        return self.downtime + (time.monotonic() if now is None else now) - self.down_since
+
+    def mean_time_to_recover(self):
+        """ :returns:
+                mean seconds to recover (MTTR), None before the first recovery
+        """
+        if not self.recover_times:
+            return None
+        return sum(self.recover_times) / len(self.recover_times)
+
+    def describe(self, now=None):
+        mttr = self.mean_time_to_recover()
+        return "{} ({}): {} failure(s), {} recovered, downtime {:.1f} s, MTTR {}{}".format(
+            self.addr, self.device, self.failures, self.recoveries, self.total_downtime(now),
+            "N/A" if mttr is None else "{:.1f} s".format(mttr), ", down" if self.is_down() else "")
+
+
+class PortSupervisor():
+
+    # Re-pairs the lost ports of the live serial_ports map ({short address: entry}), see above
+    # tty_devices: devices to watch instead of the SEGGER devices; list_devices: replacement scanner (tests)
+    # device_cache: optional device_cache.DeviceInfoCache identifying the boards plugged in again
+    def __init__(self, serial_ports, oem_firmware=False, init_reporting=True, tty_devices=None,
+                 poll=SUPERVISOR_POLL, backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX,
+                 list_devices=None, device_cache=None):
+        self.serial_ports = serial_ports
+        self.device_cache = device_cache
+        self.oem_firmware = oem_firmware
+        self.init_reporting = init_reporting
+        self.poll = poll
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.list_devices = (lambda: list_uwb_devices(tty_devices)) if list_devices is None else list_devices
+        self.health = {}                # short address -> PortHealth
+        self._listeners = []
+        self._retry = {}                # tty device -> [time.monotonic() of the next attempt, backoff]
+        self._ignored = set()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._supervise_job, name="UWB Port Supervisor Thread", daemon=True)
+
+    def add_listener(self, listener):
+        """ listener(event, addr, entry), event "lost" (before the port is closed) or "recovered"
+            (new entry in serial_ports); called from the supervisor thread
+        """
+        self._listeners.append(listener)
+
+    def start(self):
+        present = self.list_devices()
+        with self._lock:
+            for addr, entry in list(self.serial_ports.items()):
+                self.health[addr] = PortHealth(addr, port_device(entry))
+            self._ignored = present - self._held_devices()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._changed:
+            self._changed.notify_all()
+
+    def stopped(self):
+        return self._stop.is_set()
+
+    def _held_devices(self):
+        # tty devices of the paired ports that are up
+        return {port_device(entry) for addr, entry in list(self.serial_ports.items())
+                if not (addr in self.health and self.health[addr].is_down())}
+
+    def is_down(self, addr):
+        with self._lock:
+            return addr in self.health and self.health[addr].is_down()
+
+    def port_failed(self, addr, error=None):
+        """ A reader lost the port of addr (read error, device disconnected). The device is paired
+            again as soon as it answers.
+        """
+        with self._lock:
+            entry = self.serial_ports.get(addr)
+            health = self.health.setdefault(addr, PortHealth(addr, port_device(entry)))
+            if health.is_down():
+                return
+            now = time.monotonic()
+            health.down_since = now
+            health.failures += 1
+            health.last_error = error
+            device = port_device(entry)
+            health.device = device
+            if device is not None:
+                self._retry[device] = [now + self.backoff_initial, self.backoff_initial]
+        sys.stdout.write(timestamp_log() + "UWB port {} ({}) lost: {}. Pairing it again\n".format(addr, device, repr(error)))
+        self._notify("lost", addr, entry)
+        close_entry_port(entry)
+        self._wakeup.set()
+
+    def wait_recovered(self, addr, stop_flag_callback=None, timeout=None):
+        """ Wait until the port of addr is paired again
+
+            :returns:
+                the new serial ports entry, None if stopped (supervisor or stop flag) or on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while addr in self.health and self.health[addr].is_down():
+                if self._stop.is_set() or (stop_flag_callback is not None and stop_flag_callback() == True):
+                    return None
+                if deadline is not None and time.monotonic() > deadline:
+                    return None
+                self._changed.wait(0.1)
+            return self.serial_ports.get(addr)
+
+    def _notify(self, event, addr, entry):
+        for listener in self._listeners:
+            try:
+                listener(event, addr, entry)
+            except Exception as e:
+                sys.stdout.write(timestamp_log() + "UWB port supervisor listener failed on {} {}: {}\n".format(event, addr, repr(e)))
+
+    def _supervise_job(self):
+        while not self._stop.is_set():
+            self.scan()
+            self._wakeup.wait(self._next_wait())
+            self._wakeup.clear()
+
+    def _next_wait(self):
+        with self._lock:
+            due = [retry[0] for retry in self._retry.values()]
+        if not due:
+            return self.poll
+        return min(self.poll, max(min(due) - time.monotonic(), 0.0))
+
+    def scan(self):
+        """ One round: lost devices, then pairing attempts of the devices due
+        """
+        present = self.list_devices()
+        with self._lock:
+            lost = [addr for addr, entry in self.serial_ports.items()
+                    if port_device(entry) not in present and not (addr in self.health and self.health[addr].is_down())]
+        for addr in lost:
+            self.port_failed(addr, serial.SerialException("device removed"))
+        now = time.monotonic()
+        with self._lock:
+            self._ignored &= present
+            candidates = present - self._held_devices() - self._ignored
+            for device in list(self._retry):
+                if device not in present:
+                    # Unplugged again: the backoff starts over when it is back
+                    del self._retry[device]
+            due = []
+            for device in sorted(candidates):
+                retry = self._retry.setdefault(device, [now + self.backoff_initial, self.backoff_initial])
+                if retry[0] <= now:
+                    due.append(device)
+        for device in due:
+            if self._stop.is_set():
+                return
+            self._pair_device(device)
+
+    def _pair_device(self, device):
+        t_attempt = time.monotonic()
+        try:
+            ret = pair_uwb_port(device, self.oem_firmware, self.init_reporting, self.stopped,
+                                device_cache=self.device_cache)
+            error = None if ret != -1 else "stopped"
+        except BaseException as e:
+            ret, error = -1, e
+        now = time.monotonic()
+        if ret == -1:
+            with self._lock:
+                retry = self._retry.setdefault(device, [now, self.backoff_initial])
+                retry[1] = min(retry[1] * BACKOFF_FACTOR, self.backoff_max)
+                retry[0] = now + retry[1]
+            if not self._stop.is_set():
+                sys.stdout.write(timestamp_log() + "UWB device {} pairing failed ({}), next attempt in {:.1f} s\n"
+                                 .format(device, repr(error), retry[1]))
+            return
+        addr, entry = ret
+        if self.device_cache is not None:
+            try:
+                self.device_cache.save()
+            except OSError as e:
+                sys.stdout.write(timestamp_log() + "UWB device cache not saved. error: " + repr(e) + "\n")
+        with self._changed:
+            self._retry.pop(device, None)
+            old_entry = self.serial_ports.get(addr)
+            self.serial_ports[addr] = entry
+            health = self.health.setdefault(addr, PortHealth(addr, device))
+            health.device = device
+            recovered_in = None
+            if health.is_down():
+                recovered_in = now - health.down_since
+                health.downtime += recovered_in
+                health.recover_times.append(recovered_in)
+                health.recoveries += 1
+                health.down_since = None
+            self._changed.notify_all()
+        if old_entry is not None and old_entry is not entry and recovered_in is None:
+            # The same board on another device while its old port is still up: keep the new one
+            close_entry_port(old_entry)
+        if recovered_in is not None:
+            sys.stdout.write(timestamp_log() + "UWB port {} recovered on {} in {:.2f} s (pairing {:.2f} s). {}\n"
+                             .format(addr, device, recovered_in, now - t_attempt, health.describe(now)))
+        else:
+            sys.stdout.write(timestamp_log() + "UWB port {} ({}) plugged in and paired in {:.2f} s\n"
+                             .format(addr, device, now - t_attempt))
+        self._notify("recovered", addr, entry)
+
+    def report(self):
+        """ :returns:
+                {short address: PortHealth copy values} as a dictionary per port
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {addr: {"device": h.device, "failures": h.failures, "recoveries": h.recoveries,
+                           "downtime": h.total_downtime(now), "mttr": h.mean_time_to_recover(), "down": h.is_down()}
+                    for addr, h in self.health.items()}
+
+    def log_report(self):
+        now = time.monotonic()
+        with self._lock:
+            lines = [h.describe(now) for h in self.health.values() if h.failures]
+        if not lines:
+            sys.stdout.write(timestamp_log() + "UWB port supervisor: no port lost\n")
+        for line in lines:
+            sys.stdout.write(timestamp_log() + "UWB port supervisor: " + line + "\n")
+
+    def metric_samples(self):
+        """ :returns:
+                samples of the metrics endpoint (metrics_server.py)
+        """
+        samples = []
+        for addr, port_report in self.report().items():
+            labels = (("port", addr),)
+            samples.append(("uwb_port_up", labels, 0 if port_report["down"] else 1))
+            samples.append(("uwb_port_failures_total", labels, port_report["failures"]))
+            samples.append(("uwb_port_recoveries_total", labels, port_report["recoveries"]))
+            samples.append(("uwb_port_downtime_seconds_total", labels, port_report["downtime"]))
+            if port_report["mttr"] is not None:
+                samples.append(("uwb_port_time_to_recover_seconds", labels, port_report["mttr"]))
+        return samples
+
+
+def port_device(entry):
+    """ :returns:
+            tty device of a serial ports entry, None if unknown
+    """
+    if not entry:
+        return None
+    return getattr(entry.get("port"), "port", None)
+
+
+def close_entry_port(entry):
+    port = entry.get("port") if entry else None
+    if port is None:
+        return
+    try:
+        port.close()
+    except (OSError, serial.SerialException):
+        pass
+
+
+if __name__ == "__main__":
+    # Unit Testing: a ranging session against the emulated boards of two vehicles (dwm_emulator.py).
+    # The A end master is unplugged (and plugged in again on another tty device), the B end master
+    # hangs (read error with the device still present): both are paired again and swapped into the
+    # multiplexer while the other end keeps reporting, without stopping the ranging job.
+    import io, os, queue, tempfile
+    from dwm_emulator import DwmEmulator, make_fleet, SIDE_A, SIDE_B
+    from utils import pairing_uwb_ports
+    from serial_mux import end_ranging_job_multiplexed
+
+    vehicles = make_fleet(2, spacing=8000)
+    emulator = DwmEmulator(vehicles, period_scale=0.5, seed=21).start()
+    serial_ports = {}
+    log_out, sys.stdout = sys.stdout, io.StringIO()
+    assert pairing_uwb_ports(serial_ports_dict=serial_ports, serial_tty_devices=emulator.tty_devices(vehicles[:1])) == 1
+    ego = {dev.short_id: dev for dev in emulator.devices if dev.vehicle is vehicles[0]}
+    master_a = next(dev for dev in ego.values() if dev.role == "tag" and dev.side == SIDE_A)
+    master_b = next(dev for dev in ego.values() if dev.role == "tag" and dev.side == SIDE_B)
+
+    supervisor = PortSupervisor(serial_ports, backoff_initial=0.2, poll=0.1,
+                                list_devices=lambda: set(emulator.tty_devices(vehicles[:1])) - {None})
+    data_ptr_queues = {SIDE_A: queue.Queue(), SIDE_B: queue.Queue()}
+    stop = threading.Event()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        job = threading.Thread(target=end_ranging_job_multiplexed,
+                               kwargs={"serial_ports": serial_ports, "data_ptr_queues": data_ptr_queues,
+                                       "log_fpath": tmp_dir, "stop_flag_callback": stop.is_set, "exp_name": "hotplug",
+                                       "supervisor": supervisor},
+                               daemon=True)
+        job.start()
+
+        def frames_within(seconds):
+            for q in data_ptr_queues.values():
+                while not q.empty():
+                    q.get()
+            time.sleep(seconds)
+            return {side: q.qsize() for side, q in data_ptr_queues.items()}
+
+        def wait_up(addr, timeout=20.0):
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and (supervisor.is_down(addr) or supervisor.health.get(addr) is None
+                                                   or supervisor.health[addr].recoveries == 0):
+                time.sleep(0.05)
+
+        deadline = time.monotonic() + 10.0
+        while time.monotonic() < deadline and any(q.empty() for q in data_ptr_queues.values()):
+            time.sleep(0.05)
+        assert min(frames_within(1.5).values()) > 5
+        old_device = master_a.tty_device
+        emulator.unplug(master_a.short_id)
+        during = frames_within(1.0)
+        # Another pseudo terminal takes the freed tty device: the board comes back on a new one
+        import pty
+        busy_fds = pty.openpty()
+        emulator.replug(master_a.short_id)
+        assert master_a.tty_device != old_device
+        wait_up(master_a.short_id)
+        after = frames_within(1.5)
+
+        # B end master hung: the reader fails, the device is still present
+        supervisor.port_failed(master_b.short_id, serial.SerialException("simulated read error"))
+        wait_up(master_b.short_id)
+        after_b = frames_within(1.5)
+        stop.set()
+        job.join(10.0)
+    sys.stdout, log_txt = log_out, sys.stdout.getvalue()
+    report = supervisor.report()
+    assert during[SIDE_A] == 0 and during[SIDE_B] > 5, during
+    assert min(after.values()) > 5 and min(after_b.values()) > 5, (after, after_b)
+    assert report[master_a.short_id]["recoveries"] == 1 and report[master_a.short_id]["device"] == master_a.tty_device
+    assert report[master_b.short_id]["recoveries"] == 1 and not job.is_alive()
+    assert serial_ports[master_a.short_id]["port"].port == master_a.tty_device
+    for addr in (master_a.short_id, master_b.short_id):
+        print("port {}: downtime {:.2f} s, time to recover {:.2f} s".format(addr, report[addr]["downtime"], report[addr]["mttr"]))
+    print("frames/s while the A master was unplugged: A {:.0f}, B {:.0f}; after the recoveries: A {:.0f}, B {:.0f}"
+          .format(during[SIDE_A], during[SIDE_B], after_b[SIDE_A] / 1.5, after_b[SIDE_B] / 1.5))
+    assert "UWB port supervisor: " + master_a.short_id in log_txt
+    for entry in serial_ports.values():
+        close_entry_port(entry)
+    for fd in busy_fds:
+        os.close(fd)
+    emulator.stop()
+    print("All port supervisor tests passed")
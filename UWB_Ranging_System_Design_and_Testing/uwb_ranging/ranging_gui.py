@@ -9,6 +9,15 @@ from tkinter import font
 from tkinter import messagebox
 from pop_out_exp_meta import ExpMetaInfoCollectApp
 from utils import *
+from serial_mux import end_ranging_job_multiplexed
+from port_supervisor import PortSupervisor
+from multiproc_ranging import end_ranging_job_multiprocess
+from end_fusion import EndFusionBuffer
+from vehicle_tracker import VehicleTracker, frame_time_ns
+from ttc_estimator import TtcMonitor, format_ttc, format_event
+from rate_controller import AdaptiveRateController
+from pipeline_latency import PIPELINE_LATENCY
+from metrics_server import METRICS, count_detections
 
 
 # This file contains the GUI interface program of the ranging unit to control the
@@ -142,18 +151,49 @@ class RangingGUI(Frame):
         # UWB parameters
         self.uwb_init_thread = None
         self.uwb_init_ret_val = None
-        self.q_a_end = queue.LifoQueue()
-        self.q_b_end = queue.LifoQueue()
-        self.a_end_ranging_thread_async = None
-        self.b_end_ranging_thread_async = None
+        # A/B end fusion: frames of both ends paired and aligned in time, the display takes the newest pair
+        self.end_fusion = None
+        self.new_end_fusion()
+        self.ranging_thread_mux = None
 
-        self.last_a_data_report, self.last_b_data_report = None, None
+        # Per-vehicle tracks: the displayed distances are predicted at display time
+        self.vehicle_tracker = VehicleTracker()
+        # Closing speed and time-to-collision by windowed regression, threshold crossings are logged
+        self.ttc_monitor = TtcMonitor()
+        self.last_veh_detection_lists = None
 
         self.uwb_serial_ports = {}
+        # Optional session_replay.SessionRecorder capturing the serial traffic of the masters
+        self.session_recorder = None
+        # Optional clock_sync.ClockSyncService: its estimates are logged into each experiment
+        self.clock_sync = None
+        # Serial tty devices to pair (e.g. boards emulated by dwm_emulator.py), None: all SEGGER devices
+        self.uwb_tty_devices = None
+        # Pair the lost ports again during the experiments (port_supervisor.py)
+        self.port_supervision = True
+        # Optional device_cache.DeviceInfoCache: warm starts of the pairing
+        self.device_cache = None
+        # Read the masters in their own processes, the fusion stays in the Tk process (multiproc_ranging.py)
+        self.multiprocess = False
+        # Update rate of the masters following the vehicles around (rate_controller.py), per experiment
+        self.adaptive_rate = True
+        self.rate_controller = None
+        # Ranging reports of the masters: "shell" DIST lines or "tlv" dwm_loc_get polls (report_source.py)
+        self.report_source = "shell"
 
         # Camera parameters
         self.video_recorder, self.audio_recorder = None, None
 
+    def new_end_fusion(self):
+        # A fresh fusion buffer for each experiment: no frame, pair or statistics of the previous one.
+        # The ranging job of the previous experiment may still put a last frame into the old buffer.
+        self.end_fusion = EndFusionBuffer()
+        METRICS.set_collector("pair_source", self.end_fusion.metric_samples)
+        self.q_a_end = self.end_fusion.end_queue(A_END_CODE)
+        self.q_b_end = self.end_fusion.end_queue(B_END_CODE)
+        self.last_a_data_report, self.last_b_data_report = None, None
+        self.last_veh_detection_lists = None
+
     @property
     def all_uwb_serial_port_ready(self):
         if len(self.uwb_serial_ports) == 4:
@@ -240,7 +280,9 @@ class RangingGUI(Frame):
                                                             kwargs={"oem_firmware": False, 
                                                                     "init_reporting": True, 
                                                                     "serial_ports_dict": self.uwb_serial_ports,
-                                                                    "stop_flag_callback": lambda: not self.started},
+                                                                    "stop_flag_callback": lambda: not self.started,
+                                                                    "serial_tty_devices": self.uwb_tty_devices,
+                                                                    "device_cache": self.device_cache},
                                                             name="UWB Serial Port Init Thread",
                                                             daemon=True)
             self.uwb_init_thread.start()
@@ -264,29 +306,33 @@ class RangingGUI(Frame):
 
         self.init_uwb_serial_ports_non_blocking()
 
-        if not self.a_end_ranging_thread_async:
-            self.a_end_ranging_thread_async = threading.Thread( target=end_ranging_job_async_single,
-                                                                kwargs={"serial_ports": self.uwb_serial_ports, 
-                                                                        "end_side_code": A_END_CODE,
-                                                                        "data_ptr_queue_single_end": self.q_a_end,
-                                                                        "log_fpath": self.fdir,
-                                                                        "stop_flag_callback": lambda: not self.started,
-                                                                        "oem_firmware": False,
-                                                                        "exp_name": self.experiment_name},
-                                                                name="A End Reporting Thread Async",
-                                                                daemon=True)
-
-        if not self.b_end_ranging_thread_async:
-            self.b_end_ranging_thread_async = threading.Thread( target=end_ranging_job_async_single,
-                                                                kwargs={"serial_ports": self.uwb_serial_ports, 
-                                                                        "end_side_code": B_END_CODE,
-                                                                        "data_ptr_queue_single_end": self.q_b_end,
-                                                                        "log_fpath": self.fdir,
-                                                                        "stop_flag_callback": lambda: not self.started,
-                                                                        "oem_firmware": False,
-                                                                        "exp_name": self.experiment_name},
-                                                                name="B End Reporting Thread Async",
-                                                                daemon=True)
+        if not self.ranging_thread_mux:
+            self.new_end_fusion()
+            # One multiplexer thread serves the masters of both ends
+            ranging_kwargs = {"serial_ports": self.uwb_serial_ports,
+                              "data_ptr_queues": {A_END_CODE: self.q_a_end,
+                                                  B_END_CODE: self.q_b_end},
+                              "log_fpath": self.fdir,
+                              "stop_flag_callback": lambda: not self.started,
+                              "oem_firmware": False,
+                              "exp_name": self.experiment_name,
+                              "report_source": self.report_source}
+            if self.multiprocess:
+                # ... or one reader process per master, joined by this thread
+                ranging_target = end_ranging_job_multiprocess
+            else:
+                ranging_target = end_ranging_job_multiplexed
+                ranging_kwargs.update({"recorder": self.session_recorder,
+                                       "supervisor": PortSupervisor(self.uwb_serial_ports, tty_devices=self.uwb_tty_devices,
+                                                                    device_cache=self.device_cache)
+                                                     if self.port_supervision else None})
+            if self.adaptive_rate and not self.multiprocess:
+                self.rate_controller = AdaptiveRateController(self.uwb_serial_ports)
+                METRICS.set_collector("rate_controller", self.rate_controller.metric_samples)
+            self.ranging_thread_mux = threading.Thread( target=ranging_target,
+                                                        kwargs=ranging_kwargs,
+                                                        name="A/B End Reporting Thread Multiplexed",
+                                                        daemon=True)
         try:
             self.vid_f_name = self.experiment_name + "-ground-truth-vid"
             self.video_recorder = VideoRecorder(fdir=self.fdir, fname=self.vid_f_name) 
@@ -294,15 +340,16 @@ class RangingGUI(Frame):
         except (NameError, OSError) as e:
             sys.stdout.write(timestamp_log() + "Camera recorder init failed.\n")
             self.video_recorder, self.audio_recorder = None, None
-        self.a_end_ranging_thread_async.start()
-        self.b_end_ranging_thread_async.start()
+        self.ranging_thread_mux.start()
+        if self.clock_sync is not None:
+            self.clock_sync.open_session(self.fdir, self.experiment_name)
         if self.video_recorder is not None and self.audio_recorder is not None:
             try:
                 start_AVrecording(self.video_recorder, self.audio_recorder, self.fdir, self.vid_f_name)
             except BaseException as e:
                 sys.stdout.write(timestamp_log() + " starting AV recording error: " + repr(e) + "\n")
 
-        self.after(100, self.show_ranging_res_async, self.q_a_end, self.q_b_end)
+        self.after(100, self.show_ranging_res_async, self.end_fusion)
 
     def stop_ranging(self):
         self.root.attributes("-fullscreen", False)
@@ -318,6 +365,13 @@ class RangingGUI(Frame):
         self.stop_button.state(["disabled"])
         self.start_time = None
         self.latest_exp_txt.set("    Exp: {} finished.".format(self.latest_exp_name))
+        if self.clock_sync is not None:
+            self.clock_sync.close_session()
+        if self.rate_controller is not None:
+            # The masters back to 10 Hz for the next experiment
+            self.rate_controller.close()
+            self.rate_controller = None
+            METRICS.set_collector("rate_controller", None)
         
         if self.video_recorder is not None and self.audio_recorder is not None:
             try:
@@ -337,48 +391,66 @@ class RangingGUI(Frame):
                 self.uwb_serial_ports = {}
             self.uwb_init_thread = None
         
-        if self.a_end_ranging_thread_async:
-            self.a_end_ranging_thread_async = None
-        if self.b_end_ranging_thread_async:
-            self.b_end_ranging_thread_async = None
+        if self.ranging_thread_mux:
+            self.ranging_thread_mux = None
+        sys.stdout.write(timestamp_log() + "A/B end fusion: " + self.end_fusion.summary() + "\n")
         if sys.platform.startswith('win') or sys.platform.startswith('linux'):
             # Pop up window to enter experiment meta. Blocking mainloop.
             exp_meta_info_window = ExpMetaInfoCollectApp(self.root, self.fdir, self.latest_exp_name)
         self.start_button.state(["!disabled"])
 
-    def show_ranging_res_async(self, q_a, q_b):
+    def show_ranging_res_async(self, end_fusion):
         # Queue put rate/speed is at most 10 Hz (less than 10 Hz when UWB signal is bad)
         # Queue get rate/speed is fixed 10 Hz by calling self.after(100, *args)
-        # whenever 
-        try:
-            a_data_point = q_a.get(block=False) 
-            [uwb_reporting_dict_a, ranging_results_foreign_slaves_from_a_master] = a_data_point
-            self.last_a_data_report = [uwb_reporting_dict_a, ranging_results_foreign_slaves_from_a_master]
-        except queue.Empty:
-            pass
-        
+        # The fusion buffer pairs the frames of both ends by reception time and interpolates the
+        # distances to a common instant; only the newest pair is kept (end_fusion.py).
+        # The A/B skew and pairing latency statistics are in end_fusion.stats().
+        if end_fusion is not self.end_fusion:
+            # Buffer of a previous experiment: the display loop of the current one took over
+            return
+        new_pair_taken_ns = None
         try:
-            b_data_point = q_b.get(block=False)
-            [uwb_reporting_dict_b, ranging_results_foreign_slaves_from_b_master] = b_data_point
-            self.last_b_data_report = [uwb_reporting_dict_b, ranging_results_foreign_slaves_from_b_master]
-        except queue.Empty:
-            pass
-        if self.last_a_data_report is not None and self.last_b_data_report is not None:
+            self.last_a_data_report, self.last_b_data_report = end_fusion.get(block=False)
+            new_pair_taken_ns = time.monotonic_ns()
             a_master_info_pos = self.last_a_data_report[0]['masterInfoPos']
             b_master_info_pos = self.last_b_data_report[0]['masterInfoPos']
             veh_detection_list_a, veh_detection_list_b = process_async_raw_ranging_results(self.last_a_data_report, self.last_b_data_report, a_master_info_pos, b_master_info_pos)
+            self.vehicle_tracker.update(A_END_CODE, veh_detection_list_a, frame_time_ns(self.last_a_data_report))
+            self.vehicle_tracker.update(B_END_CODE, veh_detection_list_b, frame_time_ns(self.last_b_data_report))
+            ttc_events = (self.ttc_monitor.update(A_END_CODE, veh_detection_list_a, frame_time_ns(self.last_a_data_report))
+                          + self.ttc_monitor.update(B_END_CODE, veh_detection_list_b, frame_time_ns(self.last_b_data_report)))
+            for event in ttc_events:
+                sys.stdout.write(timestamp_log() + "TTC event: " + format_event(event) + "\n")
+            if self.rate_controller is not None:
+                self.rate_controller.update(A_END_CODE, veh_detection_list_a, frame_time_ns(self.last_a_data_report),
+                                            self.last_a_data_report[0].get("superFrameNumber"))
+                self.rate_controller.update(B_END_CODE, veh_detection_list_b, frame_time_ns(self.last_b_data_report),
+                                            self.last_b_data_report[0].get("superFrameNumber"))
+            self.last_veh_detection_lists = veh_detection_list_a, veh_detection_list_b
+            geometry_ns = time.monotonic_ns()
+            METRICS.inc("uwb_consumer_pairs_total")
+            count_detections("A", veh_detection_list_a)
+            count_detections("B", veh_detection_list_b)
+        except queue.Empty:
+            pass
+        if self.last_veh_detection_lists is not None:
+            # The frames are 100+ ms old by now: show the distances predicted at display time
+            veh_detection_list_a, veh_detection_list_b = self.last_veh_detection_lists
+            display_time_ns = time.monotonic_ns()
+            self.vehicle_tracker.annotate_prediction(A_END_CODE, veh_detection_list_a, display_time_ns)
+            self.vehicle_tracker.annotate_prediction(B_END_CODE, veh_detection_list_b, display_time_ns)
             
-            a_txt_to_show, a_flag = display_safety_ranging_results(veh_detection_list_a, length_unit="METRIC")
-            b_txt_to_show, b_flag = display_safety_ranging_results(veh_detection_list_b, length_unit="METRIC")
-            self.a_end_txt.set(a_txt_to_show)
-            self.b_end_txt.set(b_txt_to_show)
+            a_txt_to_show, a_flag = display_safety_ranging_results(veh_detection_list_a, length_unit="METRIC", use_predicted=True)
+            b_txt_to_show, b_flag = display_safety_ranging_results(veh_detection_list_b, length_unit="METRIC", use_predicted=True)
+            self.a_end_txt.set(a_txt_to_show + format_ttc(veh_detection_list_a))
+            self.b_end_txt.set(b_txt_to_show + format_ttc(veh_detection_list_b))
             self.configure_ui_by_ranging_res(self.a_end_lbl, a_flag)
             self.configure_ui_by_ranging_res(self.b_end_lbl, b_flag)
-            a_stmp = datetime.strptime(self.last_a_data_report[0].get("timeStamp").split(" local")[0][1:], '%Y-%m-%d %H:%M:%S.%f')
-            b_stmp = datetime.strptime(self.last_b_data_report[0].get("timeStamp").split(" local")[0][1:], '%Y-%m-%d %H:%M:%S.%f')
-            time_diff = abs((a_stmp - b_stmp).total_seconds())
+            if new_pair_taken_ns is not None:
+                PIPELINE_LATENCY.record_pair((self.last_a_data_report, self.last_b_data_report),
+                                             new_pair_taken_ns, geometry_ns, time.monotonic_ns())
         
-        self.after(100, self.show_ranging_res_async, q_a, q_b)
+        self.after(100, self.show_ranging_res_async, end_fusion)
 
     def configure_ui_by_ranging_res(self, label_ui, range_flag):
         if range_flag < 0:
@@ -0,0 +1,632 @@
+#!/usr/bin/python3
+
+import sys, math, time, threading
+import serial
+from utils import timestamp_log
+from vehicle_tracker import near_side_adjusted_dist
+from ttc_estimator import DIST_THRESHOLDS, TTC_THRESHOLDS, TTC_MIN_CLOSING_SPEED
+
+
+# This file contains the adaptive update rate controller of the masters.
+# The masters are paired with "aurs 1 1" (10 Hz, the fastest rate of the firmware) and used to keep
+# it for the whole session: with no vehicle around, the UWB channel, the UARTs and the host still
+# carry and process 10 frames per second per end. AdaptiveRateController runs on the output of
+# process_async_raw_ranging_results() (after VehicleTracker and TtcMonitor) and picks the rate of
+# the masters from the adjusted distance (vehicle_tracker.near_side_adjusted_dist) and the closing
+# speed ("ttc_closing_speed" of ttc_estimator.py, "closing_speed" of vehicle_tracker.py when the
+# regression has too few samples at a low rate) of every detected vehicle:
+#   level 0, "hazard": aurs 1 1 (10 Hz)     a vehicle within 10 m or less than 10 s away
+#   level 1, "near":   aurs 2 2 (5 Hz)      a vehicle within 30 m or less than 20 s away
+#   level 2, "clear":  aurs 4 4 (2.5 Hz)    otherwise
+# Both masters get the same rate: the A/B end fusion (end_fusion.py) pairs the frames of the ends,
+# and a slow end would slow down the pairs of the other one.
+#   - raising is immediate;
+#   - lowering needs the thresholds cleared by RATE_HYSTERESIS for RATE_HOLD seconds in a row;
+#   - every change takes a token of a budget of RATE_CHANGE_BUDGET changes, one token regained
+#     every RATE_BUDGET_PERIOD seconds. Raising goes through with an empty budget, lowering waits.
+# Each command typed into the shell of a master is echoed into its reporting stream and may cost
+# a frame, hence the budget. The commands are written by RateCommandChannel, one thread per master:
+# the consumer (GUI, headless service) never waits for the serial port, and both masters are typed
+# at once. The reading thread owns the input of the ports, so the characters are paced by a fixed
+# delay, not by their echo (shell_channel.py). A raise pre-empts a lowering still pending or being
+# typed. Every command starts with a CR, ending whatever a garbled previous command left in the
+# shell line.
+# The reports interleaved with the typed characters may garble a command: each change is confirmed
+# by the frame period of the end observed by update() (super frame numbers over the reception
+# times) once the command is written, and the command is typed again, up to RATE_MAX_RETRIES times,
+# if the period did not change. A port not commanded yet (start, port paired again by
+# port_supervisor.py) gets the current rate; the masters are set back to 10 Hz when the controller
+# is closed.
+# A master polled through the TLV UART API (report_source.TlvLocSource, --report-source tlv) has no
+# shell to type into: its rate goes out as a dwm_upd_rate_set request, sent by its reading thread
+# between two polls, and the poll period follows the rate.
+
+A_END_CODE, B_END_CODE = 2, 1
+UPD_RATE_UNIT = 0.1                             # Seconds per "aurs" unit
+RATE_LEVELS = ((1, 1), (2, 2), (4, 4))          # "aurs <upd_rate> <upd_rate_stat>" per level, fastest first
+RATE_LEVEL_NAMES = ("hazard", "near", "clear")
+# (distance mm, TTC s) below which a vehicle needs the level, per level but the last one
+RATE_THRESHOLDS = ((DIST_THRESHOLDS[0], TTC_THRESHOLDS[0]), (30000, 20.0))
+RATE_HYSTERESIS = 0.2           # Relative margin above the thresholds before lowering the rate
+RATE_HOLD = 5.0                 # Seconds the margin must hold before lowering the rate
+RATE_CHANGE_BUDGET = 4          # Rate changes in a burst
+RATE_BUDGET_PERIOD = 30.0       # Seconds to regain one rate change of the budget
+RATE_CHAR_DELAY = 0.1           # Seconds between the characters of a command
+RATE_CONFIRM_SETTLE = 0.5       # Seconds after a written command before measuring the period (the last old-rate report)
+RATE_CONFIRM_WINDOW = 1.5       # Seconds, and at least RATE_CONFIRM_FRAMES periods, of frames to measure the period
+RATE_CONFIRM_FRAMES = 4
+RATE_CONFIRM_TOLERANCE = 0.3    # Relative error of the measured period confirming a rate
+RATE_CONFIRM_TIMEOUT = 5.0      # Seconds before a command not written (port error) is typed again
+RATE_MAX_RETRIES = 3
+SHELL_CLEAR_LINE = b"\r"
+
+
+def aurs_command(upd_rate):
+    """ :returns:
+            shell command bytes of an (upd_rate, upd_rate_stat) pair, e.g. b"aurs 1 1\\r"
+    """
+    return "aurs {} {}\r".format(*upd_rate).encode()
+
+
+def rate_hz(upd_rate):
+    return 1.0 / (upd_rate[0] * UPD_RATE_UNIT)
+
+
+class RateCommandChannel():
+
+    # Non-blocking "aurs" writer: submit() queues the rate of a device, replacing the one still
+    # pending for it, and returns; one background thread per device types the commands.
+    def __init__(self, char_delay=RATE_CHAR_DELAY):
+        self.char_delay = char_delay
+        self._pending = {}      # device id: (serial port, (upd_rate, upd_rate_stat))
+        self._typing = {}       # device id: rate being typed
+        self._abort = set()     # devices whose command being typed is pre-empted
+        self._written = {}      # device id: (rate, time.monotonic_ns()) of the last command written
+        self._sources = {}      # device id: polled report source (TLV API) setting the rate instead
+        self._workers = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+        self.written, self.replaced, self.preempted, self.failed, self.bytes_written = 0, 0, 0, 0, 0
+
+    def start(self):
+        return self
+
+    def submit(self, dev, serial_port, upd_rate, preempt=False, source=None):
+        """ Queue the rate of a device. preempt: also abort the command being typed for it
+            (if for another rate), e.g. a lowering when raising. source: report source of the device
+            (report_source.py); one with set_upd_rate() sends the rate instead of the shell command
+        """
+        with self._cond:
+            if self._stopped:
+                return
+            if hasattr(source, "set_upd_rate"):
+                # Replaces the rate still pending in the source, sent before its next poll
+                self._sources[dev] = source
+                source.set_upd_rate(upd_rate)
+                self.written += 1
+                self.bytes_written += 6
+                return
+            self._sources.pop(dev, None)
+            if dev in self._pending:
+                self.replaced += 1
+                del self._pending[dev]
+            self._pending[dev] = (serial_port, tuple(upd_rate))
+            if preempt and self._typing.get(dev, tuple(upd_rate)) != tuple(upd_rate):
+                self._abort.add(dev)
+            if dev not in self._workers:
+                self._workers[dev] = threading.Thread(target=self._write_job, args=(dev,),
+                                                      name="UWB Rate Command Thread {}".format(dev), daemon=True)
+                self._workers[dev].start()
+            self._cond.notify_all()
+
+    def written_ns(self, dev, upd_rate):
+        """ :returns:
+                time.monotonic_ns() at which the command of the rate was last written to the device, None if never
+        """
+        source = self._sources.get(dev)
+        if source is not None:
+            return source.upd_rate_written_ns(upd_rate)
+        written = self._written.get(dev)
+        if written is None or written[0] != tuple(upd_rate):
+            return None
+        return written[1]
+
+    def flush(self, timeout=None):
+        """ Wait until the pending commands are written
+
+            :returns:
+                True if none is left
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._typing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout=5.0):
+        self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._pending.clear()
+            self._abort.update(self._typing)
+            self._cond.notify_all()
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.join(timeout)
+
+    def _type(self, dev, serial_port, command):
+        """ :returns:
+                True if the command was typed whole, False if pre-empted
+        """
+        for i, B in enumerate(SHELL_CLEAR_LINE + command):
+            if dev in self._abort:
+                if i > len(SHELL_CLEAR_LINE):
+                    # End the partial command: answered by its usage, or not found
+                    serial_port.write(SHELL_CLEAR_LINE)
+                return False
+            serial_port.write(bytes([B]))
+            time.sleep(self.char_delay)
+        return True
+
+    def _write_job(self, dev):
+        while True:
+            with self._cond:
+                while dev not in self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                serial_port, upd_rate = self._pending.pop(dev)
+                self._typing[dev] = upd_rate
+                self._abort.discard(dev)
+            command = aurs_command(upd_rate)
+            try:
+                if serial_port.is_open:
+                    if self._type(dev, serial_port, command):
+                        self._written[dev] = (upd_rate, time.monotonic_ns())
+                        self.written += 1
+                        self.bytes_written += len(SHELL_CLEAR_LINE) + len(command)
+                    else:
+                        self.preempted += 1
+            except (serial.SerialException, OSError, ValueError) as e:
+                # The reading thread reports the port (port_supervisor.py), the next port gets the rate
+                self.failed += 1
+                sys.stdout.write(timestamp_log() + "UWB update rate command {} to {} failed: {}\n"
+                                 .format(command.strip().decode(), dev, repr(e)))
+            finally:
+                with self._cond:
+                    del self._typing[dev]
+                    self._cond.notify_all()
+
+
+class AdaptiveRateController():
+
+    # Common update rate of the masters of both ends, from the detected vehicles of each end
+    def __init__(self, serial_ports, channel=None,
+                 levels=RATE_LEVELS,
+                 thresholds=RATE_THRESHOLDS,
+                 hysteresis=RATE_HYSTERESIS,
+                 hold=RATE_HOLD,
+                 budget=RATE_CHANGE_BUDGET,
+                 budget_period=RATE_BUDGET_PERIOD):
+        self.serial_ports = serial_ports
+        self.channel = RateCommandChannel().start() if channel is None else channel
+        self.levels = levels
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+        self.hold = hold
+        self.budget = budget
+        self.budget_period = budget_period
+        self.level = 0                  # The masters are paired at aurs 1 1
+        self.demands = {}               # end side code: (level to raise to, level kept with the margin)
+        self.ports = {}                 # end side code: serial port commanded at the current level
+        self.confirming = {}            # end side code: state of the confirmation of the last command
+        self.lower_since = None         # t_ns since which a lower level holds
+        self.suppressed_since = None    # t_ns since which lowering waits for the budget
+        self.tokens = float(budget)
+        self.tokens_t = None
+        self.changes = {"raise": 0, "lower": 0}
+        self.suppressed = 0
+        self.confirmations = {"confirmed": 0, "retried": 0, "unconfirmed": 0}
+
+    @property
+    def upd_rate(self):
+        return self.levels[self.level]
+
+    def demand(self, veh_detection_list, margin=1.0):
+        """ :returns:
+                fastest level needed by the vehicles of an end, the thresholds scaled by margin
+        """
+        level = len(self.levels) - 1
+        for veh_dict in veh_detection_list:
+            dist = near_side_adjusted_dist(veh_dict)
+            if dist is None:
+                continue
+            closing_speed = veh_dict.get("ttc_closing_speed", veh_dict.get("closing_speed"))
+            ttc = math.inf
+            if closing_speed is not None and closing_speed > TTC_MIN_CLOSING_SPEED:
+                ttc = dist / closing_speed
+            for i, (dist_threshold, ttc_threshold) in enumerate(self.thresholds[:level]):
+                if dist <= dist_threshold * margin or ttc <= ttc_threshold * margin:
+                    level = i
+                    break
+        return level
+
+    def update(self, end_side_code, veh_detection_list, t_ns, frame_number=None):
+        """ Feed the vehicles processed by process_async_raw_ranging_results() for one end, measured
+            at t_ns (time.monotonic_ns() of the frame), and change the rate of the masters if needed.
+            frame_number: super frame number of the frame of the end, to confirm the rate changes
+
+            :returns:
+                the new level if the rate was changed, None otherwise
+        """
+        self.demands[end_side_code] = (self.demand(veh_detection_list),
+                                       self.demand(veh_detection_list, 1 + self.hysteresis))
+        self._command_new_ports(t_ns)
+        if frame_number is not None:
+            self._confirm(end_side_code, t_ns, frame_number)
+        raise_level = min(demand[0] for demand in self.demands.values())
+        keep_level = min(demand[1] for demand in self.demands.values())
+        if raise_level < self.level:
+            self.lower_since = self.suppressed_since = None
+            self._take_token(t_ns)
+            return self._set_level(raise_level, t_ns)
+        if keep_level <= self.level:
+            self.lower_since = self.suppressed_since = None
+            return None
+        if self.lower_since is None:
+            self.lower_since = t_ns
+        if t_ns - self.lower_since < self.hold * 1e9:
+            return None
+        if not self._take_token(t_ns):
+            if self.suppressed_since is None:
+                self.suppressed_since = t_ns
+                self.suppressed += 1
+            return None
+        self.lower_since = self.suppressed_since = None
+        return self._set_level(keep_level, t_ns)
+
+    def _take_token(self, t_ns):
+        if self.tokens_t is not None:
+            self.tokens = min(self.budget, self.tokens + (t_ns - self.tokens_t) / 1e9 / self.budget_period)
+        self.tokens_t = t_ns
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def _master_ports(self):
+        """ :returns:
+                {end side code: (device id, serial port)} of the paired masters
+        """
+        masters = {}
+        for dev, entry in list(self.serial_ports.items()):
+            side = entry.get("info_pos", {}).get("side_master")
+            if side in (A_END_CODE, B_END_CODE) and entry.get("port") is not None:
+                masters[side] = (dev, entry["port"])
+        return masters
+
+    def _source(self, dev):
+        return self.serial_ports.get(dev, {}).get("report_source")
+
+    def _submit(self, side, dev, port, t_ns, preempt=False, retries=0):
+        self.ports[side] = port
+        self.channel.submit(dev, port, self.upd_rate, preempt=preempt, source=self._source(dev))
+        self.confirming[side] = {"dev": dev, "port": port, "upd_rate": self.upd_rate, "submitted_ns": t_ns,
+                                 "retries": retries, "start": None}
+
+    def _command_new_ports(self, t_ns):
+        for side, (dev, port) in self._master_ports().items():
+            if self.ports.get(side) is not port:
+                self._submit(side, dev, port, t_ns)
+
+    def _confirm(self, side, t_ns, frame_number):
+        """ Compare the frame period of an end with the rate of its last command, once written;
+            type the command again if the master did not take it
+        """
+        state = self.confirming.get(side)
+        if state is None:
+            return
+        written_ns = self.channel.written_ns(state["dev"], state["upd_rate"])
+        if written_ns is None or written_ns < state["submitted_ns"]:
+            if t_ns - state["submitted_ns"] > RATE_CONFIRM_TIMEOUT * 1e9:
+                self._retry(side, state, t_ns, "not written")
+            return
+        if state["start"] is None:
+            if t_ns >= written_ns + RATE_CONFIRM_SETTLE * 1e9:
+                state["start"] = (t_ns, frame_number)
+            return
+        t_0, n_0 = state["start"]
+        expected = state["upd_rate"][0] * UPD_RATE_UNIT
+        if (t_ns - t_0 < max(RATE_CONFIRM_WINDOW, RATE_CONFIRM_FRAMES * expected) * 1e9
+                or frame_number <= n_0):
+            return
+        period = (t_ns - t_0) / 1e9 / (frame_number - n_0)
+        if abs(period / expected - 1) <= RATE_CONFIRM_TOLERANCE:
+            self.confirmations["confirmed"] += 1
+            del self.confirming[side]
+        else:
+            self._retry(side, state, t_ns, "frame period {:.2f} s".format(period))
+
+    def _retry(self, side, state, t_ns, reason):
+        if state["retries"] >= RATE_MAX_RETRIES:
+            self.confirmations["unconfirmed"] += 1
+            del self.confirming[side]
+            sys.stdout.write(timestamp_log() + "UWB update rate: aurs {} {} not taken by master {} ({}), given up\n"
+                             .format(*state["upd_rate"], state["dev"], reason))
+            return
+        self.confirmations["retried"] += 1
+        sys.stdout.write(timestamp_log() + "UWB update rate: aurs {} {} not taken by master {} ({}), sent again\n"
+                         .format(*state["upd_rate"], state["dev"], reason))
+        self._submit(side, state["dev"], state["port"], t_ns, preempt=True, retries=state["retries"] + 1)
+
+    def _set_level(self, level, t_ns):
+        direction = "raise" if level < self.level else "lower"
+        sys.stdout.write(timestamp_log() + "UWB update rate: {} -> {} (aurs {} {}, {:g} Hz), rate change budget {:.1f}\n"
+                         .format(RATE_LEVEL_NAMES[self.level], RATE_LEVEL_NAMES[level], *self.levels[level],
+                                 rate_hz(self.levels[level]), self.tokens))
+        self.level = level
+        self.changes[direction] += 1
+        for side, (dev, port) in self._master_ports().items():
+            self._submit(side, dev, port, t_ns, preempt=direction == "raise")
+        return level
+
+    def close(self):
+        """ Set the masters back to 10 Hz and stop the command channel
+        """
+        if self.level != 0:
+            self.level = 0
+            for side, (dev, port) in self._master_ports().items():
+                self.channel.submit(dev, port, self.upd_rate, preempt=True, source=self._source(dev))
+        self.channel.stop()
+
+    def metric_samples(self):
+        """ :returns:
+                samples of the metrics endpoint (metrics_server.py)
+        """
+        samples = [("uwb_update_rate_hz", (("end", "A" if side == A_END_CODE else "B"),), rate_hz(self.upd_rate))
+                   for side in sorted(self.ports)]
+        samples += [("uwb_rate_changes_total", (("direction", direction),), n) for direction, n in self.changes.items()]
+        samples.append(("uwb_rate_changes_suppressed_total", (), self.suppressed))
+        samples += [("uwb_rate_commands_total", (("result", result),), n)
+                    for result, n in (("written", self.channel.written), ("replaced", self.channel.replaced),
+                                      ("preempted", self.channel.preempted), ("failed", self.channel.failed))]
+        samples += [("uwb_rate_confirmations_total", (("result", result),), n) for result, n in self.confirmations.items()]
+        return samples
+
+
+if __name__ == "__main__":
+    # Unit Testing: levels, hysteresis, hold and budget on synthetic vehicles; then a ranging session
+    # against the emulated boards (dwm_emulator.py): the rate of the masters follows the controller,
+    # a garbled command is typed again, frames and host CPU time at 10 Hz and when the track is clear.
+    import io, queue, tempfile
+    from vehicle_tracker import frame_time_ns
+
+    class RecordingChannel():
+        def __init__(self):
+            self.commands = []
+            self.written, self.replaced, self.preempted, self.failed = 0, 0, 0, 0
+
+        def submit(self, dev, serial_port, upd_rate, preempt=False, source=None):
+            self.commands.append((dev, aurs_command(upd_rate)))
+
+        def written_ns(self, dev, upd_rate):
+            return None
+
+        def stop(self):
+            pass
+
+    class FakePort():
+        is_open = True
+
+    def vehicle(dist, closing_speed=0, side=A_END_CODE, near_side=True):
+        foreign = B_END_CODE if side == A_END_CODE else A_END_CODE
+        return {"vehicle_id": 2, "master_doing_ranging": {"side_master": side},
+                "near_side_code_local": side if near_side else foreign,
+                "near_side_code_foreign": foreign, "closing_speed": closing_speed,
+                "slaves_in_ranging": [{"side_slave": foreign, "adjusted_dist": dist}]}
+
+    log_out, sys.stdout = sys.stdout, io.StringIO()
+    ports = {"AAAA": {"port": FakePort(), "info_pos": {"side_master": A_END_CODE}},
+             "BBBB": {"port": FakePort(), "info_pos": {"side_master": B_END_CODE}},
+             "CCCC": {"port": FakePort(), "info_pos": {"side_slave": A_END_CODE}}}
+    channel = RecordingChannel()
+    controller = AdaptiveRateController(ports, channel=channel)
+    t = [0]
+    def run(seconds, veh_a=(), veh_b=(), period=0.1):
+        levels = []
+        for _ in range(int(round(seconds / period))):
+            t[0] += int(period * 1e9)
+            levels.append(controller.update(A_END_CODE, list(veh_a), t[0]))
+            levels.append(controller.update(B_END_CODE, list(veh_b), t[0]))
+        return [level for level in levels if level is not None]
+
+    # The masters are set to the current rate first, then lowered after the hold time only
+    assert run(RATE_HOLD - 0.5) == [] and sorted(channel.commands) == [("AAAA", b"aurs 1 1\r"), ("BBBB", b"aurs 1 1\r")]
+    assert run(1.0) == [2] and channel.commands[-2:] == [("AAAA", b"aurs 4 4\r"), ("BBBB", b"aurs 4 4\r")]
+    # Vehicles not on the side of the master are ignored, distance and TTC raise at once
+    assert run(1.0, veh_a=[vehicle(5000, near_side=False)]) == []
+    assert run(0.1, veh_b=[vehicle(29000, side=B_END_CODE)]) == [1]
+    assert run(0.1, veh_a=[vehicle(25000, closing_speed=3000)]) == [0]
+    # Around a threshold: within the hysteresis margin, no change
+    assert run(30.0, veh_a=[vehicle(10500)]) == [] and controller.level == 0
+    assert run(10.0, veh_a=[vehicle(12500)]) == [1]
+    # Flapping vehicle: raising is immediate, lowering is held back by the budget
+    changes_before, t_0 = dict(controller.changes), t[0]
+    for _ in range(20):
+        run(0.5, veh_a=[vehicle(8000)])
+        run(RATE_HOLD + 1.0, veh_a=[vehicle(50000)])
+    lowered = controller.changes["lower"] - changes_before["lower"]
+    raised = controller.changes["raise"] - changes_before["raise"]
+    assert raised - lowered in (0, 1) and lowered < 20
+    assert lowered <= RATE_CHANGE_BUDGET + (t[0] - t_0) / 1e9 / RATE_BUDGET_PERIOD and controller.suppressed > 0
+    assert controller.level == 2 or controller.lower_since is not None
+    # A master paired again (port_supervisor.py) gets the current rate
+    n_commands = len(channel.commands)
+    ports["AAAA"] = dict(ports["AAAA"], port=FakePort())
+    run(0.1, veh_a=[vehicle(50000)])
+    assert channel.commands[n_commands] == ("AAAA", aurs_command(controller.upd_rate))
+    samples = dict(((name, labels), value) for name, labels, value in controller.metric_samples())
+    assert samples[("uwb_update_rate_hz", (("end", "A"),))] == rate_hz(controller.upd_rate)
+    sys.stdout = log_out
+    print("Flapping vehicle: {} raises, {} lowers in {:.0f} s, {} lowerings held back by the budget"
+          .format(raised, lowered, (t[0] - t_0) / 1e9, controller.suppressed))
+
+    # Command channel: the rates of a device replace each other while pending, the devices are typed
+    # in parallel, a raise pre-empts the lowering being typed
+    class SlowPort():
+        is_open = True
+        def __init__(self):
+            self.data = bytearray()
+        def write(self, data):
+            self.data += data
+    port_a, port_b = SlowPort(), SlowPort()
+    channel = RateCommandChannel(char_delay=0.01).start()
+    t_0 = time.monotonic()
+    for upd_rate in RATE_LEVELS * 3:
+        channel.submit("AAAA", port_a, upd_rate)
+    assert time.monotonic() - t_0 < 0.01
+    assert channel.flush(5.0) and channel.replaced >= 7 and port_a.data.endswith(b"\raurs 4 4\r")
+    t_0 = time.monotonic()
+    channel.submit("AAAA", port_a, RATE_LEVELS[1])
+    channel.submit("BBBB", port_b, RATE_LEVELS[1])
+    assert channel.flush(5.0)
+    t_both = time.monotonic() - t_0
+    assert t_both < 1.5 * len(b"\raurs 2 2\r") * 0.01, t_both
+    channel.stop()
+    channel = RateCommandChannel(char_delay=0.05).start()
+    port_a.data.clear()
+    channel.submit("AAAA", port_a, RATE_LEVELS[2])
+    time.sleep(0.2)
+    channel.submit("AAAA", port_a, RATE_LEVELS[0], preempt=True)
+    assert channel.flush(5.0) and channel.preempted == 1
+    typed = bytes(port_a.data)
+    assert typed.startswith(b"\raur") and typed.endswith(b"\r\raurs 1 1\r") and b"aurs 4 4" not in typed, typed
+    assert channel.written_ns("AAAA", RATE_LEVELS[2]) is None and channel.written_ns("AAAA", RATE_LEVELS[0]) is not None
+    channel.stop()
+
+    # Ranging session against the emulated boards of the ego vehicle alone: the track is clear
+    from dwm_emulator import DwmEmulator, make_fleet
+    from utils import pairing_uwb_ports
+    from serial_mux import end_ranging_job_multiplexed
+
+    vehicles = make_fleet(1)
+    emulator = DwmEmulator(vehicles, seed=25).start()
+    serial_ports = {}
+    sys.stdout = io.StringIO()
+    assert pairing_uwb_ports(serial_ports_dict=serial_ports, serial_tty_devices=emulator.tty_devices()) == 1
+    masters = [dev for dev in emulator.tags]
+    data_ptr_queues = {A_END_CODE: queue.Queue(), B_END_CODE: queue.Queue()}
+    stop = threading.Event()
+    controller = AdaptiveRateController(serial_ports, hold=1.0)
+    frames = {A_END_CODE: 0, B_END_CODE: 0}
+    hazard = threading.Event()
+
+    def consumer_job():
+        while not stop.is_set():
+            for side, q in data_ptr_queues.items():
+                try:
+                    data_point = q.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                frames[side] += 1
+                controller.update(side, [vehicle(5000, side=side)] if hazard.is_set() else [], frame_time_ns(data_point),
+                                  data_point[0]["superFrameNumber"])
+
+    def measure(seconds):
+        start = dict(frames)
+        cpu_0 = time.process_time()
+        time.sleep(seconds)
+        return sum(frames[side] - start[side] for side in frames) / seconds, (time.process_time() - cpu_0) / seconds
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        job = threading.Thread(target=end_ranging_job_multiplexed,
+                               kwargs={"serial_ports": serial_ports, "data_ptr_queues": data_ptr_queues,
+                                       "log_fpath": tmp_dir, "stop_flag_callback": stop.is_set, "exp_name": "rate"},
+                               daemon=True)
+        job.start()
+        consumer = threading.Thread(target=consumer_job, daemon=True)
+        hazard.set()
+        consumer.start()
+        deadline = time.monotonic() + 10.0
+        while time.monotonic() < deadline and min(frames.values()) == 0:
+            time.sleep(0.05)
+        fixed_rate, fixed_cpu = measure(3.0)
+        # The characters of the lowering are lost: the frame period does not change, the command is typed again
+        emulator.min_char_gap = 1.0
+        hazard.clear()
+        deadline = time.monotonic() + 15.0
+        while time.monotonic() < deadline and controller.confirmations["retried"] == 0:
+            time.sleep(0.05)
+        assert controller.confirmations["retried"] >= 1 and all(dev.upd_rate == list(RATE_LEVELS[0]) for dev in masters)
+        emulator.min_char_gap = 0.0
+        deadline = time.monotonic() + 15.0
+        while time.monotonic() < deadline and not all(dev.upd_rate == list(RATE_LEVELS[-1]) for dev in masters):
+            time.sleep(0.05)
+        assert controller.level == len(RATE_LEVELS) - 1, controller.level
+        assert all(dev.upd_rate == list(RATE_LEVELS[-1]) for dev in masters)
+        clear_rate, clear_cpu = measure(3.0)
+        confirmed = controller.confirmations["confirmed"]
+        assert confirmed >= 2, controller.confirmations
+        # A vehicle close by: both masters back to 10 Hz at once
+        hazard.set()
+        t_0 = time.monotonic()
+        deadline = t_0 + 5.0
+        while time.monotonic() < deadline and not all(dev.upd_rate == list(RATE_LEVELS[0]) for dev in masters):
+            time.sleep(0.01)
+        raise_latency = time.monotonic() - t_0
+        assert controller.level == 0 and all(dev.upd_rate == list(RATE_LEVELS[0]) for dev in masters)
+        assert raise_latency < 2 * len(b"\raurs 1 1\r") * RATE_CHAR_DELAY, raise_latency
+        hazard.clear()
+        stop.set()
+        job.join(timeout=5.0)
+        consumer.join(timeout=2.0)
+        controller.close()
+        shell_commands = (controller.channel.written, controller.channel.bytes_written)
+
+        # Masters polled through the TLV API: the rates go out as dwm_upd_rate_set, the polls follow them
+        stop.clear()
+        controller = AdaptiveRateController(serial_ports, hold=1.0)
+        frames = {A_END_CODE: 0, B_END_CODE: 0}
+        job = threading.Thread(target=end_ranging_job_multiplexed,
+                               kwargs={"serial_ports": serial_ports, "data_ptr_queues": data_ptr_queues,
+                                       "log_fpath": tmp_dir, "stop_flag_callback": stop.is_set, "exp_name": "rate-tlv",
+                                       "report_source": "tlv"},
+                               daemon=True)
+        job.start()
+        consumer = threading.Thread(target=consumer_job, daemon=True)
+        consumer.start()
+        deadline = time.monotonic() + 20.0
+        while time.monotonic() < deadline and not (controller.level == len(RATE_LEVELS) - 1 and not controller.confirming):
+            time.sleep(0.05)
+        assert all(dev.upd_rate == list(RATE_LEVELS[-1]) for dev in masters) and not controller.confirming
+        tlv_clear_rate, _ = measure(4.0)
+        hazard.set()
+        t_0 = time.monotonic()
+        deadline = t_0 + 5.0
+        while time.monotonic() < deadline and not all(dev.upd_rate == list(RATE_LEVELS[0]) for dev in masters):
+            time.sleep(0.01)
+        tlv_raise_latency = time.monotonic() - t_0
+        assert all(dev.upd_rate == list(RATE_LEVELS[0]) for dev in masters)
+        assert tlv_raise_latency < 2 * RATE_LEVELS[-1][0] * UPD_RATE_UNIT, tlv_raise_latency
+        tlv_confirmations = dict(controller.confirmations)
+        hazard.clear()
+        stop.set()
+        job.join(timeout=5.0)
+        consumer.join(timeout=2.0)
+        controller.close()
+        for entry in serial_ports.values():
+            entry["port"].close()
+    emulator.stop()
+    sys.stdout = log_out
+    assert clear_rate < fixed_rate * 0.5, (fixed_rate, clear_rate)
+    print("Emulated masters: {:.1f} frames/s at 10 Hz, {:.1f} frames/s when clear ({:.0%} fewer); host CPU {:.1%} -> {:.1%}; "
+          "{} rate commands ({} bytes)".format(fixed_rate, clear_rate, 1 - clear_rate / fixed_rate, fixed_cpu, clear_cpu,
+                                               *shell_commands))
+    print("Both masters raised to 10 Hz in {:.2f} s; confirmations: {}".format(raise_latency, confirmed))
+    assert abs(tlv_clear_rate - 2 * rate_hz(RATE_LEVELS[-1])) < 1.0, tlv_clear_rate
+    print("TLV API: {:.1f} frames/s when clear, both masters raised to 10 Hz in {:.2f} s; confirmations: {}"
+          .format(tlv_clear_rate, tlv_raise_latency, tlv_confirmations))
+    print("All rate controller tests passed")
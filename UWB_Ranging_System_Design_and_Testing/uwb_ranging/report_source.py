@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+import sys, os, time, struct, threading
+import importlib, importlib.util
+import serial
+from dist_parser import AnchorReading, DistReport
+from utils import resume_master_reporting, write_shell_command, make_dist_report
+
+
+def import_tag_mqtt_publisher_module(name):
+    """ Import a module copied alongside this file, or else the one of ../tag_mqtt_publisher by its file path:
+        ../tag_mqtt_publisher is not added to sys.path, its utils.py cannot shadow the one of this directory
+
+        :returns:
+            module. Raises ImportError if there is none
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        pass
+    fpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tag_mqtt_publisher", name + ".py")
+    spec = importlib.util.spec_from_file_location(name, fpath)
+    if spec is None or not os.path.isfile(fpath):
+        raise ImportError("no module {} alongside nor in ../tag_mqtt_publisher".format(name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+try:
+    # TLV UART API of ../tag_mqtt_publisher (or DWM1001.py copied alongside this file)
+    DWM1001 = import_tag_mqtt_publisher_module("DWM1001")
+except ImportError:
+    DWM1001 = None
+
+
+# This file contains the report sources of the master ranging data.
+# A report source delivers (report, data_raw) frames to the end ranging job:
+#   ShellReportSource:  "DIST" text lines of the shell mode reporting (aurs/lec), parsed by dist_parser.py
+#   TlvLocSource:       binary TLV API polling of dwm_loc_get (API section 5.3.10) in UART API mode,
+#                       framed by read_all_TLV() of ../tag_mqtt_publisher/DWM1001.py. No text is printed
+#                       or parsed. Frames are ~20 bytes per anchor instead of ~45, which leaves room
+#                       for update rates beyond 10 Hz.
+#                       The masters are polled at their update rate: read with DWM1001.dwm_upd_rate_get()
+#                       at the start, and changed with DWM1001.dwm_upd_rate_set() by set_upd_rate() (adaptive
+#                       rate controller, rate_controller.py), sent by the reading thread between two polls.
+# uwb_master.py --report-source selects the source of all the ranging paths (end ranging threads,
+# serial multiplexer, reader processes).
+# Both sources produce the DistReport record of make_dist_report(). The TLV API reports no
+# acceleration nor UWB local time. The tag position is reported only if the location engine
+# produced one (non-zero quality factor), as "POS=[...]" only appears with the LE enabled.
+
+TLV_LOC_GET_REQUEST = b"\x0C\x00"
+TLV_TYPE_POS = 0x41
+TLV_TYPE_DIST_ANCHOR = 0x48     # Node in anchor mode
+TLV_TYPE_DIST_TAG = 0x49        # Node in tag mode (masters)
+TLV_POS = struct.Struct("<iiiB")
+TLV_TAG_ANCHOR = struct.Struct("<HIBiiiB")  # UWB address, distance, distance qf, anchor position x/y/z, position qf
+TLV_UPD_RATE_UNIT = 0.1         # Seconds per update rate unit (100 ms)
+TLV_POLL_PERIOD = 0.1           # Seconds between dwm_loc_get polls if the update rate cannot be read ("aurs 1 1")
+TLV_RESPONSE_TIMEOUT = 1.0      # Seconds to wait for a complete dwm_loc_get response
+
+# Shell commands to switch the master over to the TLV UART API
+SHELL_CMD_AURS_FAST = b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D'    # "aurs 1 1"
+SHELL_CMD_QUIT = b'\x71\x75\x69\x74\x0D'                        # "quit": leave shell mode, back to UART API mode
+
+
+def decode_loc_get_frames(frames):
+    """ Decode the TLV frames of a dwm_loc_get response (tag mode), as split by DWM1001.read_all_TLV(),
+        into a DIST report
+
+        :returns:
+            DistReport, or raises ValueError on error codes and incomplete or broken responses
+    """
+    if not frames or bytes(frames[0][:2]) != b"\x40\x01":
+        raise ValueError("broken dwm_loc_get response: {}".format(b"".join(frames).hex()))
+    err_code = frames[0][2]
+    if err_code != 0:
+        raise ValueError("dwm_loc_get error {}: {}".format(err_code, DWM1001.ERROR_CLS.get(err_code, "unknown")))
+    if len(frames) != 3:
+        raise ValueError("incomplete dwm_loc_get response: {}".format(b"".join(frames).hex()))
+    est_pos, est_pos_qf, anchors = None, None, []
+    for frame in frames[1:]:
+        tlv_type, tlv_len = frame[0], frame[1]
+        if tlv_type == TLV_TYPE_POS and tlv_len == TLV_POS.size:
+            pos_x, pos_y, pos_z, pos_qf = TLV_POS.unpack_from(frame, 2)
+            if pos_qf:
+                est_pos, est_pos_qf = (pos_x, pos_y, pos_z), pos_qf
+        elif tlv_type == TLV_TYPE_DIST_TAG and tlv_len >= 1:
+            anchor_nbr = frame[2]
+            if tlv_len != 1 + anchor_nbr * TLV_TAG_ANCHOR.size:
+                raise ValueError("dwm_loc_get: {} bytes for {} anchors".format(tlv_len - 1, anchor_nbr))
+            for addr, dist_to, dist_qf, anc_x, anc_y, anc_z, _ in TLV_TAG_ANCHOR.iter_unpack(frame[3:]):
+                anchors.append(AnchorReading("{:04X}".format(addr), anc_x, anc_y, anc_z, dist_to, dist_qf))
+        elif tlv_type == TLV_TYPE_DIST_ANCHOR:
+            raise ValueError("dwm_loc_get: the node is in anchor mode, not a master")
+    return DistReport(anchors, est_pos=est_pos, est_pos_qf=est_pos_qf)
+
+
+def encode_loc_get_response(report, pos_qf=0):
+    """ Encode a DIST report as the TLV response of dwm_loc_get (tag mode). Inverse of
+        decode_loc_get_frames(), used to emulate a master in tests.
+
+        :returns:
+            bytes
+    """
+    if report.est_pos is not None:
+        pos = TLV_POS.pack(*report.est_pos, report.est_pos_qf)
+    else:
+        pos = TLV_POS.pack(0, 0, 0, pos_qf)
+    dist = bytes([len(report.anchors)]) + b"".join(
+        TLV_TAG_ANCHOR.pack(int(anc.anc_id, 16), anc.dist_to, anc.anc_qf, anc.x, anc.y, anc.z, 100)
+        for anc in report.anchors)
+    return (bytes([0x40, 1, 0, TLV_TYPE_POS, len(pos)]) + pos
+            + bytes([TLV_TYPE_DIST_TAG, len(dist)]) + dist)
+
+
+class ShellReportSource():
+
+    # "DIST" text lines of the shell mode reporting
+    def __init__(self, serial_port, oem_firmware=False):
+        self.serial_port = serial_port
+        self.oem_firmware = oem_firmware
+        self.rx_ns = None   # time.monotonic_ns() of the latest serial read (pipeline_latency.py)
+
+    def start(self):
+        resume_master_reporting(self.serial_port, self.oem_firmware)
+        self.serial_port.reset_input_buffer()
+
+    def read_frame(self):
+        """ :returns:
+                (DistReport or None if not a report, raw line bytes)
+        """
+        # Raw bytes are parsed without decoding
+        data_raw = self.serial_port.readline().rstrip()
+        self.rx_ns = time.monotonic_ns()
+        if not data_raw[:4] == b"DIST":
+            return None, data_raw
+        return make_dist_report(data_raw, self.oem_firmware), data_raw
+
+    def stop(self):
+        pass
+
+
+class TlvLocSource():
+
+    # Binary TLV API polling of dwm_loc_get, at the update rate of the master (or a fixed period)
+    def __init__(self, serial_port, period=None):
+        if DWM1001 is None:
+            raise ImportError("the TLV report source needs DWM1001.py of ../tag_mqtt_publisher")
+        self.serial_port = serial_port
+        self.fixed_period = period
+        self.period = TLV_POLL_PERIOD if period is None else period
+        self.upd_rate = None
+        self.errors = 0
+        self.rx_ns = None   # time.monotonic_ns() of the latest serial read (pipeline_latency.py)
+        self._next_poll = 0.0
+        self._requested_upd_rate = None     # Set by set_upd_rate(), sent by the reading thread
+        self._upd_rate_requested = threading.Event()    # Wakes the reading thread up between two polls
+        self._upd_rate_set_ns = None        # (update rate, time.monotonic_ns()) of the last dwm_upd_rate_set
+
+    def start(self):
+        if not self.serial_port.is_open:
+            self.serial_port.open()
+        # Let the master range at 10 Hz, then leave the shell mode (DIST text reporting stops)
+        write_shell_command(self.serial_port, command=b'\x0D\x0D', delay=0.2)
+        write_shell_command(self.serial_port, command=SHELL_CMD_AURS_FAST, delay=0.2)
+        write_shell_command(self.serial_port, command=SHELL_CMD_QUIT, delay=0.2)
+        time.sleep(0.2)
+        try:
+            act_upd_intval, sta_upd_intval, _ = DWM1001.dwm_upd_rate_get(self.serial_port)
+            # In ms, from 100 ms units
+            self._apply_upd_rate((act_upd_intval // 100, sta_upd_intval // 100))
+        except ValueError:
+            # Polled at TLV_POLL_PERIOD
+            self.serial_port.reset_input_buffer()
+        self._next_poll = time.monotonic()
+
+    def _apply_upd_rate(self, upd_rate):
+        self.upd_rate = tuple(upd_rate)
+        if self.fixed_period is None:
+            self.period = upd_rate[0] * TLV_UPD_RATE_UNIT
+
+    def set_upd_rate(self, upd_rate):
+        """ Ask for an update rate (active, stationary in 100 ms units); never blocks, the request is
+            sent by the reading thread at once (or after the poll in progress), the latest one replacing the others
+        """
+        self._requested_upd_rate = tuple(upd_rate)
+        self._upd_rate_requested.set()
+
+    def upd_rate_written_ns(self, upd_rate):
+        """ :returns:
+                time.monotonic_ns() at which the master accepted the update rate, None if it did not (yet)
+        """
+        written = self._upd_rate_set_ns
+        if written is None or written[0] != tuple(upd_rate):
+            return None
+        return written[1]
+
+    def _send_upd_rate(self, upd_rate):
+        # dwm_upd_rate_set writes to the flash of the master: hundreds of ms in the worst case
+        try:
+            DWM1001.dwm_upd_rate_set(self.serial_port, *upd_rate)
+        except ValueError:
+            self.errors += 1
+            self.serial_port.reset_input_buffer()
+            return
+        self._apply_upd_rate(upd_rate)
+        self._upd_rate_set_ns = (tuple(upd_rate), time.monotonic_ns())
+
+    def read_frame(self):
+        """ :returns:
+                (DistReport or None if no valid response, raw TLV bytes as hexadecimal text)
+        """
+        wait = self._next_poll - time.monotonic()
+        if wait > 0 and self._upd_rate_requested.wait(wait):
+            # Polled again at the new rate, from now on
+            self._next_poll = time.monotonic()
+        self._upd_rate_requested.clear()
+        upd_rate, self._requested_upd_rate = self._requested_upd_rate, None
+        if upd_rate is not None:
+            self._send_upd_rate(upd_rate)
+        self._next_poll = max(self._next_poll + self.period, time.monotonic())
+        self.serial_port.write(TLV_LOC_GET_REQUEST)
+        # Error frame, then position and distances frames if there is no error
+        frames = DWM1001.read_all_TLV(self.serial_port, expecting=3, timeout=TLV_RESPONSE_TIMEOUT)
+        self.rx_ns = time.monotonic_ns()
+        data_raw = b"TLV," + b"".join(frames).hex().encode()
+        try:
+            return decode_loc_get_frames(frames), data_raw
+        except ValueError:
+            self.errors += 1
+            # Drop the rest of a broken response to get back in sync with the next one
+            self.serial_port.reset_input_buffer()
+            return None, data_raw
+
+    def stop(self):
+        pass
+
+
+REPORT_SOURCES = {"shell": ShellReportSource, "tlv": TlvLocSource}
+
+
+def make_report_source(kind, serial_port, oem_firmware=False):
+    """ :returns:
+            report source of the given kind (REPORT_SOURCES: "shell" or "tlv") reading the serial port
+    """
+    if kind == "tlv":
+        # The TLV API is the same on the OEM PANS and the dwm-accelerometer-enabled firmware
+        return TlvLocSource(serial_port)
+    if kind == "shell":
+        return ShellReportSource(serial_port, oem_firmware)
+    raise ValueError("unknown report source: {}".format(kind))
+
+
+if __name__ == "__main__":
+    # Unit Testing: the TLV frames of the sample field test log reports decode into the
+    # same records as the text parser (minus ACC/UWBLOCALTIME, absent from the TLV API)
+    import pty, tty, threading, timeit
+    from dist_parser import parse_dist_report
+
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+    reports = [parse_dist_report(line) for line in lines]
+
+    def expected_dict(report):
+        expected = report.to_dict()
+        expected.pop("acc", None)
+        expected.pop("timestamp", None)
+        return expected
+
+    def split_frames(response):
+        # The frames of a response, as read_all_TLV() splits them
+        frames, pos = [], 0
+        while pos + 2 <= len(response) and pos + 2 + response[pos + 1] <= len(response):
+            frames.append(memoryview(response)[pos:pos + 2 + response[pos + 1]])
+            pos += 2 + response[pos + 1]
+        return frames
+
+    responses = [encode_loc_get_response(report) for report in reports]
+    for report, response in zip(reports, responses):
+        assert decode_loc_get_frames(split_frames(response)).to_dict() == expected_dict(report)
+    pos_report = DistReport(reports[0].anchors, est_pos=(1200, -350, 2000), est_pos_qf=77)
+    assert decode_loc_get_frames(split_frames(encode_loc_get_response(pos_report))).to_dict() == pos_report.to_dict()
+    for broken in (b"", b"\x40\x01\x02", responses[0][:-3], b"\x40\x01\x00\x41\x0d" + bytes(13) + b"\x48\x01\x00",
+                   b"\x40\x01\x00\x41\x0d" + bytes(13) + b"\x49\x02\x01\x00"):
+        try:
+            decode_loc_get_frames(split_frames(broken))
+            raise AssertionError("no ValueError for {}".format(broken.hex()))
+        except ValueError:
+            pass
+    print("{} reports decoded from TLV identically to the text parser".format(len(reports)))
+
+    # Polling an emulated master in UART API mode over a pty
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(slave_fd)
+    def emulated_master():
+        idx = 0
+        while True:
+            try:
+                request = os.read(master_fd, 2)
+            except OSError:
+                return
+            if request == TLV_LOC_GET_REQUEST:
+                os.write(master_fd, responses[idx % len(responses)])
+                idx += 1
+    threading.Thread(target=emulated_master, daemon=True).start()
+    port = serial.Serial(os.ttyname(slave_fd), baudrate=115200, timeout=3.0)
+    source = TlvLocSource(port, period=0)
+    t0 = time.monotonic()
+    polled = [source.read_frame() for _ in range(len(reports))]
+    elapsed = time.monotonic() - t0
+    assert [d.to_dict() for d, _ in polled] == [expected_dict(r) for r in reports] and source.errors == 0
+    print("{} dwm_loc_get polls over a pty: {:.0f} Hz".format(len(polled), len(polled) / elapsed))
+
+    text_bytes = sum(len(line) + 2 for line in lines) / len(lines)
+    tlv_bytes = sum(len(r) for r in responses) / len(responses)
+    t_text = timeit.timeit(lambda: [parse_dist_report(line) for line in lines], number=5)
+    response_frames = [split_frames(r) for r in responses]
+    t_tlv = timeit.timeit(lambda: [decode_loc_get_frames(frames) for frames in response_frames], number=5)
+    print("per report: text {:.0f} bytes, {:.1f} us | TLV {:.0f} bytes, {:.1f} us"
+          .format(text_bytes, t_text / 5 / len(lines) * 1e6, tlv_bytes, t_tlv / 5 / len(lines) * 1e6))
+
+    # Polling an emulated DWM1001 master at its update rate, changed by dwm_upd_rate_set
+    from dwm_emulator import DwmEmulator, make_fleet
+    emulator = DwmEmulator(make_fleet(1), seed=7).start()
+    tag = emulator.tags[0]
+    port = serial.Serial(tag.tty_device, baudrate=115200, timeout=3.0)
+    source = make_report_source("tlv", port)
+    source.start()
+    assert source.upd_rate == (1, 1) and abs(source.period - 0.1) < 1e-9, source.upd_rate
+    assert source.read_frame()[0] is not None
+    source.set_upd_rate((5, 20))
+    assert source.upd_rate_written_ns((5, 20)) is None
+    t0 = time.monotonic()
+    frames = [source.read_frame() for _ in range(4)]
+    elapsed = time.monotonic() - t0
+    assert tag.upd_rate == [5, 20] and source.upd_rate_written_ns((5, 20)) is not None
+    assert all(report is not None for report, _ in frames) and source.errors == 0
+    assert 3 * 0.5 - 0.05 < elapsed < 4 * 0.5 + 0.3, elapsed
+    print("TLV polling follows dwm_upd_rate_set: {:.2f} s between polls".format(elapsed / 3))
+    port.close()
+    emulator.stop()
@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+
+import sys, os, time, errno, threading, selectors
+from datetime import datetime
+import serial
+from utils import timestamp_log, find_end_master, resume_master_reporting, EndReportingProcessor
+from metrics_server import METRICS
+from report_source import make_report_source
+
+
+# This file contains the serial multiplexer of the ranging unit.
+# Instead of one blocking readline() thread per master, all paired master ports are
+# registered to a single selector (epoll/kqueue/poll on Linux/macOS). The multiplexer
+# thread wakes up only when a port has bytes to read, reads everything available
+# without blocking, splits the chunks into lines and dispatches every complete line
+# to the per-end processor (utils.EndReportingProcessor) of the port.
+# Ports without a selectable file descriptor (Windows, pyserial URL handlers such as loop://)
+# fall back to one blocking readline() thread per port, feeding the same processors.
+# Polled report sources (report_source.TlvLocSource, --report-source tlv) have no lines to select:
+# each one is served by a polling thread handing its reports to the same processors.
+# With a port supervisor (port_supervisor.py), a failed port is handed over to the supervisor
+# instead of stopping its end: the processor keeps running, and the port paired again is swapped in.
+
+MUX_READ_SIZE = 4096            # Bytes per non-blocking read (one DIST line is ~100-200 bytes)
+MUX_SELECT_TIMEOUT = 0.1        # Seconds between stop flag checks when no port is reporting
+MUX_MAX_LINE_BYTES = 4096       # A partial line longer than this is UART noise and is discarded
+
+
+def selectable_fileno(serial_port):
+    """ Get the file descriptor of a serial port if it can be registered to a selector
+
+        :returns:
+            file descriptor, or None if the port needs the threaded fallback
+    """
+    if sys.platform.startswith('win'):
+        # Windows selectors only support sockets
+        return None
+    try:
+        fd = serial_port.fileno()
+    except (AttributeError, serial.SerialException, OSError, ValueError):
+        return None
+    return fd if isinstance(fd, int) and fd >= 0 else None
+
+
+class SerialMultiplexer():
+
+    # Single-thread, event-driven reader of many serial ports
+    # on_drop(serial_port, processor, error): called for a failed port instead of stopping its processor
+    def __init__(self, read_size=MUX_READ_SIZE, select_timeout=MUX_SELECT_TIMEOUT, on_drop=None):
+        self.read_size = read_size
+        self.on_drop = on_drop
+        self.select_timeout = select_timeout
+        self.lines = 0
+        self.discarded_bytes = 0
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._ports = {}                # port -> [processor, pending partial line]
+        self._fallback_threads = []
+        self._stopped = threading.Event()
+        # Self-pipe to wake the selector up on stop() / new ports
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._mux_thread = threading.Thread(target=self.run,
+                                            name="Serial Multiplexer Thread",
+                                            daemon=True)
+
+    def add_port(self, serial_port, processor):
+        """ Register a serial port with the processor consuming its lines
+
+            :returns:
+                True if the port is served by the selector, False if by a fallback thread
+        """
+        fd = selectable_fileno(serial_port)
+        with self._lock:
+            self._ports[serial_port] = [processor, bytearray()]
+        if fd is None:
+            t = threading.Thread(target=self._fallback_read_job,
+                                 args=(serial_port, processor),
+                                 name="Serial Multiplexer Fallback Thread {}".format(getattr(serial_port, "name", "")),
+                                 daemon=True)
+            self._fallback_threads.append(t)
+            if self._mux_thread.is_alive():
+                t.start()
+            return False
+        self._selector.register(fd, selectors.EVENT_READ, serial_port)
+        self.wakeup()
+        return True
+
+    def add_source(self, serial_port, source, processor):
+        """ Register a polled report source (report_source.py, started) of a serial port,
+            served by a polling thread instead of the selector
+        """
+        with self._lock:
+            self._ports[serial_port] = [processor, bytearray()]
+        t = threading.Thread(target=self._source_poll_job,
+                             args=(serial_port, source, processor),
+                             name="Serial Multiplexer Polling Thread {}".format(getattr(serial_port, "name", "")),
+                             daemon=True)
+        self._fallback_threads.append(t)
+        if self._mux_thread.is_alive():
+            t.start()
+
+    def remove_port(self, serial_port):
+        with self._lock:
+            entry = self._ports.pop(serial_port, None)
+        for key in list(self._selector.get_map().values()):
+            if key.data is serial_port:
+                self._selector.unregister(key.fileobj)
+        return entry
+
+    def ports(self):
+        with self._lock:
+            return list(self._ports)
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\x00")
+        except (BlockingIOError, OSError):
+            # The pipe is already full of pending wakeups
+            pass
+
+    def start(self):
+        self._mux_thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self.wakeup()
+        if self._mux_thread.is_alive() and self._mux_thread is not threading.current_thread():
+            self._mux_thread.join(timeout)
+
+    def _dispatch(self, serial_port, chunk, timestamp_dt, rx_ns=None):
+        entry = self._ports.get(serial_port)
+        if entry is None:
+            return
+        processor, pending = entry
+        pending.extend(chunk)
+        start = 0
+        while True:
+            idx = pending.find(b"\n", start)
+            if idx < 0:
+                break
+            self.lines += 1
+            processor.process_line(bytes(pending[start:idx]).rstrip(), timestamp_dt, rx_ns)
+            start = idx + 1
+        del pending[:start]
+        if len(pending) > MUX_MAX_LINE_BYTES:
+            self.discarded_bytes += len(pending)
+            METRICS.inc("uwb_discarded_bytes_total", (("end", processor.end_name),), len(pending))
+            del pending[:]
+
+    def _drop_port(self, serial_port, exp):
+        entry = self.remove_port(serial_port)
+        if entry is None:
+            return
+        processor = entry[0]
+        METRICS.inc("uwb_reporting_failures_total", (("end", processor.end_name),))
+        if self.on_drop is not None:
+            sys.stdout.write(timestamp_log() + processor.end_name + " end reporting interrupted on port {}. Last fetched UART data: {}. error: {}\n"
+                             .format(getattr(serial_port, "name", ""), bytes(entry[1]), repr(exp)))
+            self.on_drop(serial_port, processor, exp)
+            return
+        processor.stop(verbose=False)
+        sys.stdout.write(timestamp_log() + processor.end_name + " end reporting stopped on port {}. Last fetched UART data: {}. error: {}\n"
+                         .format(getattr(serial_port, "name", ""), bytes(entry[1]), repr(exp)))
+
+    def _read_ready(self, serial_port, fd):
+        try:
+            chunk = os.read(fd, self.read_size)
+            rx_ns = time.monotonic_ns()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._drop_port(serial_port, e)
+            return
+        if not chunk:
+            # Readable without data: the device is disconnected
+            self._drop_port(serial_port, serial.SerialException("device disconnected"))
+            return
+        try:
+            self._dispatch(serial_port, chunk, None, rx_ns)
+        except Exception as e:
+            self._drop_port(serial_port, e)
+
+    def _fallback_read_job(self, serial_port, processor):
+        while not self._stopped.is_set() and serial_port in self._ports:
+            try:
+                # Raw bytes are parsed without decoding
+                data_raw = serial_port.readline()
+            except (AttributeError, serial.serialutil.SerialException) as e:
+                if self._stopped.is_set():
+                    return
+                self._drop_port(serial_port, e)
+                return
+            if data_raw:
+                try:
+                    self.lines += 1
+                    processor.process_line(data_raw.rstrip(), None, time.monotonic_ns())
+                except Exception as e:
+                    self._drop_port(serial_port, e)
+                    return
+
+    def _source_poll_job(self, serial_port, source, processor):
+        while not self._stopped.is_set() and serial_port in self._ports:
+            try:
+                report, data_raw = source.read_frame()
+            except (AttributeError, serial.serialutil.SerialException) as e:
+                if self._stopped.is_set():
+                    return
+                self._drop_port(serial_port, e)
+                return
+            if report is not None:
+                try:
+                    self.lines += 1
+                    processor.process_report(report, data_raw, None, source.rx_ns)
+                except Exception as e:
+                    self._drop_port(serial_port, e)
+                    return
+
+    def run(self, stop_flag_callback=None):
+        """ Multiplexer loop. Runs until stop() or until the stop flag callback returns True
+        """
+        for t in self._fallback_threads:
+            if t.ident is None:
+                t.start()
+        try:
+            while not self._stopped.is_set():
+                if stop_flag_callback is not None:
+                    if stop_flag_callback() == True:
+                        break
+                for key, _ in self._selector.select(self.select_timeout):
+                    if key.data is None:
+                        try:
+                            while os.read(self._wakeup_r, 512):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+                    self._read_ready(key.data, key.fd)
+        finally:
+            self._stopped.set()
+            for t in self._fallback_threads:
+                if t.is_alive() and t is not threading.current_thread():
+                    t.join(self.select_timeout + 3.0)
+
+    def close(self):
+        self.stop()
+        self._selector.close()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def end_ranging_job_multiplexed(serial_ports,
+                                data_ptr_queues,
+                                log_fpath,
+                                stop_flag_callback=None,
+                                oem_firmware=False,
+                                exp_name="",
+                                binary_log=True,
+                                compress_log=False,
+                                recorder=None,
+                                supervisor=None,
+                                report_source="shell"):
+    """ Serve the masters of all requested ends from a single (multiplexer) thread.
+        Drop-in replacement of one end_ranging_job_async_single() thread per end.
+
+        :param data_ptr_queues: dictionary of end side code -> data pointer queue of the end
+        :param recorder: optional session_replay.SessionRecorder capturing the serial traffic of the masters
+        :param supervisor: optional port_supervisor.PortSupervisor (not started) re-pairing the lost ports
+                           during the session
+        :param report_source: "shell" (DIST lines, selector) or "tlv" (dwm_loc_get polling threads), report_source.py
+        :returns:
+            None
+    """
+    processors = {}
+    for end_side_code in data_ptr_queues:
+        master_dev_id, master_info_pos = find_end_master(serial_ports, end_side_code, stop_flag_callback)
+        if master_dev_id == "":
+            return
+        processors[master_dev_id] = EndReportingProcessor(serial_ports, end_side_code, master_info_pos,
+                                                          data_ptr_queues[end_side_code], log_fpath,
+                                                          oem_firmware=oem_firmware, exp_name=exp_name,
+                                                          binary_log=binary_log, compress_log=compress_log)
+
+    ports_master = {}
+
+    def on_drop(serial_port, processor, exp):
+        for master_dev_id, port_master in list(ports_master.items()):
+            if port_master is serial_port:
+                supervisor.port_failed(master_dev_id, exp)
+
+    def on_port_event(event, addr, entry):
+        port_master = ports_master.get(addr)
+        if event == "lost":
+            if port_master is not None:
+                mux.remove_port(port_master)
+        elif event == "recovered" and addr in processors:
+            add_master_port(addr)
+
+    def add_master_port(master_dev_id):
+        if master_dev_id in ports_master:
+            # Swapped: the previous port of the master is not served anymore
+            mux.remove_port(ports_master[master_dev_id])
+        port_master = serial_ports[master_dev_id].get("port")
+        if recorder is not None:
+            # Recorded ports are not selectable: served by fallback threads, every byte read is captured
+            port_master = recorder.wrap(master_dev_id, serial_ports)
+        ports_master[master_dev_id] = port_master
+        if report_source == "tlv":
+            source = make_report_source(report_source, port_master, oem_firmware)
+            source.start()
+            # Update rate changes of the adaptive rate controller go through the source (rate_controller.py)
+            serial_ports[master_dev_id]["report_source"] = source
+            mux.add_source(port_master, source, processors[master_dev_id])
+            return
+        resume_master_reporting(port_master, oem_firmware)
+        port_master.reset_input_buffer()
+        mux.add_port(port_master, processors[master_dev_id])
+
+    mux = SerialMultiplexer(on_drop=on_drop if supervisor is not None else None)
+    for master_dev_id, processor in processors.items():
+        processor.start()
+        add_master_port(master_dev_id)
+    if supervisor is not None:
+        supervisor.add_listener(on_port_event)
+        METRICS.set_collector("port_supervisor", supervisor.metric_samples)
+        supervisor.start()
+    try:
+        mux.run(stop_flag_callback)
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
+            supervisor.log_report()
+        for master_dev_id, processor in processors.items():
+            # Supervised: the processors of the lost ports are still running
+            if supervisor is not None or ports_master[master_dev_id] in mux.ports():
+                processor.stop()
+        mux.close()
+
+
+if __name__ == "__main__":
+    # Unit Testing: replay the sample field test log through pseudo terminals and compare
+    # the multiplexed processing with the per-line processing of the reading threads.
+    import pty, tty, queue, tempfile, re
+
+    class RecordingProcessor():
+        end_name = "TEST"
+        def __init__(self):
+            self.lines = []
+        def process_line(self, data_raw, timestamp_dt=None, rx_ns=None):
+            self.lines.append(data_raw)
+            return data_raw[:4] == b"DIST"
+        def stop(self, verbose=True):
+            pass
+
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(b" end reporting raw data: ")[1].rstrip() for line in f if b" end reporting raw data: " in line]
+
+    n_ports = 8
+    ptys = [pty.openpty() for _ in range(n_ports)]
+    for master_fd, slave_fd in ptys:
+        tty.setraw(slave_fd)
+    ports = [serial.serial_for_url(os.ttyname(slave_fd), baudrate=115200, timeout=3.0) for _, slave_fd in ptys]
+    processors = [RecordingProcessor() for _ in range(n_ports)]
+    mux = SerialMultiplexer()
+    for p, proc in zip(ports, processors):
+        assert mux.add_port(p, proc), "pty is not selectable"
+    mux.start()
+    t0 = time.time()
+    # Interleave the lines of all ports with arbitrary chunk boundaries
+    payload = b"".join(line + b"\r\n" for line in lines) + b"dwm> garbage without line ending"
+    for offset in range(0, len(payload), 137):
+        for master_fd, _ in ptys:
+            os.write(master_fd, payload[offset:offset + 137])
+    deadline = time.time() + 10
+    while time.time() < deadline and any(len(proc.lines) < len(lines) for proc in processors):
+        time.sleep(0.01)
+    elapsed = time.time() - t0
+    mux.stop()
+    assert mux._mux_thread.is_alive() is False, "multiplexer did not stop"
+    for proc in processors:
+        assert proc.lines == lines, "line splitting mismatch"
+    print("{} ports x {} lines multiplexed by one thread in {:.3f} s".format(n_ports, len(lines), elapsed))
+
+    # Full per-end processing: same frames and logs as the per-port reading threads
+    q_mux, q_ref = queue.Queue(), queue.Queue()
+    serial_ports = {"0487": {}, "15BA": {}, "0090": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref = EndReportingProcessor(serial_ports, 1, {"side_master": 1}, q_ref, tmp_dir, exp_name="ref", binary_log=False)
+        muxed = EndReportingProcessor(serial_ports, 1, {"side_master": 1}, q_mux, tmp_dir, exp_name="mux", binary_log=False)
+        ref.start(), muxed.start()
+        fixed_dt = datetime(2021, 5, 25, 8, 52, 15)
+        for line in lines:
+            ref.process_line(line, fixed_dt)
+        mux = SerialMultiplexer()
+        mux._ports[ports[0]] = [muxed, bytearray()]
+        for offset in range(0, len(payload), 61):
+            mux._dispatch(ports[0], payload[offset:offset + 61], fixed_dt)
+        ref.stop(verbose=False), muxed.stop(verbose=False)
+        assert q_ref.qsize() == q_mux.qsize() == len(lines)
+        for name in ("-data-B-user-processed_log.log", "-data-B-raw_log.log"):
+            ref_txt = open(os.path.join(tmp_dir, "ref" + name)).read()
+            mux_txt = open(os.path.join(tmp_dir, "mux" + name)).read()
+            strip_utc_ref = lambda txt: re.sub(r".*=== UTC TIME REFERENCE ===.*\n", "", txt)
+            assert strip_utc_ref(ref_txt) == strip_utc_ref(mux_txt), "log mismatch for " + name
+        mux.close()
+    print("{} frames processed identically to the per-end reading threads".format(len(lines)))
+    for p in ports:
+        p.close()
+    for master_fd, slave_fd in ptys:
+        os.close(master_fd)
+        os.close(slave_fd)
@@ -0,0 +1,704 @@
+#!/usr/bin/python3
+
+import sys, os, time, json, ast, select, atexit, threading, argparse, tempfile
+import serial
+from utils import timestamp_log, end_ranging_job_async_single, RX_STAMP_KEY
+from mono_clock import parse_log_timestamp_us
+
+
+# This file contains the session recorder and replayer of the ranging unit.
+#   SessionRecorder:    captures the raw serial bytes read from (and written to) the master ports of a
+#                       live session, with monotonic timestamps, into a session capture file:
+#                           # UWB ranging session capture v1
+#                           # device {"dev": "88BA", "name": "/dev/ttyACM0", "info_pos": {...}}
+#                           <ns from the session start> <device id> <R|W> <hexadecimal bytes>
+#   SessionCapture:     the devices and timestamped chunks of a capture, loaded from a capture file or
+#                       imported from the -raw_log.log text logs of the field tests (data/sample/).
+#   ReplaySerial:       fake serial port writing the captured bytes of a device into a pipe at their
+#                       capture time, 1x, Nx or as fast as possible (speed 0). It has the pyserial calls
+#                       of the ranging jobs and a selectable file descriptor for the serial multiplexer,
+#                       so the capture goes through end_ranging_job_async_single()/end_ranging_job_multiplexed()
+#                       and the GUI/headless consumers unchanged.
+#   replay_session():   replays a capture into the headless service, and reports the frames/s and the
+#                       end-to-end latency (from the delivery of a DIST line to the publishing of its result).
+# Replay (POSIX only, select() on pipes):
+#   python3 session_replay.py <capture file | *-raw_log.log ...> [--speed N] [--reader single|mux]
+# Record/replay within uwb_master.py: --record <capture file>, --replay <capture file> [--replay-speed N]
+
+CAPTURE_MAGIC = "# UWB ranging session capture v1"
+CAPTURE_DEVICE = "# device "
+REPLAY_AFAP = 0                 # Replay speed: as fast as possible (paced by the consumers only)
+REPLAY_READ_TIMEOUT = 3.0       # Seconds of a readline() without data, as the paired serial ports
+REPLAY_READ_SIZE = 4096
+REPLAY_POLL = 0.1               # Seconds between the closed port checks of a blocking read
+REPLAY_DRAIN_TIMEOUT = 5.0      # Seconds to wait for the consumers after the last replayed byte
+RAW_LOG_SEPARATOR = b" end reporting raw data: "
+RAW_LOG_SCAN_FRAMES = 100       # Frames of the processed log scanned to find the master and local slaves
+RECORD_FLUSH_PERIOD_NS = 200_000_000    # Most recent capture time lost by a crash of a recording session
+
+
+class SessionCapture():
+
+    # Devices and timestamped serial chunks of one ranging session
+    def __init__(self):
+        self.devices = {}       # device id -> {"name": port name, "info_pos": info_pos of the serial_ports entry}
+        self.chunks = []        # (ns from the session start, device id, "R" read / "W" written, bytes)
+
+    def add_device(self, dev, info_pos, name=None):
+        self.devices[dev] = {"name": name, "info_pos": info_pos}
+
+    def add_chunk(self, t_ns, dev, data, direction="R"):
+        self.chunks.append((t_ns, dev, direction, data))
+
+    def normalize(self):
+        """ Sort the chunks by time and start the session at 0
+        """
+        self.chunks.sort(key=lambda chunk: chunk[0])
+        if self.chunks and self.chunks[0][0] != 0:
+            t0_ns = self.chunks[0][0]
+            self.chunks = [(t_ns - t0_ns, dev, direction, data) for t_ns, dev, direction, data in self.chunks]
+
+    def rx_chunks(self, dev):
+        return [(t_ns, data) for t_ns, chunk_dev, direction, data in self.chunks if chunk_dev == dev and direction == "R"]
+
+    @property
+    def duration(self):
+        return self.chunks[-1][0] / 1e9 if self.chunks else 0.0
+
+    def master_devices(self):
+        """ :returns:
+                dictionary of end side code -> device id of the masters with captured data
+        """
+        rx_devs = {dev for _, dev, direction, _ in self.chunks if direction == "R"}
+        return {info["info_pos"].get("side_master"): dev for dev, info in self.devices.items()
+                if dev in rx_devs and info["info_pos"].get("side_master") is not None}
+
+    def mirror_end(self, dev, mirrored_dev=None):
+        """ Replay the data of a master as the master of the other end as well (captures of one end only)
+
+            :returns:
+                device id of the mirrored master
+        """
+        mirrored_dev = dev + "-mirror" if mirrored_dev is None else mirrored_dev
+        info_pos = dict(self.devices[dev]["info_pos"])
+        info_pos["side_master"] = 3 - info_pos["side_master"]
+        self.add_device(mirrored_dev, info_pos, name=mirrored_dev)
+        self.chunks.extend([(t_ns, mirrored_dev, direction, data) for t_ns, chunk_dev, direction, data in self.chunks
+                            if chunk_dev == dev])
+        self.normalize()
+        return mirrored_dev
+
+    def save(self, fpath):
+        with open(fpath, "w") as f:
+            f.write(CAPTURE_MAGIC + "\n")
+            for dev, info in self.devices.items():
+                f.write(format_device_line(dev, info["info_pos"], info["name"]))
+            for t_ns, dev, direction, data in self.chunks:
+                f.write("{} {} {} {}\n".format(t_ns, dev, direction, data.hex()))
+
+    @classmethod
+    def load(cls, fpath):
+        capture = cls()
+        with open(fpath, "r") as f:
+            if f.readline().rstrip() != CAPTURE_MAGIC:
+                raise ValueError("not a session capture file: {}".format(fpath))
+            for line in f:
+                if not line.endswith("\n"):
+                    break       # Last line of a recording cut by a crash
+                if line.startswith(CAPTURE_DEVICE):
+                    device = json.loads(line[len(CAPTURE_DEVICE):])
+                    capture.add_device(device["dev"], device["info_pos"], device.get("name"))
+                elif line.strip():
+                    t_ns, dev, direction, data = line.split()
+                    capture.add_chunk(int(t_ns), dev, bytes.fromhex(data), direction)
+        capture.normalize()
+        return capture
+
+    def serial_ports(self, clock, timeout=REPLAY_READ_TIMEOUT):
+        """ Build the serial ports dictionary of pairing_uwb_ports() with fake serial ports replaying
+            the captured data of the masters. The other devices (local slaves) have no port.
+
+            :returns:
+                dictionary of device id -> {"port": ReplaySerial or None, "info_pos": info_pos}
+        """
+        serial_ports = {}
+        for dev, info in self.devices.items():
+            chunks = self.rx_chunks(dev)
+            port = ReplaySerial(chunks, clock, name=info["name"] or dev, timeout=timeout) if chunks else None
+            serial_ports[dev] = {"port": port, "info_pos": info["info_pos"]}
+        return serial_ports
+
+
+def format_device_line(dev, info_pos, name=None):
+    return CAPTURE_DEVICE + json.dumps({"dev": dev, "name": name, "info_pos": info_pos}, default=str) + "\n"
+
+
+def import_raw_log(fpath, capture=None, master_info_pos=None, local_slaves=None):
+    """ Import a -raw_log.log text log of the field tests as the captured data of its master: one chunk
+        per reported line at its logged local time. The master position and the local slaves are read
+        from the -user-processed_log.log alongside, unless given.
+
+        :returns:
+            SessionCapture (the given one, with the master and local slaves of the log added)
+    """
+    capture = SessionCapture() if capture is None else capture
+    if master_info_pos is None or local_slaves is None:
+        processed_info_pos, processed_local_slaves = scan_processed_log(fpath.replace("-raw_log.log", "-user-processed_log.log"))
+        master_info_pos = processed_info_pos if master_info_pos is None else master_info_pos
+        local_slaves = processed_local_slaves if local_slaves is None else local_slaves
+    master_info_pos = dict(master_info_pos)
+    dev = master_info_pos.pop("master_id", None) or "END{}".format(master_info_pos.get("side_master"))
+    capture.add_device(dev, master_info_pos, name=os.path.basename(fpath))
+    for slave_id in local_slaves:
+        if slave_id not in capture.devices:
+            capture.add_device(slave_id, {})
+    with open(fpath, "rb") as f:
+        for line in f:
+            if RAW_LOG_SEPARATOR not in line:
+                continue
+            head, data_raw = line.split(RAW_LOG_SEPARATOR, 1)
+            # "[%Y-%m-%d %H:%M:%S.%f local] B"
+            # Local time: the capture is normalized to start at 0
+            capture.add_chunk(parse_log_timestamp_us(head) * 1000, dev, data_raw.rstrip() + b"\r\n")
+    capture.normalize()
+    return capture
+
+
+def scan_processed_log(fpath, frames=RAW_LOG_SCAN_FRAMES):
+    """ Find the master position and the local slaves (anchors never decoded as foreign slaves)
+        in the first frames of a -user-processed_log.log text log
+
+        :returns:
+            (master_info_pos, list of local slave ids)
+    """
+    master_info_pos, anchors, foreign = None, [], set()
+    with open(fpath, "r") as f:
+        for line in f:
+            if " end reporting uwb data: " in line:
+                if frames == 0:
+                    break
+                frames -= 1
+                uwb_reporting_dict = ast.literal_eval(line.split(" end reporting uwb data: ", 1)[1])
+                master_info_pos = uwb_reporting_dict["masterInfoPos"]
+                anchors.extend(anc for anc in uwb_reporting_dict.get("all_anc_id", []) if anc not in anchors)
+            elif " end reporting decoded foreign slaves: " in line:
+                foreign.update(slave.get("slave_id") for slave in ast.literal_eval(line.split(" end reporting decoded foreign slaves: ", 1)[1]))
+    if master_info_pos is None:
+        raise ValueError("no reported frame in {}".format(fpath))
+    return master_info_pos, [anc for anc in anchors if anc not in foreign]
+
+
+def load_replay_source(fpaths):
+    """ Load a capture file, or import -raw_log.log text logs (one per end). The master of a capture
+        of one end only (as the sample logs) is replayed into both ends.
+
+        :returns:
+            SessionCapture
+    """
+    if len(fpaths) == 1 and not fpaths[0].endswith("-raw_log.log"):
+        capture = SessionCapture.load(fpaths[0])
+    else:
+        capture = SessionCapture()
+        for fpath in fpaths:
+            import_raw_log(fpath, capture)
+    masters = capture.master_devices()
+    if len(masters) == 1:
+        capture.mirror_end(list(masters.values())[0])
+    return capture
+
+
+class SessionRecorder():
+
+    # Live capture of the serial traffic of the master ports into a session capture file.
+    # Chunks are written as they are read, and flushed to the file every RECORD_FLUSH_PERIOD_NS at most:
+    # a crash loses the last fraction of a second of the capture only.
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.chunks = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._devices = set()
+        self._t0_ns = time.monotonic_ns()
+        self._flushed_ns = 0
+        self._file = open(fpath, "w")
+        self._file.write(CAPTURE_MAGIC + "\n")
+        self._file.flush()
+        atexit.register(self.close)
+        sys.stdout.write(timestamp_log() + "Recording the serial traffic of the session into {}\n".format(fpath))
+
+    def wrap(self, dev, serial_ports):
+        """ Record the devices of the serial ports dictionary, and the traffic of the port of dev
+
+            :returns:
+                RecordingSerial wrapping the port of dev
+        """
+        with self._lock:
+            for other_dev, entry in serial_ports.copy().items():
+                if other_dev not in self._devices:
+                    self._devices.add(other_dev)
+                    self._file.write(format_device_line(other_dev, entry.get("info_pos", {}),
+                                                        getattr(entry.get("port"), "name", None)))
+        return RecordingSerial(serial_ports[dev]["port"], dev, self)
+
+    def record(self, dev, data, direction="R"):
+        t_ns = time.monotonic_ns() - self._t0_ns
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write("{} {} {} {}\n".format(t_ns, dev, direction, bytes(data).hex()))
+            self.chunks += 1
+            self.bytes += len(data)
+            if t_ns - self._flushed_ns >= RECORD_FLUSH_PERIOD_NS:
+                self._file.flush()
+                self._flushed_ns = t_ns
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                sys.stdout.write(timestamp_log() + "Session recording stopped: {} chunks, {} bytes in {}\n"
+                                 .format(self.chunks, self.bytes, self.fpath))
+
+
+class RecordingSerial():
+
+    # Serial port proxy recording the bytes read from and written to the port. It has no file descriptor:
+    # the serial multiplexer reads it through readline() (threaded fallback) so that every byte is recorded.
+    def __init__(self, serial_port, dev, recorder):
+        self.serial_port = serial_port
+        self.dev = dev
+        self.recorder = recorder
+
+    def readline(self, *args, **kwargs):
+        data = self.serial_port.readline(*args, **kwargs)
+        if data:
+            self.recorder.record(self.dev, data)
+        return data
+
+    def read(self, *args, **kwargs):
+        data = self.serial_port.read(*args, **kwargs)
+        if data:
+            self.recorder.record(self.dev, data)
+        return data
+
+    def write(self, data):
+        self.recorder.record(self.dev, data, direction="W")
+        return self.serial_port.write(data)
+
+    def fileno(self):
+        raise AttributeError("recorded ports are not selectable")
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+
+class ReplayClock():
+
+    # Common time base of the replayed ports of a session. The playback starts once every port is
+    # read by its consumer, so that no port loses data to the input buffer resets of the startup,
+    # and the ports keep their captured timing relative to each other.
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.t0_ns = None
+        self.started = threading.Event()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def register(self):
+        with self._lock:
+            self._pending += 1
+
+    def arm(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending <= 0 and not self.started.is_set():
+                self.start()
+
+    def start(self):
+        self.t0_ns = time.monotonic_ns()
+        self.started.set()
+
+    def wait_until(self, t_ns, stop_event):
+        """ Wait until the replay time of a chunk captured at t_ns (from the session start)
+
+            :returns:
+                False if stopped while waiting
+        """
+        while not self.started.wait(REPLAY_POLL):
+            if stop_event.is_set():
+                return False
+        if self.speed <= REPLAY_AFAP:
+            return not stop_event.is_set()
+        wait = (self.t0_ns + t_ns / self.speed - time.monotonic_ns()) / 1e9
+        if wait > 0:
+            return not stop_event.wait(wait)
+        return not stop_event.is_set()
+
+
+class ReplaySerial():
+
+    # Fake serial port replaying the captured bytes of one device through a pipe, paced by the replay clock.
+    # The master is reporting from the start: before the playback, every poll of in_waiting sees more
+    # bytes (is_reporting_loc()), the shell commands written are dropped and the input buffer resets
+    # lose nothing. At the end of the capture the device is silent: readline() times out.
+    def __init__(self, chunks, clock, name="replay", timeout=REPLAY_READ_TIMEOUT):
+        self.name = self.port = name
+        self.timeout = timeout
+        self.chunks = chunks
+        self.clock = clock
+        self.is_open = True
+        self.written = 0
+        self.deliveries = []            # time.monotonic_ns() at which each DIST line was written into the pipe
+        self.finished = threading.Event()
+        self._armed = False
+        self._probe = 0
+        self._buffer = bytearray()
+        self._stop = threading.Event()
+        self._r, self._w = os.pipe()
+        clock.register()
+        self._feeder = threading.Thread(target=self._feed_job, name="Replay Feeder Thread {}".format(name), daemon=True)
+        self._feeder.start()
+
+    def _feed_job(self):
+        partial = b""
+        for t_ns, data in self.chunks:
+            if not self.clock.wait_until(t_ns, self._stop):
+                return
+            view = memoryview(data)
+            try:
+                # Blocks while the pipe is full: the consumer paces the "as fast as possible" replay
+                while view:
+                    view = view[os.write(self._w, view):]
+            except OSError:
+                # Port closed
+                return
+            delivered_ns = time.monotonic_ns()
+            lines = (partial + data).split(b"\n")
+            partial = lines.pop()
+            self.deliveries.extend(delivered_ns for line in lines if line[:4] == b"DIST")
+        self.finished.set()
+
+    def _arm(self):
+        if not self._armed:
+            self._armed = True
+            self.clock.arm()
+
+    def fileno(self):
+        # Registered to the selector of the serial multiplexer: the consumer starts reading
+        self._arm()
+        return self._r
+
+    @property
+    def in_waiting(self):
+        if not self._armed:
+            self._probe += 1
+            return self._probe
+        import fcntl, termios, array
+        buf = array.array("i", [0])
+        fcntl.ioctl(self._r, termios.FIONREAD, buf)
+        return buf[0] + len(self._buffer)
+
+    def _fill(self, deadline):
+        """ Read the bytes available in the pipe into the buffer, waiting for some until the deadline
+
+            :returns:
+                True if bytes were read
+        """
+        while True:
+            if not self.is_open:
+                raise serial.SerialException("replay port {} is closed".format(self.name))
+            wait = REPLAY_POLL if deadline is None else min(REPLAY_POLL, deadline - time.monotonic())
+            if wait < 0:
+                return False
+            try:
+                readable, _, _ = select.select([self._r], [], [], wait)
+                if readable:
+                    self._buffer.extend(os.read(self._r, REPLAY_READ_SIZE))
+                    return True
+            except (OSError, ValueError) as e:
+                # Closed by another thread while waiting
+                raise serial.SerialException("replay port {} is closed".format(self.name)) from e
+
+    def readline(self, size=-1):
+        self._arm()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            idx = self._buffer.find(b"\n")
+            if idx >= 0:
+                line = bytes(self._buffer[:idx + 1])
+                del self._buffer[:idx + 1]
+                return line
+            if not self._fill(deadline):
+                # Timeout: partial line, as pyserial
+                line = bytes(self._buffer)
+                self._buffer.clear()
+                return line
+
+    def read(self, size=1):
+        self._arm()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self._buffer) < size and self._fill(deadline):
+            pass
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def reset_input_buffer(self):
+        if not self._armed:
+            return
+        self._buffer.clear()
+        while select.select([self._r], [], [], 0)[0]:
+            os.read(self._r, REPLAY_READ_SIZE)
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def open(self):
+        if not self.is_open:
+            raise serial.SerialException("replay port {} cannot be reopened".format(self.name))
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self._stop.set()
+        # Closing the read end first fails a blocked write of the feeder
+        os.close(self._r)
+        self._feeder.join()
+        os.close(self._w)
+
+
+class FrameTap():
+
+    # put() adapter between an end ranging job and its consumer queue, recording the reception
+    # time (RX_STAMP_KEY) of every frame by super frame number
+    def __init__(self, queue_single_end):
+        self.queue = queue_single_end
+        self.rx_ns = []
+
+    def put(self, data_point, block=True, timeout=None):
+        self.rx_ns.append(data_point[0].get(RX_STAMP_KEY))
+        self.queue.put(data_point, block, timeout)
+
+
+class LatencySink():
+
+    # Headless output sink recording the publishing time of the results by A/B super frame number
+    def __init__(self):
+        self.published = []         # (A super frame number, B super frame number, time.monotonic_ns())
+
+    def publish(self, record):
+        self.published.append((record["A"]["superFrameNumber"], record["B"]["superFrameNumber"], time.monotonic_ns()))
+
+    def close(self):
+        pass
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """ :returns:
+            dictionary of "p<N>" -> value (nearest rank), plus "max"
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    ret = {"p{}".format(p): values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+    ret["max"] = values[-1]
+    return ret
+
+
+def replay_session(capture, speed=1.0, reader="single", fusion_tolerance=None, log_fpath=None):
+    """ Replay a session capture through the end ranging jobs into the headless ranging service
+        (A/B end fusion, adjusted distances, vehicle tracking and TTC), until the consumers processed
+        the whole capture.
+        reader: "single" for one end_ranging_job_async_single() thread per end, "mux" for the serial multiplexer
+
+        :returns:
+            dictionary of the replay statistics: frames, results, frames/s and latencies (ms)
+    """
+    from end_fusion import make_pair_source, FUSION_TOLERANCE
+    from headless_service import HeadlessRangingService
+    from serial_mux import end_ranging_job_multiplexed
+    from vehicle_tracker import VehicleTracker
+    from ttc_estimator import TtcMonitor
+
+    masters = capture.master_devices()
+    clock = ReplayClock(speed)
+    serial_ports = capture.serial_ports(clock)
+    notify = threading.Event()
+    pair_source = make_pair_source(FUSION_TOLERANCE if fusion_tolerance is None else fusion_tolerance, notify)
+    taps = {side: FrameTap(pair_source.end_queue(side)) for side in masters}
+    sink = LatencySink()
+    service = HeadlessRangingService(pair_source, notify, [sink], serial_ports=serial_ports,
+                                     tracker=VehicleTracker(), ttc_monitor=TtcMonitor())
+    log_dir = tempfile.TemporaryDirectory() if log_fpath is None else None
+    job_kwargs = {"serial_ports": serial_ports, "log_fpath": log_fpath or log_dir.name,
+                  "stop_flag_callback": service.stopped, "exp_name": "replay-" + timestamp_log(shorten=True)}
+    if reader == "mux":
+        ranging_threads = [threading.Thread(target=end_ranging_job_multiplexed,
+                                            kwargs=dict(job_kwargs, data_ptr_queues=taps),
+                                            name="Replay Reporting Thread Multiplexed", daemon=True)]
+    else:
+        ranging_threads = [threading.Thread(target=end_ranging_job_async_single,
+                                            kwargs=dict(job_kwargs, end_side_code=side, data_ptr_queue_single_end=tap),
+                                            name="Replay Reporting Thread {}".format(side), daemon=True)
+                           for side, tap in taps.items()]
+    replay_ports = [serial_ports[dev]["port"] for dev in masters.values()]
+
+    def drain_job():
+        # Stop the service once every replayed frame is processed and the last pair is consumed
+        for port in replay_ports:
+            while not port.finished.wait(REPLAY_POLL):
+                if service.stopped():
+                    return
+        deadline = time.monotonic() + REPLAY_DRAIN_TIMEOUT
+        while time.monotonic() < deadline and not service.stopped():
+            processed = all(len(taps[side].rx_ns) >= len(serial_ports[dev]["port"].deliveries) for side, dev in masters.items())
+            if processed and notify.is_set() is False and (not sink.published or time.monotonic_ns() - sink.published[-1][2] > 2e8):
+                break
+            time.sleep(REPLAY_POLL)
+        service.stop()
+
+    for t in ranging_threads:
+        t.start()
+    drain_thread = threading.Thread(target=drain_job, name="Replay Drain Thread", daemon=True)
+    drain_thread.start()
+    service.run()
+    for t in ranging_threads:
+        t.join(REPLAY_READ_TIMEOUT + 1.0)
+    if log_dir is not None:
+        log_dir.cleanup()
+
+    # Latencies from the delivery of the DIST lines into the (fake) serial port
+    deliveries = {side: serial_ports[dev]["port"].deliveries for side, dev in masters.items()}
+    rx_latency = [(rx_ns - deliveries[side][sfn]) / 1e6 for side, tap in taps.items()
+                  for sfn, rx_ns in enumerate(tap.rx_ns) if sfn < len(deliveries[side])]
+    a_side, b_side = 2, 1
+    e2e_latency = [(published_ns - max(deliveries[a_side][sfn_a], deliveries[b_side][sfn_b])) / 1e6
+                   for sfn_a, sfn_b, published_ns in sink.published
+                   if a_side in deliveries and b_side in deliveries
+                   and sfn_a < len(deliveries[a_side]) and sfn_b < len(deliveries[b_side])]
+    frames = sum(len(tap.rx_ns) for tap in taps.values())
+    # Throughputs from the start of the playback to the last frame received / the last result published
+    t0_ns = clock.t0_ns or 0
+    elapsed = (max([tap.rx_ns[-1] for tap in taps.values() if tap.rx_ns] + [t0_ns]) - t0_ns) / 1e9
+    elapsed_results = (max([p[2] for p in sink.published[-1:]] + [t0_ns]) - t0_ns) / 1e9
+    return {"speed": speed, "reader": reader, "capture_s": capture.duration, "elapsed_s": elapsed,
+            "delivered": sum(len(d) for d in deliveries.values()), "frames": frames, "results": len(sink.published),
+            "frames_per_s": frames / elapsed if elapsed else 0.0,
+            "results_per_s": len(sink.published) / elapsed_results if elapsed_results else 0.0,
+            "rx_latency_ms": percentiles(rx_latency), "e2e_latency_ms": percentiles(e2e_latency),
+            "errors": service.errors, "pairing": pair_source.summary()}
+
+
+def format_replay_report(report):
+    fmt_latency = lambda stats: ", ".join("{} {:.2f}".format(k, v) for k, v in stats.items()) or "N/A"
+    return ("replay {} ({} reader): {}/{} frames, {} results in {:.2f} s (capture {:.2f} s) | "
+            "{:.1f} frames/s, {:.1f} results/s | serial->RX latency ms: {} | serial->published latency ms: {}"
+            .format("{:g}x".format(report["speed"]) if report["speed"] else "as fast as possible", report["reader"], report["frames"], report["delivered"], report["results"],
+                    report["elapsed_s"], report["capture_s"], report["frames_per_s"], report["results_per_s"],
+                    fmt_latency(report["rx_latency_ms"]), fmt_latency(report["e2e_latency_ms"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded ranging session (or field test raw logs) into the headless service")
+    parser.add_argument("sources", nargs="+", help="session capture file, or -raw_log.log text logs (one per end)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0: as fast as possible (default: %(default)s)")
+    parser.add_argument("--reader", choices=("single", "mux"), default="single",
+                        help="end_ranging_job_async_single() per end, or the serial multiplexer (default: %(default)s)")
+    parser.add_argument("--save", help="save the (imported) capture as a session capture file")
+    args = parser.parse_args()
+    capture = load_replay_source(args.sources)
+    if args.save:
+        capture.save(args.save)
+    report = replay_session(capture, speed=args.speed, reader=args.reader)
+    print(format_replay_report(report))
+
+
+if __name__ == "__main__":
+    # Replay: python3 session_replay.py <capture file | *-raw_log.log ...> [--speed N] [--reader single|mux]
+    if len(sys.argv) > 1:
+        main()
+        sys.exit(0)
+    # Unit Testing: import the sample field test log, save/load it as a capture, replay it at 1x, 10x and
+    # as fast as possible through both readers, and record a replayed session back into an identical capture.
+    import io, queue
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    capture = import_raw_log(sample_raw_log)
+    assert capture.master_devices() == {1: "88BA"}
+    assert sorted(dev for dev, info in capture.devices.items() if not info["info_pos"]) == ["1912", "8D38"]
+    with open(sample_raw_log, "rb") as f:
+        lines = [line.split(RAW_LOG_SEPARATOR)[1].rstrip() for line in f if RAW_LOG_SEPARATOR in line]
+    assert [data.rstrip() for _, data in capture.rx_chunks("88BA")] == lines
+    capture.mirror_end("88BA")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        capture_fpath = os.path.join(tmp_dir, "sample.capture")
+        capture.save(capture_fpath)
+        loaded = SessionCapture.load(capture_fpath)
+        assert loaded.chunks == capture.chunks and loaded.devices == capture.devices
+    print("{} frames of {:.1f} s imported, saved and loaded".format(len(lines), capture.duration))
+
+    # Short replays: the first 10 s of the capture
+    short = SessionCapture()
+    short.devices = capture.devices
+    short.chunks = [chunk for chunk in capture.chunks if chunk[0] < 10e9]
+    n_frames = len(short.rx_chunks("88BA"))
+    for speed, reader in ((1.0, "single"), (10.0, "mux"), (REPLAY_AFAP, "single"), (REPLAY_AFAP, "mux")):
+        sys.stdout, log_out = io.StringIO(), sys.stdout
+        t_0 = time.monotonic()
+        report = replay_session(short, speed=speed, reader=reader)
+        wall = time.monotonic() - t_0
+        sys.stdout = log_out
+        assert report["delivered"] == report["frames"] == 2 * n_frames, report
+        assert report["results"] > 0 and report["errors"] == 0, report
+        if speed:
+            # Paced by the capture timing
+            assert abs(report["elapsed_s"] - short.duration / speed) < 0.1 + 0.05 * short.duration / speed, report
+            assert report["rx_latency_ms"]["p50"] < 5, report
+        print(format_replay_report(report) + " | wall {:.1f} s".format(wall))
+
+    # Record the fake serial ports of a replay: same bytes, same relative timing
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clock = ReplayClock(speed=5.0)
+        serial_ports = short.serial_ports(clock, timeout=0.5)
+        sys.stdout, log_out = io.StringIO(), sys.stdout
+        recorder = SessionRecorder(os.path.join(tmp_dir, "recorded.capture"))
+        q_b = queue.Queue()
+        stop_flag = threading.Event()
+        job = threading.Thread(target=end_ranging_job_async_single,
+                               kwargs={"serial_ports": serial_ports, "end_side_code": 1, "data_ptr_queue_single_end": q_b,
+                                       "log_fpath": tmp_dir, "stop_flag_callback": stop_flag.is_set,
+                                       "exp_name": "record", "recorder": recorder}, daemon=True)
+        job.start()
+        # The A end is not read in this test: start the playback of the B end alone
+        serial_ports["88BA-mirror"]["port"].fileno()
+        serial_ports["88BA"]["port"].finished.wait(10)
+        while q_b.qsize() < n_frames and job.is_alive():
+            time.sleep(0.05)
+        stop_flag.set()
+        job.join()
+        # Flushed while recording: the file already holds the capture but its last RECORD_FLUSH_PERIOD_NS
+        time.sleep(RECORD_FLUSH_PERIOD_NS / 1e9)
+        recorder.record("88BA", b"\r", direction="W")
+        unclosed = SessionCapture.load(recorder.fpath)
+        assert len(unclosed.chunks) == recorder.chunks, (len(unclosed.chunks), recorder.chunks)
+        recorder.close()
+        sys.stdout = log_out
+        for entry in serial_ports.values():
+            if entry["port"] is not None:
+                entry["port"].close()
+        recorded = SessionCapture.load(recorder.fpath)
+        assert b"".join(data for _, data in recorded.rx_chunks("88BA")) == b"".join(data for _, data in short.rx_chunks("88BA"))
+        assert set(recorded.devices) == set(short.devices)
+        original_t = [t_ns for t_ns, _ in short.rx_chunks("88BA")]
+        recorded_t = [t_ns for t_ns, _ in recorded.rx_chunks("88BA")]
+        jitter = max(abs((r - recorded_t[0]) * 5.0 - (o - original_t[0])) for r, o in zip(recorded_t, original_t)) / 1e6
+        assert q_b.qsize() == n_frames and jitter < 100, (q_b.qsize(), jitter)
+        print("{} frames recorded from a 5x replay, identical bytes, timing within {:.1f} ms (capture time)".format(n_frames, jitter))
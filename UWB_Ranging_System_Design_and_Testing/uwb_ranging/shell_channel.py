@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+
+import time, threading
+
+
+# This file contains the adaptive shell command writer of the DWM1001 UART shell.
+# The DWM shell echoes every typed character and prints the "dwm> " prompt when a command
+# is done. Instead of sleeping a fixed delay before every byte, a command byte is written,
+# then the channel waits for its echo; the next byte follows as soon as the echo arrived and
+# the learned minimum inter-byte gap of the device has passed. After the last byte the
+# channel waits for the prompt (with a deadline) and returns everything it read.
+# Without echo (e.g. the shell is not up yet) each byte falls back to the fixed pacing of the
+# given delay, so a command is never slower than before. The "Enter" sequences waking the
+# shell up always keep the fixed pacing.
+# The inter-byte gap is learned per device: shrunk after every echoed character, raised
+# back when a character got lost, and never lowered again below a gap that lost characters.
+# A command that lost characters at a learned gap is typed once more at the raised gap.
+
+SHELL_PROMPT = b"dwm>"
+SHELL_MIN_GAP = 0.002           # Floor of the learned inter-byte gap in seconds
+SHELL_GAP_DECAY = 0.7           # Gap shrink factor per echoed character
+SHELL_POLL_INTERVAL = 0.002     # Seconds between input buffer polls while waiting for echo
+SHELL_PROMPT_TIMEOUT = 1.0      # Seconds to wait for the prompt after a fully echoed command
+CR, LF = 0x0D, 0x0A
+
+
+class ShellCommandChannel():
+
+    # Adaptive command writer of one serial port (device)
+    def __init__(self, serial_port):
+        self.serial_port = serial_port
+        self.gap = None                 # learned inter-byte gap; None until the first echo
+        self.failed_gap = 0.0           # largest gap that has lost characters
+        self.echoed_cmds = 0
+        self.unechoed_cmds = 0
+        self.retried_cmds = 0
+        self.lock = threading.Lock()
+
+    def _read_available(self, captured):
+        n = self.serial_port.in_waiting
+        if n:
+            captured.extend(self.serial_port.read(n))
+        return n
+
+    def _wait_for(self, captured, start, targets, timeout):
+        """ Read until one of the target bytes shows up in captured[start:] or the timeout
+
+            :returns:
+                index of the target byte, or -1 at the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            idx = min((i for i in (captured.find(t, start) for t in targets) if i >= 0), default=-1)
+            if idx >= 0:
+                return idx
+            if time.monotonic() >= deadline:
+                return -1
+            if not self._read_available(captured):
+                time.sleep(SHELL_POLL_INTERVAL)
+
+    def _learn(self, echoed, delay):
+        if echoed:
+            gap = delay if self.gap is None else self.gap
+            self.gap = max(SHELL_MIN_GAP, gap * SHELL_GAP_DECAY, 2 * self.failed_gap)
+        elif self.gap is not None:
+            # Echo worked before: the character was lost because it was typed too fast
+            self.failed_gap = max(self.failed_gap, self.gap)
+            self.gap = min(delay, 2 * self.failed_gap)
+
+    def _write_paced(self, command, delay, captured):
+        """ Write the command bytes, each one paced by its echo or the learned gap
+
+            :returns:
+                (position after the last echo in captured, number of lost characters)
+        """
+        pos = 0
+        lost = 0
+        time.sleep(delay if self.gap is None else min(self.gap, delay))
+        for B in command:
+            gap = delay if self.gap is None else min(self.gap, delay)
+            t_written = time.monotonic()
+            self.serial_port.write(bytes([B]))
+            # The echo of "Enter" may come back as CR or LF
+            targets = (b"\r", b"\n") if B == CR else (bytes([B]),)
+            idx = self._wait_for(captured, pos, targets, delay)
+            if idx < 0:
+                # No echo: the fixed pacing has already been waited for.
+                # Characters are only lost (typed too fast) if the device echoed before.
+                if B not in (CR, LF) and self.gap is not None:
+                    lost += 1
+                    self._learn(False, delay)
+                continue
+            if B not in (CR, LF):
+                self._learn(True, delay)
+            pos = idx + 1
+            remaining = gap - (time.monotonic() - t_written)
+            if remaining > 0:
+                time.sleep(remaining)
+        return pos, lost
+
+    def command(self, command, delay=0.1, prompt_timeout=SHELL_PROMPT_TIMEOUT):
+        """ Write a shell command and collect the echo, the response and the prompt
+
+            :returns:
+                bytes read from the port while writing the command
+        """
+        with self.lock:
+            captured = bytearray()
+            if not any(B not in (CR, LF) for B in command):
+                # "Enter" sequences (waking up the shell) keep the fixed pacing: the reported
+                # data lines end with CR LF as well and cannot be told apart from an echo.
+                for B in command:
+                    time.sleep(delay)
+                    self.serial_port.write(bytes([B]))
+                time.sleep(delay)
+                self._read_available(captured)
+                return bytes(captured)
+            pos, lost = self._write_paced(command, delay, captured)
+            if lost and command[-1:] == b"\r":
+                # Characters were lost at the learned gap: the shell got a garbled line.
+                # Type the command once more at the raised gap.
+                self.retried_cmds += 1
+                self._wait_for(captured, pos, (SHELL_PROMPT,), prompt_timeout)
+                pos, lost = self._write_paced(command, delay, captured)
+            if lost or self.gap is None:
+                self.unechoed_cmds += 1
+            else:
+                self.echoed_cmds += 1
+            if self.gap is not None and not lost and command[-1:] == b"\r":
+                self._wait_for(captured, pos, (SHELL_PROMPT,), prompt_timeout)
+            else:
+                self._read_available(captured)
+            return bytes(captured)
+
+
+_shell_channels = {}
+_shell_channels_lock = threading.Lock()
+
+
+def shell_channel_for(serial_port):
+    """ Get the shell command channel of a serial port. Learned delays are kept per device
+        name and survive closing/reopening the port.
+
+        :returns:
+            ShellCommandChannel
+    """
+    key = getattr(serial_port, "port", None) or id(serial_port)
+    with _shell_channels_lock:
+        channel = _shell_channels.get(key)
+        if channel is None or channel.serial_port is not serial_port:
+            learned = channel
+            channel = ShellCommandChannel(serial_port)
+            if learned is not None:
+                channel.gap, channel.failed_gap = learned.gap, learned.failed_gap
+            _shell_channels[key] = channel
+        return channel
+
+
+if __name__ == "__main__":
+    # Unit Testing: a pty-emulated DWM shell echoing characters, optionally dropping
+    # characters typed faster than its minimum inter-byte gap
+    import os, pty, tty, serial
+
+    def emulated_shell(min_gap=0.0):
+        master_fd, slave_fd = pty.openpty()
+        tty.setraw(slave_fd)
+        def job():
+            buf, last = b"", 0.0
+            while True:
+                try:
+                    c = os.read(master_fd, 1)
+                except OSError:
+                    return
+                now = time.monotonic()
+                too_fast, last = now - last < min_gap, now
+                if too_fast and c != b"\r":
+                    continue
+                os.write(master_fd, c)
+                buf += c
+                if c == b"\r":
+                    cmd, buf = buf.strip(), b""
+                    if cmd.startswith(b"aurs"):
+                        os.write(master_fd, b"\naurs: ok\r\n")
+                    elif cmd == b"si":
+                        os.write(master_fd, b"\n[000048.180 INF] sys: fw2 fw_ver=x01030001 cfg_ver=x00010700\r\n")
+                    os.write(master_fd, b"dwm> ")
+        threading.Thread(target=job, daemon=True).start()
+        return serial.Serial(os.ttyname(slave_fd), baudrate=115200, timeout=3.0)
+
+    aurs = b'\x61\x75\x72\x73\x20\x36\x30\x30\x20\x36\x30\x30\x0D'
+    p = emulated_shell()
+    t0 = time.monotonic()
+    for B in aurs:
+        time.sleep(0.2)
+        p.write(bytes([B]))
+    time.sleep(0.2)
+    t_fixed = time.monotonic() - t0
+    p.reset_input_buffer()
+    channel = shell_channel_for(p)
+    times = []
+    for _ in range(8):
+        t0 = time.monotonic()
+        out = channel.command(aurs, delay=0.2)
+        times.append(time.monotonic() - t0)
+        assert b"aurs 600 600" in out and b"aurs: ok" in out and out.rstrip().endswith(b"dwm>"), out
+    out = channel.command(b"si\r", delay=0.2)
+    assert b"fw_ver=x01030001" in out and out.rstrip().endswith(b"dwm>"), out
+    print("'aurs 600 600': fixed pacing {:.2f} s, adaptive {} s (learned gap {:.3f} s)"
+          .format(t_fixed, " ".join("{:.3f}".format(t) for t in times), channel.gap))
+    assert times[-1] * 10 < t_fixed
+
+    # A slow device: characters typed faster than 30 ms are lost. The channel backs off
+    # and settles on a gap that never loses characters again.
+    slow = shell_channel_for(emulated_shell(min_gap=0.03))
+    results = [slow.command(aurs, delay=0.2).count(b"aurs: ok") for _ in range(12)]
+    assert slow.unechoed_cmds == 0 and slow.gap >= 0.03, (results, slow.gap)
+    print("slow device: learned gap {:.3f} s, {} commands retyped while learning"
+          .format(slow.gap, slow.retried_cmds))
+
+    # No echo at all (e.g. reporting mode): fixed pacing
+    m, s = pty.openpty()
+    mute = ShellCommandChannel(serial.Serial(os.ttyname(s), timeout=3.0))
+    t0 = time.monotonic()
+    mute.command(b'\x73\x69\x0D', delay=0.2)
+    assert abs(time.monotonic() - t0 - 0.8) < 0.1 and mute.gap is None
+    print("no echo: fixed pacing of {:.2f} s kept".format(time.monotonic() - t0))
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only required by the batch decoder (offline reprocessing)
+    np = None
+
+
+# This file contains the decoder of the slave informative positions.
+# The slave (anchor) firmware encodes its informative position into the regular
+# anchor position fields it reports: x, y, z (int32, little endian) and qf (uint8).
+# Laid out as the 13 bytes x[0:4] y[4:8] z[8:12] qf[12]:
+#   x_slave:                bytes 2-3,  signed      (x >> 16)
+#   y_slave:                bytes 6-7,  signed      (y >> 16)
+#   z_slave:                bytes 10-11, unsigned   ((z >> 16) & 0xFFFF)
+#   vehicle_length_slave:   bytes 8-9,  unsigned    (z & 0xFFFF)
+#   id_assoc:               byte 1,     unsigned    ((x >> 8) & 0xFF)
+#   side_slave:             z_slave % 3 (Modulo-3 encoded end side; 1: "B", 2: "A", 0: "UNKNOWN")
+# Positions and vehicle length are reported in cm and decoded into mm (x 10).
+# The per-frame path and the NumPy batch path below share these shifts and masks.
+
+INT32_MIN, INT32_MAX = -0x80000000, 0x7FFFFFFF
+HALF_WORD_SHIFT, HALF_WORD_MASK = 16, 0xFFFF
+ID_ASSOC_SHIFT, ID_ASSOC_MASK = 8, 0xFF
+SIDE_MODULO = 3
+CM_TO_MM = 10
+
+SLAVE_INFO_FIELDS = ["x_slave", "y_slave", "z_slave", "vehicle_length_slave", "id_assoc", "side_slave"]
+SLAVE_INFO_DTYPE = [("x_slave", "<i4"), ("y_slave", "<i4"), ("z_slave", "<i4"),
+                    ("vehicle_length_slave", "<i4"), ("id_assoc", "<i4"), ("side_slave", "<i4")]
+
+
+def decode_slave_info_fields(x, y, z, qf=0):
+    """ Decode the informative position of one slave from its reported anchor position
+
+        :returns:
+            (x_slave, y_slave, z_slave, vehicle_length_slave, id_assoc, side_slave)
+            Raises OverflowError for values outside int32 (uint8 for qf), as int.to_bytes() did.
+    """
+    if not (INT32_MIN <= x <= INT32_MAX and INT32_MIN <= y <= INT32_MAX and INT32_MIN <= z <= INT32_MAX and 0 <= qf <= 0xFF):
+        raise OverflowError("slave position out of the int32/uint8 range: {}".format((x, y, z, qf)))
+    z_slave = (z >> HALF_WORD_SHIFT) & HALF_WORD_MASK
+    return ((x >> HALF_WORD_SHIFT) * CM_TO_MM,
+            (y >> HALF_WORD_SHIFT) * CM_TO_MM,
+            z_slave * CM_TO_MM,
+            (z & HALF_WORD_MASK) * CM_TO_MM,
+            (x >> ID_ASSOC_SHIFT) & ID_ASSOC_MASK,
+            z_slave % SIDE_MODULO)
+
+
+def encode_slave_info_fields(x_slave, y_slave, z_slave, vehicle_length_slave, id_assoc, side_slave):
+    """ Encode the informative position of one slave (mm) into the anchor position fields reported
+        by the slave firmware. Inverse of decode_slave_info_fields(), used to emulate slaves.
+        The height is rounded to the nearest cm carrying the end side (modulo 3).
+
+        :returns:
+            (x, y, z) anchor position fields
+    """
+    z_cm = int(round(z_slave / CM_TO_MM))
+    z_cm += (side_slave - z_cm) % SIDE_MODULO
+    x = (int(round(x_slave / CM_TO_MM)) << HALF_WORD_SHIFT) | ((id_assoc & ID_ASSOC_MASK) << ID_ASSOC_SHIFT)
+    y = int(round(y_slave / CM_TO_MM)) << HALF_WORD_SHIFT
+    z = (z_cm << HALF_WORD_SHIFT) | (int(round(vehicle_length_slave / CM_TO_MM)) & HALF_WORD_MASK)
+    return x, y, z
+
+
+def decode_slave_info_batch(x, y, z, qf=None):
+    """ Decode the informative positions of many slaves at once, e.g. all anchors of a whole log
+
+        :returns:
+            NumPy structured array of SLAVE_INFO_DTYPE, one entry per input position.
+            Raises OverflowError for values outside int32 (uint8 for qf), as int.to_bytes() did.
+    """
+    if np is None:
+        raise ImportError("NumPy is required by decode_slave_info_batch()")
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    z = np.asarray(z, dtype=np.int64)
+    for values in (x, y, z):
+        if values.size and (values.min() < INT32_MIN or values.max() > INT32_MAX):
+            raise OverflowError("slave positions out of the int32 range")
+    if qf is not None:
+        qf = np.asarray(qf, dtype=np.int64)
+        if qf.size and (qf.min() < 0 or qf.max() > 0xFF):
+            raise OverflowError("slave quality factors out of the uint8 range")
+    decoded = np.empty(x.shape, dtype=SLAVE_INFO_DTYPE)
+    # Arithmetic right shifts keep the sign of the upper half words of x and y
+    decoded["x_slave"] = (x >> HALF_WORD_SHIFT) * CM_TO_MM
+    decoded["y_slave"] = (y >> HALF_WORD_SHIFT) * CM_TO_MM
+    z_slave = (z >> HALF_WORD_SHIFT) & HALF_WORD_MASK
+    decoded["z_slave"] = z_slave * CM_TO_MM
+    decoded["vehicle_length_slave"] = (z & HALF_WORD_MASK) * CM_TO_MM
+    decoded["id_assoc"] = (x >> ID_ASSOC_SHIFT) & ID_ASSOC_MASK
+    decoded["side_slave"] = z_slave % SIDE_MODULO
+    return decoded
+
+
+def slave_positions_from_reports(ranging_json_dicts):
+    """ Flatten the anchors of parsed reports (make_json_dict_accel_en() dictionaries) into arrays
+        for decode_slave_info_batch()
+
+        :returns:
+            (frame index, slave ids, x, y, z, qf, dist_to) lists, one entry per anchor
+    """
+    frame_idx, slave_ids, x, y, z, qf, dist_to = [], [], [], [], [], [], []
+    for idx, ranging_json_dict in enumerate(ranging_json_dicts):
+        for anc in ranging_json_dict.get("all_anc_id", []):
+            slave_reporting_raw = ranging_json_dict.get(anc, {})
+            frame_idx.append(idx)
+            slave_ids.append(anc)
+            x.append(slave_reporting_raw.get('x', 0))
+            y.append(slave_reporting_raw.get('y', 0))
+            z.append(slave_reporting_raw.get('z', 0))
+            qf.append(slave_reporting_raw.get('anc_qf', 0))
+            dist_to.append(slave_reporting_raw.get('dist_to', 0))
+    return frame_idx, slave_ids, x, y, z, qf, dist_to
+
+
+if __name__ == "__main__":
+    # Unit Testing: bit-identical to the original bytearray decoding of utils.decode_slave_info_position()
+    import os, random, timeit
+
+    def reference_decode(x, y, z, qf):
+        recover_bytes = bytearray()
+        recover_bytes.extend(x.to_bytes(4, "little", signed=True))
+        recover_bytes.extend(y.to_bytes(4, "little", signed=True))
+        recover_bytes.extend(z.to_bytes(4, "little", signed=True))
+        recover_bytes.extend(qf.to_bytes(1, "little", signed=False))
+        x_slave = int.from_bytes(bytearray([recover_bytes[2], recover_bytes[3]]), 'little', signed=True)
+        y_slave = int.from_bytes(bytearray([recover_bytes[6], recover_bytes[7]]), 'little', signed=True)
+        z_slave = int.from_bytes(bytearray([recover_bytes[10], recover_bytes[11]]), 'little', signed=False)
+        vehicle_length_slave = int.from_bytes(bytearray([recover_bytes[8], recover_bytes[9]]), 'little', signed=False)
+        id_slave = int.from_bytes(bytearray([recover_bytes[1]]), 'little', signed=False)
+        return x_slave * 10, y_slave * 10, z_slave * 10, vehicle_length_slave * 10, id_slave, z_slave % 3
+
+    random.seed(0)
+    edges = [INT32_MIN, INT32_MIN + 1, -65536, -65535, -256, -1, 0, 1, 255, 256, 65535, 65536, INT32_MAX - 1, INT32_MAX]
+    samples = [(x, y, z, 100) for x in edges for y in edges[::3] for z in edges]
+    samples += [(random.randint(INT32_MIN, INT32_MAX), random.randint(INT32_MIN, INT32_MAX),
+                 random.randint(INT32_MIN, INT32_MAX), random.randint(0, 255)) for _ in range(200000)]
+    sample_raw_log = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results",
+                                  "data", "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    from dist_parser import parse_dist_report
+    with open(sample_raw_log, "rb") as f:
+        reports = [parse_dist_report(line.split(b" end reporting raw data: ")[1]).to_dict() for line in f if b" end reporting raw data: " in line]
+    _, _, log_x, log_y, log_z, log_qf, _ = slave_positions_from_reports(reports)
+    samples += list(zip(log_x, log_y, log_z, log_qf))
+
+    expected = [reference_decode(*s) for s in samples]
+    assert [decode_slave_info_fields(*s) for s in samples] == expected, "per-frame decoder mismatch"
+    for x_slave, y_slave, z_slave, length, id_assoc, side in [(290, 1190, 2810, 15480, 1, 2), (11670, -1070, 2980, 15500, 1, 1),
+                                                              (-32000, 5000, 0, 65530, 255, 0)]:
+        decoded_fields = decode_slave_info_fields(*encode_slave_info_fields(x_slave, y_slave, z_slave, length, id_assoc, side))
+        assert decoded_fields[:2] == (x_slave, y_slave) and decoded_fields[3:] == (length, id_assoc, side), decoded_fields
+        assert abs(decoded_fields[2] - z_slave) <= 20
+    xs, ys, zs, qfs = (list(v) for v in zip(*samples))
+    decoded = decode_slave_info_batch(xs, ys, zs, qfs)
+    assert [tuple(int(v) for v in row) for row in decoded.tolist()] == expected, "batch decoder mismatch"
+    for bad in ((INT32_MAX + 1, 0, 0, 0), (0, INT32_MIN - 1, 0, 0), (0, 0, 0, 256), (0, 0, 0, -1)):
+        for decoder in (reference_decode, decode_slave_info_fields, lambda *s: decode_slave_info_batch(*([v] for v in s))):
+            try:
+                decoder(*bad)
+                raise AssertionError("no OverflowError for {}".format(bad))
+            except OverflowError:
+                pass
+    print("{} slave positions ({} from the sample field test log) decoded bit-identically".format(len(samples), len(log_x)))
+
+    n = len(samples)
+    t_reference = timeit.timeit(lambda: [reference_decode(*s) for s in samples], number=1)
+    t_fields = timeit.timeit(lambda: [decode_slave_info_fields(*s) for s in samples], number=1)
+    t_batch = timeit.timeit(lambda: decode_slave_info_batch(xs, ys, zs, qfs), number=1)
+    print("bytearray: {:.0f} slaves/s | per-frame bit ops: {:.0f} slaves/s ({:.1f}x) | NumPy batch: {:.0f} slaves/s ({:.1f}x)"
+          .format(n / t_reference, n / t_fields, t_reference / t_fields, n / t_batch, t_reference / t_batch))
@@ -0,0 +1,384 @@
+#!/usr/bin/python3
+
+import sys, os, math, collections
+from vehicle_tracker import near_side_adjusted_dist
+
+
+# This file contains the streaming closing speed and time-to-collision (TTC) estimator.
+# The adjusted distances of each foreign vehicle (end side, id_assoc) are fitted by a least squares
+# line over a sliding time window. The fit is kept as running sums, updated in O(1) when a sample
+# enters or leaves the window: the history is never re-scanned. Samples far off the current fit
+# (residual gate scaled by the running residual level) are rejected as outliers, the fit restarts
+# after TTC_GATE_RESTART rejections in a row (vehicle switch).
+#   closing speed:  -slope of the fitted line (mm/s, positive when approaching)
+#   TTC:            fitted distance / closing speed (s), inf when not approaching
+# TtcMonitor adds "ttc" and "ttc_closing_speed" to the processed vehicle dictionaries and emits
+# threshold crossing events (distance and TTC, with hysteresis) for the GUI and the output sinks.
+# The same code runs offline over the post-processed field test results:
+#   python3 ttc_estimator.py PostProcessed_xyz.csv [...]
+# writes TTC_xyz.csv alongside and prints the threshold crossings with the TTC estimated then,
+# to compare with the TTC at threshold reporting of ../uwb_ranging_fieldtest_results/simulation_pending_improvement.
+
+TTC_WINDOW = 1.0                # Seconds of samples in the regression window
+TTC_MIN_SAMPLES = 5             # Samples in the window before estimating
+TTC_MIN_CLOSING_SPEED = 100.0   # mm/s: slower closing speeds give an infinite TTC
+TTC_SIGMA_MEAS = 100.0          # mm: initial residual level (UWB ranging standard deviation)
+TTC_ROBUST_K = 4.0              # Residual gate in residual levels
+TTC_GATE_MIN = 1000.0           # mm: smallest residual gate (outliers of the field tests are ~8 m off)
+TTC_GATE_RESTART = 3            # Consecutive rejected samples restarting the fit
+TTC_REANCHOR = 60.0             # Seconds between recomputations of the running sums (rounding drift)
+# Same limits as the GUI colors (LIMIT_WARNING, LIMIT_ALARM of ranging_gui.py)
+DIST_THRESHOLDS = (10000, 3000) # mm
+TTC_THRESHOLDS = (10.0, 5.0)    # Seconds
+DIST_HYSTERESIS = 0.05          # Relative margin above a threshold to re-arm its crossing event
+TTC_HYSTERESIS = 0.2
+
+
+class WindowedLineFit():
+
+    # Least squares line d = a + b * t over a sliding time window, from running sums.
+    # Times are kept in seconds relative to an anchor (first sample), re-anchored every TTC_REANCHOR.
+    def __init__(self, window=TTC_WINDOW):
+        self.window_ns = int(window * 1e9)
+        self.reanchor_ns = int(TTC_REANCHOR * 1e9)
+        self.samples = collections.deque()     # (t_ns, dist)
+        self.clear()
+
+    def clear(self):
+        self.samples.clear()
+        self.anchor_ns = None
+        self.n, self.sum_t, self.sum_d, self.sum_tt, self.sum_td = 0, 0.0, 0.0, 0.0, 0.0
+
+    def _accumulate(self, t_ns, dist, sign):
+        t = (t_ns - self.anchor_ns) / 1e9
+        self.n += sign
+        self.sum_t += sign * t
+        self.sum_d += sign * dist
+        self.sum_tt += sign * t * t
+        self.sum_td += sign * t * dist
+
+    def _reanchor(self):
+        samples = list(self.samples)
+        self.clear()
+        self.anchor_ns = samples[0][0]
+        for t_ns, dist in samples:
+            self.samples.append((t_ns, dist))
+            self._accumulate(t_ns, dist, 1)
+
+    def add(self, t_ns, dist):
+        if self.anchor_ns is None:
+            self.anchor_ns = t_ns
+        self.samples.append((t_ns, dist))
+        self._accumulate(t_ns, dist, 1)
+        while self.samples[0][0] < t_ns - self.window_ns:
+            old_t_ns, old_dist = self.samples.popleft()
+            self._accumulate(old_t_ns, old_dist, -1)
+        if t_ns - self.anchor_ns > self.reanchor_ns:
+            self._reanchor()
+
+    def line(self):
+        """ :returns:
+                (slope mm/s, fitted distance at the latest sample), None if the window is degenerate
+        """
+        if self.n < 2:
+            return None
+        var_t = self.sum_tt - self.sum_t * self.sum_t / self.n
+        if var_t <= 1e-9:
+            return None
+        slope = (self.sum_td - self.sum_t * self.sum_d / self.n) / var_t
+        t_last = (self.samples[-1][0] - self.anchor_ns) / 1e9
+        return slope, self.sum_d / self.n + slope * (t_last - self.sum_t / self.n)
+
+    def value_at(self, t_ns):
+        """ :returns:
+                fitted distance at t_ns, None if the window is degenerate
+        """
+        line = self.line()
+        if line is None:
+            return None
+        slope, dist_last = line
+        return dist_last + slope * (t_ns - self.samples[-1][0]) / 1e9
+
+
+class ClosingSpeedEstimator():
+
+    # Robust windowed regression of the distance of one vehicle
+    def __init__(self, window=TTC_WINDOW, min_samples=TTC_MIN_SAMPLES):
+        self.fit = WindowedLineFit(window)
+        self.min_samples = min_samples
+        self.level = TTC_SIGMA_MEAS     # running mean absolute residual (mm)
+        self.rejected_run = []          # consecutive rejected samples
+        self.rejected = 0
+        self.restarts = 0
+
+    def add(self, t_ns, dist):
+        """ Add a measured distance at t_ns
+
+            :returns:
+                True if accepted, False if rejected as an outlier
+        """
+        samples = self.fit.samples
+        if samples and (t_ns <= samples[-1][0] or t_ns - samples[-1][0] > self.fit.window_ns):
+            if t_ns <= samples[-1][0]:
+                # Frame already used, or out of order
+                return False
+            # Gap longer than the window: start over
+            self.fit.clear()
+        if self.fit.n >= self.min_samples:
+            predicted = self.fit.value_at(t_ns)
+            residual = abs(dist - predicted) if predicted is not None else 0.0
+            if residual > max(TTC_ROBUST_K * self.level, TTC_GATE_MIN):
+                self.rejected_run.append((t_ns, dist))
+                if len(self.rejected_run) < TTC_GATE_RESTART:
+                    self.rejected += 1
+                    return False
+                # Not outliers: start over from the rejected samples
+                self.restarts += 1
+                self.fit.clear()
+                self.level = TTC_SIGMA_MEAS
+                for sample in self.rejected_run[:-1]:
+                    self.fit.add(*sample)
+            else:
+                self.level += 0.1 * (residual - self.level)
+        self.rejected_run.clear()
+        self.fit.add(t_ns, dist)
+        return True
+
+    def estimate(self, t_ns=None):
+        """ :returns:
+                (fitted distance mm, closing speed mm/s, TTC s), None before TTC_MIN_SAMPLES samples
+        """
+        if self.fit.n < self.min_samples:
+            return None
+        line = self.fit.line()
+        if line is None:
+            return None
+        slope, dist = line
+        if t_ns is not None:
+            dist += slope * (t_ns - self.fit.samples[-1][0]) / 1e9
+        closing_speed = -slope
+        if dist <= 0:
+            ttc = 0.0
+        elif closing_speed > TTC_MIN_CLOSING_SPEED:
+            ttc = dist / closing_speed
+        else:
+            ttc = float("inf")
+        return dist, closing_speed, ttc
+
+
+class TtcMonitor():
+
+    # Closing speed, TTC and threshold crossing events of the detected vehicles of both ends
+    def __init__(self, dist_thresholds=DIST_THRESHOLDS, ttc_thresholds=TTC_THRESHOLDS, window=TTC_WINDOW):
+        self.dist_thresholds = dist_thresholds
+        self.ttc_thresholds = ttc_thresholds
+        self.window = window
+        self.estimators = {}    # (end side code, vehicle id): ClosingSpeedEstimator
+        self.below = {}         # (end side code, vehicle id, kind, threshold): True while below the threshold
+
+    def _crossings(self, key, kind, value, thresholds, hysteresis, fields):
+        events = []
+        for threshold in thresholds:
+            state_key = key + (kind, threshold)
+            below = self.below.get(state_key, False)
+            if not below and value <= threshold:
+                self.below[state_key] = True
+                events.append(dict(fields, kind=kind, threshold=threshold, crossing="below"))
+            elif below and value > threshold * (1 + hysteresis):
+                self.below[state_key] = False
+                events.append(dict(fields, kind=kind, threshold=threshold, crossing="above"))
+        return events
+
+    def update_distance(self, key, dist, t_ns):
+        """ Feed one measured distance of a key (end side code, vehicle id, ...)
+
+            :returns:
+                ((fitted distance, closing speed, TTC) or None, list of threshold crossing events)
+        """
+        estimator = self.estimators.get(key)
+        if estimator is None:
+            estimator = self.estimators[key] = ClosingSpeedEstimator(self.window)
+        if not estimator.add(t_ns, dist):
+            return None, []
+        estimate = estimator.estimate()
+        if estimate is None:
+            return None, []
+        fit_dist, closing_speed, ttc = estimate
+        fields = {"key": key, "t_ns": t_ns, "dist": round(fit_dist), "closing_speed": round(closing_speed),
+                  "ttc": round(ttc, 2) if math.isfinite(ttc) else None}
+        events = self._crossings(key, "distance", fit_dist, self.dist_thresholds, DIST_HYSTERESIS, fields)
+        if math.isfinite(ttc):
+            events += self._crossings(key, "ttc", ttc, self.ttc_thresholds, TTC_HYSTERESIS, fields)
+        else:
+            for threshold in self.ttc_thresholds:
+                if self.below.pop(key + ("ttc", threshold), False):
+                    events.append(dict(fields, kind="ttc", threshold=threshold, crossing="above"))
+        return estimate, events
+
+    def update(self, end_side_code, veh_detection_list, t_ns):
+        """ Feed the vehicles processed by process_async_raw_ranging_results() for one end, measured
+            at t_ns (time.monotonic_ns() of the frame). Estimated vehicles get "ttc" (s, None when not
+            approaching) and "ttc_closing_speed" (mm/s).
+
+            :returns:
+                list of threshold crossing events (dictionaries)
+        """
+        events = []
+        for veh_dict in veh_detection_list:
+            dist = near_side_adjusted_dist(veh_dict)
+            if dist is None:
+                continue
+            estimate, veh_events = self.update_distance((end_side_code, veh_dict["vehicle_id"]), dist, t_ns)
+            if estimate is not None:
+                _, closing_speed, ttc = estimate
+                veh_dict["ttc"] = round(ttc, 2) if math.isfinite(ttc) else None
+                veh_dict["ttc_closing_speed"] = int(round(closing_speed))
+            events += veh_events
+        return events
+
+
+def format_ttc(veh_detection_list):
+    """ :returns:
+            display text of the closing speed and TTC of the first estimated vehicle, "" if none or not approaching
+    """
+    for veh_dict in veh_detection_list:
+        if "ttc_closing_speed" in veh_dict:
+            if veh_dict["ttc"] is None or veh_dict["ttc_closing_speed"] <= TTC_MIN_CLOSING_SPEED:
+                return ""
+            return "  |  {:.1f} m/s, TTC {:.1f} s".format(veh_dict["ttc_closing_speed"] / 1000, veh_dict["ttc"])
+    return ""
+
+
+def format_event(event):
+    """ :returns:
+            log text of a threshold crossing event
+    """
+    unit = " s" if event["kind"] == "ttc" else " mm"
+    return "vehicle {} {} {} {}{} (distance {} mm, closing speed {} mm/s, TTC {} s)".format(
+        event["key"], event["kind"], event["crossing"], event["threshold"], unit,
+        event["dist"], event["closing_speed"], event["ttc"])
+
+
+def read_postprocessed_series(csv_file):
+    """ Read the adjusted distances of a PostProcessed_*.csv file (moving_data_processing.py)
+
+        :returns:
+            {(initiating master, reporting vehicle, reporting slave): [(t_ns, distance mm, surveyed mm or None), ...]}
+    """
+    import csv
+    series = {}
+    with open(csv_file, newline="") as f:
+        for row in csv.DictReader(f):
+            if not row.get("Correction Distance (mm)") or not row.get("Timestamp Norm (s)"):
+                continue
+            key = (row["Initiating Master"], row["Reporting Vehicle"], row["Reporting Slave"])
+            survey = row.get("Surveyed Distance (mm)")
+            series.setdefault(key, []).append((int(round(float(row["Timestamp Norm (s)"]) * 1e9)),
+                                               float(row["Correction Distance (mm)"]),
+                                               float(survey) if survey else None))
+    return series
+
+
+def run_offline(csv_file, monitor=None, out_file=None):
+    """ Run the estimator over a PostProcessed_*.csv file, write the estimates to out_file
+        (TTC_<name>.csv alongside by default)
+
+        :returns:
+            list of threshold crossing events
+    """
+    import csv
+    monitor = TtcMonitor() if monitor is None else monitor
+    if out_file is None:
+        stem = os.path.splitext(os.path.basename(csv_file))[0]
+        out_file = os.path.join(os.path.dirname(csv_file), "TTC_" + stem.replace("PostProcessed_", "") + ".csv")
+    events = []
+    with open(out_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Timestamp Norm (s)", "Initiating Master", "Reporting Vehicle", "Reporting Slave",
+                         "Correction Distance (mm)", "Fitted Distance (mm)", "Closing Speed (mm/s)", "TTC (s)", "Surveyed Distance (mm)"])
+        for key, samples in read_postprocessed_series(csv_file).items():
+            for t_ns, dist, survey in samples:
+                estimate, key_events = monitor.update_distance(key, dist, t_ns)
+                events += key_events
+                fit_dist, closing_speed, ttc = estimate if estimate is not None else ("", "", "")
+                writer.writerow(["{:.6f}".format(t_ns / 1e9), *key, dist,
+                                 round(fit_dist) if fit_dist != "" else "",
+                                 round(closing_speed) if closing_speed != "" else "",
+                                 ("{:.2f}".format(ttc) if math.isfinite(ttc) else "inf") if ttc != "" else "",
+                                 "" if survey is None else survey])
+    return events
+
+
+if __name__ == "__main__":
+    import glob, random, timeit
+    if len(sys.argv) > 1:
+        for csv_file in sys.argv[1:]:
+            events = run_offline(csv_file)
+            print("{}: {} threshold crossings".format(csv_file, len(events)))
+            for event in events:
+                print("    {:.2f} s: {}".format(event["t_ns"] / 1e9, format_event(event)))
+        sys.exit(0)
+
+    # Unit Testing: the running sums give the batch least squares fit of the window
+    rng = random.Random(3)
+    fit = WindowedLineFit(window=1.0)
+    samples = []
+    for k in range(3000):
+        t_ns = 10**12 + k * 100000000 + rng.randint(-5000000, 5000000)
+        dist = 50000 - 3000 * k * 0.1 + rng.gauss(0, 100)
+        fit.add(t_ns, dist)
+        samples.append((t_ns, dist))
+        window = [(t, d) for t, d in samples if t >= t_ns - fit.window_ns]
+        if len(window) < 2:
+            continue
+        ts = [(t - window[0][0]) / 1e9 for t, _ in window]
+        mean_t, mean_d = sum(ts) / len(ts), sum(d for _, d in window) / len(window)
+        slope = (sum((t - mean_t) * (d - mean_d) for t, (_, d) in zip(ts, window))
+                 / sum((t - mean_t) ** 2 for t in ts))
+        assert fit.n == len(window) and abs(fit.line()[0] - slope) < 1e-6 * max(1.0, abs(slope)), (k, fit.line(), slope)
+
+    # Simulated approach as in simulation_pending_improvement (constant speed, UWB noise, 10 % dropped
+    # reports, 10 Hz): TTC when the estimated distance crosses each threshold, vs the actual TTC
+    for speed_mph in (5, 10, 25):
+        speed = speed_mph * 447.04      # mm/s
+        monitor = TtcMonitor(dist_thresholds=(91440, 15240), ttc_thresholds=())  # 300 ft, 50 ft
+        start, crossings = 457200, {}   # 1500 ft
+        outliers = 0
+        for k in range(100000):
+            true_dist = start - speed * k * 0.1
+            if true_dist <= 0:
+                break
+            if rng.random() < 0.1:
+                continue
+            dist = true_dist + rng.gauss(0, 97.5)
+            if rng.random() < 0.01:
+                dist += rng.choice((-1, 1)) * 8000     # as the outliers of the sample field test log
+                outliers += 1
+            _, events = monitor.update_distance((1, 3), dist, k * 100000000)
+            for event in events:
+                if event["crossing"] == "below":
+                    crossings[event["threshold"]] = (event["ttc"], true_dist / speed)
+        estimator = monitor.estimators[(1, 3)]
+        assert set(crossings) == {91440, 15240} and estimator.restarts == 0 and estimator.rejected >= outliers * 0.8
+        for threshold, (ttc, ttc_actual) in sorted(crossings.items(), reverse=True):
+            assert abs(ttc - ttc_actual) < 0.05 * ttc_actual + 0.3, (speed_mph, threshold, ttc, ttc_actual)
+        print("simulated {} mph approach: TTC at 300 ft {:.2f} s (actual {:.2f} s), at 50 ft {:.2f} s (actual {:.2f} s)"
+              .format(speed_mph, *crossings[91440], *crossings[15240]))
+
+    # Measured: the post-processed field test results shipped with the repository
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results", "data")
+    import tempfile
+    for csv_file in sorted(glob.glob(os.path.join(data_dir, "*.csv"))):
+        out_file = os.path.join(tempfile.mkdtemp(), "TTC.csv")
+        events = run_offline(csv_file, out_file=out_file)
+        with open(out_file) as f:
+            rows = f.read().splitlines()
+        estimated = sum(1 for row in rows[1:] if row.split(",")[5])
+        print("{}: {} of {} samples estimated, {} threshold crossings".format(os.path.basename(csv_file), estimated, len(rows) - 1, len(events)))
+        for event in events:
+            print("    {}".format(format_event(event)))
+
+    estimator = ClosingSpeedEstimator()
+    t_add = timeit.timeit(lambda: (estimator.add(estimator.fit.samples[-1][0] + 100000000 if estimator.fit.samples else 0,
+                                                 20000.0), estimator.estimate()), number=100000)
+    print("per sample: add + estimate {:.1f} us".format(t_add / 100000 * 1e6))
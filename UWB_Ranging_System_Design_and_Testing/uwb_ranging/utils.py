@@ -1,9 +1,16 @@
 from datetime import datetime
-from collections import defaultdict
 from functools import partial
-import sys, time, json, re, base64, math, os, threading
+import sys, time, json, re, base64, os, threading
 import serial, serial.tools.list_ports
 import atexit, signal
+from dist_parser import parse_dist_report
+from slave_info_codec import decode_slave_info_fields
+from shell_channel import shell_channel_for
+from geometry_engine import process_async_geometry, process_synced_geometry
+from pipeline_latency import PIPELINE_LATENCY, STAGE_STAMPS_KEY
+from frame_records import RX_STAMP_KEY, MasterInfo, Frame, decode_slave_readings, as_dist_report
+from metrics_server import METRICS
+from mono_clock import CLOCK, datetime_to_local_us
 
 
 TIME_FORMAT_SHORT = '%Y-%m-%d-%H-%M-%S'
@@ -21,30 +28,37 @@ def timestamp_log(incl_UTC=False, brackets=True, shorten=False):
     """
     if shorten:
         return str(datetime.now().strftime(TIME_FORMAT_SHORT))
+    # Local and UTC times of the same instant, from the monotonic clock (mono_clock.py)
+    now_ns = CLOCK.now_ns()
     if brackets:
-        local_timestp = "["+str(datetime.now().strftime(TIME_FORMAT_LONG))+" local] "
-        utc_timestp = "["+str(datetime.utcnow().strftime(TIME_FORMAT_LONG))+" UTC] "
+        local_timestp = "["+CLOCK.format_local(now_ns)+" local] "
     else:
-        local_timestp = str(datetime.now().strftime(TIME_FORMAT_LONG))+" local "
-        utc_timestp = str(datetime.utcnow().strftime(TIME_FORMAT_LONG))+" UTC "
+        local_timestp = CLOCK.format_local(now_ns)+" local "
     if incl_UTC:
-        return local_timestp + utc_timestp
+        if brackets:
+            return local_timestp + "["+CLOCK.format_utc(now_ns)+" UTC] "
+        return local_timestp + CLOCK.format_utc(now_ns)+" UTC "
     else:
         return local_timestp    
 
 
-def write_shell_command(serial_port, command, delay=0.1):
+def write_shell_command(serial_port, command, delay=0.1, adaptive=True):
     """ Function wrapper to properly write shell commands into DWM1001-Dev with delay 
         Delay is necessary for successful command input. 
+        By default, bytes are paced by their echo and the learned delay of the device 
+        (see shell_channel.py), falling back to the given delay when there is no echo. 
         
         :returns:
-            None
+            bytes read from the port while writing the command (echo, response and prompt)
     """
     if serial_port.is_open:
+        if adaptive:
+            return shell_channel_for(serial_port).command(command, delay=delay)
         time.sleep(delay)
         for B in command:
             serial_port.write(bytes([B]))
             time.sleep(delay)
+    return b""
 
 
 def on_exit(serial_port, verbose=False):
@@ -98,8 +112,7 @@ def is_uwb_shell_ok(serial_port, verbose=False):
     """
     if serial_port.is_open:
         serial_port.reset_input_buffer()
-        write_shell_command(serial_port, command=b'\x0D\x0D', delay=0.2)
-        if serial_port.in_waiting:
+        if write_shell_command(serial_port, command=b'\x0D\x0D', delay=0.2) or serial_port.in_waiting:
             return True
     return False
 
@@ -161,73 +174,225 @@ def serial_port_uart_init(serial_port, oem_firmware=False, pause_reporting=True)
         raise e
 
 
+PAIRING_TIMEOUT = 60.0     # Seconds for all ports to be paired (deadline of the whole discovery)
+
+
+def list_uwb_devices(serial_tty_devices=None):
+    """ Serial tty devices of the UWB boards present (SEGGER J-Link of the DWM1001-Dev), or
+        the given tty devices that exist (e.g. emulated boards)
+
+        :returns:
+            set of tty devices
+    """
+    if serial_tty_devices is not None:
+        return {dev for dev in serial_tty_devices if os.path.exists(dev)}
+    return {p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'SEGGER'}
+
+
+def pair_uwb_port(dev, oem_firmware=False, init_reporting=True, stop_flag_callback=None, step_times=None, device_cache=None):
+    """ Open, initialize and identify the UWB device of one serial tty device.
+        Worker of pairing_uwb_ports(). Durations of the steps are recorded into step_times.
+        With a device_cache (device_cache.DeviceInfoCache), a board cached and unchanged is
+        identified by a single "si" instead of the full interrogation.
+
+        :returns:
+            (short uwb address, serial ports entry), or -1 if stopped
+    """
+    step_times = {} if step_times is None else step_times
+    t_step = time.monotonic()
+    try:
+        p = serial.Serial(dev, baudrate=115200, timeout=3.0)
+    except BaseException as e:
+        sys.stdout.write(timestamp_log() + " Opening serial port {} failed. error: ".format(dev) + repr(e) + "\n")
+        raise e
+    step_times["open"] = time.monotonic() - t_step
+    try:
+        t_step = time.monotonic()
+        serial_port_available_check_flock(p)
+        step_times["flock"] = time.monotonic() - t_step
+        # Initialize the UART shell command
+        t_step = time.monotonic()
+        serial_port_uart_init(p)
+        step_times["uart_init"] = time.monotonic() - t_step
+        t_step = time.monotonic()
+        cached, raw_si = None, []
+        if device_cache is not None and device_cache.warm():
+            cached = device_cache.lookup(query_uart_sys_info(p), time.monotonic() - t_step)
+        if cached is not None:
+            sys_info, info_pos = cached
+        else:
+            sys_info = parse_uart_sys_info(p, stop_flag_callback, verbose=True, raw_si=raw_si)
+        step_times["sys_info"] = time.monotonic() - t_step
+        if sys_info == -1: 
+            if p.is_open:
+                p.close()
+            return -1
+        uwb_addr_short = sys_info.get("addr")[-4:]
+        # Link the individual Master/Slave with the serial ports by hashmap
+        serial_port_entry = {}
+        serial_port_entry["port"] = p
+        serial_port_entry["sys_info"] = sys_info
+        if "an" in sys_info["uwb_mode"]:
+            serial_port_entry["config"] = "slave"
+            serial_port_entry["info_pos"] = {}
+            if device_cache is not None and cached is None:
+                device_cache.store(raw_si[-1], sys_info, None, step_times["sys_info"])
+            # here we temporarily set slave end side unknown to its hosting vehicle.
+            # TODO: encode slave info position into its label let its hosting vehicle know its informative position.
+            # TODO: Maybe later we can close the ports linking to the Slave/Anchors if no needs.
+            # TODO: (03272021) Find a way around if slave serial ports cannot be opened (by discovery on 03272021).
+            # NOTE: (03282021) The way around: downgrade the slave fm to the OEM PANS firmware. Only keep the master's fw new.
+            # TODO: Add reverse compatibility to the rc.local if no display is connected.  
+            
+        elif "tn" in sys_info["uwb_mode"]: 
+            serial_port_entry["config"] = "master"
+            master_info_dict = info_pos if cached is not None else decode_info_pos_from_label(sys_info["label"])
+            if device_cache is not None and cached is None:
+                device_cache.store(raw_si[-1], sys_info, master_info_dict, time.monotonic() - t_step)
+            master_info_dict["master_id"] = uwb_addr_short
+            serial_port_entry["info_pos"] = master_info_dict
+            
+            if init_reporting:
+                t_step = time.monotonic()
+                if oem_firmware:
+                    if not is_reporting_loc(p):
+                        # Type "lec\n" to the dwm shell console to activate data reporting
+                        # TODO: try to determine if typing "lec\n" actually shuts off 
+                        write_shell_command(p, command=b'\x6C\x65\x63\x0D', delay=0.2)
+                else:
+                    # Write "aurs 1 1" to speed up data reporting into 0.1s/ea. (resume data reporting)
+                    write_shell_command(p, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D', delay=0.2)
+                step_times["init_reporting"] = time.monotonic() - t_step
+        else:
+            sys.stdout.write(timestamp_log() + " unknown master/slave configuration for {}!\n".format(uwb_addr_short))
+            raise serial.SerialException("Unexpected master/slave config. Check from Android APP.")
+    except BaseException as e:
+        if p.is_open:
+            p.close()
+        raise e
+    return uwb_addr_short, serial_port_entry
+
+
 def pairing_uwb_ports(  oem_firmware=False, 
                         init_reporting=True, 
                         serial_ports_dict=None, 
-                        stop_flag_callback=None):
-    serial_tty_devices = [p.device for p in serial.tools.list_ports.comports() 
-                            if p.manufacturer == 'SEGGER']
-    try:
-        serial_ports = {} if serial_ports_dict is None else serial_ports_dict
-        opened_ports = []
-        # Match the serial ports with the device list
-        for dev in serial_tty_devices:
-            try:
-                p = serial.Serial(dev, baudrate=115200, timeout=3.0)
-                opened_ports.append(p)
-            except BaseException as e:
-                sys.stdout.write(timestamp_log() + " Opening serial port {} failed. error: ".format(dev) + repr(e) + "\n")
-                raise e
-            serial_port_available_check_flock(p)
-            # Initialize the UART shell command
-            if serial_port_uart_init(p):
-                sys_info = parse_uart_sys_info(p, stop_flag_callback, verbose=True)
-                if sys_info == -1: 
-                    if p.is_open:
-                        p.close()
-                    return -1
-                uwb_addr_short = sys_info.get("addr")[-4:]
-                # Link the individual Master/Slave with the serial ports by hashmap
-                serial_ports[uwb_addr_short] = {}
-                serial_ports[uwb_addr_short]["port"] = p
-                serial_ports[uwb_addr_short]["sys_info"] = sys_info
-                if "an" in sys_info["uwb_mode"]:
-                    serial_ports[uwb_addr_short]["config"] = "slave"
-                    serial_ports[uwb_addr_short]["info_pos"] = {}
-                    # here we temporarily set slave end side unknown to its hosting vehicle.
-                    # TODO: encode slave info position into its label let its hosting vehicle know its informative position.
-                    # TODO: Maybe later we can close the ports linking to the Slave/Anchors if no needs.
-                    # TODO: (03272021) Find a way around if slave serial ports cannot be opened (by discovery on 03272021).
-                    # NOTE: (03282021) The way around: downgrade the slave fm to the OEM PANS firmware. Only keep the master's fw new.
-                    # TODO: Add reverse compatibility to the rc.local if no display is connected.  
-                    
-                elif "tn" in sys_info["uwb_mode"]: 
-                    serial_ports[uwb_addr_short]["config"] = "master"
-                    master_info_dict = decode_info_pos_from_label(sys_info["label"])
-                    master_info_dict["master_id"] = uwb_addr_short
-                    serial_ports[uwb_addr_short]["info_pos"] = master_info_dict
-                    
-                    if init_reporting:
-                        if oem_firmware:
-                            if not is_reporting_loc(p):
-                                # Type "lec\n" to the dwm shell console to activate data reporting
-                                # TODO: try to determine if typing "lec\n" actually shuts off 
-                                write_shell_command(p, command=b'\x6C\x65\x63\x0D', delay=0.2)
-                        else:
-                            # Write "aurs 1 1" to speed up data reporting into 0.1s/ea. (resume data reporting)
-                            write_shell_command(p, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D', delay=0.2)
-                else:
-                    sys.stdout.write(timestamp_log() + " unknown master/slave configuration for {}!\n".format(uwb_addr_short))
-                    raise serial.SerialException("Unexpected master/slave config. Check from Android APP.")
+                        stop_flag_callback=None,
+                        timeout=PAIRING_TIMEOUT,
+                        startup_report=None,
+                        serial_tty_devices=None,
+                        device_cache=None):
+    """ Pair all the UWB devices connected to the serial ports, one worker thread per port.
+        Workers stop when the user stops the init, when another port failed, or at the deadline.
+        Per-port and per-step durations are written into startup_report (if given).
+        device_cache: optional device_cache.DeviceInfoCache for warm starts, saved at the end.
 
-    except BaseException as e:
+        :returns:
+            1 if successful, -1 if stopped by the user, or the exception of the failure
+    """
+    t_start = time.monotonic()
+    deadline = None if timeout is None else t_start + timeout
+    if serial_tty_devices is None:
+        serial_tty_devices = sorted(list_uwb_devices())
+    serial_ports = {} if serial_ports_dict is None else serial_ports_dict
+    startup_report = {} if startup_report is None else startup_report
+    startup_report["ports"] = {dev: {"status": "pending", "steps": {}} for dev in serial_tty_devices}
+    results_lock = threading.Lock()
+    failures = []
+    aborted = threading.Event()
+
+    def worker_stop_flag():
+        if aborted.is_set():
+            return True
+        if stop_flag_callback is not None and stop_flag_callback() == True:
+            return True
+        return deadline is not None and time.monotonic() > deadline
+
+    def pairing_worker(dev):
+        port_report = startup_report["ports"][dev]
+        t_port = time.monotonic()
+        try:
+            ret = pair_uwb_port(dev, oem_firmware, init_reporting, worker_stop_flag, port_report["steps"], device_cache)
+            if ret == -1:
+                port_report["status"] = "stopped"
+                return
+            uwb_addr_short, serial_port_entry = ret
+            port_report["addr"] = uwb_addr_short
+            port_report["config"] = serial_port_entry["config"]
+            with results_lock:
+                if aborted.is_set():
+                    # Too late: pairing_uwb_ports() has already returned
+                    serial_port_entry["port"].close()
+                    port_report["status"] = "aborted"
+                    return
+                serial_ports[uwb_addr_short] = serial_port_entry
+                port_report["status"] = "paired"
+        except BaseException as e:
+            port_report["status"] = "failed"
+            with results_lock:
+                failures.append(e)
+            aborted.set()
+        finally:
+            port_report["total"] = time.monotonic() - t_port
+
+    workers = [threading.Thread(target=pairing_worker, args=(dev,),
+                                name="UWB Serial Port Pairing Thread {}".format(dev),
+                                daemon=True) for dev in serial_tty_devices]
+    for t in workers:
+        t.start()
+    # Wait for all workers, but never past the deadline or the first failure.
+    # Workers still running afterwards see the abort flag and close their ports.
+    for t in workers:
+        while t.is_alive() and not aborted.is_set() and (deadline is None or time.monotonic() < deadline):
+            t.join(0.1)
+    with results_lock:
+        aborted.set()
+        for port_report in startup_report["ports"].values():
+            if port_report["status"] == "pending":
+                port_report["status"] = "unfinished"
+    startup_report["total"] = time.monotonic() - t_start
+    for dev, port_report in startup_report["ports"].items():
+        METRICS.inc("uwb_pairing_total", (("status", port_report["status"]),))
+        sys.stdout.write(timestamp_log() + "Serial port {} pairing {} in {:.2f} s ({})\n"
+                         .format(dev, port_report["status"], port_report.get("total", 0.0),
+                                 ", ".join("{}: {:.2f} s".format(k, v) for k, v in port_report["steps"].items())))
+    sys.stdout.write(timestamp_log() + "UWB ports pairing finished in {:.2f} s\n".format(startup_report["total"]))
+    if device_cache is not None:
+        startup_report["device_cache"] = device_cache.report()
+        sys.stdout.write(timestamp_log() + "UWB device cache: " + device_cache.describe() + "\n")
+        try:
+            device_cache.save()
+        except OSError as e:
+            sys.stdout.write(timestamp_log() + "UWB device cache not saved. error: " + repr(e) + "\n")
+
+    if failures:
+        sys.stdout.write(timestamp_log() + " paring uwb ports failed. returning exception to UI. error: " + repr(failures[0]) + "\n")
+        return failures[0]
+    if stop_flag_callback is not None and stop_flag_callback() == True:
+        return -1
+    if any(port_report["status"] != "paired" for port_report in startup_report["ports"].values()):
+        e = TimeoutError("UWB ports pairing did not finish within {} s".format(timeout))
         sys.stdout.write(timestamp_log() + " paring uwb ports failed. returning exception to UI. error: " + repr(e) + "\n")
         return e
     return 1
     
     
-def parse_uart_sys_info(serial_port, stop_flag_callback=None, verbose=False, attempt=5):
+def query_uart_sys_info(serial_port):
+    """ Single "si" query of a device whose shell is up and reporting paused (warm start, see
+        device_cache.py). No retry: an incomplete dump fails the validation of the cache.
+
+        :returns:
+            "si" dump
+    """
+    serial_port.reset_input_buffer()
+    # Write "si" to show system information of DWM1001
+    byte_si = write_shell_command(serial_port, command=b'\x73\x69\x0D', delay=0.2)
+    byte_si += serial_port.read(serial_port.in_waiting)
+    return str(byte_si, encoding="utf-8", errors="replace")
+
+
+def parse_uart_sys_info(serial_port, stop_flag_callback=None, verbose=False, attempt=5, raw_si=None):
     """ Get the system config information of the tag device through UART
+        The "si" dump parsed is appended to raw_si (if given).
 
         :returns:
             Dictionary of system information
@@ -248,14 +413,15 @@ def parse_uart_sys_info(serial_port, stop_flag_callback=None, verbose=False, att
             write_shell_command(serial_port, command=b'\x0D\x0D', delay=0.5)
             # Write "aurs 600 600" to slow down data reporting into 60s/ea.
             # "aurs 600 600\n"
-            write_shell_command(serial_port, command=b'\x61\x75\x72\x73\x20\x36\x30\x30\x20\x36\x30\x30\x0D', delay=0.2 * (1 + attempt_cnt/10)) 
+            byte_si = write_shell_command(serial_port, command=b'\x61\x75\x72\x73\x20\x36\x30\x30\x20\x36\x30\x30\x0D', delay=0.2 * (1 + attempt_cnt/10)) 
             # Write "si" to show system information of DWM1001
-            write_shell_command(serial_port, command=b'\x73\x69\x0D', delay=0.2 * (1 + attempt_cnt/10))
-            byte_si = serial_port.read(serial_port.in_waiting)
+            byte_si += write_shell_command(serial_port, command=b'\x73\x69\x0D', delay=0.2 * (1 + attempt_cnt/10))
+            byte_si += serial_port.read(serial_port.in_waiting)
             si = str(byte_si, encoding="utf-8")
             if "aurs" not in si:
                 sys.stdout.write(timestamp_log() + "Resetting reporting rate to 60s/ea. failed for port {}, preventing system info fetch. Retrying...\n".format(serial_port.name))
                 # It is critical to reopen the UART comports. Otherwise the data won't go through. 
+                METRICS.inc("uwb_serial_reopens_total", (("port", serial_port.name),))
                 serial_port.close()
                 time.sleep(0.5)
                 serial_port.open()
@@ -310,6 +476,8 @@ def parse_uart_sys_info(serial_port, stop_flag_callback=None, verbose=False, att
                 sys_info["lp"] = bool(int(re.search("(?<=\slp=)(.*)(?=\sstat_det=)", si).group(0)))
                 # Normal update rate, int
                 sys_info["upd_rate_norm"] = int(re.search("(?<=upd_rate_norm=)(.*)(?=\supd_rate_stat=)",si).group(0))
+            if raw_si is not None:
+                raw_si.append(si)
             return sys_info
         
         except BaseException as e:
@@ -324,7 +492,21 @@ def config_uart_settings(serial_port, settings):
     pass 
 
 
-def make_json_dict_oem(raw_string):
+def make_dist_report(raw_string, oem_firmware=False, on_fallback=None):
+    """ Parse the raw string reporting into a compact DIST report (dist_parser.py), the record of
+        make_json_dict_accel_en()/make_json_dict_oem() before its conversion into a dictionary
+        on_fallback: called when the report is parsed by the regular expression fallback (dist_parser.py)
+        :returns:
+            DistReport
+    """
+    try:
+        return parse_dist_report(raw_string, oem_firmware=oem_firmware, on_fallback=on_fallback)
+    except BaseException as e:
+        sys.stdout.write(timestamp_log() + "JSON dictionary parsing failed: raw string: {} \n".format(raw_string))
+        raise e
+
+
+def make_json_dict_oem(raw_string, on_fallback=None):
     """ Parse the raw string reporting to make JSON-style dictionary
         sample input:
         les\n: 022E[7.94,8.03,0.00]=3.38 9280[7.95,0.00,0.00]=5.49 DCAE[0.00,8.03,0.00]=7.73 5431[0.00,0.00,0.00]=9.01 le_us=3082 est[6.97,5.17,-1.77,53]
@@ -333,115 +515,26 @@ def make_json_dict_oem(raw_string):
         Notice: wrong-format (convoluted) UART reportings exist at high update rate. 
             e.g.(lec\n): 
             DIST,4,AN0,0090,0.00,0.00,0.00,3.25,AN1,D91E,0.00,0.00,0.00,3.33,AN2,0487,0.00,0.00,0.00,0.18,AN3,15BA,0.00,0,AN3,15BA,0.00,0.00,0.00,0.00
-            AN3 is reported in a wrong format. Use regular expression to avoid discarding the entire reporting.
+            AN3 is reported in a wrong format. The parser skips it instead of discarding the entire reporting.
+        Accepts bytes straight from serial.readline() as well. See dist_parser.py.
+        on_fallback: called when the report is parsed by the regular expression fallback (dist_parser.py)
         :returns:
             Dictionary of parsed UWB reporting
     """
-    try:
-        data = {}
-        # ---------parse for anchors and individual readings---------
-        anc_match_iter = re.finditer(   "(?<=AN)(?P<anc_idx>[0-9]{1})[,]"
-                                        "(?P<anc_id>.{4})[,]"
-                                        "(?P<anc_x>[+-]?[0-9]*[.][0-9]{2})[,]"
-                                        "(?P<anc_y>[+-]?[0-9]*[.][0-9]{2})[,]"
-                                        "(?P<anc_z>[+-]?[0-9]*[.][0-9]{2})[,]"
-                                        "(?P<dist_to>[+-]?[0-9]*[.][0-9]{2})", raw_string)
-        all_anc_id = []
-        num_anc = 0
-        for regex_match in anc_match_iter:
-            anc_id = regex_match.group("anc_id")
-            all_anc_id.append(anc_id)
-            data[anc_id] = {}
-            data[anc_id]['anc_id'] = anc_id
-            data[anc_id]['x'] = float(regex_match.group("anc_x"))
-            data[anc_id]['y'] = float(regex_match.group("anc_y"))
-            data[anc_id]['z'] = float(regex_match.group("anc_z"))
-            data[anc_id]['dist_to'] = float(regex_match.group("dist_to"))
-            num_anc += 1
-        data['anc_num'] = num_anc
-        data['all_anc_id'] = all_anc_id
-        # ---------if location is calculated, parse calculated location---------
-        pos_match = re.search("(?<=POS[,])"
-                                "(?P<pos_x>[-+]?[0-9]*[.][0-9]{2})[,]"
-                                "(?P<pos_y>[-+]?[0-9]*[.][0-9]{2})[,]"
-                                "(?P<pos_z>[-+]?[0-9]*[.][0-9]{2})[,]"
-                                "(?P<pos_qf>[0-9]*)", raw_string)
-        if pos_match:
-            data['est_pos'] = {}
-            data['est_pos']['x'] = float(pos_match.group("pos_x"))
-            data['est_pos']['y'] = float(pos_match.group("pos_y"))
-            data['est_pos']['z'] = float(pos_match.group("pos_z"))
-            data['est_pos_qf'] = int(pos_match.group("pos_qf"))
-    except BaseException as e:
-        sys.stdout.write(timestamp_log() + "JSON dictionary regex parsing failed: raw string: {} \n".format(raw_string))
-        raise e
-    return data
+    return make_dist_report(raw_string, oem_firmware=True, on_fallback=on_fallback).to_dict()
 
 
-def make_json_dict_accel_en(raw_string):
+def make_json_dict_accel_en(raw_string, on_fallback=None):
     """ Parse the raw string reporting to make JSON-style dictionary, with the dwm-accelerometer-enabled firmware (unit in mm, all integers)
         sample input:
         DIST,4;[AN0,C584,160,0,-1510]=[1176,100];[AN1,8287,-2700,0,1340]=[2801,100];[AN2,DA36,400,3250,790]=[2838,100];[AN3,9234,2910,-2984,550]=[3058,100];POS=[502,827,803,58];ACC=[-512,768,9449];UWBLOCALTIME,38439537;
-        Notice: wrong-format (convoluted) UART reportings may also exist at high update rate. Use regular expression to avoid discarding the entire reporting.
+        Notice: wrong-format (convoluted) UART reportings may also exist at high update rate. The parser skips them instead of discarding the entire reporting.
+        Accepts bytes straight from serial.readline() as well. See dist_parser.py.
+        on_fallback: called when the report is parsed by the regular expression fallback (dist_parser.py)
         :returns:
             Dictionary of parsed UWB reporting
     """
-    try:
-        data = {}
-        # ---------parse for anchors and individual readings---------
-        anc_match_iter = re.finditer(   "(?<=\[AN)(?P<anc_idx>[0-9]{1})[,]"
-                                        "(?P<anc_id>.{4})[,]"
-                                        "(?P<anc_x>[+-]?[0-9]*)[,]"
-                                        "(?P<anc_y>[+-]?[0-9]*)[,]"
-                                        "(?P<anc_z>[+-]?[0-9]*)(\]\=\[)"
-                                        "(?P<dist_to>[+-]?[0-9]*)[,]"
-                                        "(?P<anc_qf>[+-]?[0-9]*)(\]\;)", raw_string)
-        all_anc_id = []
-        num_anc = 0
-        for regex_match in anc_match_iter:
-            anc_id = regex_match.group("anc_id")
-            all_anc_id.append(anc_id)
-            data[anc_id] = {}
-            data[anc_id]['anc_id'] = anc_id
-            data[anc_id]['x'] = int(regex_match.group("anc_x"))
-            data[anc_id]['y'] = int(regex_match.group("anc_y"))
-            data[anc_id]['z'] = int(regex_match.group("anc_z"))
-            data[anc_id]['dist_to'] = int(regex_match.group("dist_to"))
-            data[anc_id]['anc_qf'] = int(regex_match.group("anc_qf"))
-            num_anc += 1
-        data['anc_num'] = num_anc
-        data['all_anc_id'] = all_anc_id
-        # ---------if location is calculated, parse calculated location---------
-        pos_match = re.search("(?<=POS=\[)"
-                              "(?P<pos_x>[-+]?[0-9]*)[,]"
-                              "(?P<pos_y>[-+]?[0-9]*)[,]"
-                              "(?P<pos_z>[-+]?[0-9]*)[,]"
-                              "(?P<pos_qf>[-+]?[0-9]*)(\]\;)", raw_string)
-        if pos_match:
-            data['est_pos'] = {}
-            data['est_pos']['x'] = int(pos_match.group("pos_x"))
-            data['est_pos']['y'] = int(pos_match.group("pos_y"))
-            data['est_pos']['z'] = int(pos_match.group("pos_z"))
-            data['est_pos_qf'] = int(pos_match.group("pos_qf"))
-            
-        acc_match = re.search("(?<=ACC=\[)"
-                              "(?P<acc_x>[-+]?[0-9]*)[,]"
-                              "(?P<acc_y>[-+]?[0-9]*)[,]"
-                              "(?P<acc_z>[-+]?[0-9]*)(\]\;)", raw_string)
-        if acc_match:
-            data['acc'] = {}
-            data['acc']['x'] = int(acc_match.group("acc_x"))
-            data['acc']['y'] = int(acc_match.group("acc_y"))
-            data['acc']['z'] = int(acc_match.group("acc_z"))
-        
-        timestamp_match = re.search("(?<=UWBLOCALTIME)[,](?P<timestamp>[-+]?[0-9]*)[;]", raw_string)
-        if timestamp_match:
-            data['timestamp'] = int(timestamp_match.group("timestamp"))
-            
-    except BaseException as e:
-        sys.stdout.write(timestamp_log() + "JSON dictionary regex parsing failed: raw string: {} \n".format(raw_string))
-        raise e
-    return data
+    return make_dist_report(raw_string, oem_firmware=False, on_fallback=on_fallback).to_dict()
 
 
 def process_async_raw_ranging_results(  a_data_point, 
@@ -452,168 +545,8 @@ def process_async_raw_ranging_results(  a_data_point,
     # Check time stamps first. 
     # if the same vehicle slaves were detected (2 slaves), input argument ranging_results_foreign_slaves_same_side could contain
     # at most 2 slaves. (max 4 slaves could be detected due to firmware restrictions.)
-    slave_res_by_vehicles_a_side = defaultdict(list)
-    slave_res_by_vehicles_b_side = defaultdict(list)
-    [uwb_reporting_dict_a, ranging_results_foreign_slaves_from_a_master] = a_data_point
-    [uwb_reporting_dict_b, ranging_results_foreign_slaves_from_b_master] = b_data_point
-    # parse the slaves in distance-increasing order, for a side
-    for ranging_dict in ranging_results_foreign_slaves_from_a_master:
-        assoc_id = ranging_dict["id_assoc"]
-        slave_res_by_vehicles_a_side[assoc_id].append(ranging_dict)
-    # parse the slaves in distance-increasing order, for b side
-    for ranging_dict in ranging_results_foreign_slaves_from_b_master:
-        assoc_id = ranging_dict["id_assoc"]
-        slave_res_by_vehicles_b_side[assoc_id].append(ranging_dict)
-    ret_a, ret_b = [], []
-    for (veh, slave_dicts) in slave_res_by_vehicles_a_side.items():
-        # ----------- A end ranging results -----------
-        vehicle_dict = {}
-        vehicle_dict["vehicle_id"] = veh
-        vehicle_dict["master_doing_ranging"] = master_info_dict_a
-        vehicle_dict["slaves_in_ranging"] = slave_dicts
-        vehicle_dict["near_side_code_local"] = determine_near_side_local(   veh,
-                                                                            ranging_results_foreign_slaves_from_a_master,
-                                                                            ranging_results_foreign_slaves_from_b_master,
-                                                                            master_info_dict_a,
-                                                                            master_info_dict_b,
-                                                                            allow_unknown=False)
-        vehicle_dict["near_side_code_foreign"] = determine_near_side_foreign(veh,
-                                                                             ranging_results_foreign_slaves_from_a_master,
-                                                                             ranging_results_foreign_slaves_from_b_master,
-                                                                             master_info_dict_a,
-                                                                             master_info_dict_b,
-                                                                             allow_unknown=False)
-        adjusted_dist = float('inf')
-        if vehicle_dict["near_side_code_local"] == 2: # close side of foreign vehicle is B (self.A v.s. others.B)
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] == 1: # self.A v.s. others.B.A_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_a["x_master"] - ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_a["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_a["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                elif ranging_res_dict["side_slave"] == 2: # self.A v.s. others.B.B_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_a["x_master"] + ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_a["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_a["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                else:
-                    raise BaseException("A side: Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        elif vehicle_dict["near_side_code_local"] == 1: # close side of foreign vehicle is A (self.A v.s. others.A)
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] == 2: # self.A v.s. others.A.B_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_a["x_master"] - ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_a["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_a["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                elif ranging_res_dict["side_slave"] == 1: # self.A v.s. others.A.A_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_a["x_master"] + ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_a["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_a["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                else:
-                    raise BaseException("A side: Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        ret_a.append(vehicle_dict)
-
-    for (veh, slave_dicts) in slave_res_by_vehicles_b_side.items():
-        vehicle_dict = {}
-        vehicle_dict["vehicle_id"] = veh
-        vehicle_dict["master_doing_ranging"] = master_info_dict_b
-        vehicle_dict["slaves_in_ranging"] = slave_dicts
-        vehicle_dict["near_side_code_local"] = determine_near_side_local(   veh,
-                                                                            ranging_results_foreign_slaves_from_b_master,
-                                                                            ranging_results_foreign_slaves_from_a_master,
-                                                                            master_info_dict_b,
-                                                                            master_info_dict_a,
-                                                                            allow_unknown=False)
-        vehicle_dict["near_side_code_foreign"] = determine_near_side_foreign(veh,
-                                                                             ranging_results_foreign_slaves_from_b_master,
-                                                                             ranging_results_foreign_slaves_from_a_master,
-                                                                             master_info_dict_b,
-                                                                             master_info_dict_a,
-                                                                             allow_unknown=False)
-        adjusted_dist = float('inf')
-        if vehicle_dict["near_side_code_local"] == 1: # close side of foreign vehicle is A (self.B v.s. others.A)
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] == 1: # self.B v.s. others.A.A_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_b["x_master"] + ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_b["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_b["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                elif ranging_res_dict["side_slave"] == 2: # self.B v.s. others.A.B_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_b["x_master"] - ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_b["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_b["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                else:
-                    raise BaseException("B side: Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        elif vehicle_dict["near_side_code_local"] == 2: # close side of foreign vehicle is B (self.B v.s. others.B)
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] == 2: # self.B v.s. others.B.B_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_b["x_master"] - ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_b["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_b["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                elif ranging_res_dict["side_slave"] == 1: # self.B v.s. others.B.A_slave
-                    if ranging_res_dict["id_assoc"] != vehicle_dict["vehicle_id"]:
-                        continue
-                    x_diff =   master_info_dict_b["x_master"] + ranging_res_dict['x_slave']
-                    y_diff =   master_info_dict_b["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_b["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        side_to_side_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        side_to_side_dist = float("nan")
-                    adjusted_dist = min(side_to_side_dist, adjusted_dist)
-                else:
-                    raise BaseException("B side: Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        ret_b.append(vehicle_dict)
-    return ret_a, ret_b
+    # The adjusted distances of all slaves are computed by the sign-table driven geometry engine (geometry_engine.py).
+    return process_async_geometry(a_data_point, b_data_point, master_info_dict_a, master_info_dict_b)
 
 
 def process_sycned_raw_ranging_results( ranging_results_foreign_slaves_same_side,
@@ -623,86 +556,12 @@ def process_sycned_raw_ranging_results( ranging_results_foreign_slaves_same_side
     # slaves on the same vehicle of the master has been already filtered-out. Sorted by UWB ranging distances.
     # if the same vehicle slaves were detected (2 slaves), input argument ranging_results_foreign_slaves_same_side could contain
     # at most 2 slaves. (max 4 slaves could be detected due to firmware restrictions.)
-    slave_res_by_vehicles = defaultdict(list)
-    
-    # parse the slaves in distance-increasing order
-    for ranging_dict in ranging_results_foreign_slaves_same_side:
-        assoc_id = ranging_dict["id_assoc"]
-        slave_res_by_vehicles[assoc_id].append(ranging_dict)
-    ret = []
-    for (veh, slave_dicts) in slave_res_by_vehicles.items():
-        vehicle_dict = {}
-        vehicle_dict["vehicle_id"] = veh
-        vehicle_dict["master_doing_ranging"] = master_info_dict_same_side
-        vehicle_dict["near_side_code_foreign"] = determine_near_side_foreign(veh,
-                                                                             ranging_results_foreign_slaves_same_side,
-                                                                             ranging_results_foreign_slaves_opposite_side,
-                                                                             master_info_dict_same_side,
-                                                                             master_info_dict_opposite_side,
-                                                                             allow_unknown=False)
-        vehicle_dict["near_side_code_local"] = determine_near_side_local(veh,
-                                                                         ranging_results_foreign_slaves_same_side,
-                                                                         ranging_results_foreign_slaves_opposite_side,
-                                                                         master_info_dict_same_side,
-                                                                         master_info_dict_opposite_side,
-                                                                         allow_unknown=False)
-        vehicle_dict["slaves_in_ranging"] = slave_dicts
-        if master_info_dict_same_side["side_master"] != vehicle_dict["near_side_code_local"]:
-            # if the current master is not on the side near the current vehicle.
-            # TODO: this value may still be useful for other use cases. e.g. determination of relative
-            # positions when multiple tracks are involved (2-D dimensions).
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] != vehicle_dict["near_side_code_foreign"]:
-                    # process the far side of the foreign vehicle (non-safety critical).
-                    x_diff =   master_info_dict_same_side["x_master"] + ranging_res_dict['x_slave']
-                    y_diff = - master_info_dict_same_side["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_same_side["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        adjusted_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) + x_diff)
-                    except ValueError:
-                        adjusted_dist = float("nan")
-                elif ranging_res_dict["side_slave"] == vehicle_dict["near_side_code_foreign"]:
-                    # process the near side of the foreign vehicle (non safety critical).
-                    x_diff =   master_info_dict_same_side["x_master"] - ranging_res_dict['x_slave']
-                    y_diff = - master_info_dict_same_side["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_same_side["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        adjusted_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) + x_diff)
-                    except ValueError:
-                        adjusted_dist = float("nan")
-                else:
-                    raise BaseException("Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        elif master_info_dict_same_side["side_master"] == vehicle_dict["near_side_code_local"]:
-            # if the current master is exactly the side near the current vehicle.
-            # TODO: this value may still be useful for other use cases. e.g. determination of relative
-            # positions when multiple tracks are involved (2-D dimensions).
-            for ranging_res_dict in slave_dicts: 
-                if ranging_res_dict["side_slave"] != vehicle_dict["near_side_code_foreign"]:
-                    # process the far side of the foreign vehicle (non-safety critical).
-                    x_diff =   master_info_dict_same_side["x_master"] - ranging_res_dict['x_slave']
-                    y_diff = - master_info_dict_same_side["y_master"] + ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_same_side["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        adjusted_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        adjusted_dist = float("nan")
-                elif ranging_res_dict["side_slave"] == vehicle_dict["near_side_code_foreign"]:
-                    # process the near side of the foreign vehicle (safety critical!).
-                    x_diff =   master_info_dict_same_side["x_master"] + ranging_res_dict['x_slave']
-                    y_diff = - master_info_dict_same_side["y_master"] - ranging_res_dict['y_slave']
-                    z_diff =   master_info_dict_same_side["z_master"] - ranging_res_dict['z_slave']
-                    try:
-                        adjusted_dist = int(math.sqrt(ranging_res_dict["dist_to"]**2 - z_diff**2 - y_diff**2) - x_diff)
-                    except ValueError:
-                        adjusted_dist = float("nan")
-                else:
-                    raise BaseException("Undetermined side of the foreign vehicle slave unit.")
-                ranging_res_dict["adjusted_dist"] = adjusted_dist
-        else:
-            raise BaseException("Undetermined side of the local vehicle master unit.")
-        ret.append(vehicle_dict)
-    return ret
+    # TODO: the far side results may still be useful for other use cases. e.g. determination of relative
+    # positions when multiple tracks are involved (2-D dimensions).
+    return process_synced_geometry(ranging_results_foreign_slaves_same_side,
+                                   ranging_results_foreign_slaves_opposite_side,
+                                   master_info_dict_same_side,
+                                   master_info_dict_opposite_side)
 
 
 def determine_near_side_foreign(vehicle,
@@ -768,41 +627,48 @@ def decode_info_pos_from_label(label_string):
     return ret
 
 
+def encode_info_pos_to_label(info_pos):
+    """ Encode the informative position of a master (mm) into its label. Inverse of
+        decode_info_pos_from_label(), used to emulate masters (dwm_emulator.py).
+
+        :returns:
+            label string
+    """
+    info_pos_bytes = bytearray()
+    info_pos_bytes.extend(int(round(info_pos["x_master"] / 10)).to_bytes(2, 'little', signed=True))
+    info_pos_bytes.extend(int(round(info_pos["y_master"] / 10)).to_bytes(2, 'little', signed=True))
+    info_pos_bytes.extend(int(round(info_pos["z_master"] / 10)).to_bytes(2, 'little', signed=False))
+    info_pos_bytes.extend(bytes([info_pos["id_assoc"], info_pos["side_master"]]))
+    info_pos_bytes.extend(int(round(info_pos["vehicle_length_master"] / 10)).to_bytes(2, 'little', signed=False))
+    # Padded to 12 bytes, as the labels written by the Android application
+    info_pos_bytes.extend(bytes(2))
+    return str(base64.b64encode(bytes(info_pos_bytes)), encoding="ascii")
+
+
 def decode_slave_info_position(ranging_json_dict):
     # decode the slave informative position from ranging dictionary, generated by 
     # make_json_dict_accel_en().
     # Note: only results generated with make_json_dict_accel_en() with matching UWB
     # firmware will yield the expected results. Acceleration values will be compromised otherwise.
     # End side information is encoded with a Modulo-3 method in the integer of Z field (TOR). Z (TOR) field is unsigned.
+    # See slave_info_codec.py for the byte layout and the NumPy batch decoder for offline reprocessing.
     slave_info_dict = {}
     slave_info_dict["all_anc_id"] = ranging_json_dict.get("all_anc_id", [])
     for anc in ranging_json_dict.get("all_anc_id", []):
         slave_reporting_raw = ranging_json_dict.get(anc, {})
-        slave_x_regular_pos = slave_reporting_raw.get('x', int(0))
-        slave_y_regular_pos = slave_reporting_raw.get('y', int(0))
-        slave_z_regular_pos = slave_reporting_raw.get('z', int(0))
-        slave_qf_regular_pos = slave_reporting_raw.get('anc_qf', int(0))
-        slave_dist_to = slave_reporting_raw.get('dist_to', int(0))
-        recover_bytes = bytearray()
-        recover_bytes.extend(slave_x_regular_pos.to_bytes(4, "little", signed=True))
-        recover_bytes.extend(slave_y_regular_pos.to_bytes(4, "little", signed=True))
-        recover_bytes.extend(slave_z_regular_pos.to_bytes(4, "little", signed=True))
-        recover_bytes.extend(slave_qf_regular_pos.to_bytes(1, "little", signed=False))
-        x_slave = int.from_bytes(bytearray([recover_bytes[2], recover_bytes[3]]), 'little', signed=True)
-        y_slave = int.from_bytes(bytearray([recover_bytes[6], recover_bytes[7]]), 'little', signed=True)
-        z_slave = int.from_bytes(bytearray([recover_bytes[10], recover_bytes[11]]), 'little', signed=False)
-        vehicle_length_slave = int.from_bytes(bytearray([recover_bytes[8], recover_bytes[9]]), 'little', signed=False)
-        id_slave = int.from_bytes(bytearray([recover_bytes[1]]), 'little', signed=False)
-        side_slave = z_slave % 3
-        slave_info_dict[anc] = {}
-        slave_info_dict[anc]['slave_id'] = anc
-        slave_info_dict[anc]['x_slave'] = x_slave * 10
-        slave_info_dict[anc]['y_slave'] = y_slave * 10
-        slave_info_dict[anc]['z_slave'] = z_slave * 10
-        slave_info_dict[anc]['vehicle_length_slave'] = vehicle_length_slave * 10
-        slave_info_dict[anc]['id_assoc'] = id_slave
-        slave_info_dict[anc]['side_slave'] = side_slave
-        slave_info_dict[anc]['dist_to'] = slave_reporting_raw.get('dist_to', int(0))
+        x_slave, y_slave, z_slave, vehicle_length_slave, id_slave, side_slave = decode_slave_info_fields(
+            slave_reporting_raw.get('x', int(0)),
+            slave_reporting_raw.get('y', int(0)),
+            slave_reporting_raw.get('z', int(0)),
+            slave_reporting_raw.get('anc_qf', int(0)))
+        slave_info_dict[anc] = {'slave_id': anc,
+                                'x_slave': x_slave,
+                                'y_slave': y_slave,
+                                'z_slave': z_slave,
+                                'vehicle_length_slave': vehicle_length_slave,
+                                'id_assoc': id_slave,
+                                'side_slave': side_slave,
+                                'dist_to': slave_reporting_raw.get('dist_to', int(0))}
     return slave_info_dict
 
 
@@ -824,7 +690,7 @@ def parse_distance(dist_in_mm, length_unit):
         return "UNKNOWN"
 
 
-def display_safety_ranging_results(processed_master_reporting_by_vehicles, length_unit="METRIC", debug=False):
+def display_safety_ranging_results(processed_master_reporting_by_vehicles, length_unit="METRIC", debug=False, use_predicted=False):
     # End Sample Reporting (processed and adjusted): 
     # [{'vehicle_id': 2, 'master_doing_ranging': {}, 'near_side_code_foreign': 2, 'near_side_code_local': 2, 'slaves_in_ranging': [{'slave_id': '0B1E', 'x_slave': 20, 'y_slave': -3190, 'z_slave': 740, 'vehicle_length_slave': 930, 'id_assoc': 2, 'side_slave': 2, 'dist_to': 3658, 'adjusted_dist': 1763}, {'slave_id': '459A', 'x_slave': 30, 'y_slave': 3370, 'z_slave': 790, 'vehicle_length_slave': 930, 'id_assoc': 2, 'side_slave': 1, 'dist_to': 4520, 'adjusted_dist': 3040}]}]
     # TODO: convert the raw data into either JSON format or CSV format
@@ -841,23 +707,29 @@ def display_safety_ranging_results(processed_master_reporting_by_vehicles, lengt
             vehicle_adjusted_dist_mm = [slave_dict["adjusted_dist"] for slave_dict in veh_dict["slaves_in_ranging"] 
                                             if slave_dict["side_slave"] == veh_dict["near_side_code_foreign"]]
             if len(vehicle_adjusted_dist_mm) > 0:
+                # use_predicted: distance predicted at display time by the vehicle tracker (vehicle_tracker.py)
+                display_dist_mm = vehicle_adjusted_dist_mm[0]
+                if use_predicted:
+                    display_dist_mm = veh_dict.get("predicted_dist", display_dist_mm)
                 return "{} side: Detected Vehicle {}: {}".format(   side_name_from_code(master_side_code),
                                                                     vehicle_id,
-                                                                    parse_distance(vehicle_adjusted_dist_mm[0], length_unit)), vehicle_adjusted_dist_mm[0]
+                                                                    parse_distance(display_dist_mm, length_unit)), display_dist_mm
             else:
                 return "{} side: No Vehicle Detected! ".format(side_name_from_code(master_side_code)), -2
         else:
             return "{} side: Detection Results N/A. Error".format(side_name_from_code(master_side_code)), -3
 
 
-def end_ranging_job_async_single(   serial_ports,
-                                    end_side_code,
-                                    data_ptr_queue_single_end,
-                                    log_fpath,
-                                    stop_flag_callback=None,
-                                    oem_firmware=False,
-                                    exp_name=""):
+def find_end_master(serial_ports, end_side_code, stop_flag_callback=None):
+    """ Wait until the master of the given end side is paired
+
+        :returns:
+            (master device id, master informative position), or ("", {}) if stopped
+    """
     while not serial_ports:
+        if stop_flag_callback is not None:
+            if stop_flag_callback() == True:
+                return "", {}
         time.sleep(0.1)
         continue
 
@@ -866,16 +738,19 @@ def end_ranging_job_async_single(   serial_ports,
     while master_dev_id == "":
         if stop_flag_callback is not None:
             if stop_flag_callback() == True:
-                return
+                return "", {}
         serial_ports_local_copy = serial_ports.copy()
         for dev in serial_ports_local_copy:
             if serial_ports_local_copy[dev]["info_pos"].get("side_master") == end_side_code:
                 master_dev_id = dev
                 master_info_pos = serial_ports_local_copy[dev]["info_pos"]
                 break
+    return master_dev_id, master_info_pos
 
-    data_pointer = [{}, []]
-    port_master = serial_ports[master_dev_id].get("port")
+
+def resume_master_reporting(port_master, oem_firmware=False):
+    """ Open the master serial port and make sure the master is reporting ranging data
+    """
     try:
         if not port_master.is_open:
             port_master.open()
@@ -889,67 +764,181 @@ def end_ranging_job_async_single(   serial_ports,
             # Write "aurs 1 1" to speed up data reporting into 0.1s/ea.
             write_shell_command(port_master, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D', delay=0.2)
 
-    super_frame = 0
-    end_name = "A" if end_side_code == 2 else "B" if end_side_code == 1 else "UNKNOWN"
-    port_master.reset_input_buffer()
-    sys.stdout.write(timestamp_log() + end_name + " end reporting thread started. See processed data entries in file: {}\n".format(exp_name+"-data-"+end_name+"-user-processed"+"_log.log"))
-    sys.stdout.write(timestamp_log() + end_name + " end reporting thread started. See raw data entries in file: {}\n".format(exp_name+"-data-"+end_name+"-raw"+"_log.log"))
-    
-    # Explicitly Notify the Time Reference from UTC
-    sys.stdout.write(timestamp_log(incl_UTC=True) + " === UTC TIME REFERENCE === \n")
-    with open(os.path.join(log_fpath, exp_name+"-data-"+end_name+"-user-processed"+"_log.log"), "a") as d_log:
-        d_log.write(timestamp_log(incl_UTC=True) + " === UTC TIME REFERENCE === \n")
-    with open(os.path.join(log_fpath, exp_name+"-data-"+end_name+"-raw"+"_log.log"), "a") as raw_log:
-        raw_log.write(timestamp_log(incl_UTC=True) + " === UTC TIME REFERENCE === \n")
+
+class EndReportingProcessor():
+
+    # Per-end processing of the reported UART lines of one master: parsing, slave decoding,
+    # foreign slave filtering, logging and hand-over to the consumer queue.
+    # Shared by the per-end reading threads and the serial multiplexer (serial_mux.py).
+    def __init__(self, serial_ports, end_side_code, master_info_pos, data_ptr_queue_single_end, log_fpath,
+                 oem_firmware=False,
+                 exp_name="",
+                 binary_log=True,
+                 compress_log=False):
+        self.serial_ports = serial_ports
+        self.end_side_code = end_side_code
+        self.end_name = "A" if end_side_code == 2 else "B" if end_side_code == 1 else "UNKNOWN"
+        self.master_info_pos = master_info_pos
+        # Shared by the frames of the end (frame_records.py)
+        self.master_info = MasterInfo.from_dict(master_info_pos)
+        self.data_ptr_queue_single_end = data_ptr_queue_single_end
+        self.oem_firmware = oem_firmware
+        self.super_frame = 0
+        # Counted by the calling (reading) thread (metrics_server.py)
+        self.metric_labels = (("end", self.end_name),)
+        # Frames are handed over to a background writer thread. Log files are kept open
+        # and never touched by the serial reading thread.
+        from log_writer import RangingLogWriter
+        self.log_writer = RangingLogWriter(log_fpath, exp_name, self.end_name, master_info_pos,
+                                           oem_firmware=oem_firmware, binary=binary_log, compress=compress_log)
+
+    def start(self):
+        for log_name in self.log_writer.log_names():
+            sys.stdout.write(timestamp_log() + self.end_name + " end reporting thread started. See data entries in file: {}\n".format(log_name))
+        # Explicitly Notify the Time Reference from UTC
+        sys.stdout.write(timestamp_log(incl_UTC=True) + " === UTC TIME REFERENCE === \n")
+        self.log_writer.start()
+
+    def stop(self, verbose=True):
+        self.log_writer.stop()
+        if verbose:
+            for log_name in self.log_writer.log_names():
+                sys.stdout.write(timestamp_log() + self.end_name + " end reporting thread stopped. See data entries in file: {}\n".format(log_name))
+
+    def process_line(self, data_raw, timestamp_dt=None, rx_ns=None):
+        """ Process one reported line (raw bytes, line ending stripped) of the master.
+            rx_ns: time.monotonic_ns() of the serial read of the line (pipeline_latency.py), now if None
+
+            :returns:
+                True if the line was a ranging report, False otherwise
+        """
+        if not data_raw[:4] == b"DIST":
+            return False
+        if rx_ns is None:
+            rx_ns = time.monotonic_ns()
+        try:
+            report = make_dist_report(data_raw, self.oem_firmware, self.count_regex_fallback)
+        except Exception:
+            METRICS.inc("uwb_parse_failures_total", self.metric_labels)
+            raise
+        self.process_report(report, data_raw, timestamp_dt, rx_ns)
+        return True
+
+    def count_regex_fallback(self):
+        METRICS.inc("uwb_regex_fallbacks_total", self.metric_labels)
+
+    def process_report(self, report, data_raw, timestamp_dt=None, rx_ns=None):
+        """ Process one parsed report (DistReport, or make_json_dict_accel_en() dictionary) of the master,
+            from the shell text reporting or from another report source (report_source.py).
+            rx_ns: time.monotonic_ns() of the serial read of the report, now if None
+        """
+        rx_monotonic_ns = time.monotonic_ns()
+        # Stage stamps [read, parsed, decoded, queued] of the latency instrumentation (pipeline_latency.py)
+        stage_stamps = [rx_monotonic_ns if rx_ns is None else rx_ns, rx_monotonic_ns, 0, 0]
+        # Logged local time in integer microseconds (mono_clock.py): no string per frame.
+        # timestamp_dt: local datetime overriding the serial read time (replays of logged frames)
+        local_us = CLOCK.local_us(stage_stamps[0]) if timestamp_dt is None else datetime_to_local_us(timestamp_dt)
+        report = as_dist_report(report, self.oem_firmware)
+        slave_readings = decode_slave_readings(report)
+        ranging_results_foreign_slaves_from_master = []
+        foreign_indices = []
+        for idx, anc in enumerate(report.anchors):
+            if not self.serial_ports.get(anc.anc_id):
+                # If the anchor/slave id is not recognized, it is from foreign vehicle (filter out local slaves). 
+                ranging_results_foreign_slaves_from_master.append(slave_readings[anc.anc_id])
+                foreign_indices.append(idx)
+        stage_stamps[2] = time.monotonic_ns()
+        # Numeric reception time to align the A/B ends; not written to the logs
+        frame = Frame(report, self.super_frame, self.master_info, rx_monotonic_ns, stage_stamps)
+        # The writer thread only reads the parsed report; the decoded slaves are logged by index
+        self.log_writer.put_frame(local_us, self.super_frame, frame, foreign_indices, data_raw)
+        # Sort by proximity - nearest slave first
+        ranging_results_foreign_slaves_from_master.sort(key=slave_distance)
+        # We DO NOT process the raw ranging slave results. Instead, we report them async, incl. timestamp
+        # and have the external process/thread to process the slave results (because being async)
+        # A new data point per frame: frames handed over earlier must not change under the consumer
+        data_pointer = [frame, ranging_results_foreign_slaves_from_master]
+        self.super_frame += 1
+        # Stamped before the hand-over: the stamps do not change under the consumer
+        stage_stamps[3] = time.monotonic_ns()
+        PIPELINE_LATENCY.record_frame(self.end_name, stage_stamps)
+        METRICS.inc("uwb_frames_total", self.metric_labels)
+        self.data_ptr_queue_single_end.put(data_pointer)
+
+
+def slave_distance(slave_reading):
+    return slave_reading.dist_to
+
+
+def end_ranging_job_async_single(   serial_ports,
+                                    end_side_code,
+                                    data_ptr_queue_single_end,
+                                    log_fpath,
+                                    stop_flag_callback=None,
+                                    oem_firmware=False,
+                                    exp_name="",
+                                    binary_log=True,
+                                    compress_log=False,
+                                    report_source="shell",
+                                    recorder=None,
+                                    supervisor=None):
+    # supervisor: optional port_supervisor.PortSupervisor (started) pairing the port of the master
+    # again on serial errors; the end waits for it instead of stopping
+    master_dev_id, master_info_pos = find_end_master(serial_ports, end_side_code, stop_flag_callback)
+    if master_dev_id == "":
+        return
+
+    port_master = serial_ports[master_dev_id].get("port")
+    if recorder is not None:
+        # Capture the serial traffic of the master (session_replay.SessionRecorder)
+        port_master = recorder.wrap(master_dev_id, serial_ports)
+    # "shell": DIST text lines of the shell mode reporting; "tlv": dwm_loc_get polling of the TLV UART API
+    from report_source import make_report_source
+    source = make_report_source(report_source, port_master, oem_firmware)
+    source.start()
+    # Update rate changes of the adaptive rate controller go through a polled source (rate_controller.py)
+    serial_ports[master_dev_id]["report_source"] = source
+
+    processor = EndReportingProcessor(serial_ports, end_side_code, master_info_pos, data_ptr_queue_single_end, log_fpath,
+                                      oem_firmware=oem_firmware, exp_name=exp_name,
+                                      binary_log=binary_log, compress_log=compress_log)
+    end_name = processor.end_name
+    processor.start()
 
     while True:
         if stop_flag_callback is not None:
             if stop_flag_callback() == True:
-                sys.stdout.write(timestamp_log() + end_name + " end reporting thread stopped. See processed data entries in file: {}\n".format(exp_name+"-data-"+end_name+"-user-processed"+"_log.log"))
-                sys.stdout.write(timestamp_log() + end_name + " end reporting thread stopped. See raw data entries in file: {}\n".format(exp_name+"-data-"+end_name+"-raw"+"_log.log"))
+                processor.stop()
                 return
         try:
             try:
-                data_raw = str(port_master.readline(), encoding="UTF-8").rstrip()
+                report, data_raw = source.read_frame()
+                rx_ns = getattr(source, "rx_ns", None)
             except (AttributeError, serial.serialutil.SerialException) as e:
                 # When exiting (on_exit/on_killed), the port is closed before 
                 # the readline() is called. Therefore the loop would then go 
                 # through one unstable iteration before completing. Ignoring this. 
-                pass
-            timestamp = timestamp_log()
-            if not data_raw[:4] == "DIST":
-                continue
-            if oem_firmware:
-                uwb_reporting_dict = make_json_dict_oem(data_raw)
-            else:
-                uwb_reporting_dict = make_json_dict_accel_en(data_raw)
-            slave_reporting_dict = decode_slave_info_position(uwb_reporting_dict)
-            uwb_reporting_dict['superFrameNumber'] = super_frame
-            uwb_reporting_dict['timeStamp'] = timestamp
-            uwb_reporting_dict['masterInfoPos'] = master_info_pos
-            ranging_results_foreign_slaves_from_master = []
-            for anc in uwb_reporting_dict.get("all_anc_id", []):
-                if not serial_ports.get(anc):
-                    # If the anchor/slave id is not recognized, it is from foreign vehicle (filter out local slaves). 
-                    ranging_results_foreign_slaves_from_master.append(slave_reporting_dict.get(anc, {}))
-            # Sort by proximity - nearest slave first
-            ranging_results_foreign_slaves_from_master.sort(key=lambda x: x.get("dist_to", float("inf")))
-            data_pointer[0] = uwb_reporting_dict
-            # We DO NOT process the raw ranging slave results. Instead, we report them async, incl. timestamp
-            # and have the external process/thread to process the slave results (because being async)
-            data_pointer[1] = ranging_results_foreign_slaves_from_master
-            super_frame += 1
-            data_ptr_queue_single_end.put(data_pointer)
-
-            # wait for new UWB reporting results
-            with open(os.path.join(log_fpath, exp_name+"-data-"+end_name+"-user-processed"+"_log.log"), "a") as d_log:
-                d_log.write(timestamp + end_name + " end reporting uwb data: " + repr(data_pointer[0]) + "\n")
-                d_log.write(timestamp + end_name + " end reporting decoded foreign slaves: " + repr(data_pointer[1]) + "\n")
-            
-            with open(os.path.join(log_fpath, exp_name+"-data-"+end_name+"-raw"+"_log.log"), "a") as raw_log:
-                raw_log.write(timestamp + end_name + " end reporting raw data: " + data_raw + "\n")
+                report, data_raw = None, b""
+                METRICS.inc("uwb_serial_errors_total", processor.metric_labels)
+                if supervisor is not None and not (stop_flag_callback is not None and stop_flag_callback() == True):
+                    # The processor (and its logs) keeps running while the port is paired again
+                    supervisor.port_failed(master_dev_id, e)
+                    entry = supervisor.wait_recovered(master_dev_id, stop_flag_callback)
+                    if entry is None:
+                        processor.stop()
+                        return
+                    port_master = entry.get("port")
+                    if recorder is not None:
+                        port_master = recorder.wrap(master_dev_id, serial_ports)
+                    source = make_report_source(report_source, port_master, oem_firmware)
+                    source.start()
+                    serial_ports[master_dev_id]["report_source"] = source
+            if report is not None:
+                processor.process_report(report, data_raw, None, rx_ns)
             
         except Exception as exp:
+            METRICS.inc("uwb_reporting_failures_total", processor.metric_labels)
+            processor.stop(verbose=False)
             timestamp = timestamp_log()
             data_raw = str(port_master.readline(), encoding="UTF-8").rstrip()
             sys.stdout.write(timestamp + end_name + " end reporting thread failed. Last fetched UART data: {}. Thread: {}\n"
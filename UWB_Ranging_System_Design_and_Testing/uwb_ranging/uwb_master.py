@@ -2,9 +2,23 @@
 
 import os, sys
 
-import threading, queue
+import threading, queue, argparse
 
 from utils import *
+from serial_mux import end_ranging_job_multiplexed
+from multiproc_ranging import end_ranging_job_multiprocess
+from end_fusion import make_pair_source, FUSION_TOLERANCE
+from headless_service import HeadlessRangingService, make_sink
+from vehicle_tracker import VehicleTracker
+from ttc_estimator import TtcMonitor
+from session_replay import SessionRecorder, ReplayClock, load_replay_source
+from pipeline_latency import PIPELINE_LATENCY, SUMMARY_PERIOD
+from metrics_server import METRICS, METRICS_PORT, start_metrics_server
+from clock_sync import SYNC_HOST, SYNC_PORT, start_clock_sync
+from port_supervisor import PortSupervisor
+from rate_controller import AdaptiveRateController
+from report_source import REPORT_SOURCES
+from device_cache import DeviceInfoCache, DEVICE_CACHE_FILE
 from ranging_gui import RangingGUI
 
 from tkinter import *
@@ -58,6 +72,73 @@ def config_uart_settings(serial_port, settings):
 
 def main():
     dirname = os.path.dirname(__file__)    
+    parser = argparse.ArgumentParser(description="UWB ranging unit (GUI, or headless service without a display)")
+    parser.add_argument("--sink", action="append", dest="sinks",
+                        help="headless output sink, repeatable: stdout (default), unix:<path>, udp:<host>:<port>, mqtt://<host>[:<port>]/<topic>")
+    parser.add_argument("--fusion-tolerance", type=float, default=FUSION_TOLERANCE,
+                        help="headless: max A/B frame skew in seconds to pair and align the ends, 0: latest frames unaligned (default: %(default)s)")
+    parser.add_argument("--record", help="capture the serial traffic of the masters into a session capture file (session_replay.py)")
+    parser.add_argument("--replay", nargs="+",
+                        help="replay a session capture file, or -raw_log.log text logs, instead of the UWB devices")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="replay speed factor, 0: as fast as possible (default: %(default)s)")
+    parser.add_argument("--tty", action="append", dest="tty_devices",
+                        help="serial tty device of a UWB device to pair, repeatable, e.g. emulated boards of dwm_emulator.py "
+                             "(default: all SEGGER devices)")
+    parser.add_argument("--latency-summary", type=float, default=SUMMARY_PERIOD,
+                        help="seconds between two pipeline latency summary lines in the log, 0: none; "
+                             "SIGUSR1 dumps the full table (default: %(default)s)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="local HTTP port of the Prometheus metrics endpoint http://127.0.0.1:<port>/metrics, "
+                             "0: none (default: %(default)s)")
+    parser.add_argument("--sync-peer", action="append", dest="sync_peers",
+                        help="computer of another vehicle to estimate the clock offset/drift with, repeatable: host[:port] "
+                             "(logged into <exp_name>-clock_sync.csv)")
+    parser.add_argument("--sync-port", type=int,
+                        help="UDP port answering the clock sync requests of the other vehicles, 0: none "
+                             "(default: {} with --sync-peer, none otherwise)".format(SYNC_PORT))
+    parser.add_argument("--sync-host", default=SYNC_HOST,
+                        help="address of the interface of the clock sync, e.g. the one on the network of the vehicles "
+                             "(default: %(default)s, all interfaces)")
+    parser.add_argument("--no-hotplug", action="store_true",
+                        help="do not pair the lost UWB ports again during a session (port_supervisor.py): "
+                             "a failed master stops its end")
+    parser.add_argument("--no-device-cache", action="store_true",
+                        help="interrogate the shell of every UWB device at pairing, without the device info cache "
+                             "of the warm starts (device_cache.py)")
+    parser.add_argument("--refresh-device-cache", action="store_true",
+                        help="interrogate the shell of every UWB device at pairing and rewrite the device info cache")
+    parser.add_argument("--processes", action="store_true",
+                        help="read each master in its own process, frames handed over through shared memory rings "
+                             "(multiproc_ranging.py); without --record, --replay and the hot-plug supervisor")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="keep the masters at 10 Hz (aurs 1 1) instead of adapting their update rate to the "
+                             "vehicles around (rate_controller.py); always fixed with --processes")
+    parser.add_argument("--report-source", choices=sorted(REPORT_SOURCES), default="shell",
+                        help="ranging reports of the masters: shell DIST lines, or dwm_loc_get polls of the TLV UART "
+                             "API at the update rate of the masters (report_source.py) (default: %(default)s)")
+    args = parser.parse_args()
+    if args.processes and (args.record or args.replay):
+        parser.error("--processes cannot record nor replay sessions")
+    if (args.record or args.replay) and args.report_source != "shell":
+        parser.error("--record and --replay capture and replay the shell reporting only")
+    # Stage latencies of the ranging pipeline (pipeline_latency.py)
+    PIPELINE_LATENCY.start_summary(args.latency_summary)
+    PIPELINE_LATENCY.install_dump_signal()
+    start_metrics_server(args.metrics_port)
+    # Clock offset/drift between the vehicle computers (clock_sync.py)
+    clock_sync = start_clock_sync(args.sync_port, args.sync_peers, args.sync_host)
+    if clock_sync is not None:
+        METRICS.set_collector("clock_sync", clock_sync.metric_samples)
+    recorder = SessionRecorder(args.record) if args.record else None
+    # Device information of the boards of the last runs (device_cache.py)
+    device_cache = None
+    if not args.no_device_cache:
+        device_cache = DeviceInfoCache(os.path.join(USERDIR, USERNAME, "uwb_ranging", DEVICE_CACHE_FILE),
+                                       refresh=args.refresh_device_cache)
+    replay_ports = None
+    if args.replay:
+        replay_ports = load_replay_source(args.replay).serial_ports(ReplayClock(args.replay_speed))
     try:
         # ----------- Init GUI display if there is a screen ----------- 
         # ---- UI interactions are available to control ranging within GUI ----
@@ -66,36 +147,80 @@ def main():
         gui = RangingGUI(root=gui_root, parent=gui_root)
         gui.set_user_dir(USERDIR)
         gui.set_user_name(USERNAME)
+        gui.session_recorder = recorder
+        gui.clock_sync = clock_sync
+        gui.uwb_tty_devices = args.tty_devices
+        gui.port_supervision = not args.no_hotplug and replay_ports is None and not args.processes
+        gui.multiprocess = args.processes
+        gui.adaptive_rate = not args.fixed_rate and not args.processes
+        gui.report_source = args.report_source
+        gui.device_cache = device_cache
+        if replay_ports is not None:
+            # All devices "paired": the GUI does not look for UWB devices
+            gui.uwb_serial_ports.update(replay_ports)
         gui.root.mainloop()
         gui.root.update()
     except TclError as e:
         # ---- there is no peripheral display to support GUI -----
         # ---- Run ranging automatically at background -----
         serial_ports = {}
-        pairing_uwb_ports(init_reporting=True, serial_ports_dict=serial_ports)
+        if replay_ports is not None:
+            serial_ports, ret = replay_ports, 1
+        else:
+            ret = pairing_uwb_ports(init_reporting=True, serial_ports_dict=serial_ports, serial_tty_devices=args.tty_devices,
+                                    device_cache=device_cache)
+        if ret != 1:
+            # Exit: ranging_service.sh starts the program again
+            for entry in serial_ports.values():
+                entry["port"].close()
+            sys.exit(1)
         A_END_CODE, B_END_CODE = 2, 1
-        q_a_end, q_b_end = queue.LifoQueue(), queue.LifoQueue()
-        a_end_ranging_thread = threading.Thread(target=end_ranging_job_async_single,
-                                                kwargs={"serial_ports": serial_ports, 
-                                                        "end_side_code": A_END_CODE,
-                                                        "data_ptr_queue_single_end": q_a_end,
-                                                        "log_fpath": os.path.join(USERDIR, USERNAME, "uwb_ranging"),
-                                                        "exp_name": timestamp_log(shorten=True)},
-                                                name="A End Reporting Thread Async",
-                                                daemon=True)
-        b_end_ranging_thread = threading.Thread(target=end_ranging_job_async_single,
-                                                kwargs={"serial_ports": serial_ports, 
-                                                        "end_side_code": B_END_CODE,
-                                                        "data_ptr_queue_single_end": q_b_end,
-                                                        "log_fpath": os.path.join(USERDIR, USERNAME, "uwb_ranging"),
-                                                        "exp_name": timestamp_log(shorten=True)},
-                                                name="B End Reporting Thread Async",
-                                                daemon=True)
-        a_end_ranging_thread.start()
-        b_end_ranging_thread.start()
-        
-        while True:
-            pass
+        # The pair source wakes up the service on new A/B pairs
+        notify = threading.Event()
+        pair_source = make_pair_source(args.fusion_tolerance, notify)
+        METRICS.set_collector("pair_source", pair_source.metric_samples)
+        sinks = [make_sink(spec) for spec in (args.sinks or ["stdout"])]
+        log_fpath, exp_name = os.path.join(USERDIR, USERNAME, "uwb_ranging"), timestamp_log(shorten=True)
+        if clock_sync is not None:
+            clock_sync.open_session(log_fpath, exp_name)
+        # Lost masters are paired again without stopping the other end (port_supervisor.py)
+        supervisor = None
+        if not args.no_hotplug and replay_ports is None and not args.processes:
+            supervisor = PortSupervisor(serial_ports, tty_devices=args.tty_devices, device_cache=device_cache)
+        # The reader processes own the ports of the masters with --processes
+        rate_controller = None
+        if not args.fixed_rate and not args.processes:
+            rate_controller = AdaptiveRateController(serial_ports)
+            METRICS.set_collector("rate_controller", rate_controller.metric_samples)
+        service = HeadlessRangingService(pair_source, notify, sinks, serial_ports=serial_ports,
+                                         tracker=VehicleTracker(), ttc_monitor=TtcMonitor(),
+                                         rate_controller=rate_controller)
+        ranging_kwargs = {"serial_ports": serial_ports,
+                          "data_ptr_queues": {A_END_CODE: pair_source.end_queue(A_END_CODE),
+                                              B_END_CODE: pair_source.end_queue(B_END_CODE)},
+                          "log_fpath": log_fpath,
+                          "stop_flag_callback": service.stopped,
+                          "exp_name": exp_name,
+                          "report_source": args.report_source}
+        if args.processes:
+            # Reader and logger processes, the fusion stays in this one (multiproc_ranging.py)
+            ranging_target = end_ranging_job_multiprocess
+        else:
+            ranging_target = end_ranging_job_multiplexed
+            ranging_kwargs.update({"recorder": recorder, "supervisor": supervisor})
+        ranging_thread_mux = threading.Thread(target=ranging_target,
+                                              kwargs=ranging_kwargs,
+                                              name="A/B End Reporting Thread Multiplexed",
+                                              daemon=True)
+        service.ranging_thread = ranging_thread_mux
+        service.install_signal_handlers()
+        ranging_thread_mux.start()
+        ret = service.run()
+        if recorder is not None:
+            recorder.close()
+        if clock_sync is not None:
+            clock_sync.close_session()
+        sys.exit(ret)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+import sys, os, math, time
+from utils import RX_STAMP_KEY
+from end_fusion import FUSED_STAMP_KEY
+
+
+# This file contains the per-vehicle tracking filter of the ranging pipeline.
+# The adjusted distance of a detected vehicle (display_safety_ranging_results()) is measured at the
+# reception of a frame, and displayed 100 ms or more later. At closing speeds this lag eats into the
+# safety margin. VehicleTracker runs on the output of process_async_raw_ranging_results() and keeps
+# one constant-velocity alpha-beta filter per foreign vehicle (end side, id_assoc) of each end:
+#   - "tracked_dist":   filtered adjusted distance at the frame time (mm)
+#   - "closing_speed":  rate at which the distance shrinks (mm/s, positive when approaching)
+#   - "predicted_dist": distance predicted at the display time (mm), see annotate_prediction()
+# are added to the vehicle dictionaries. Each update and prediction is O(1). Outliers beyond
+# TRACK_GATE are rejected; tracks are restarted after TRACK_GATE_RESTART rejections in a row, or
+# on their next measurement when not updated for TRACK_TIMEOUT.
+# The gains are the steady-state Kalman gains of the constant-velocity model (Kalata tracking index)
+# for the reporting period, the measurement noise of the UWB ranging and the acceleration of the vehicles.
+#   python3 vehicle_tracker.py [PostProcessed_*.csv ...]
+# replays the sample field test log and the post-processed field test results, and compares the
+# predicted distances at display time with the surveyed distances (or measured ones without survey).
+
+TRACKER_PERIOD = 0.1            # Seconds: reporting period of the masters
+TRACKER_SIGMA_MEAS = 100.0      # mm: standard deviation of the UWB ranging (DWM1001)
+TRACKER_SIGMA_ACCEL = 1000.0    # mm/s^2: acceleration of the vehicles (maneuvering rail vehicles)
+TRACK_TIMEOUT = 1.0             # Seconds without update before a track is restarted
+TRACK_GATE = 3000.0             # mm: residual beyond which a measurement is rejected (outlier)
+TRACK_GATE_RESTART = 3          # Consecutive rejected measurements restarting the track (vehicle switch)
+MAX_PREDICTION = 0.5            # Seconds: longest extrapolation of a track
+DISPLAY_LATENCY = 0.15          # Seconds: age of a frame when displayed (GUI polling and rendering), for the replay
+
+
+def alpha_beta_gains(period=TRACKER_PERIOD, sigma_meas=TRACKER_SIGMA_MEAS, sigma_accel=TRACKER_SIGMA_ACCEL):
+    """ Steady-state gains of the constant-velocity Kalman filter, from the tracking index
+        lambda = sigma_accel * period^2 / sigma_meas (Kalata, 1984)
+
+        :returns:
+            (alpha, beta)
+    """
+    lam = sigma_accel * period * period / sigma_meas
+    root = math.sqrt(lam * lam + 8 * lam)
+    alpha = -(lam * lam + 8 * lam - (lam + 4) * root) / 8
+    beta = (lam * lam + 4 * lam - lam * root) / 4
+    return alpha, beta
+
+
+def frame_time_ns(data_point):
+    """ :returns:
+            time.monotonic_ns() of a data point: the common instant of a fused A/B pair, the reception
+            time otherwise (now if not stamped)
+    """
+    uwb_reporting_dict = data_point[0]
+    t_ns = uwb_reporting_dict.get(FUSED_STAMP_KEY, uwb_reporting_dict.get(RX_STAMP_KEY))
+    return time.monotonic_ns() if t_ns is None else t_ns
+
+
+def near_side_adjusted_dist(veh_dict):
+    """ Adjusted distance of a processed vehicle as displayed by display_safety_ranging_results():
+        nearest slave on the near side of the foreign vehicle, seen from the near side master
+
+        :returns:
+            distance in mm, or None if the vehicle is not on the side of the master (or not a finite distance)
+    """
+    if veh_dict["master_doing_ranging"].get("side_master") != veh_dict["near_side_code_local"]:
+        return None
+    for slave_dict in veh_dict["slaves_in_ranging"]:
+        if slave_dict["side_slave"] == veh_dict["near_side_code_foreign"]:
+            dist = slave_dict.get("adjusted_dist")
+            if dist is None or not math.isfinite(dist):
+                return None
+            return dist
+    return None
+
+
+class AlphaBetaTrack():
+
+    # Constant-velocity track of one distance
+    __slots__ = ("dist", "rate", "t_ns", "updates", "rejected")
+
+    def __init__(self, dist, t_ns):
+        self.dist = float(dist)
+        self.rate = 0.0         # mm/s
+        self.t_ns = t_ns
+        self.updates = 1
+        self.rejected = 0       # consecutive measurements rejected by the gate
+
+    def update(self, dist, t_ns, alpha, beta):
+        """ :returns:
+                residual of the measurement (mm)
+        """
+        dt = (t_ns - self.t_ns) / 1e9
+        if dt <= 0:
+            # Frame already used (the same pair handed over again), or out of order
+            return 0.0
+        predicted = self.dist + self.rate * dt
+        residual = dist - predicted
+        self.dist = predicted + alpha * residual
+        self.rate += beta / dt * residual
+        self.t_ns = t_ns
+        self.updates += 1
+        return residual
+
+    def predict(self, t_ns):
+        dt = min((t_ns - self.t_ns) / 1e9, MAX_PREDICTION)
+        return self.dist + self.rate * dt
+
+
+class VehicleTracker():
+
+    # One alpha-beta track per foreign vehicle seen from each end
+    def __init__(self, period=TRACKER_PERIOD, sigma_meas=TRACKER_SIGMA_MEAS, sigma_accel=TRACKER_SIGMA_ACCEL):
+        self.alpha, self.beta = alpha_beta_gains(period, sigma_meas, sigma_accel)
+        self.timeout_ns = int(TRACK_TIMEOUT * 1e9)
+        self.tracks = {}        # (end side code, id_assoc): AlphaBetaTrack
+        self.restarts = 0
+        self.rejected = 0
+
+    def update_track(self, key, dist, t_ns):
+        """ Update (or start) the track of a key with a measured distance at t_ns
+
+            :returns:
+                AlphaBetaTrack
+        """
+        track = self.tracks.get(key)
+        if track is not None and t_ns - track.t_ns <= self.timeout_ns:
+            if abs(dist - track.predict(t_ns)) <= TRACK_GATE:
+                track.rejected = 0
+                track.update(dist, t_ns, self.alpha, self.beta)
+                return track
+            track.rejected += 1
+            if track.rejected < TRACK_GATE_RESTART:
+                self.rejected += 1
+                return track
+        if track is not None:
+            self.restarts += 1
+        track = AlphaBetaTrack(dist, t_ns)
+        self.tracks[key] = track
+        return track
+
+    def update(self, end_side_code, veh_detection_list, t_ns):
+        """ Update the tracks with the vehicles processed by process_async_raw_ranging_results()
+            for one end, measured at t_ns (time.monotonic_ns() of the frame). Tracked vehicles get
+            "tracked_dist" and "closing_speed".
+        """
+        for veh_dict in veh_detection_list:
+            dist = near_side_adjusted_dist(veh_dict)
+            if dist is None:
+                continue
+            track = self.update_track((end_side_code, veh_dict["vehicle_id"]), dist, t_ns)
+            veh_dict["tracked_dist"] = int(round(track.dist))
+            veh_dict["closing_speed"] = int(round(-track.rate))
+
+    def annotate_prediction(self, end_side_code, veh_detection_list, t_ns):
+        """ Add "predicted_dist", the distance predicted at t_ns (display time), to the tracked vehicles
+        """
+        for veh_dict in veh_detection_list:
+            track = self.tracks.get((end_side_code, veh_dict["vehicle_id"]))
+            if track is not None and "tracked_dist" in veh_dict:
+                veh_dict["predicted_dist"] = int(round(track.predict(t_ns)))
+
+    def predict(self, end_side_code, vehicle_id, t_ns):
+        """ :returns:
+                predicted distance of a vehicle at t_ns, None if not tracked (or the track timed out)
+        """
+        track = self.tracks.get((end_side_code, vehicle_id))
+        if track is None or t_ns - track.t_ns > self.timeout_ns:
+            return None
+        return track.predict(t_ns)
+
+
+def replay_series(tracker, key, series, latency_ns, reference=None):
+    """ Replay the measured distances of one vehicle through a tracker and compare, at display time
+        (frame time + latency), the held measurement and the predicted distance with the reference.
+        Reference: the surveyed distance at each frame if given, the measured distance at display
+        time (interpolated between the frames) otherwise.
+
+        :returns:
+            (list of held errors, list of predicted errors), mm
+    """
+    held_err, predicted_err = [], []
+    times = [t for t, _ in series]
+    for idx, (t_ns, dist) in enumerate(series):
+        track = tracker.update_track(key, dist, t_ns)
+        t_display = t_ns + latency_ns
+        if reference is not None:
+            if reference[idx] is None:
+                continue
+            truth = reference[idx]
+        else:
+            nxt = idx + 1
+            while nxt < len(series) and times[nxt] < t_display:
+                nxt += 1
+            if nxt >= len(series) or times[nxt] - times[nxt - 1] > tracker.timeout_ns:
+                continue
+            (t0, d0), (t1, d1) = series[nxt - 1], series[nxt]
+            truth = d0 + (d1 - d0) * (t_display - t0) / (t1 - t0) if t1 != t0 else d1
+        if track.updates < 3:
+            continue
+        held_err.append(dist - truth)
+        predicted_err.append(track.predict(t_display) - truth)
+    return held_err, predicted_err
+
+
+if __name__ == "__main__":
+    # Replay benchmark on the field test logs: the sample log (B end) through the ranging pipeline
+    # with its logged reception times, and the post-processed field test results (csv).
+    import csv, glob, io, tempfile, timeit
+    from data_mailbox import DataRing
+    from utils import EndReportingProcessor, process_async_raw_ranging_results
+    from mono_clock import parse_log_timestamp_us
+
+    def rms(errors):
+        return math.sqrt(sum(e * e for e in errors) / len(errors)) if errors else float("nan")
+
+    def median_abs(errors):
+        return sorted(map(abs, errors))[len(errors) // 2] if errors else float("nan")
+
+    def report(name, held_err, predicted_err):
+        print("{}: {} frames | error at display time: held RMS {:.0f} mm, median {:.0f} mm | predicted RMS {:.0f} mm, median {:.0f} mm"
+              .format(name, len(held_err), rms(held_err), median_abs(held_err), rms(predicted_err), median_abs(predicted_err)))
+
+    alpha, beta = alpha_beta_gains()
+    print("alpha-beta gains at {:.0f} Hz: alpha {:.3f}, beta {:.3f}".format(1 / TRACKER_PERIOD, alpha, beta))
+    # Constant closing speed: the prediction is exact after convergence, whatever the frame age
+    tracker = VehicleTracker()
+    for k in range(50):
+        track = tracker.update_track((1, 3), 20000 - 4000 * k * 0.1, k * 100000000)
+    assert abs(track.rate + 4000) < 1 and abs(tracker.predict(1, 3, 49 * 100000000 + 150000000) - (20000 - 4000 * 5.05)) < 1
+    assert tracker.predict(1, 3, 49 * 100000000 + 2 * tracker.timeout_ns) is None
+
+    latency_ns = int(DISPLAY_LATENCY * 1e9)
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "uwb_ranging_fieldtest_results", "data")
+    sample_raw_log = os.path.join(data_dir, "sample", "2021-05-25-08-52-15-data-B-raw_log.log")
+    with open(sample_raw_log, "rb") as f:
+        entries = [line.split(b" end reporting raw data: ") for line in f if b" end reporting raw data: " in line]
+    stamps = [parse_log_timestamp_us(ts) for ts, _ in entries]
+    t_ns_frames = [(stamp - stamps[0]) * 1000 for stamp in stamps]
+
+    master_b = {"x_master": 2400, "y_master": -1470, "z_master": 1890, "vehicle_length_master": 12140, "id_assoc": 2, "side_master": 1}
+    master_a = dict(master_b, side_master=2)
+    local_slaves = {"8D38": {"port": None}, "1912": {"port": None}}
+    tmp_dir = tempfile.mkdtemp()
+    ring_a, ring_b = DataRing(maxlen=len(entries)), DataRing(maxlen=len(entries))
+    sys.stdout, log_out = io.StringIO(), sys.stdout
+    processor_a = EndReportingProcessor(local_slaves, 2, master_a, ring_a, tmp_dir, exp_name="tracker-test")
+    processor_b = EndReportingProcessor(local_slaves, 1, master_b, ring_b, tmp_dir, exp_name="tracker-test")
+    for processor in (processor_a, processor_b):
+        processor.start()
+    for _, line in entries:
+        processor_a.process_line(line.rstrip())
+        processor_b.process_line(line.rstrip())
+    for processor in (processor_a, processor_b):
+        processor.stop(verbose=False)
+    sys.stdout = log_out
+    frames = [process_async_raw_ranging_results(a_point, b_point, master_a, master_b)
+              for (_, a_point), (_, b_point) in zip(ring_a.snapshot(), ring_b.snapshot())]
+
+    # Pipeline: update per frame, predict at display time
+    tracker = VehicleTracker()
+    series = {}
+    for t_ns, (veh_list_a, veh_list_b) in zip(t_ns_frames, frames):
+        tracker.update(1, veh_list_b, t_ns)
+        tracker.annotate_prediction(1, veh_list_b, t_ns + latency_ns)
+        for veh_dict in veh_list_b:
+            dist = near_side_adjusted_dist(veh_dict)
+            if dist is not None:
+                assert "predicted_dist" in veh_dict and "closing_speed" in veh_dict
+                series.setdefault(veh_dict["vehicle_id"], []).append((t_ns, dist))
+    closing = [veh_dict["closing_speed"] for _, veh_list_b in frames for veh_dict in veh_list_b if "closing_speed" in veh_dict]
+    print("sample log: {} frames, {} vehicle tracks, closing speed up to {:.1f} m/s, {} outliers rejected, {} track restarts"
+          .format(len(frames), len(series), max(map(abs, closing)) / 1000, tracker.rejected, tracker.restarts))
+    held_all, predicted_all = [], []
+    for vehicle_id, vehicle_series in series.items():
+        held_err, predicted_err = replay_series(VehicleTracker(), vehicle_id, vehicle_series, latency_ns)
+        held_all += held_err
+        predicted_all += predicted_err
+    report("sample log, B end, {:.0f} ms display latency".format(DISPLAY_LATENCY * 1e3), held_all, predicted_all)
+    assert rms(predicted_all) < rms(held_all)
+
+    # Post-processed field test results: tracks by initiating master, reporting vehicle and slave
+    csv_files = sys.argv[1:] or sorted(glob.glob(os.path.join(data_dir, "*.csv")))
+    for csv_file in csv_files:
+        series, surveyed = {}, {}
+        with open(csv_file, newline="") as f:
+            for row in csv.DictReader(f):
+                if not row.get("Correction Distance (mm)"):
+                    continue
+                key = (row["Initiating Master"], row["Reporting Vehicle"], row["Reporting Slave"])
+                series.setdefault(key, []).append((int(float(row["Timestamp Norm (s)"]) * 1e9),
+                                                   float(row["Correction Distance (mm)"])))
+                survey = row.get("Surveyed Distance (mm)")
+                surveyed.setdefault(key, []).append(float(survey) if survey else None)
+        held_all, predicted_all = [], []
+        for key, vehicle_series in series.items():
+            reference = surveyed[key] if any(s is not None for s in surveyed[key]) else None
+            held_err, predicted_err = replay_series(VehicleTracker(), key, vehicle_series, latency_ns, reference)
+            held_all += held_err
+            predicted_all += predicted_err
+        with_survey = any(s is not None for values in surveyed.values() for s in values)
+        report("{} ({})".format(os.path.basename(csv_file), "surveyed" if with_survey else "no survey: measured"),
+               held_all, predicted_all)
+
+    veh_list_b = frames[len(frames) // 2][1]
+    t_update = timeit.timeit(lambda: tracker.update(1, veh_list_b, t_ns_frames[-1]), number=20000)
+    t_predict = timeit.timeit(lambda: tracker.annotate_prediction(1, veh_list_b, t_ns_frames[-1]), number=20000)
+    print("per frame ({} vehicles): update {:.1f} us, prediction {:.1f} us"
+          .format(len(veh_list_b), t_update / 20000 * 1e6, t_predict / 20000 * 1e6))
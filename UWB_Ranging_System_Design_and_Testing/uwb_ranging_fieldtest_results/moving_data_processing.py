@@ -1,15 +1,14 @@
-import os, re
+import os
 import json
 from pathlib import Path
-from datetime import datetime
+from datetime import timedelta
 import pandas as pd
 import math
 
-from utils import offset_calculate, post_process_get_moving_test_data_and_timestamp, post_process_new_data_entry
+from utils import post_process_pc_time_offset, post_process_log_timestamp_us, post_process_normalize_timestamps, post_process_get_moving_test_data_and_timestamp, post_process_new_data_entry
 from utils import same_track_side_longitudinal_dist, oppo_track_side_longitudinal_dist,post_process_device_side_code_to_str
 
 ROOT_DIR = os.path.join("C:/Users/wangz/OneDrive/University_RU/NSUWB/")
-EPOCH_DT = datetime(1970,1,1)
 
 pd.set_option('display.float_format', lambda x: '%.5f' % x)
 STATIC_RAW_SURVEY_RESULTS = {
@@ -43,13 +42,8 @@ def tabularize_individual_tests(filename, Surveyed_dist=None):
     print("processing {}...".format(filename))
     _dirname = os.path.dirname(filename)
 
-    T430_offset, P52_offset = offset_calculate() 
-
     # Identify the PC for time offset
-    if "T430" in filename:
-        t_offset = T430_offset
-    elif "P52" in filename:
-        t_offset = P52_offset
+    t_offset = post_process_pc_time_offset(filename)
 
     # Identify the vehicle
     if "v1" in filename or "V1" in filename:
@@ -67,6 +61,7 @@ def tabularize_individual_tests(filename, Surveyed_dist=None):
     # Only read file from processed log.
     if "processed_log" in filename:
         df = read_df_from_processed_input(filename, t_offset, Surveyed_dist)
+        df = post_process_normalize_timestamps(df, filename)
         # Dataframe to save into csv file
         converted_filename = "PostProcessed_" + Path(filename).stem + ".csv"
         df.to_csv(os.path.join(_dirname, converted_filename), date_format="%Y-%m-%d %H:%M:%S.%5f", index=False)
@@ -106,6 +101,7 @@ def read_df_from_processed_input(filename, t_offset, Surveyed_dist=None):
             'Timestamp Norm (s)', 
             'Timestamp Local (s)', 
             ])
+    t_offset_us = t_offset // timedelta(microseconds=1)
     with open(filename, "r") as input_f:
         i = 0
         while True:
@@ -125,19 +121,10 @@ def read_df_from_processed_input(filename, t_offset, Surveyed_dist=None):
 
                 # Analyze the processed data for now. Read the next line.
                 data_processed_raw = input_f.readline()
-                datetime_re_match = re.search(   
-                    "(?<=[[])"
-                    "(?P<raw_tstmp>[0-9]{4}[\-]"
-                    "[0-9]{2}[\-][0-9]{2}\s[0-9]{2}[\:][0-9]{2}[\:][0-9]{2}"
-                    "[\.][0-9]{6})(?<!\s[local])", data_processed_raw)
-
-                datetime_str = datetime_re_match.group("raw_tstmp")
-                datetime_raw = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S.%f')
-                datetime_norm = datetime_raw + t_offset
-
-                # NOTE: UTC not considered. 
-                Timestamp_norm = (datetime_norm - EPOCH_DT).total_seconds()
-                Timestamp_local = (datetime_raw - EPOCH_DT).total_seconds()
+                # NOTE: UTC not considered. Integer microseconds, parsed at fixed positions
+                datetime_local_us = post_process_log_timestamp_us(data_processed_raw)
+                Timestamp_norm = (datetime_local_us + t_offset_us) / 1e6
+                Timestamp_local = datetime_local_us / 1e6
                 Initiating_master = master_info.get('master_id')
 
                 data_processed_str = data_processed_raw.split("end reporting decoded foreign slaves: ")[-1].replace("\'", "\"")
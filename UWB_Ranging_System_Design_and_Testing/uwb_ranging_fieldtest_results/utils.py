@@ -1,12 +1,30 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import defaultdict
 from functools import partial
 import sys, time, json, re, base64, math, os, threading
 import serial, serial.tools.list_ports
 import atexit, signal
+import numpy as np
 import pandas as pd
 
 
+try:
+    # Shared DIST report parser and slave position decoder of ../uwb_ranging: copied alongside this file,
+    # or ../uwb_ranging on PYTHONPATH (appended after this directory, not to shadow this utils.py)
+    from dist_parser import parse_dist_report
+    from slave_info_codec import decode_slave_info_batch, slave_positions_from_reports
+except ImportError:
+    # make_json_dict_oem()/make_json_dict_accel_en() parse with their own regular expressions,
+    # post_process_decode_slaves_from_raw_log() is not available
+    parse_dist_report = None
+
+try:
+    # Fixed position parsing of the log timestamps (../uwb_ranging/mono_clock.py), without strptime()
+    from mono_clock import parse_log_timestamp_us
+except ImportError:
+    # Regular expression and strptime() below
+    parse_log_timestamp_us = None
+
 TIME_FORMAT_SHORT = '%Y-%m-%d-%H-%M-%S'
 TIME_FORMAT_LONG  = '%Y-%m-%d %H:%M:%S.%f'
 VIRTUAL_VEH_SURVEY_OFFSET = 0
@@ -419,6 +437,9 @@ def make_json_dict_oem(raw_string):
             Dictionary of parsed UWB reporting
     """
     try:
+        if parse_dist_report is not None:
+            return parse_dist_report(raw_string, oem_firmware=True).to_dict()
+        # Without dist_parser (see the imports): the original regular expressions
         data = {}
         # ---------parse for anchors and individual readings---------
         anc_match_iter = re.finditer(   "(?<=AN)(?P<anc_idx>[0-9]{1})[,]"
@@ -468,6 +489,9 @@ def make_json_dict_accel_en(raw_string):
             Dictionary of parsed UWB reporting
     """
     try:
+        if parse_dist_report is not None:
+            return parse_dist_report(raw_string, oem_firmware=False).to_dict()
+        # Without dist_parser (see the imports): the original regular expressions
         data = {}
         # ---------parse for anchors and individual readings---------
         anc_match_iter = re.finditer(   "(?<=\[AN)(?P<anc_idx>[0-9]{1})[,]"
@@ -1079,6 +1103,28 @@ def post_process_get_moving_test_data_and_timestamp(root_dir,
     return test_fname_list, instant_location_list_local
 
 
+def post_process_decode_slaves_from_raw_log(raw_log_file):
+    # Decode the slave informative positions of every anchor reported in a "-raw_log.log" file
+    # in one pass (NumPy batch decoder), instead of one decode_slave_info_position() call per frame.
+    if parse_dist_report is None:
+        raise ImportError("dist_parser/slave_info_codec of ../uwb_ranging are required")
+    timestamps, reports = [], []
+    with open(raw_log_file, "rb") as f:
+        for line in f:
+            head, sep, data_raw = line.partition(b" end reporting raw data: ")
+            if not sep:
+                continue
+            timestamps.append(head[1:27].decode("ascii"))
+            reports.append(parse_dist_report(data_raw).to_dict())
+    frame_idx, slave_ids, x, y, z, qf, dist_to = slave_positions_from_reports(reports)
+    df = pd.DataFrame(decode_slave_info_batch(x, y, z, qf))
+    df.insert(0, "slave_id", slave_ids)
+    df.insert(0, "Frame", frame_idx)
+    df.insert(0, "Timestamp", pd.to_datetime([timestamps[i] for i in frame_idx], format=TIME_FORMAT_LONG))
+    df["dist_to"] = dist_to
+    return df
+
+
 def oppo_track_side_longitudinal_dist(master_info, slave):
     x_diff =   master_info["x_master"] - slave['x_slave']
     y_diff =   master_info["y_master"] - slave['y_slave']
@@ -1147,6 +1193,98 @@ def post_process_convert_distance_unit_to_mm(string_distance):
     return float('nan')
 
 
+def post_process_log_timestamp_us(log_line):
+    """ Local timestamp heading a line of the processed logs ("[%Y-%m-%d %H:%M:%S.%f local] ...")
+
+        :returns:
+            integer microseconds since 1970-01-01 (naive local time, UTC not considered)
+    """
+    if parse_log_timestamp_us is not None:
+        try:
+            return parse_log_timestamp_us(log_line)
+        except ValueError:
+            pass
+    datetime_re_match = re.search(   
+        "(?<=[[])"
+        "(?P<raw_tstmp>[0-9]{4}[\\-]"
+        "[0-9]{2}[\\-][0-9]{2}\\s[0-9]{2}[\\:][0-9]{2}[\\:][0-9]{2}"
+        "[\\.][0-9]{6})(?<!\\s[local])", log_line)
+    datetime_raw = datetime.strptime(datetime_re_match.group("raw_tstmp"), TIME_FORMAT_LONG)
+    return (datetime_raw - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+
+
+def post_process_clock_sync_file(processed_log_file):
+    """ :returns:
+            the clock sync estimates logged with a processed log (../uwb_ranging/clock_sync.py),
+            <exp_name>-clock_sync.csv next to <exp_name>-data-<A|B>-..._log.log; None if not logged
+    """
+    clock_sync_file = processed_log_file.split("-data-")[0] + "-clock_sync.csv"
+    return clock_sync_file if os.path.exists(clock_sync_file) else None
+
+
+def post_process_pc_time_offset(filename):
+    """ :returns:
+            timedelta normalizing the local timestamps of the PC named in the log file name (T430/P52,
+            offset_calculate()); zero for the other computers, aligned by post_process_normalize_timestamps()
+    """
+    T430_offset, P52_offset = offset_calculate()
+    if "T430" in filename:
+        return T430_offset
+    elif "P52" in filename:
+        return P52_offset
+    return timedelta(0)
+
+
+def post_process_normalize_timestamps(df, processed_log_file):
+    """ Normalize the timestamps of a post-processed dataframe with the clock offset/drift logged by the
+        vehicles (../uwb_ranging/clock_sync.py), if they were synchronized
+
+        :returns:
+            the dataframe, unchanged if no clock sync estimates were logged
+    """
+    clock_sync_file = post_process_clock_sync_file(processed_log_file)
+    if clock_sync_file is None:
+        return df
+    return post_process_align_clock_sync(df, clock_sync_file)
+
+
+def post_process_clock_sync_correction(df_sync, timestamp_local_s, reference=None):
+    """ Correction of the local timestamps of a vehicle computer, from its clock sync estimates
+        (offsets of the peers interpolated in time, extrapolated with the drift beyond the first/last estimate)
+
+        :returns:
+            seconds to add to timestamp_local_s (array), to the clock of the reference peer, or to the
+            mean clock of the computer and its peers if None (as offset_calculate() of two PCs)
+    """
+    t_us = np.asarray(timestamp_local_s, dtype=float) * 1e6
+    peers = sorted(df_sync["peer"].unique()) if reference is None else [reference]
+    correction_us = np.zeros_like(t_us)
+    for peer in peers:
+        df_peer = df_sync[df_sync["peer"] == peer].sort_values("local_us")
+        if df_peer.empty:
+            raise ValueError("no clock sync estimates with {}".format(peer))
+        x = df_peer["local_us"].to_numpy(dtype=float)
+        offset_us = df_peer["offset_est_us"].to_numpy(dtype=float)
+        drift = df_peer["drift_ppm"].to_numpy(dtype=float) * 1e-6
+        correction_us += np.interp(t_us, x, offset_us) \
+            + np.where(t_us < x[0], (t_us - x[0]) * drift[0], 0.0) \
+            + np.where(t_us > x[-1], (t_us - x[-1]) * drift[-1], 0.0)
+    if reference is None:
+        correction_us /= len(peers) + 1
+    return correction_us / 1e6
+
+
+def post_process_align_clock_sync(df, clock_sync_file, reference=None):
+    """ Normalize the timestamps of a post-processed dataframe with the clock sync estimates
+        instead of the photo-synced snapshots of offset_calculate()
+    """
+    df_sync = pd.read_csv(clock_sync_file)
+    df["Timestamp Norm (s)"] = df["Timestamp Local (s)"] \
+        + post_process_clock_sync_correction(df_sync, df["Timestamp Local (s)"], reference)
+    df["Datetime Normalized"] = pd.to_datetime(df["Timestamp Norm (s)"], unit='s')
+    return df
+
+
 def post_process_new_data_entry(Surveyed_dist, master_info, Timestamp_norm, Timestamp_local, Adjusted_dist, slave, Reporting_slave, UWB_dist, master_side, slave_side):
     return  [pd.to_datetime(Timestamp_norm, unit='s')] \
         + [master_info.get("master_id")] \